@@ -1,4 +1,5 @@
 import json
+from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 
@@ -15,7 +16,66 @@ async def _safe_group_discard(consumer):
         await consumer.channel_layer.group_discard(group, consumer.channel_name)
 
 
-class PostazioneConsumer(AsyncWebsocketConsumer):
+class ConsumerNotifiche(AsyncWebsocketConsumer):
+    """Base dei consumer che ricevono dal bus notifiche (apps.api.notify).
+
+    Un 'notifiche.batch' contiene gli eventi di una raffica, gia' fusi
+    per entita': ognuno passa dal suo handler come se fosse arrivato da
+    solo, ma le send vengono raccolte e partono in un unico frame
+    {'type': 'batch', 'eventi': [...]}. Il browser aggiorna una volta.
+    """
+    _raccolta = None
+
+    async def notifiche_batch(self, event):
+        raccolta = self._raccolta = []
+        try:
+            for ev in event.get('eventi', []):
+                try:
+                    handler = getattr(self, get_handler_name(ev), None)
+                except ValueError:
+                    handler = None
+                if handler is not None:
+                    await handler(ev)
+        finally:
+            self._raccolta = None
+        if raccolta:
+            await super().send(text_data=json.dumps({'type': 'batch', 'eventi': raccolta}))
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self._raccolta is not None and text_data is not None and not close:
+            self._raccolta.append(json.loads(text_data))
+            return
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+
+class FlussoOrdiniMixin:
+    """Delta versionati degli ordini (apps/ordini/flusso.py).
+
+    Il client tiene l'ultima seq applicata; al (re)connect o quando
+    vede un buco manda {'type': 'riprendi', 'seq': N} e riceve i delta
+    persi o uno snapshot.
+    """
+    flusso_postazione_id = None
+
+    async def ordine_delta(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'ordine_delta',
+            'seq': event['seq'],
+            'ordine_id': event['ordine_id'],
+            'op': event['op'],
+            'campi': event['campi'],
+            'postazioni': event['postazioni'],
+        }))
+
+    async def riprendi_flusso(self, data):
+        from apps.ordini import flusso
+
+        risposta = await database_sync_to_async(flusso.riprendi)(
+            data.get('seq'), self.flusso_postazione_id)
+        await self.send(text_data=json.dumps(risposta))
+
+
+class PostazioneConsumer(FlussoOrdiniMixin, ConsumerNotifiche):
     async def connect(self):
         from django.contrib.auth.models import AnonymousUser
 
@@ -25,6 +85,8 @@ class PostazioneConsumer(AsyncWebsocketConsumer):
             
         self.postazione_id = self.scope['url_route']['kwargs']['postazione_id']
         self.room_group_name = f'postazione_{self.postazione_id}'
+        if str(self.postazione_id).isdigit():
+            self.flusso_postazione_id = int(self.postazione_id)
         
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -41,6 +103,8 @@ class PostazioneConsumer(AsyncWebsocketConsumer):
         
         if message_type == 'aggiorna_stato_item':
             await self.aggiorna_stato_item(data)
+        elif message_type == 'riprendi':
+            await self.riprendi_flusso(data)
     
     async def aggiorna_stato_item(self, data):
         item_id = data.get('item_id')
@@ -104,7 +168,7 @@ class PostazioneConsumer(AsyncWebsocketConsumer):
             return False
 
 
-class OrdiniConsumer(AsyncWebsocketConsumer):
+class OrdiniConsumer(FlussoOrdiniMixin, ConsumerNotifiche):
     async def connect(self):
         from django.contrib.auth.models import AnonymousUser
 
@@ -123,6 +187,11 @@ class OrdiniConsumer(AsyncWebsocketConsumer):
     async def disconnect(self, close_code):
         await _safe_group_discard(self)
 
+    async def receive(self, text_data):
+        data = json.loads(text_data)
+        if data.get('type') == 'riprendi':
+            await self.riprendi_flusso(data)
+
     async def nuovo_ordine_created(self, event):
         await self.send(text_data=json.dumps({
             'type': 'nuovo_ordine_created',
@@ -185,7 +254,9 @@ class OrdiniConsumer(AsyncWebsocketConsumer):
         }))
 
 
-class DashboardConsumer(AsyncWebsocketConsumer):
+class DashboardConsumer(ConsumerNotifiche):
+    etag_tv = None
+
     async def connect(self):
         from django.contrib.auth.models import AnonymousUser
 
@@ -193,13 +264,21 @@ class DashboardConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
             
-        self.room_group_name = 'dashboard_stats'
+        # ws/dashboard/tv/: le TV ricevono lo snapshot della board
+        # (apps/postazioni/board_tv.py) appena collegate e poi a ogni cambio
+        tv = self.scope['url_route']['kwargs'].get('canale') == 'tv'
+        self.room_group_name = 'dashboard_tv' if tv else 'dashboard_stats'
         
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
         await self.accept()
+        if tv:
+            from apps.postazioni.board_tv import snapshot
+
+            snap = await database_sync_to_async(snapshot)()
+            await self.tv_board({'etag': snap['etag'], 'board': snap['board']})
 
     async def disconnect(self, close_code):
         await _safe_group_discard(self)
@@ -210,8 +289,25 @@ class DashboardConsumer(AsyncWebsocketConsumer):
             'stats': event['stats']
         }))
 
+    async def tv_versione(self, event):
+        """Versione nuova della board TV: lo snapshot si prepara qui (da
+        cache per versione) e parte solo se e' cambiato davvero."""
+        from apps.postazioni.board_tv import snapshot
+
+        snap = await database_sync_to_async(snapshot)()
+        if snap['etag'] != self.etag_tv:
+            await self.tv_board({'etag': snap['etag'], 'board': snap['board']})
+
+    async def tv_board(self, event):
+        self.etag_tv = event['etag']
+        await self.send(text_data=json.dumps({
+            'type': 'tv_board',
+            'etag': event['etag'],
+            'board': event['board'],
+        }))
+
 
-class MessaggiConsumer(AsyncWebsocketConsumer):
+class MessaggiConsumer(ConsumerNotifiche):
     """Consumer per la pagina /messaggi/ (inbox WhatsApp).
 
     Subscribe al group 'messaggi_wa' e inoltra al frontend gli eventi:
@@ -256,7 +352,7 @@ class MessaggiConsumer(AsyncWebsocketConsumer):
         }))
 
 
-class TasksConsumer(AsyncWebsocketConsumer):
+class TasksConsumer(ConsumerNotifiche):
     """Consumer del modulo task operatori (badge navbar).
 
     Group 'tasks_staff'. A differenza degli altri consumer, oltre agli
@@ -0,0 +1,53 @@
+"""Elaboratore dedicato dell'inbox dei webhook WhatsApp (WebhookInArrivo).
+
+Il web process sveglia il suo elaboratore da solo a ogni webhook
+salvato; questo comando serve per farlo girare in un servizio separato,
+o per rielaborare a mano le righe rimaste in coda. Il claim e' atomico:
+puo' convivere con il web senza elaborare due volte lo stesso evento.
+
+Uso:
+    python manage.py elabora_webhook_whatsapp
+    python manage.py elabora_webhook_whatsapp --una-volta   # svuota ed esce
+    python manage.py elabora_webhook_whatsapp --riprova-errori --una-volta
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.api.wa_inbox import LOTTO, Elaboratore
+
+
+class Command(BaseCommand):
+    help = 'Elabora l\'inbox dei webhook WhatsApp in arrivo.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lotto', type=int, default=None,
+                            help='Eventi per lotto (default wa_inbox.LOTTO).')
+        parser.add_argument('--una-volta', action='store_true',
+                            help='Svuota la coda ed esce.')
+        parser.add_argument('--riprova-errori', action='store_true',
+                            help='Rimette in coda gli eventi in errore prima di partire.')
+
+    def handle(self, *args, **options):
+        from apps.messaggi.models import WebhookInArrivo
+
+        if options['riprova_errori']:
+            n = WebhookInArrivo.objects.filter(stato='errore').update(
+                stato='in_coda', tentativi=0)
+            self.stdout.write(f'{n} eventi in errore rimessi in coda.')
+
+        elab = Elaboratore(lotto=options['lotto'] or LOTTO)
+        if options['una_volta']:
+            presi = elab.svuota(timeout=10 * 60)
+            self.stdout.write(self.style.SUCCESS(f'{presi} eventi elaborati.'))
+            return
+
+        elab.avvia()
+        self.stdout.write('Elaboratore webhook WhatsApp avviato (Ctrl+C per uscire).')
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            self.stdout.write('Arresto: attendo il lotto in corso...')
+        finally:
+            elab.ferma()
@@ -1,57 +1,240 @@
-"""Helper sicuro per inviare notifiche WebSocket.
+"""Bus delle notifiche WebSocket: un sender per processo, a lotti.
 
-Strategia fire-and-forget in daemon thread: la send Redis avviene in
-un thread separato; la view ritorna IMMEDIATAMENTE senza aspettarla.
-Se Redis e' lento o non risponde:
-- la richiesta HTTP non viene bloccata
-- il thread eventualmente termina al timeout interno della libreria
-- come daemon, viene killato al shutdown del processo senza warning
+Prima notify_group() apriva un thread e un event loop nuovo
+(async_to_sync) per OGNI messaggio: un ordine completato (item, stato,
+pagamento, lista) faceva partire una raffica di thread e di publish
+Redis in pochi millisecondi, e ogni tablet ricaricava la pagina una
+volta per evento.
 
-Questo elimina sia il blocco runtime (cascade 499/502) sia il warning
-'took too long to shut down and was killed' di Daphne.
+Ora c'e' un unico thread "notify-bus" per processo con il suo event
+loop e una asyncio.Queue; il channel layer (e la sua connessione Redis)
+resta legato a quel loop per tutta la vita del processo.
+
+- notify_group() accoda e torna subito (call_soon_threadsafe): la view
+  non aspetta mai Redis. Coda piena (NOTIFY_CODA_MAX) -> il messaggio
+  viene scartato e contato: sono notifiche live, al reconnect il
+  client ricarica comunque da REST.
+- Il sender raccoglie per NOTIFY_FINESTRA_MS dal primo messaggio e
+  fonde i duplicati per (gruppo, tipo, entita'): per lo stesso ordine
+  o item vince l'ultimo messaggio, nella posizione del primo (tranne i
+  delta versionati, che passano tutti).
+- Per ogni gruppo parte un solo group_send: il messaggio cosi' com'e'
+  se e' uno solo, altrimenti {'type': 'notifiche.batch', 'eventi':
+  [...]}. I consumer (ConsumerNotifiche in consumers.py) girano un
+  batch al browser come un unico frame {'type': 'batch', 'eventi':
+  [...]}, cosi' la pagina si aggiorna una volta per raffica.
+
+statistiche() da' profondita' della coda, accodati, fusi, inviati,
+scartati, errori e latenza (accodamento -> group_send); sono loggate
+ogni STATISTICHE_OGNI_SEC se nel frattempo e' passato qualcosa.
 """
+import asyncio
 import logging
+import os
 import threading
+import time
+from collections import Counter
+
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+INVIO_TIMEOUT_SEC = 2.0
+STATISTICHE_OGNI_SEC = 300
+# Chiavi che identificano l'entita' di un messaggio ai fini della fusione
+CHIAVI_ENTITA = ('ordine_id', 'item_id', 'prenotazione_id', 'conv_id', 'msg_id',
+                 'task_id')
 
-def _send_in_background(group_name: str, message: dict) -> None:
-    """Esegue la send in un thread isolato (con event loop proprio)."""
-    try:
+
+def chiave_fusione(group_name: str, message: dict):
+    """(gruppo, tipo, entita'), o None se il messaggio non va fuso.
+    I delta versionati (con 'seq', apps/ordini/flusso.py) non si fondono
+    mai: ognuno porta solo i suoi campi."""
+    if 'seq' in message:
+        return None
+    entita = tuple((k, message[k]) for k in CHIAVI_ENTITA if message.get(k) is not None)
+    if not entita:
+        return None
+    return group_name, message.get('type'), entita
+
+
+class BusNotifiche:
+    """Thread sender con event loop proprio + coda asyncio."""
+
+    def __init__(self, finestra_ms: int = None, coda_max: int = None):
+        self.finestra = (finestra_ms if finestra_ms is not None
+                         else settings.NOTIFY_FINESTRA_MS) / 1000
+        self.coda_max = coda_max or settings.NOTIFY_CODA_MAX
+        self.contatori = Counter()
+        self._latenza_tot = 0.0
+        self._latenza_max = 0.0
+        self._in_coda = 0
+        self._lock = threading.Lock()
+        self._pronto = threading.Event()
+        self._loop = None
+        self._coda = None
+        self._ultime_statistiche = time.monotonic()
+        self._thread = threading.Thread(target=self._esegui, name='notify-bus',
+                                        daemon=True)
+        self._thread.start()
+        self._pronto.wait(5)
+
+    # --- lato chiamante ----------------------------------------------
+
+    def accoda(self, group_name: str, message: dict) -> bool:
+        with self._lock:
+            self.contatori['accodati'] += 1
+            if self._in_coda >= self.coda_max or self._loop is None:
+                self.contatori['scartati'] += 1
+                return False
+            self._in_coda += 1
+        try:
+            self._loop.call_soon_threadsafe(
+                self._coda.put_nowait, (group_name, message, time.monotonic()))
+        except RuntimeError:
+            # loop chiuso (shutdown del processo)
+            with self._lock:
+                self._in_coda -= 1
+                self.contatori['scartati'] += 1
+            return False
+        return True
+
+    def ferma(self, timeout: float = 5):
+        """Invia quello che e' in coda e ferma il sender."""
+        if self._loop is not None and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._coda.put_nowait, None)
+            self._thread.join(timeout)
+
+    def statistiche(self) -> dict:
+        with self._lock:
+            stats = dict(self.contatori)
+            inviati = self.contatori['messaggi_inviati']
+            stats['in_coda'] = self._in_coda
+            stats['latenza_media_ms'] = round(self._latenza_tot / inviati * 1000, 1) if inviati else 0.0
+            stats['latenza_max_ms'] = round(self._latenza_max * 1000, 1)
+        return stats
+
+    # --- sender ------------------------------------------------------
+
+    def _esegui(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._coda = asyncio.Queue()
+        self._pronto.set()
+        try:
+            self._loop.run_until_complete(self._ciclo())
+        finally:
+            self._loop.close()
+
+    async def _ciclo(self):
         from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
 
-        channel_layer = get_channel_layer()
-        if channel_layer is None:
+        layer = get_channel_layer()
+        loop = asyncio.get_running_loop()
+        fermo = False
+        while not fermo:
+            voce = await self._coda.get()
+            if voce is None:
+                return
+            pendenti = {}
+            self._aggiungi(pendenti, voce)
+            scadenza = loop.time() + self.finestra
+            while True:
+                attesa = scadenza - loop.time()
+                if attesa <= 0:
+                    break
+                try:
+                    voce = await asyncio.wait_for(self._coda.get(), attesa)
+                except asyncio.TimeoutError:
+                    break
+                if voce is None:
+                    fermo = True
+                    break
+                self._aggiungi(pendenti, voce)
+            await self._pubblica(layer, pendenti)
+            self._logga_statistiche()
+
+    def _aggiungi(self, pendenti: dict, voce):
+        group_name, message, accodato = voce
+        with self._lock:
+            self._in_coda -= 1
+        chiave = chiave_fusione(group_name, message) or (group_name, id(message))
+        if chiave in pendenti:
+            # vince l'ultimo messaggio, la latenza parte dal primo
+            pendenti[chiave] = (group_name, message, pendenti[chiave][2])
+            self._conta('fusi')
+        else:
+            pendenti[chiave] = voce
+
+    async def _pubblica(self, layer, pendenti: dict):
+        per_gruppo = {}
+        for group_name, message, accodato in pendenti.values():
+            per_gruppo.setdefault(group_name, []).append((message, accodato))
+
+        for group_name, voci in per_gruppo.items():
+            messaggi = [m for m, _ in voci]
+            if len(messaggi) == 1:
+                payload = messaggi[0]
+            else:
+                payload = {'type': 'notifiche.batch', 'eventi': messaggi}
+            try:
+                if layer is not None:
+                    await asyncio.wait_for(layer.group_send(group_name, payload),
+                                           INVIO_TIMEOUT_SEC)
+            except Exception as e:
+                self._conta('errori')
+                logger.warning('WS notify fallito per group=%s (%s messaggi): %s',
+                               group_name, len(messaggi), e)
+                continue
+            adesso = time.monotonic()
+            with self._lock:
+                self.contatori['invii'] += 1
+                self.contatori['messaggi_inviati'] += len(messaggi)
+                if len(messaggi) > 1:
+                    self.contatori['batch'] += 1
+                for _, accodato in voci:
+                    self._latenza_tot += adesso - accodato
+                    self._latenza_max = max(self._latenza_max, adesso - accodato)
+
+    def _conta(self, chiave: str, n: int = 1):
+        with self._lock:
+            self.contatori[chiave] += n
+
+    def _logga_statistiche(self):
+        adesso = time.monotonic()
+        if adesso - self._ultime_statistiche < STATISTICHE_OGNI_SEC:
             return
-        async_to_sync(channel_layer.group_send)(group_name, message)
-    except Exception as e:
-        logger.warning(
-            'WS notify bg fallito per group=%s type=%s: %s',
-            group_name, message.get('type'), e,
-        )
+        self._ultime_statistiche = adesso
+        logger.info('Notify bus: %s', self.statistiche())
+
+
+_bus = None
+_bus_pid = None
+_bus_lock = threading.Lock()
+
+
+def bus() -> BusNotifiche:
+    """Il bus del processo (ricreato dopo un fork: il thread non passa)."""
+    global _bus, _bus_pid
+    with _bus_lock:
+        if _bus is None or _bus_pid != os.getpid():
+            _bus = BusNotifiche()
+            _bus_pid = os.getpid()
+        return _bus
 
 
 def notify_group(group_name: str, message: dict, timeout: float = 2.0) -> bool:
-    """Invia un messaggio a un gruppo channels in modo fire-and-forget.
+    """Accoda un messaggio per un gruppo channels, fire-and-forget.
 
-    Ritorna sempre True (la send e' delegata al thread di background).
-    NON aspetta il completamento: la view torna entro pochi ms anche
-    se Redis e' down. Eventuali errori sono solo loggati nel thread.
+    Ritorna False solo se il messaggio e' stato scartato (coda piena).
+    La view torna subito anche se Redis e' down: gli errori di invio
+    sono loggati dal sender e contati nelle statistiche del bus.
 
-    Il parametro `timeout` resta per retrocompatibilita ma non viene
-    piu usato (era un parziale workaround che falliva quando le
-    coroutine Redis non rispondevano al cancel).
+    Il parametro `timeout` resta per retrocompatibilita': il limite di
+    ogni group_send e' INVIO_TIMEOUT_SEC.
     """
     try:
-        thread = threading.Thread(
-            target=_send_in_background,
-            args=(group_name, message),
-            daemon=True,
-        )
-        thread.start()
-        return True
+        return bus().accoda(group_name, message)
     except Exception as e:
-        logger.warning('WS notify thread start fallito: %s', e)
+        logger.warning('WS notify accodamento fallito: %s', e)
         return False
@@ -5,6 +5,7 @@ websocket_urlpatterns = [
     re_path(r'ws/postazione/(?P<postazione_id>\w+)/$', consumers.PostazioneConsumer.as_asgi()),
     re_path(r'ws/ordini/$', consumers.OrdiniConsumer.as_asgi()),
     re_path(r'ws/dashboard/$', consumers.DashboardConsumer.as_asgi()),
+    re_path(r'ws/dashboard/(?P<canale>tv)/$', consumers.DashboardConsumer.as_asgi()),
     re_path(r'ws/messaggi/$', consumers.MessaggiConsumer.as_asgi()),
     re_path(r'ws/tasks/$', consumers.TasksConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,357 @@
+"""Test del bus notifiche WebSocket (notify.py), dei batch nei consumer,
+dell'inbox dei webhook WhatsApp (wa_inbox.py), con replay di payload
+Meta registrati (payload_webhook/), e della lista conversazioni a
+chiave sulla proiezione dell'ultimo messaggio.
+
+Esecuzione: python manage.py test apps.api
+"""
+import copy
+import hashlib
+import hmac
+import importlib
+import json
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.apps import apps as django_apps
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.clienti.models import Cliente
+from apps.messaggi.models import ConversazioneWhatsApp, MessaggioWhatsApp, WebhookInArrivo
+
+from . import wa_inbox
+from .consumers import OrdiniConsumer
+from .notify import BusNotifiche
+
+PAYLOAD = Path(__file__).parent / 'payload_webhook'
+
+
+class LayerFinto:
+    def __init__(self, errore=None):
+        self.inviati = []
+        self.errore = errore
+
+    async def group_send(self, group, message):
+        if self.errore:
+            raise self.errore
+        self.inviati.append((group, message))
+
+
+def _stato(ordine_id, nuovo):
+    return {'type': 'order_status_update', 'ordine_id': ordine_id,
+            'numero_progressivo': f'N{ordine_id}', 'vecchio_stato': 'in_attesa',
+            'nuovo_stato': nuovo, 'stato_display': nuovo, 'timestamp': ''}
+
+
+class BusNotificheTest(SimpleTestCase):
+    def _bus(self, layer):
+        patcher = mock.patch('channels.layers.get_channel_layer', return_value=layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return BusNotifiche(finestra_ms=200, coda_max=100)
+
+    def test_raffica_fusa_e_spedita_a_lotti(self):
+        layer = LayerFinto()
+        bus = self._bus(layer)
+        for stato in ('in_lavorazione', 'completato', 'consegnato'):
+            bus.accoda('ordini_list', _stato(1, stato))
+        bus.accoda('ordini_list', _stato(2, 'completato'))
+        bus.accoda('postazione_3', {'type': 'item_status_update', 'item_id': 7,
+                                    'stato': 'completato', 'timestamp': ''})
+        bus.ferma()
+
+        inviati = dict(layer.inviati)
+        self.assertEqual(len(layer.inviati), 2)
+        batch = inviati['ordini_list']
+        self.assertEqual(batch['type'], 'notifiche.batch')
+        self.assertEqual([(e['ordine_id'], e['nuovo_stato']) for e in batch['eventi']],
+                         [(1, 'consegnato'), (2, 'completato')])
+        self.assertEqual(inviati['postazione_3']['type'], 'item_status_update')
+
+        stats = bus.statistiche()
+        self.assertEqual((stats['accodati'], stats['fusi'], stats['batch'],
+                          stats['messaggi_inviati'], stats['in_coda']), (5, 2, 1, 3, 0))
+
+    def test_delta_versionati_mai_fusi(self):
+        layer = LayerFinto()
+        bus = self._bus(layer)
+        for seq in (10, 11):
+            bus.accoda('ordini_list', {'type': 'ordine.delta', 'seq': seq, 'ordine_id': 1,
+                                       'op': 'diff', 'campi': {}, 'postazioni': []})
+        bus.ferma()
+        batch = layer.inviati[0][1]
+        self.assertEqual([e['seq'] for e in batch['eventi']], [10, 11])
+        self.assertNotIn('fusi', bus.statistiche())
+
+    def test_errori_di_invio_contati(self):
+        bus = self._bus(LayerFinto(errore=ConnectionError('redis giu')))
+        self.assertTrue(bus.accoda('tasks_staff', {'type': 'task_completata', 'task_id': 1}))
+        bus.ferma()
+        self.assertEqual(bus.statistiche()['errori'], 1)
+
+
+class ConsumerBatchTest(SimpleTestCase):
+    def test_batch_in_un_solo_frame(self):
+        consumer = OrdiniConsumer()
+        with mock.patch.object(AsyncWebsocketConsumer, 'send') as send:
+            async_to_sync(consumer.notifiche_batch)({
+                'type': 'notifiche.batch',
+                'eventi': [_stato(1, 'completato'),
+                           {'type': 'pagamento_aggiunto', 'ordine_id': 1,
+                            'numero_progressivo': 'N1', 'timestamp': ''},
+                           {'type': 'sconosciuto'}],
+            })
+        send.assert_called_once()
+        frame = json.loads(send.call_args.kwargs['text_data'])
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([e['type'] for e in frame['eventi']],
+                         ['order_status_update', 'pagamento_aggiunto'])
+
+
+def _payload(nome):
+    return json.loads((PAYLOAD / f'{nome}.json').read_text())
+
+
+def _stato_consegna(wa_id, stato):
+    body = copy.deepcopy(_payload('stato_consegna'))
+    status_obj = body['entry'][0]['changes'][0]['value']['statuses'][0]
+    status_obj.update(id=wa_id, status=stato)
+    return body
+
+
+@override_settings(META_WHATSAPP_APP_SECRET='segreto')
+class WebhookInboxTest(TestCase):
+    def setUp(self):
+        for percorso in ('apps.api.wa_inbox.notify_group', 'apps.api.views.notify_group'):
+            patcher = mock.patch(percorso)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.elab = wa_inbox.Elaboratore(lotto=50)
+
+    def _post(self, body):
+        raw = json.dumps(body).encode()
+        firma = hmac.new(b'segreto', raw, hashlib.sha256).hexdigest()
+        return self.client.post(reverse('api:whatsapp-webhook'), raw,
+                                content_type='application/json',
+                                HTTP_X_HUB_SIGNATURE_256=f'sha256={firma}')
+
+    def test_webhook_salva_e_risponde_senza_elaborare(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self._post(_payload('messaggio_testo'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(callbacks), 1)  # sveglia dell'elaboratore
+        evento = WebhookInArrivo.objects.get()
+        self.assertEqual(evento.stato, 'in_coda')
+        self.assertEqual(evento.payload, _payload('messaggio_testo'))
+        self.assertFalse(MessaggioWhatsApp.objects.exists())
+
+        self.assertEqual(self._post({'entry': []}).status_code, 200)
+        raw = b'{"entry": []}'
+        response = self.client.post(reverse('api:whatsapp-webhook'), raw,
+                                    content_type='application/json',
+                                    HTTP_X_HUB_SIGNATURE_256='sha256=00')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(WebhookInArrivo.objects.count(), 2)
+
+    def test_replay_messaggi_deduplicati(self):
+        # Meta rinotifica lo stesso messaggio se la risposta tarda
+        for nome in ('messaggio_testo', 'messaggio_testo', 'messaggio_foto',
+                     'messaggio_testo'):
+            self._post(_payload(nome))
+        self.assertEqual(self.elab.svuota(), 4)
+
+        conv = ConversazioneWhatsApp.objects.get(numero_e164='+393471234567')
+        self.assertEqual(conv.non_letti, 2)
+        self.assertEqual(list(conv.messaggi.values_list('media_type', 'corpo')), [
+            ('text', 'Buongiorno, a che ora posso passare?'),
+            ('image', '[Foto] Il graffio sul paraurti'),
+        ])
+        self.assertFalse(WebhookInArrivo.objects.exclude(stato='elaborato').exists())
+
+        # un replay successivo (nuovo lotto) non duplica
+        self._post(_payload('messaggio_foto'))
+        self.elab.svuota()
+        self.assertEqual(conv.messaggi.count(), 2)
+
+    def test_stop_word_gestita_dall_elaboratore(self):
+        cliente = Cliente.objects.create(tipo='privato', nome='Mario',
+                                         telefono='+393471234567')
+        body = copy.deepcopy(_payload('messaggio_testo'))
+        body['entry'][0]['changes'][0]['value']['messages'][0]['text']['body'] = 'STOP'
+        with mock.patch('threading.Thread.start') as avvio:
+            self._post(body)
+            self.elab.svuota()
+            # un replay non rifa' l'opt-out
+            self._post(body)
+            self.elab.svuota()
+        avvio.assert_not_called()
+        cliente.refresh_from_db()
+        self.assertTrue(cliente.blocca_marketing)
+        self.assertEqual(cliente.blocca_marketing_motivo, 'STOP via WhatsApp')
+
+    def test_raffica_di_status_fusa_in_pochi_update(self):
+        conv = ConversazioneWhatsApp.objects.create(numero_e164='+393330000001')
+        MessaggioWhatsApp.objects.bulk_create([
+            MessaggioWhatsApp(conversazione=conv, direzione='out', corpo=f'Promo {i}',
+                              wa_message_id=f'wamid.OUT.{i}', stato='sent')
+            for i in range(40)
+        ])
+        for i in range(40):
+            for stato in ('delivered', 'read', 'sent'):  # 'sent' in ritardo
+                WebhookInArrivo.objects.create(payload=_stato_consegna(f'wamid.OUT.{i}', stato))
+        WebhookInArrivo.objects.create(payload=_stato_consegna('wamid.SCONOSCIUTO', 'read'))
+
+        self.elab.lotto = 60  # i tre status di un messaggio nello stesso lotto
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.elab.svuota(), 121)
+        # 3 lotti: prelievo, una lettura e un UPDATE per stato, chiusura;
+        # mai una query per status
+        self.assertLess(len(queries), 30)
+        self.assertEqual(set(MessaggioWhatsApp.objects.values_list('stato', flat=True)),
+                         {'read'})
+        self.assertEqual(wa_inbox.notify_group.call_count, 40)
+
+    def test_status_solo_in_avanti(self):
+        conv = ConversazioneWhatsApp.objects.create(numero_e164='+393330000001')
+        letto = MessaggioWhatsApp.objects.create(conversazione=conv, direzione='out',
+                                                 wa_message_id='wamid.A', stato='read')
+        inviato = MessaggioWhatsApp.objects.create(conversazione=conv, direzione='out',
+                                                   wa_message_id='wamid.B', stato='sent')
+        in_attesa = MessaggioWhatsApp.objects.create(conversazione=conv, direzione='out',
+                                                     wa_message_id='wamid.C', stato='received')
+        wa_inbox.applica_stati({'wamid.A': 'delivered', 'wamid.B': 'failed',
+                                'wamid.C': 'failed'})
+        for msg, atteso in ((letto, 'read'), (inviato, 'sent'), (in_attesa, 'failed')):
+            msg.refresh_from_db()
+            self.assertEqual(msg.stato, atteso)
+
+    def test_evento_rotto_non_blocca_il_lotto(self):
+        from . import views
+
+        originale = views._handle_incoming
+
+        def _handle(msg, contacts):
+            if msg.get('type') == 'image':
+                raise ValueError('payload rotto')
+            return originale(msg, contacts)
+
+        self._post(_payload('messaggio_foto'))
+        self._post(_payload('messaggio_testo'))
+        with mock.patch.object(views, '_handle_incoming', side_effect=_handle), \
+                self.assertLogs('apps.api.wa_inbox', level='ERROR'):
+            self.elab.svuota()
+
+        rotto, buono = WebhookInArrivo.objects.order_by('pk')
+        self.assertEqual((rotto.stato, rotto.tentativi), ('errore', wa_inbox.MAX_TENTATIVI))
+        self.assertIn('payload rotto', rotto.errore)
+        self.assertEqual(buono.stato, 'elaborato')
+        self.assertEqual(MessaggioWhatsApp.objects.count(), 1)
+
+
+class InboxProiezioneTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch('apps.api.wa_inbox.notify_group')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(User.objects.create_user('inbox', is_staff=True))
+
+    def _conv(self, numero, n_messaggi=1):
+        conv = ConversazioneWhatsApp.objects.create(numero_e164=numero)
+        for i in range(n_messaggi):
+            MessaggioWhatsApp.objects.create(conversazione=conv, direzione='in',
+                                             corpo=f'{numero} #{i}', wa_message_id=f'{numero}.{i}')
+        return conv
+
+    def test_proiezione_segue_messaggi(self):
+        conv = self._conv('+393330000001')
+        out = MessaggioWhatsApp.objects.create(conversazione=conv, direzione='out',
+                                               corpo='x' * 100, wa_message_id='wamid.OUT',
+                                               stato='sent')
+        conv.refresh_from_db()
+        self.assertEqual((conv.ultimo_messaggio_id, conv.ultimo_preview, conv.ultimo_direzione,
+                          conv.ultimo_stato), (out.pk, 'x' * 80, 'out', 'sent'))
+        self.assertEqual(conv.ultimo_messaggio_il, out.creato_il)
+
+        wa_inbox.applica_stati({'wamid.OUT': 'delivered'})
+        conv.refresh_from_db()
+        self.assertEqual(conv.ultimo_stato, 'delivered')
+
+        # un messaggio piu' vecchio modificato non tocca l'anteprima
+        primo = conv.messaggi.order_by('pk').first()
+        primo.corpo = 'modificato'
+        primo.save()
+        conv.refresh_from_db()
+        self.assertEqual(conv.ultimo_preview, 'x' * 80)
+
+        out.delete()
+        conv.refresh_from_db()
+        self.assertEqual((conv.ultimo_messaggio_id, conv.ultimo_preview), (primo.pk, 'modificato'))
+
+    def test_lista_una_query_e_pagine_a_chiave(self):
+        convs = [self._conv(f'+39333000{i:04d}') for i in range(12)]
+        # due conversazioni con lo stesso istante: decide l'id
+        stesso = timezone.now() - timedelta(hours=1)
+        ConversazioneWhatsApp.objects.filter(pk__in=[convs[3].pk, convs[4].pk]).update(
+            ultimo_messaggio_il=stesso)
+        attesi = list(ConversazioneWhatsApp.objects.order_by(
+            '-ultimo_messaggio_il', '-pk').values_list('pk', flat=True))
+
+        url = reverse('api:wa-list')
+        self.client.get(url)  # sessione e utente in cache
+        with CaptureQueriesContext(connection) as queries:
+            d = self.client.get(url).json()
+        self.assertEqual(len([q for q in queries if 'messaggi_' in q['sql']]), 1)
+        self.assertEqual([c['id'] for c in d['conversazioni']], attesi)
+        self.assertEqual(d['conversazioni'][0]['preview'], f'{convs[-1].numero_e164} #0')
+        self.assertIsNone(d['successivo'])
+
+        visti, cursore = [], ''
+        while True:
+            d = self.client.get(url, {'limite': 5, 'dopo': cursore}).json()
+            visti += [c['id'] for c in d['conversazioni']]
+            cursore = d['successivo']
+            if not cursore:
+                break
+        self.assertEqual(visti, attesi)
+
+    def test_dettaglio_messaggi_precedenti(self):
+        conv = self._conv('+393330000001', n_messaggi=7)
+        url = reverse('api:wa-detail', args=[conv.pk])
+        d = self.client.get(url, {'limite': 3}).json()
+        self.assertEqual([m['corpo'][-2:] for m in d['messaggi']], ['#4', '#5', '#6'])
+        d = self.client.get(url, {'limite': 3, 'prima': d['precedenti']}).json()
+        self.assertEqual([m['corpo'][-2:] for m in d['messaggi']], ['#1', '#2', '#3'])
+        d = self.client.get(url, {'limite': 3, 'prima': d['precedenti']}).json()
+        self.assertEqual([m['corpo'][-2:] for m in d['messaggi']], ['#0'])
+        self.assertIsNone(d['precedenti'])
+
+    def test_backfill_migrazione(self):
+        migrazione = importlib.import_module(
+            'apps.messaggi.migrations.0005_proiezione_ultimo_messaggio')
+        conv = self._conv('+393330000001', n_messaggi=3)
+        vuota = ConversazioneWhatsApp.objects.create(numero_e164='+393330000002')
+        ConversazioneWhatsApp.objects.update(ultimo_messaggio=None, ultimo_preview='',
+                                             ultimo_direzione='', ultimo_stato='')
+        migrazione.popola_ultimo_messaggio(django_apps, None)
+        conv.refresh_from_db()
+        vuota.refresh_from_db()
+        ultimo = conv.messaggi.order_by('-creato_il', '-pk').first()
+        self.assertEqual((conv.ultimo_messaggio_id, conv.ultimo_preview, conv.ultimo_stato),
+                         (ultimo.pk, ultimo.corpo, 'received'))
+        self.assertEqual(conv.ultimo_messaggio_il, ultimo.creato_il)
+        self.assertIsNone(vuota.ultimo_messaggio_id)
+
+    def test_cancellazione_conversazione_senza_ricalcoli(self):
+        conv = self._conv('+393330000001', n_messaggi=20)
+        with CaptureQueriesContext(connection) as queries:
+            conv.delete()
+        self.assertLess(len(queries), 10)
+        self.assertFalse(MessaggioWhatsApp.objects.exists())
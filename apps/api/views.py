@@ -6,26 +6,29 @@ WhatsApp` e usa le utility di `apps.clients.whatsapp` per invii API Meta.
 Layout:
 - `whatsapp_webhook`: l'endpoint che Meta chiama. GET verifica setup,
   POST riceve messaggi e status updates. csrf_exempt + verifica
-  X-Hub-Signature-256 con HMAC-SHA256(app_secret, raw_body).
+  X-Hub-Signature-256 con HMAC-SHA256(app_secret, raw_body). Il body
+  finisce nell'inbox WebhookInArrivo e lo elabora wa_inbox.py.
 - `lista_conversazioni`, `dettaglio_conversazione`, `invia_messaggio`,
   `segna_letti`, `aggancia_cliente`: API JSON per l'inbox UI.
-- Helper interni: `_verify_signature`, `_handle_incoming`,
-  `_handle_status`, `_match_cliente_da_telefono`.
+- Helper interni: `_verify_signature`, `_handle_incoming` (chiamato
+  dall'elaboratore dell'inbox), `_match_cliente_da_telefono`. Gli
+  status di consegna li applica wa_inbox.applica_stati, a lotti.
 
 Notify realtime: dopo ogni cambio di stato rilevante, chiamiamo
 `apps.api.notify.notify_group` con group `messaggi_wa` cosi' il
 frontend (vedi consumer estensione) si aggiorna senza refresh.
 """
+import base64
 import hashlib
 import hmac
 import json
 import logging
-import threading
 from datetime import datetime, timedelta
 
 import requests
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.db.models import Q
 from django.http import (HttpResponse, JsonResponse,
                          HttpResponseForbidden, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
@@ -34,9 +37,11 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
 from apps.clienti.models import Cliente
+from apps.clienti.utils import cliente_per_e164
 from apps.clients import whatsapp as wa
 from apps.messaggi.models import ConversazioneWhatsApp, MessaggioWhatsApp
 
+from . import wa_inbox
 from .notify import notify_group
 
 logger = logging.getLogger(__name__)
@@ -73,17 +78,9 @@ def _match_cliente_da_telefono(numero_e164: str):
     """Cerca un Cliente il cui telefono (qualunque sia il formato) normalizzi
     allo stesso numero E.164. None se non trovato.
 
-    Iteriamo solo sui clienti con telefono non vuoto. Per gestionali con
-    ~migliaia di clienti basta e avanza; se in futuro la rubrica cresce,
-    convertiamo telefono in field E.164 indicizzato.
+    Una query sulla colonna indicizzata Cliente.telefono_e164.
     """
-    if not numero_e164:
-        return None
-    for c in Cliente.objects.exclude(telefono='').only('id', 'telefono'):
-        normalized = wa._to_e164(c.telefono)
-        if normalized == numero_e164:
-            return c
-    return None
+    return cliente_per_e164(numero_e164)
 
 
 def _handle_incoming(payload_msg: dict, contacts: list[dict]):
@@ -203,8 +200,8 @@ def _handle_incoming(payload_msg: dict, contacts: list[dict]):
     )
     conv.ultimo_incoming_il = timezone.now()
     conv.non_letti = (conv.non_letti or 0) + 1
-    conv.save(update_fields=['ultimo_incoming_il', 'non_letti', 'cliente',
-                             'ultimo_messaggio_il'])
+    # ultimo_messaggio_il e l'anteprima li ha gia' scritti la create()
+    conv.save(update_fields=['ultimo_incoming_il', 'non_letti', 'cliente'])
 
     notify_group(_GROUP_WA, {
         'type': 'nuovo_messaggio_wa',
@@ -223,32 +220,26 @@ def _handle_incoming(payload_msg: dict, contacts: list[dict]):
 
     # Auto-handler Quick Reply: se il messaggio e' la risposta a un
     # template prenotazione_proposta_orario, conferma o annulla
-    # automaticamente la prenotazione del cliente. Lanciato in thread
-    # daemon per non bloccare la risposta al webhook (Meta retrya
-    # se non rispondiamo entro pochi secondi).
+    # automaticamente la prenotazione del cliente.
+    # _handle_incoming gira nell'elaboratore dell'inbox (wa_inbox.py),
+    # fuori dalla richiesta del webhook: gli handler partono qui, nel
+    # suo thread, e le connessioni le chiude il suo ciclo. Un evento
+    # rielaborato si ferma al dedup sopra, quindi niente doppie azioni.
     # Strip + check case-insensitive per essere robusti contro spazi
     # extra o variazioni che Meta a volte introduce.
     corpo_norm = (corpo or '').strip()
     if media_type == 'text' and corpo_norm in _QUICK_REPLY_AZIONI:
-        logger.info('Quick reply detected: %r -> spawn handler conv=%d',
+        logger.info('Quick reply detected: %r -> handler conv=%d',
                    corpo_norm, conv.pk)
-        threading.Thread(
-            target=_handle_quick_reply,
-            args=(conv.pk, corpo_norm),
-            daemon=True,
-        ).start()
+        _handle_quick_reply(conv.pk, corpo_norm)
 
     # STOP-word marketing: se il cliente chiede di non essere contattato,
     # attiva l'opt-out sul Cliente collegato alla conversazione e conferma
     # con un testo (finestra 24h appena aperta dal suo incoming, quindi
-    # il testo libero passa). In thread per non bloccare il webhook.
+    # il testo libero passa).
     if media_type == 'text' and _e_stop_word(corpo_norm):
         logger.info('STOP-word marketing rilevata conv=%d: %r', conv.pk, corpo_norm)
-        threading.Thread(
-            target=_handle_stop_word,
-            args=(conv.pk,),
-            daemon=True,
-        ).start()
+        _handle_stop_word(conv.pk)
 
 
 # Quick Reply buttons del template prenotazione_proposta_orario.
@@ -314,7 +305,8 @@ def _handle_quick_reply(conv_pk: int, testo: str):
     """Esegue auto-azione sulla prenotazione in_attesa del cliente in
     base al Quick Reply Button cliccato.
 
-    Eseguito in daemon thread separato:
+    Eseguito dall'elaboratore dell'inbox (wa_inbox.py), dopo il
+    salvataggio del messaggio:
     - 'Confermo' -> stato='confermata', notifica conferma
     - 'No, non riesco' -> stato='annullata', manda elenco slot
       alternativi via testo libero (finestra 24h aperta -> niente
@@ -372,22 +364,17 @@ def _handle_quick_reply(conv_pk: int, testo: str):
             p.stato = 'confermata'
             p.proposta_inviata_il = None
             p.save(update_fields=['stato', 'proposta_inviata_il'])
-            if hasattr(p.slot, 'aggiorna_contatori'):
-                p.slot.aggiorna_contatori()
             notifica_prenotazione_confermata(p)
             logger.info('Auto-confermata prenotazione %s via Quick Reply "Confermo"',
                        p.codice_prenotazione)
 
         elif testo == 'No, non riesco':
             # Annulla e libera lo slot
-            vecchio_slot = p.slot
             p.stato = 'annullata'
             p.proposta_inviata_il = None
             nota = (p.nota_interna or '').strip()
             p.nota_interna = (nota + '\n' if nota else '') + 'Rifiutata dal cliente via WhatsApp (Quick Reply "No, non riesco").'
             p.save(update_fields=['stato', 'nota_interna', 'proposta_inviata_il'])
-            if hasattr(vecchio_slot, 'aggiorna_contatori'):
-                vecchio_slot.aggiorna_contatori()
             logger.info('Auto-annullata prenotazione %s via Quick Reply "No, non riesco"',
                        p.codice_prenotazione)
             # Manda al cliente l'invito a riprovare dal sito o a
@@ -435,31 +422,6 @@ def _proponi_riprovare_text(to_e164: str) -> None:
         logger.warning('proponi_riprovare error to=%s: %s', to_e164, e)
 
 
-def _handle_status(status_obj: dict):
-    """Aggiorna stato di un messaggio outgoing in base ai delivery report."""
-    wa_id = status_obj.get('id', '')
-    new_stato = status_obj.get('status', '')  # sent/delivered/read/failed
-    if not wa_id or not new_stato:
-        return
-    if new_stato not in {'sent', 'delivered', 'read', 'failed'}:
-        return
-    try:
-        msg = MessaggioWhatsApp.objects.get(wa_message_id=wa_id)
-    except MessaggioWhatsApp.DoesNotExist:
-        return
-    # Solo "promozioni" di stato (sent -> delivered -> read), no regressioni
-    rank = {'sent': 1, 'delivered': 2, 'read': 3, 'failed': 0}
-    if rank.get(new_stato, 0) >= rank.get(msg.stato, 0):
-        msg.stato = new_stato
-        msg.save(update_fields=['stato'])
-        notify_group(_GROUP_WA, {
-            'type': 'aggiorna_stato_wa',
-            'conv_id': msg.conversazione_id,
-            'msg_id': msg.pk,
-            'stato': new_stato,
-        })
-
-
 @csrf_exempt
 @require_http_methods(['GET', 'POST'])
 def whatsapp_webhook(request):
@@ -486,21 +448,10 @@ def whatsapp_webhook(request):
         logger.warning('WhatsApp webhook body non JSON: %s', e)
         return HttpResponse('ok', status=200)  # 200 per non far retryare Meta
 
-    try:
-        for entry in body.get('entry', []):
-            for change in entry.get('changes', []):
-                value = change.get('value', {})
-                contacts = value.get('contacts', [])
-                # Messaggi in entrata
-                for msg in value.get('messages', []):
-                    _handle_incoming(msg, contacts)
-                # Status update messaggi outgoing
-                for status_obj in value.get('statuses', []):
-                    _handle_status(status_obj)
-    except Exception as e:
-        # Non vogliamo che Meta retry-i in loop: log e 200
-        logger.error('WhatsApp webhook errore processing: %s', e, exc_info=True)
-
+    # Il lavoro vero lo fa l'elaboratore dell'inbox (wa_inbox.py): qui
+    # solo il salvataggio, cosi' Meta ha il 200 subito. Se la scrittura
+    # fallisce la view va in 500 e Meta ritenta: meglio che perderlo.
+    wa_inbox.salva(body)
     return HttpResponse('ok', status=200)
 
 
@@ -512,7 +463,7 @@ def _is_staff(user):
     return user.is_authenticated and user.is_staff
 
 
-def _serialize_conv(c: ConversazioneWhatsApp, ultimo: MessaggioWhatsApp | None = None) -> dict:
+def _serialize_conv(c: ConversazioneWhatsApp) -> dict:
     # Nome+cognome (o ragione sociale) usando la property `nome_completo`
     # gia' esistente sul modello Cliente. Per numeri sconosciuti -> default.
     if c.cliente:
@@ -527,8 +478,10 @@ def _serialize_conv(c: ConversazioneWhatsApp, ultimo: MessaggioWhatsApp | None =
         'non_letti': c.non_letti,
         'ultimo_messaggio_il': c.ultimo_messaggio_il.isoformat() if c.ultimo_messaggio_il else None,
         'finestra_24h_aperta': c.finestra_24h_aperta(),
-        'preview': (ultimo.corpo[:80] if ultimo else ''),
-        'preview_direzione': (ultimo.direzione if ultimo else ''),
+        # proiezione dell'ultimo messaggio, scritta dal suo save()
+        'preview': c.ultimo_preview,
+        'preview_direzione': c.ultimo_direzione,
+        'preview_stato': c.ultimo_stato,
     }
 
 
@@ -546,34 +499,84 @@ def _serialize_msg(m: MessaggioWhatsApp) -> dict:
     }
 
 
+# --- paginazione a chiave: cursore opaco (timestamp ISO, id) ---------
+
+def _cursore(dt, pk) -> str:
+    return base64.urlsafe_b64encode(json.dumps([dt.isoformat(), pk]).encode()).decode()
+
+
+def _da_cursore(cursore):
+    """(datetime, id) dal cursore, None se manca o e' rotto."""
+    if not cursore:
+        return None
+    try:
+        iso, pk = json.loads(base64.urlsafe_b64decode(cursore.encode()))
+        return datetime.fromisoformat(iso), int(pk)
+    except (ValueError, TypeError):
+        return None
+
+
+def _limite(request, default: int, massimo: int) -> int:
+    try:
+        return max(1, min(massimo, int(request.GET.get('limite') or default)))
+    except ValueError:
+        return default
+
+
 @login_required
 @require_http_methods(['GET'])
 def lista_conversazioni(request):
+    """Conversazioni dalla piu' recente, a pagine. Query: limite
+    (default 200), dopo (cursore 'successivo' della pagina prima).
+
+    Una query sull'indice conv_wa_lista_idx: l'anteprima dell'ultimo
+    messaggio e' gia' sulla conversazione.
+    """
     if not _is_staff(request.user):
         return JsonResponse({'error': 'forbidden'}, status=403)
-    convs = ConversazioneWhatsApp.objects.select_related('cliente').all()[:200]
-    # Per ogni conv, ultimo msg per preview (1 query per conv -> tollerabile per N<=200)
-    out = []
-    for c in convs:
-        ultimo = c.messaggi.order_by('-creato_il').first()
-        out.append(_serialize_conv(c, ultimo))
-    return JsonResponse({'conversazioni': out})
+    limite = _limite(request, 200, 500)
+    convs = ConversazioneWhatsApp.objects.select_related('cliente').order_by(
+        '-ultimo_messaggio_il', '-pk')
+    dopo = _da_cursore(request.GET.get('dopo'))
+    if dopo is not None:
+        ts, pk = dopo
+        convs = convs.filter(Q(ultimo_messaggio_il__lt=ts)
+                             | Q(ultimo_messaggio_il=ts, pk__lt=pk))
+    convs = list(convs[:limite + 1])
+    successivo = None
+    if len(convs) > limite:
+        convs = convs[:limite]
+        successivo = _cursore(convs[-1].ultimo_messaggio_il, convs[-1].pk)
+    return JsonResponse({'conversazioni': [_serialize_conv(c) for c in convs],
+                         'successivo': successivo})
 
 
 @login_required
 @require_http_methods(['GET'])
 def dettaglio_conversazione(request, pk):
+    """Ultimi messaggi in ordine cronologico. Query: limite (default
+    100), prima (cursore 'precedenti' per i messaggi piu' vecchi)."""
     if not _is_staff(request.user):
         return JsonResponse({'error': 'forbidden'}, status=403)
     conv = get_object_or_404(
         ConversazioneWhatsApp.objects.select_related('cliente'), pk=pk
     )
-    # Ultimi 100 messaggi in ordine cronologico
-    msgs = list(conv.messaggi.order_by('-creato_il')[:100])
+    limite = _limite(request, 100, 500)
+    msgs = conv.messaggi.select_related('operatore').order_by('-creato_il', '-pk')
+    prima = _da_cursore(request.GET.get('prima'))
+    if prima is not None:
+        ts, msg_pk = prima
+        msgs = msgs.filter(Q(creato_il__lt=ts) | Q(creato_il=ts, pk__lt=msg_pk))
+    msgs = list(msgs[:limite + 1])
+    precedenti = None
+    if len(msgs) > limite:
+        msgs = msgs[:limite]
+        precedenti = _cursore(msgs[-1].creato_il, msgs[-1].pk)
     msgs.reverse()
     return JsonResponse({
-        'conversazione': _serialize_conv(conv, msgs[-1] if msgs else None),
+        'conversazione': _serialize_conv(conv),
         'messaggi': [_serialize_msg(m) for m in msgs],
+        'precedenti': precedenti,
     })
 
 
@@ -610,8 +613,7 @@ def invia_messaggio(request, pk):
         stato='sent',
         operatore=request.user,
     )
-    # ultimo_messaggio_il aggiornato da auto_now sulla conversazione al save()
-    conv.save(update_fields=['ultimo_messaggio_il'])
+    # ultimo messaggio della conversazione aggiornato dalla create()
 
     notify_group(_GROUP_WA, {
         'type': 'nuovo_messaggio_wa',
@@ -0,0 +1,281 @@
+"""Inbox dei webhook WhatsApp: ricezione durevole, elaborazione a lotti.
+
+Prima whatsapp_webhook elaborava ogni entry dentro la richiesta
+(_handle_incoming, _handle_status, stop-word e quick reply): una
+raffica di delivery report (ogni invio di campagna ne genera fino a
+tre) teneva occupati i worker gunicorn con una get + save per status,
+e se la risposta tardava Meta ritentava, raddoppiando il carico.
+
+Ora la view verifica la firma, salva il body in WebhookInArrivo
+(apps.messaggi.models) e risponde 200. Il lavoro lo fa l'elaboratore,
+con lo stesso schema dell'outbox (apps/clients/wa_dispatcher.py):
+
+- un thread per processo, svegliato al commit di ogni salva(), oppure
+  `manage.py elabora_webhook_whatsapp` in un servizio a parte; il
+  claim e' atomico (UPDATE ... WHERE stato='in_coda'), piu' processi
+  possono lavorare la stessa inbox;
+- preleva fino a LOTTO eventi alla volta e li scompone: i messaggi in
+  entrata sono deduplicati per id Meta (nel lotto; contro il DB ci
+  pensa _handle_incoming), gli status sono fusi per id Meta tenendo il
+  piu' avanzato (sent < delivered < read; failed solo su un messaggio
+  senza esito, come prima) e applicati con un UPDATE per stato di
+  arrivo, invece di get + save per ognuno (piu' uno per l'anteprima
+  delle conversazioni, ConversazioneWhatsApp.ultimo_stato);
+- rielaborare un evento non fa danni (dedup dei messaggi, status solo
+  in avanti), quindi niente transazione sul lotto: se fallisce, i suoi
+  eventi si rifanno uno per uno e solo quello rotto torna in coda,
+  fino a MAX_TENTATIVI, poi resta in 'errore' con il messaggio;
+- righe 'in_lavorazione' di un processo morto tornano in coda dopo
+  PRESA_SCADUTA_SEC; quelle elaborate si cancellano dopo
+  CONSERVA_GIORNI.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .notify import notify_group
+
+logger = logging.getLogger(__name__)
+
+LOTTO = 200
+PRESA_SCADUTA_SEC = 5 * 60
+ATTESA_CODA_VUOTA_SEC = 5
+MANUTENZIONE_OGNI_SEC = 60
+MAX_TENTATIVI = 5
+CONSERVA_GIORNI = 7
+# id Meta per query negli status (resta sotto i limiti di parametri SQLite)
+BLOCCO_ID = 500
+
+GRUPPO_WA = 'messaggi_wa'
+# Rango degli stati di consegna: si applica solo uno status che non
+# torna indietro. 'received' (e failed) valgono 0.
+RANGO_STATO = {'sent': 1, 'delivered': 2, 'read': 3, 'failed': 0}
+
+
+def salva(payload: dict):
+    """Mette il body del webhook nell'inbox e sveglia l'elaboratore al commit."""
+    from apps.messaggi.models import WebhookInArrivo
+
+    evento = WebhookInArrivo.objects.create(payload=payload)
+    transaction.on_commit(lambda: elaboratore().sveglia())
+    return evento
+
+
+def scomponi(payloads) -> tuple[list, dict]:
+    """Da una lista di body webhook: ([(messaggio, contacts)] in entrata,
+    senza doppioni per id Meta, {wa_message_id: status piu' avanzato})."""
+    messaggi, visti, stati = [], set(), {}
+    for body in payloads:
+        if not isinstance(body, dict):
+            continue
+        for entry in body.get('entry') or []:
+            for change in entry.get('changes') or []:
+                value = change.get('value') or {}
+                contacts = value.get('contacts') or []
+                for msg in value.get('messages') or []:
+                    wa_id = msg.get('id', '')
+                    if wa_id and wa_id in visti:
+                        continue
+                    visti.add(wa_id)
+                    messaggi.append((msg, contacts))
+                for status_obj in value.get('statuses') or []:
+                    wa_id = status_obj.get('id', '')
+                    nuovo = status_obj.get('status', '')
+                    if not wa_id or nuovo not in RANGO_STATO:
+                        continue
+                    if wa_id not in stati or RANGO_STATO[nuovo] >= RANGO_STATO[stati[wa_id]]:
+                        stati[wa_id] = nuovo
+    return messaggi, stati
+
+
+def _superabili(nuovo: str) -> list:
+    """Stati che `nuovo` puo' sostituire (rango minore o uguale)."""
+    return ['received'] + [s for s, r in RANGO_STATO.items()
+                           if r <= RANGO_STATO[nuovo] and s != nuovo]
+
+
+def applica_stati(stati: dict) -> int:
+    """Applica gli status fusi ai MessaggioWhatsApp: una lettura per
+    blocco di id e un UPDATE per stato di arrivo. Ritorna i messaggi
+    aggiornati."""
+    from apps.messaggi.models import ConversazioneWhatsApp, MessaggioWhatsApp
+
+    per_stato = {}  # stato nuovo -> [(pk, conversazione_id)]
+    ids = list(stati)
+    for i in range(0, len(ids), BLOCCO_ID):
+        for pk, conv_id, wa_id, attuale in MessaggioWhatsApp.objects.filter(
+                wa_message_id__in=ids[i:i + BLOCCO_ID]).values_list(
+                'pk', 'conversazione_id', 'wa_message_id', 'stato'):
+            nuovo = stati[wa_id]
+            if nuovo != attuale and RANGO_STATO[nuovo] >= RANGO_STATO.get(attuale, 0):
+                per_stato.setdefault(nuovo, []).append((pk, conv_id))
+
+    adesso = timezone.now()
+    aggiornati = 0
+    for nuovo, righe in per_stato.items():
+        pks = [pk for pk, _ in righe]
+        # stato__in: se un altro processo e' andato avanti nel frattempo
+        # non si torna indietro. La proiezione sulla conversazione (se e'
+        # il suo ultimo messaggio) va nella stessa transazione.
+        with transaction.atomic():
+            aggiornati += MessaggioWhatsApp.objects.filter(
+                pk__in=pks, stato__in=_superabili(nuovo),
+            ).update(stato=nuovo, aggiornato_il=adesso)
+            ConversazioneWhatsApp.objects.filter(
+                ultimo_messaggio_id__in=pks, ultimo_stato__in=_superabili(nuovo),
+            ).update(ultimo_stato=nuovo)
+        for pk, conv_id in righe:
+            notify_group(GRUPPO_WA, {
+                'type': 'aggiorna_stato_wa',
+                'conv_id': conv_id,
+                'msg_id': pk,
+                'stato': nuovo,
+            })
+    return aggiornati
+
+
+def elabora_payload(payloads):
+    """Il lavoro che prima faceva la view, per un lotto di body."""
+    from .views import _handle_incoming
+
+    messaggi, stati = scomponi(payloads)
+    for msg, contacts in messaggi:
+        _handle_incoming(msg, contacts)
+    applica_stati(stati)
+
+
+class Elaboratore:
+    def __init__(self, lotto: int = LOTTO):
+        self.lotto = lotto
+        self._lock = threading.Lock()
+        self._sveglia = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._ultima_manutenzione = 0.0
+
+    # ----- coda -------------------------------------------------------
+
+    def manutenzione(self):
+        """Rimette in coda le prese scadute e cancella gli elaborati vecchi."""
+        from apps.messaggi.models import WebhookInArrivo
+
+        adesso = timezone.now()
+        WebhookInArrivo.objects.filter(
+            stato='in_lavorazione', preso_il__lt=adesso - timedelta(seconds=PRESA_SCADUTA_SEC),
+        ).update(stato='in_coda', preso_il=None)
+        WebhookInArrivo.objects.filter(
+            stato='elaborato', elaborato_il__lt=adesso - timedelta(days=CONSERVA_GIORNI),
+        ).delete()
+
+    def preleva(self) -> list:
+        """Claim atomico dei prossimi eventi in coda (lista vuota se nessuno)."""
+        from apps.messaggi.models import WebhookInArrivo
+
+        if time.monotonic() - self._ultima_manutenzione > MANUTENZIONE_OGNI_SEC:
+            self._ultima_manutenzione = time.monotonic()
+            self.manutenzione()
+        candidati = list(WebhookInArrivo.objects.filter(stato='in_coda')
+                         .order_by('pk').values_list('pk', flat=True)[:self.lotto])
+        if not candidati:
+            return []
+        adesso = timezone.now()
+        WebhookInArrivo.objects.filter(pk__in=candidati, stato='in_coda').update(
+            stato='in_lavorazione', preso_il=adesso)
+        return list(WebhookInArrivo.objects.filter(
+            pk__in=candidati, stato='in_lavorazione', preso_il=adesso).order_by('pk'))
+
+    def elabora(self, eventi: list):
+        from apps.messaggi.models import WebhookInArrivo
+
+        try:
+            elabora_payload([e.payload for e in eventi])
+        except Exception as e:
+            if len(eventi) > 1:
+                logger.warning('Lotto webhook WA fallito (%s eventi), li rifaccio uno '
+                               'per uno: %s', len(eventi), e)
+                for evento in eventi:
+                    self.elabora([evento])
+                return
+            self._fallito(eventi[0], e)
+            return
+        WebhookInArrivo.objects.filter(pk__in=[e.pk for e in eventi]).update(
+            stato='elaborato', elaborato_il=timezone.now(), preso_il=None, errore='')
+
+    def _fallito(self, evento, errore):
+        from apps.messaggi.models import WebhookInArrivo
+
+        evento.tentativi += 1
+        evento.errore = f'{type(errore).__name__}: {errore}'[:255]
+        evento.stato = 'errore' if evento.tentativi >= MAX_TENTATIVI else 'in_coda'
+        logger.error('Webhook WA %s fallito (tentativo %s): %s', evento.pk,
+                     evento.tentativi, evento.errore, exc_info=errore)
+        WebhookInArrivo.objects.filter(pk=evento.pk).update(
+            stato=evento.stato, tentativi=evento.tentativi, errore=evento.errore,
+            preso_il=None)
+
+    # ----- thread -----------------------------------------------------
+
+    def _ciclo(self):
+        while not self._stop.is_set():
+            try:
+                eventi = self.preleva()
+                if not eventi:
+                    self._sveglia.wait(ATTESA_CODA_VUOTA_SEC)
+                    self._sveglia.clear()
+                    continue
+                self.elabora(eventi)
+            except Exception:
+                logger.exception('Errore nell\'elaboratore webhook WhatsApp')
+                time.sleep(1)
+            finally:
+                close_old_connections()
+
+    def avvia(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._ciclo, name='wa-inbox', daemon=True)
+            self._thread.start()
+
+    def sveglia(self):
+        self.avvia()
+        self._sveglia.set()
+
+    def ferma(self, timeout: float = 30):
+        """Ferma il thread lasciando finire il lotto in corso."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        self._stop.set()
+        self._sveglia.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def svuota(self, timeout: float = 60) -> int:
+        """Elabora nel thread chiamante finche' la coda e' vuota o scade
+        il timeout. Per il comando e i test. Ritorna gli eventi presi."""
+        fine = time.monotonic() + timeout
+        presi = 0
+        while time.monotonic() < fine:
+            eventi = self.preleva()
+            if not eventi:
+                break
+            self.elabora(eventi)
+            presi += len(eventi)
+        return presi
+
+
+_elaboratore = None
+_elaboratore_lock = threading.Lock()
+
+
+def elaboratore() -> Elaboratore:
+    global _elaboratore
+    with _elaboratore_lock:
+        if _elaboratore is None:
+            _elaboratore = Elaboratore()
+        return _elaboratore
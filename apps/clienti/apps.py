@@ -4,4 +4,7 @@ from django.apps import AppConfig
 class ClientiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.clienti'
-    verbose_name = 'Clienti'
\ No newline at end of file
+    verbose_name = 'Clienti'
+
+    def ready(self):
+        import apps.clienti.signals  # noqa
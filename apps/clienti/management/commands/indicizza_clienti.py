@@ -0,0 +1,27 @@
+"""Ricostruisce l'indice di ricerca clienti (tabella FTS5, solo SQLite).
+
+Nel giro normale l'indice lo tengono allineato i signal di Cliente;
+serve dopo update massivi (queryset.update, bulk_create, import) che li
+saltano. Su Postgres la colonna di ricerca e' generata dal DB e non c'e'
+niente da ricostruire.
+
+Uso:
+    python manage.py indicizza_clienti
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.clienti import ricerca
+
+
+class Command(BaseCommand):
+    help = "Ricostruisce l'indice di ricerca clienti (SQLite FTS5)."
+
+    def handle(self, *args, **options):
+        nome = ricerca.backend().nome
+        with transaction.atomic():
+            n = ricerca.ricostruisci()
+        if nome != 'sqlite_fts5':
+            self.stdout.write(f'Backend {nome}: nessun indice da ricostruire.')
+            return
+        self.stdout.write(self.style.SUCCESS(f'{n} clienti indicizzati.'))
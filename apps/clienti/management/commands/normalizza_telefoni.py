@@ -0,0 +1,28 @@
+"""Ricalcola Cliente.telefono_e164 per tutta l'anagrafica.
+
+Nel giro normale la colonna la aggiorna Cliente.save(); serve dopo
+update massivi (queryset.update, bulk_create, import) che saltano
+save(), o se cambiano le regole di normalizzazione (phonenumbers
+aggiornato). Corregge solo i clienti con il valore sbagliato.
+
+Uso:
+    python manage.py normalizza_telefoni
+    python manage.py normalizza_telefoni --dry-run
+"""
+from django.core.management.base import BaseCommand
+
+from apps.clienti.utils import riallinea_telefoni_e164
+
+
+class Command(BaseCommand):
+    help = 'Ricalcola il telefono normalizzato E.164 (chiave delle ricerche per numero).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Conta le correzioni senza salvarle')
+
+    def handle(self, *args, **options):
+        controllati, corretti = riallinea_telefoni_e164(dry_run=options['dry_run'])
+        azione = 'da correggere' if options['dry_run'] else 'corretti'
+        self.stdout.write(self.style.SUCCESS(
+            f'{corretti} telefoni {azione} su {controllati} clienti.'))
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:48
+
+from django.db import migrations, models
+
+
+def popola_telefono_e164(apps, schema_editor):
+    from apps.clients.whatsapp import _to_e164
+
+    Cliente = apps.get_model('clienti', 'Cliente')
+    blocco = []
+    for c in Cliente.objects.exclude(telefono='').only('id', 'telefono').iterator(chunk_size=2000):
+        c.telefono_e164 = _to_e164(c.telefono) or ''
+        if c.telefono_e164:
+            blocco.append(c)
+        if len(blocco) >= 2000:
+            Cliente.objects.bulk_update(blocco, ['telefono_e164'])
+            blocco = []
+    Cliente.objects.bulk_update(blocco, ['telefono_e164'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clienti', '0005_blocca_marketing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cliente',
+            name='telefono_e164',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.RunPython(popola_telefono_e164, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:53
+
+from django.db import migrations, models
+from django.db.utils import OperationalError
+
+# Indice di ricerca clienti (apps/clienti/ricerca.py): colonna generata +
+# GIN pg_trgm su Postgres, tabella FTS5 su SQLite.
+CAMPI_RICERCA = ('nome', 'cognome', 'ragione_sociale', 'email', 'telefono',
+                 'telefono_e164', 'partita_iva', 'codice_fiscale')
+
+
+def crea_indice_ricerca(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        testo = " || ' ' || ".join(f"coalesce({c}, '')" for c in CAMPI_RICERCA)
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute(
+            f'ALTER TABLE clienti_cliente ADD COLUMN ricerca text '
+            f'GENERATED ALWAYS AS (lower({testo})) STORED')
+        schema_editor.execute(
+            'CREATE INDEX cliente_ricerca_trgm ON clienti_cliente '
+            'USING gin (ricerca gin_trgm_ops)')
+    elif vendor == 'sqlite':
+        from apps.clienti.ricerca import COLONNE_FTS, TABELLA_FTS, _valore_fts
+
+        colonne = ', '.join(campo for campo, _ in COLONNE_FTS)
+        try:
+            schema_editor.execute(
+                f"CREATE VIRTUAL TABLE {TABELLA_FTS} USING fts5({colonne}, "
+                f"tokenize='unicode61 remove_diacritics 2')")
+        except OperationalError:
+            return  # SQLite senza FTS5: la ricerca resta sugli icontains
+        Cliente = apps.get_model('clienti', 'Cliente')
+        segnaposti = ', '.join(['%s'] * (len(COLONNE_FTS) + 1))
+        righe = [(c.pk, *[_valore_fts(c, campo) for campo, _ in COLONNE_FTS])
+                 for c in Cliente.objects.iterator(chunk_size=2000)]
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(f'INSERT INTO {TABELLA_FTS} (rowid, {colonne}) '
+                               f'VALUES ({segnaposti})', righe)
+
+
+def elimina_indice_ricerca(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS cliente_ricerca_trgm')
+        schema_editor.execute('ALTER TABLE clienti_cliente DROP COLUMN IF EXISTS ricerca')
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS clienti_cliente_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clienti', '0006_telefono_e164'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cliente',
+            index=models.Index(fields=['cognome', 'ragione_sociale', 'nome', 'id'], name='cliente_ordine_alfabetico'),
+        ),
+        migrations.RunPython(crea_indice_ricerca, elimina_indice_ricerca),
+    ]
@@ -3,6 +3,12 @@ from django.contrib.auth.models import User
 from django.utils import timezone
 
 
+def e164(telefono) -> str:
+    """Valore di Cliente.telefono_e164 per `telefono` ('' se non parsabile)."""
+    from apps.clients.whatsapp import _to_e164
+    return _to_e164(telefono) or ''
+
+
 class Cliente(models.Model):
     TIPO_CHOICES = [
         ('privato', 'Privato'),
@@ -13,6 +19,11 @@ class Cliente(models.Model):
     tipo = models.CharField(max_length=20, choices=TIPO_CHOICES)
     email = models.EmailField(blank=True, null=True)
     telefono = models.CharField(max_length=20)
+    # telefono normalizzato E.164 ('' se non parsabile), chiave indicizzata
+    # delle ricerche per numero; lo tiene allineato save(), per gli update
+    # massivi c'e' il comando normalizza_telefoni
+    telefono_e164 = models.CharField(max_length=20, blank=True, default='',
+                                     db_index=True, editable=False)
     indirizzo = models.TextField(blank=True)
     cap = models.CharField(max_length=10, blank=True)
     citta = models.CharField(max_length=100, blank=True)
@@ -80,10 +91,20 @@ class Cliente(models.Model):
             self.citta = self.citta.title()
         if self.indirizzo:
             self.indirizzo = self.indirizzo.title()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'telefono' in update_fields:
+            self.telefono_e164 = e164(self.telefono)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'telefono_e164'}
         super().save(*args, **kwargs)
     
     class Meta:
         verbose_name_plural = "Clienti"
+        indexes = [
+            # ordine della lista clienti e chiave della sua paginazione (ricerca.py)
+            models.Index(fields=['cognome', 'ragione_sociale', 'nome', 'id'],
+                         name='cliente_ordine_alfabetico'),
+        ]
     
     def __str__(self):
         if self.tipo == 'privato':
@@ -0,0 +1,272 @@
+"""Ricerca clienti indicizzata: autocomplete (cerca_cliente) e lista
+clienti (ClientiListView).
+
+Prima entrambe facevano un OR di icontains su cinque-sette colonne,
+piu' un count() e uno slice: ogni tasto premuto nell'autocomplete della
+cassa era una scansione completa dell'anagrafica, due volte.
+
+Qui la ricerca passa da un backend per database:
+
+- Postgres: colonna generata clienti_cliente.ricerca (testo minuscolo
+  di nominativo, email, telefoni, P.IVA e CF) con indice GIN pg_trgm.
+  Ogni parola cercata e' un LIKE '%parola%' servito dall'indice; il
+  punteggio e' word_similarity piu' un bonus per le parole che
+  iniziano con il termine. La colonna si aggiorna da sola, anche con
+  queryset.update(). (Per parole di 1-2 lettere l'indice trigrammi non
+  aiuta: l'autocomplete parte comunque da MIN_CARATTERI.)
+- SQLite: tabella FTS5 clienti_cliente_fts (rowid = id cliente),
+  allineata dai signal di Cliente (signals.py). Ogni parola diventa
+  ("parola" OR "parola"*): i match esatti pesano piu' dei prefissi nel
+  bm25, e nominativo/ragione sociale pesano piu' degli altri campi.
+  Gli update massivi che saltano i signal si recuperano con
+  `manage.py indicizza_clienti`.
+- Altri backend (o SQLite senza FTS5): gli icontains di prima, ma
+  sempre con paginazione a chiave.
+
+Le pagine non usano mai count() + OFFSET: cerca() ritorna gli id della
+pagina e un cursore opaco per la successiva (punteggio e id
+dell'ultimo risultato, o la chiave alfabetica se non c'e' testo).
+Gli oggetti si caricano dopo, con le annotazioni che servono alla
+view (Pagina.clienti).
+
+Attenzione su Postgres: le colonne usate dalla colonna generata non si
+possono ALTERare (tipo/lunghezza) senza prima toglierla; una migrazione
+che le cambia deve ricrearla.
+"""
+import base64
+import json
+import re
+from dataclasses import dataclass
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Cliente
+
+MIN_CARATTERI = 2
+TABELLA_FTS = 'clienti_cliente_fts'
+# Colonne FTS5, con il loro peso nel bm25 (stesso ordine)
+COLONNE_FTS = (('nome', 10.0), ('cognome', 10.0), ('ragione_sociale', 10.0),
+               ('email', 2.0), ('telefono', 2.0), ('partita_iva', 1.0),
+               ('codice_fiscale', 1.0))
+ORDINE_ALFABETICO = ('cognome', 'ragione_sociale', 'nome', 'pk')
+CAMPI_ICONTAINS = ('nome', 'cognome', 'ragione_sociale', 'email', 'telefono',
+                   'partita_iva', 'codice_fiscale')
+
+
+def parole(testo) -> list[str]:
+    """Parole cercate: lettere e cifre, minuscole (niente wildcard SQL)."""
+    return re.findall(r'[^\W_]+', (testo or '').lower())
+
+
+# --- cursori -----------------------------------------------------------
+
+def _codifica(valori) -> str:
+    return base64.urlsafe_b64encode(json.dumps(valori).encode()).decode()
+
+
+def _decodifica(cursore, lunghezza: int):
+    """Valori del cursore, o None (prima pagina) se manca o e' rotto."""
+    if not cursore:
+        return None
+    try:
+        valori = json.loads(base64.urlsafe_b64decode(cursore.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(valori, list) or len(valori) != lunghezza:
+        return None
+    return valori
+
+
+@dataclass
+class Pagina:
+    ids: list
+    successivo: str = None  # cursore della pagina dopo, None se e' l'ultima
+
+    def clienti(self, qs=None) -> list:
+        """I clienti della pagina nell'ordine della ricerca; `qs` per
+        annotazioni/select_related (filtrato sugli id della pagina)."""
+        qs = Cliente.objects.all() if qs is None else qs
+        per_id = {c.pk: c for c in qs.filter(pk__in=self.ids)}
+        return [per_id[i] for i in self.ids if i in per_id]
+
+
+# --- backend -----------------------------------------------------------
+
+class BackendIcontains:
+    """Fallback portabile: icontains su tutti i campi, ordine alfabetico."""
+    nome = 'icontains'
+
+    def cerca(self, parole, tipo, limite, dopo):
+        qs = Cliente.objects.all()
+        for parola in parole:
+            qs = qs.filter(_q_icontains(parola))
+        return _alfabetico(qs, tipo, limite, dopo)
+
+
+class BackendSqlite(BackendIcontains):
+    nome = 'sqlite_fts5'
+
+    def cerca(self, parole, tipo, limite, dopo):
+        match = ' AND '.join(f'("{p}" OR "{p}"*)' for p in parole)
+        pesi = ', '.join(str(peso) for _, peso in COLONNE_FTS)
+        sql = (f'SELECT r.id, r.punteggio FROM ('
+               f'SELECT rowid AS id, -bm25({TABELLA_FTS}, {pesi}) AS punteggio '
+               f'FROM {TABELLA_FTS} WHERE {TABELLA_FTS} MATCH %s) r '
+               f'JOIN clienti_cliente c ON c.id = r.id WHERE 1 = 1')
+        return _classificati(sql, [match], tipo, limite, dopo)
+
+    # --- allineamento (signal e comando indicizza_clienti) ---
+
+    def indicizza(self, clienti):
+        righe = [(c.pk, *[_valore_fts(c, campo) for campo, _ in COLONNE_FTS])
+                 for c in clienti]
+        if not righe:
+            return
+        colonne = ', '.join(campo for campo, _ in COLONNE_FTS)
+        segnaposti = ', '.join(['%s'] * (len(COLONNE_FTS) + 1))
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT OR REPLACE INTO {TABELLA_FTS} (rowid, {colonne}) '
+                f'VALUES ({segnaposti})', righe)
+
+    def rimuovi(self, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABELLA_FTS} WHERE rowid = %s', [pk])
+
+    def svuota(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABELLA_FTS}')
+
+
+class BackendPostgres(BackendIcontains):
+    nome = 'postgres_trgm'
+
+    def cerca(self, parole, tipo, limite, dopo):
+        bonus = ' + '.join(
+            "(CASE WHEN c.ricerca LIKE %s OR c.ricerca LIKE %s THEN 1 ELSE 0 END)"
+            for _ in parole)
+        params = [' '.join(parole)]
+        for p in parole:
+            params += [f'{p}%', f'% {p}%']
+        filtri = ' AND '.join('c.ricerca LIKE %s' for _ in parole)
+        params += [f'%{p}%' for p in parole]
+        sql = (f'SELECT r.id, r.punteggio FROM ('
+               f'SELECT c.id, word_similarity(%s, c.ricerca) + {bonus} AS punteggio '
+               f'FROM clienti_cliente c WHERE {filtri}) r '
+               f'JOIN clienti_cliente c ON c.id = r.id WHERE 1 = 1')
+        return _classificati(sql, params, tipo, limite, dopo)
+
+
+def _q_icontains(parola) -> Q:
+    q = Q()
+    for campo in CAMPI_ICONTAINS:
+        q |= Q(**{f'{campo}__icontains': parola})
+    return q
+
+
+def _valore_fts(cliente, campo) -> str:
+    if campo == 'telefono':
+        # cifre del numero com'e' scritto e in E.164: "333..." e "39333..."
+        cifre = re.sub(r'\D', '', cliente.telefono or '')
+        return f'{cifre} {(cliente.telefono_e164 or "").lstrip("+")}'.strip()
+    return getattr(cliente, campo) or ''
+
+
+def _classificati(sql, params, tipo, limite, dopo):
+    """Pagina di `sql` (righe r.id, r.punteggio; cliente c) per
+    punteggio decrescente, a parita' per id."""
+    params = list(params)
+    if tipo:
+        sql += ' AND c.tipo = %s'
+        params.append(tipo)
+    cursore = _decodifica(dopo, 2)
+    if cursore is not None:
+        sql += ' AND (r.punteggio < %s OR (r.punteggio = %s AND r.id > %s))'
+        params += [cursore[0], cursore[0], cursore[1]]
+    sql += ' ORDER BY r.punteggio DESC, r.id LIMIT %s'
+    params.append(limite + 1)
+    with connection.cursor() as cur:
+        cur.execute(sql, params)
+        righe = cur.fetchall()
+    successivo = None
+    if len(righe) > limite:
+        righe = righe[:limite]
+        successivo = _codifica([righe[-1][1], righe[-1][0]])
+    return Pagina([r[0] for r in righe], successivo)
+
+
+def _alfabetico(qs, tipo, limite, dopo):
+    """Pagina in ordine cognome/ragione sociale/nome, a chiave (indice
+    cliente_ordine_alfabetico)."""
+    if tipo:
+        qs = qs.filter(tipo=tipo)
+    cursore = _decodifica(dopo, len(ORDINE_ALFABETICO))
+    if cursore is not None:
+        dopo_q, uguali = Q(), {}
+        for campo, valore in zip(ORDINE_ALFABETICO, cursore):
+            dopo_q |= Q(**uguali, **{f'{campo}__gt': valore})
+            uguali[campo] = valore
+        qs = qs.filter(dopo_q)
+    righe = list(qs.order_by(*ORDINE_ALFABETICO).values_list(*ORDINE_ALFABETICO)[:limite + 1])
+    successivo = None
+    if len(righe) > limite:
+        righe = righe[:limite]
+        successivo = _codifica(list(righe[-1]))
+    return Pagina([r[-1] for r in righe], successivo)
+
+
+# database SQLite (NAME) -> la tabella FTS5 c'e'? (test e dev hanno DB diversi)
+_fts_presente = {}
+
+
+def backend():
+    """Il backend del database corrente."""
+    if connection.vendor == 'postgresql':
+        return BackendPostgres()
+    if connection.vendor == 'sqlite':
+        db = connection.settings_dict['NAME']
+        if db not in _fts_presente:
+            _fts_presente[db] = TABELLA_FTS in connection.introspection.table_names()
+        if _fts_presente[db]:
+            return BackendSqlite()
+    return BackendIcontains()
+
+
+def cerca(testo, tipo: str = '', limite: int = 50, dopo: str = None) -> Pagina:
+    """Una pagina di clienti per `testo` (classificati) o, senza testo,
+    in ordine alfabetico. `dopo` e' il cursore della pagina precedente."""
+    cercate = parole(testo)
+    if not cercate:
+        return _alfabetico(Cliente.objects.all(), tipo, limite, dopo)
+    return backend().cerca(cercate, tipo, limite, dopo)
+
+
+def indicizza(clienti):
+    """Aggiorna l'indice FTS per questi clienti (no-op fuori da SQLite)."""
+    b = backend()
+    if isinstance(b, BackendSqlite):
+        b.indicizza(clienti)
+
+
+def rimuovi(pk):
+    b = backend()
+    if isinstance(b, BackendSqlite):
+        b.rimuovi(pk)
+
+
+def ricostruisci(blocco: int = 2000) -> int:
+    """Reindicizza tutta l'anagrafica (SQLite). Ritorna i clienti
+    indicizzati, 0 se il backend non ha un indice da allineare."""
+    b = backend()
+    if not isinstance(b, BackendSqlite):
+        return 0
+    b.svuota()
+    n, righe = 0, []
+    for c in Cliente.objects.order_by('pk').iterator(chunk_size=blocco):
+        righe.append(c)
+        if len(righe) >= blocco:
+            b.indicizza(righe)
+            n, righe = n + len(righe), []
+    b.indicizza(righe)
+    return n + len(righe)
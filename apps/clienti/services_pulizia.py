@@ -22,10 +22,9 @@ Merge design:
 from dataclasses import dataclass, field
 
 from django.db import IntegrityError, transaction
-from django.db.models import Count
+from django.db.models import Count, Exists, OuterRef
 
 from .models import Cliente, PuntiFedelta
-from .utils import normalizza_telefono
 
 
 @dataclass
@@ -38,20 +37,35 @@ class ClienteInfo:
     @property
     def eliminabile(self) -> bool:
         """Anagrafica 'vuota': nessuna attivita' collegata."""
+        ha_abbonamenti = getattr(self.cliente, 'ha_abbonamenti', None)
+        if ha_abbonamenti is None:
+            ha_abbonamenti = self.cliente.abbonamenti.exists()
         return (self.n_ordini == 0 and self.n_prenotazioni == 0
-                and not self.ha_account
-                and not self.cliente.abbonamenti.exists())
+                and not self.ha_account and not ha_abbonamenti)
 
 
 def _info(c: Cliente) -> ClienteInfo:
+    # n_ordini/n_prenotazioni gia' annotati da _con_conteggi, se c'e' stato
+    n_ordini = getattr(c, 'n_ordini', None)
+    n_prenotazioni = getattr(c, 'n_prenotazioni', None)
     return ClienteInfo(
         cliente=c,
-        n_ordini=c.ordine_set.count(),
-        n_prenotazioni=c.prenotazioni.count(),
+        n_ordini=c.ordine_set.count() if n_ordini is None else n_ordini,
+        n_prenotazioni=c.prenotazioni.count() if n_prenotazioni is None else n_prenotazioni,
         ha_account=bool(c.user_id),
     )
 
 
+def _con_conteggi(qs):
+    """Conteggi di _info/eliminabile in un'unica query."""
+    from apps.abbonamenti.models import Abbonamento
+
+    abbonamenti = Abbonamento.objects.filter(cliente=OuterRef('pk'))
+    return qs.annotate(n_ordini=Count('ordine', distinct=True),
+                       n_prenotazioni=Count('prenotazioni', distinct=True),
+                       ha_abbonamenti=Exists(abbonamenti))
+
+
 def trova_duplicati() -> list[list[ClienteInfo]]:
     """Gruppi di clienti che condividono lo stesso numero (normalizzato).
 
@@ -59,17 +73,16 @@ def trova_duplicati() -> list[list[ClienteInfo]]:
     (piu' ordini prima): il primo del gruppo e' il candidato master
     naturale.
     """
+    # GROUP BY sulla colonna indicizzata, poi solo i clienti dei gruppi
+    numeri = (Cliente.objects.exclude(telefono_e164='')
+              .values('telefono_e164').annotate(n=Count('pk')).filter(n__gt=1)
+              .values('telefono_e164'))
     per_numero: dict[str, list[Cliente]] = {}
-    for c in Cliente.objects.exclude(telefono=''):
-        e164 = normalizza_telefono(c.telefono)
-        if not e164:
-            continue
-        per_numero.setdefault(e164, []).append(c)
+    for c in _con_conteggi(Cliente.objects.filter(telefono_e164__in=numeri)):
+        per_numero.setdefault(c.telefono_e164, []).append(c)
 
     gruppi = []
-    for numero, clienti in per_numero.items():
-        if len(clienti) < 2:
-            continue
+    for clienti in per_numero.values():
         infos = [_info(c) for c in clienti]
         infos.sort(key=lambda i: (-i.n_ordini, -i.n_prenotazioni,
                                   not i.ha_account, i.cliente.pk))
@@ -81,10 +94,7 @@ def trova_duplicati() -> list[list[ClienteInfo]]:
 
 def clienti_senza_telefono() -> list[ClienteInfo]:
     """Clienti senza numero o con numero non parsabile."""
-    out = []
-    for c in Cliente.objects.all():
-        if not (c.telefono or '').strip() or not normalizza_telefono(c.telefono):
-            out.append(_info(c))
+    out = [_info(c) for c in _con_conteggi(Cliente.objects.filter(telefono_e164=''))]
     out.sort(key=lambda i: (i.eliminabile is False, -i.n_ordini))
     return out
 
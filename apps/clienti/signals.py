@@ -0,0 +1,20 @@
+"""Allineamento dell'indice di ricerca clienti (ricerca.py).
+
+Serve solo su SQLite (tabella FTS5): su Postgres la colonna di ricerca
+e' generata dal DB e ricerca.indicizza/rimuovi non fanno niente.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import ricerca
+from .models import Cliente
+
+
+@receiver(post_save, sender=Cliente)
+def indicizza_cliente(sender, instance, **kwargs):
+    ricerca.indicizza([instance])
+
+
+@receiver(post_delete, sender=Cliente)
+def rimuovi_cliente(sender, instance, **kwargs):
+    ricerca.rimuovi(instance.pk)
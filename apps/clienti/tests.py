@@ -0,0 +1,160 @@
+"""Test della chiave telefonica indicizzata (Cliente.telefono_e164) e
+delle ricerche per numero che la usano (anche l'aggancio delle
+conversazioni WhatsApp), su un'anagrafica di 50k clienti,
+e della ricerca clienti indicizzata (ricerca.py).
+
+Esecuzione: python manage.py test apps.clienti
+"""
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from apps.api.views import _match_cliente_da_telefono
+from apps.clients.whatsapp import _log_outgoing_msg
+from apps.messaggi.models import ConversazioneWhatsApp
+
+from . import ricerca
+from .models import Cliente
+from .services_pulizia import clienti_senza_telefono, trova_duplicati
+from .utils import trova_cliente_per_telefono
+
+N_CLIENTI = 50_000
+
+
+def _numero(i):
+    return f'333{i:07d}'
+
+
+class TelefonoE164Test(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create salta save(): la colonna si valorizza a mano
+        Cliente.objects.bulk_create([
+            Cliente(tipo='privato', nome=f'Cliente {i}', telefono=_numero(i),
+                    telefono_e164=f'+39{_numero(i)}')
+            for i in range(N_CLIENTI)
+        ], batch_size=5000)
+
+    def test_save_normalizza(self):
+        c = Cliente.objects.create(tipo='privato', nome='Ugo', telefono='0039 347-123 4567')
+        self.assertEqual(c.telefono_e164, '+393471234567')
+        c.telefono = 'non valido'
+        c.save(update_fields=['telefono'])
+        c.refresh_from_db()
+        self.assertEqual(c.telefono_e164, '')
+
+    def test_ricerca_per_numero_una_query(self):
+        atteso = Cliente.objects.get(telefono=_numero(42_424))
+        with self.assertNumQueries(1):
+            self.assertEqual(trova_cliente_per_telefono('+39 333 004 2424'), atteso)
+        with self.assertNumQueries(1):
+            self.assertEqual(_match_cliente_da_telefono('+393330042424'), atteso)
+        with self.assertNumQueries(1):
+            self.assertIsNone(trova_cliente_per_telefono('333 004 2424', escludi_pk=atteso.pk))
+        with self.assertNumQueries(0):
+            self.assertIsNone(trova_cliente_per_telefono('abc'))
+
+    def test_invio_a_numero_nuovo_aggancia_il_cliente(self):
+        atteso = Cliente.objects.get(telefono=_numero(31_337))
+        with mock.patch('apps.api.notify.notify_group'), \
+                CaptureQueriesContext(connection) as ctx:
+            _log_outgoing_msg('+393330031337', 'Ciao', 'wamid.prova')
+        conv = ConversazioneWhatsApp.objects.get(numero_e164='+393330031337')
+        self.assertEqual(conv.cliente, atteso)
+        # niente scansione dell'anagrafica: solo lookup sulla chiave indicizzata
+        su_clienti = [q['sql'] for q in ctx.captured_queries
+                      if 'FROM "clienti_cliente"' in q['sql']]
+        self.assertEqual(len(su_clienti), 1)
+        self.assertIn('"telefono_e164" =', su_clienti[0])
+
+    def test_duplicati_con_group_by(self):
+        doppione = Cliente.objects.create(tipo='privato', nome='Doppio',
+                                          telefono='+39 333 000 0007')
+        Cliente.objects.create(tipo='privato', nome='Senza', telefono='')
+        with self.assertNumQueries(1):
+            gruppi = trova_duplicati()
+        self.assertEqual(len(gruppi), 1)
+        self.assertEqual(sorted(i.cliente.pk for i in gruppi[0]),
+                         sorted([Cliente.objects.get(telefono=_numero(7)).pk, doppione.pk]))
+        with self.assertNumQueries(1):
+            self.assertEqual([i.cliente.nome for i in clienti_senza_telefono()], ['Senza'])
+
+    def test_comando_riallinea(self):
+        Cliente.objects.filter(telefono=_numero(5)).update(telefono='347 123 4567')
+        uscita = StringIO()
+        call_command('normalizza_telefoni', stdout=uscita)
+        self.assertIn(f'1 telefoni corretti su {N_CLIENTI} clienti', uscita.getvalue())
+        self.assertEqual(trova_cliente_per_telefono('3471234567').nome, 'Cliente 5')
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class RicercaClientiTest(TestCase):
+    def setUp(self):
+        for nome, cognome, telefono in (('Mario', 'Rossi', '333 111 2222'),
+                                        ('Maria', 'Marini', '333 111 3333'),
+                                        ('Luca', 'Mariani', '347 555 6666'),
+                                        ('Anna', 'Bianchi', '320 000 0001')):
+            Cliente.objects.create(tipo='privato', nome=nome, cognome=cognome,
+                                   telefono=telefono)
+        Cliente.objects.create(tipo='azienda', ragione_sociale='Marittima Srl',
+                               telefono='0541 123456')
+        self.client.force_login(User.objects.create_user('cassa', is_staff=True))
+
+    def _nomi(self, pagina):
+        return [str(c) for c in pagina.clienti()]
+
+    def test_classificati_e_per_prefisso(self):
+        self.assertEqual(ricerca.backend().nome, 'sqlite_fts5')
+        # la parola intera batte i soli prefissi
+        self.assertEqual(self._nomi(ricerca.cerca('maria'))[0], 'Marini Maria')
+        self.assertEqual(set(self._nomi(ricerca.cerca('mar'))),
+                         {'Rossi Mario', 'Marini Maria', 'Mariani Luca', 'Marittima Srl'})
+        self.assertEqual(self._nomi(ricerca.cerca('mar ros')), ['Rossi Mario'])
+        self.assertEqual(self._nomi(ricerca.cerca('3331113')), ['Marini Maria'])
+        self.assertEqual(self._nomi(ricerca.cerca('mar', tipo='azienda')), ['Marittima Srl'])
+
+    def test_indice_segue_modifiche_e_cancellazioni(self):
+        mario = Cliente.objects.get(nome='Mario')
+        mario.cognome = 'Verdi'
+        mario.save()
+        self.assertEqual(self._nomi(ricerca.cerca('verdi')), ['Verdi Mario'])
+        self.assertEqual(self._nomi(ricerca.cerca('rossi')), [])
+        mario.delete()
+        self.assertEqual(self._nomi(ricerca.cerca('verdi')), [])
+
+    def test_paginazione_a_chiave(self):
+        visti, dopo = [], None
+        while True:
+            pagina = ricerca.cerca('mar', limite=2, dopo=dopo)
+            visti += pagina.ids
+            if pagina.successivo is None:
+                break
+            dopo = pagina.successivo
+        self.assertEqual(len(visti), 4)
+        self.assertEqual(len(set(visti)), 4)
+        # senza testo: ordine alfabetico, stessa paginazione
+        pagina = ricerca.cerca('', limite=3)
+        seconda = ricerca.cerca('', limite=3, dopo=pagina.successivo)
+        self.assertEqual(self._nomi(pagina) + self._nomi(seconda),
+                         ['Marittima Srl', 'Bianchi Anna', 'Mariani Luca',
+                          'Marini Maria', 'Rossi Mario'])
+        self.assertIsNone(seconda.successivo)
+
+    def test_autocomplete_senza_count(self):
+        url = reverse('clienti:cerca-cliente')
+        with self.assertNumQueries(4):  # sessione, utente, ricerca, clienti
+            dati = self.client.get(url, {'term': 'Mario Rossi'}).json()
+        self.assertEqual([r['text'] for r in dati['results']], ['Rossi Mario'])
+        self.assertFalse(dati['has_more'])
+
+        risposta = self.client.get(reverse('clienti:clienti-list'), {'search': 'mar'})
+        self.assertEqual(len(risposta.context['clienti']), 4)
+        self.assertIsNone(risposta.context['pagina_successiva'])
+        self.assertEqual(risposta.context['total_clienti'], 5)
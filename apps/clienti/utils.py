@@ -3,8 +3,15 @@
 Normalizzazione telefoni in E.164 e ricerca cliente per numero,
 indipendenti dal formato con cui il numero e' stato digitato
 (spazi, trattini, prefisso 00/+39, ecc.).
+
+La ricerca per numero e' un'uguaglianza sulla colonna indicizzata
+Cliente.telefono_e164 (calcolata in Cliente.save()): prima ogni
+messaggio WhatsApp in ingresso e ogni ricerca in cassa normalizzava in
+Python il telefono di TUTTI i clienti.
 """
-from .models import Cliente
+from .models import Cliente, e164
+
+BLOCCO_RIALLINEA = 2000
 
 
 def normalizza_telefono(raw: str | None) -> str | None:
@@ -64,24 +71,37 @@ def valuta_collegamento_telefono(telefono, nome, cognome, escludi_pk=None):
     return 'verifica_fallita', esistente
 
 
+def cliente_per_e164(numero_e164: str | None, escludi_pk=None):
+    """Primo Cliente (per pk) con quel telefono_e164, o None. Una query."""
+    if not numero_e164:
+        return None
+    qs = Cliente.objects.filter(telefono_e164=numero_e164)
+    if escludi_pk:
+        qs = qs.exclude(pk=escludi_pk)
+    return qs.order_by('pk').first()
+
+
 def trova_cliente_per_telefono(raw: str | None, escludi_pk=None):
     """Primo Cliente il cui telefono normalizza allo stesso E.164.
 
     None se il numero non e' parsabile o nessun cliente matcha.
     `escludi_pk` esclude un cliente (es. se stesso durante una modifica).
-
-    Loop in Python sull'anagrafica: stesso pattern di
-    _match_cliente_da_telefono (apps/api/views.py). Con migliaia di
-    clienti resta rapido; se la rubrica cresce di un ordine di
-    grandezza va aggiunto un campo telefono_e164 indicizzato.
     """
-    target = normalizza_telefono(raw)
-    if not target:
-        return None
-    qs = Cliente.objects.exclude(telefono='').only('id', 'telefono')
-    if escludi_pk:
-        qs = qs.exclude(pk=escludi_pk)
-    for c in qs:
-        if normalizza_telefono(c.telefono) == target:
-            return c
-    return None
+    return cliente_per_e164(normalizza_telefono(raw), escludi_pk=escludi_pk)
+
+
+def riallinea_telefoni_e164(dry_run: bool = False) -> tuple[int, int]:
+    """Ricalcola telefono_e164 di tutti i clienti (dopo update massivi o
+    import che saltano save()). Ritorna (controllati, corretti)."""
+    controllati, da_correggere = 0, []
+    qs = Cliente.objects.only('id', 'telefono', 'telefono_e164').order_by('pk')
+    for c in qs.iterator(chunk_size=BLOCCO_RIALLINEA):
+        controllati += 1
+        valore = e164(c.telefono)
+        if valore != c.telefono_e164:
+            c.telefono_e164 = valore
+            da_correggere.append(c)
+    if not dry_run:
+        Cliente.objects.bulk_update(da_correggere, ['telefono_e164'],
+                                    batch_size=BLOCCO_RIALLINEA)
+    return controllati, len(da_correggere)
@@ -5,16 +5,17 @@ from django.views.generic import (
     ListView, CreateView, UpdateView, DeleteView, DetailView, TemplateView
 )
 from django.urls import reverse_lazy
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse
 from django.contrib import messages
 from django.db.models import Q, Sum, Count
 from django.contrib.auth.models import User
 from django.core.mail import send_mail
 from django.conf import settings
-import csv
 import json
 from .models import Cliente, PuntiFedelta, MovimentoPunti
 from .forms import ClienteForm, ClienteSearchForm
+from . import ricerca
+from apps.core import esportazione
 from apps.ordini.models import Ordine
 
 
@@ -25,37 +26,30 @@ class ClientiListView(LoginRequiredMixin, ListView):
     paginate_by = 20
     
     def get_queryset(self):
-        queryset = Cliente.objects.annotate(
+        # Ricerca indicizzata e paginazione a chiave (ricerca.py): niente
+        # count() ne' OFFSET, le annotazioni solo sui clienti della pagina
+        self.pagina = ricerca.cerca(self.request.GET.get('search'),
+                                    tipo=self.request.GET.get('tipo') or '',
+                                    limite=self.paginate_by,
+                                    dopo=self.request.GET.get('dopo'))
+        return self.pagina.clienti(Cliente.objects.annotate(
             ordini_count=Count('ordine'),
             spesa_totale=Sum('ordine__totale_finale')
-        )
-        
-        # Filtri
-        search = self.request.GET.get('search')
-        tipo = self.request.GET.get('tipo')
-        
-        if search:
-            queryset = queryset.filter(
-                Q(nome__icontains=search) |
-                Q(cognome__icontains=search) |
-                Q(ragione_sociale__icontains=search) |
-                Q(email__icontains=search) |
-                Q(telefono__icontains=search) |
-                Q(partita_iva__icontains=search) |
-                Q(codice_fiscale__icontains=search)
-            )
-        
-        if tipo:
-            queryset = queryset.filter(tipo=tipo)
-        
-        return queryset.order_by('cognome', 'ragione_sociale', 'nome')
-    
+        ))
+
+    def paginate_queryset(self, queryset, page_size):
+        return None, None, queryset, False
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['search_form'] = ClienteSearchForm(self.request.GET)
-        context['total_clienti'] = Cliente.objects.count()
-        context['clienti_privati'] = Cliente.objects.filter(tipo='privato').count()
-        context['clienti_aziende'] = Cliente.objects.filter(tipo='azienda').count()
+        context['pagina_successiva'] = self.pagina.successivo
+        context['prima_pagina'] = not self.request.GET.get('dopo')
+        context.update(Cliente.objects.aggregate(
+            total_clienti=Count('pk'),
+            clienti_privati=Count('pk', filter=Q(tipo='privato')),
+            clienti_aziende=Count('pk', filter=Q(tipo='azienda')),
+        ))
         return context
 
 
@@ -190,40 +184,18 @@ def cerca_cliente(request):
     term = request.GET.get('term', '')
     tipo = request.GET.get('tipo', '')
     
-    if len(term) < 2 and not tipo:
+    if len(term) < ricerca.MIN_CARATTERI and not tipo:
         return JsonResponse({'results': []})
-    
-    query = Q()
-    
-    if term and len(term) >= 2:
-        query |= (
-            Q(nome__icontains=term) |
-            Q(cognome__icontains=term) |
-            Q(ragione_sociale__icontains=term) |
-            Q(email__icontains=term) |
-            Q(telefono__icontains=term)
-        )
-    
-    clienti = Cliente.objects.filter(query)
-
-    if tipo:
-        clienti = clienti.filter(tipo=tipo)
-
-    # Ordina per cognome/nome/ragione_sociale cosi' i risultati sono
-    # prevedibili (senza order_by il DB restituisce in ordine indefinito
-    # e lo slice tagliava clienti "a caso").
-    clienti = clienti.order_by('cognome', 'nome', 'ragione_sociale')
 
-    # Limite alzato da 10 a 50: con soli 10 risultati alcuni clienti
-    # gia' registrati non venivano mai mostrati (es. su termini generici
-    # come "mar" che matchano "Marco", "Maria", "Marino", ...). 50 e'
-    # abbastanza da coprire ricerche larghe senza saturare il payload.
-    # Il frontend fa gia' scroll sulla lista.
-    total = clienti.count()
-    clienti = clienti[:50]
+    # Risultati classificati dall'indice di ricerca (ricerca.py); senza
+    # termine, ordine alfabetico. Pagine da 50 a chiave: 'next' e' il
+    # cursore da ripassare come ?dopo= per i successivi.
+    if len(term) < ricerca.MIN_CARATTERI:
+        term = ''
+    pagina = ricerca.cerca(term, tipo=tipo, limite=50, dopo=request.GET.get('dopo'))
 
     results = []
-    for cliente in clienti:
+    for cliente in pagina.clienti():
         results.append({
             'id': cliente.id,
             'text': str(cliente),
@@ -234,8 +206,8 @@ def cerca_cliente(request):
 
     return JsonResponse({
         'results': results,
-        'total': total,
-        'has_more': total > len(results),
+        'has_more': pagina.successivo is not None,
+        'next': pagina.successivo,
     })
 
 
@@ -454,31 +426,20 @@ def invia_credenziali_cliente(request, pk):
 
 @login_required
 def export_clienti_csv(request):
-    """Esporta la lista clienti in CSV"""
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="clienti_export.csv"'
-    
-    writer = csv.writer(response)
-    writer.writerow([
-        'Tipo', 'Nome/Ragione Sociale', 'Email', 'Telefono', 
-        'Indirizzo', 'CAP', 'Città', 'Codice Fiscale/P.IVA',
-        'Data Registrazione', 'Ordini Totali', 'Spesa Totale'
-    ])
-    
+    """Esporta la lista clienti in CSV (o XLSX con ?formato=xlsx), in streaming"""
     clienti = Cliente.objects.annotate(
         ordini_count=Count('ordine'),
         spesa_totale=Sum('ordine__totale_finale')
-    )
-    
-    for cliente in clienti:
+    ).order_by('pk')
+
+    def _riga(cliente):
         if cliente.tipo == 'privato':
             nome = f"{cliente.nome} {cliente.cognome}"
             codice = cliente.codice_fiscale
         else:
             nome = cliente.ragione_sociale
             codice = cliente.partita_iva
-        
-        writer.writerow([
+        return [
             cliente.get_tipo_display(),
             nome,
             cliente.email,
@@ -490,9 +451,14 @@ def export_clienti_csv(request):
             cliente.data_registrazione.strftime('%d/%m/%Y'),
             cliente.ordini_count or 0,
             cliente.spesa_totale or 0
-        ])
-    
-    return response
+        ]
+
+    return esportazione.esporta(request, 'clienti_export', [
+        'Tipo', 'Nome/Ragione Sociale', 'Email', 'Telefono',
+        'Indirizzo', 'CAP', 'Città', 'Codice Fiscale/P.IVA',
+        'Data Registrazione', 'Ordini Totali', 'Spesa Totale'
+    ], esportazione.righe_da_queryset(clienti, _riga), delimiter=',', bom=False,
+        foglio='Clienti')
 
 
 @login_required
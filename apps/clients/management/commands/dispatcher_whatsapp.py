@@ -0,0 +1,45 @@
+"""Worker dedicato dell'outbox WhatsApp (MessaggioInUscita).
+
+E' il processo che manda i messaggi in coda: va tenuto acceso come
+servizio a parte (Procfile: dispatcher), uno solo. Il web scrive le
+righe e non avvia thread propri (salvo WA_DISPATCHER_NEL_WEB in
+locale); il claim atomico lascia convivere questo processo con il cron
+delle campagne senza doppi invii.
+
+Uso:
+    python manage.py dispatcher_whatsapp
+    python manage.py dispatcher_whatsapp --workers 2
+    python manage.py dispatcher_whatsapp --una-volta   # svuota ed esce
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.clients.wa_dispatcher import Dispatcher
+
+
+class Command(BaseCommand):
+    help = 'Lavora l\'outbox dei messaggi WhatsApp in uscita.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Thread di invio (default WA_DISPATCHER_WORKERS).')
+        parser.add_argument('--una-volta', action='store_true',
+                            help='Svuota la coda ed esce.')
+
+    def handle(self, *args, **options):
+        disp = Dispatcher(workers=options['workers'])
+        if options['una_volta']:
+            elaborati = disp.svuota(timeout=10 * 60)
+            self.stdout.write(self.style.SUCCESS(f'{elaborati} messaggi elaborati.'))
+            return
+
+        disp.avvia()
+        self.stdout.write(f'Dispatcher WhatsApp avviato con {disp.workers} worker (Ctrl+C per uscire).')
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            self.stdout.write('Arresto: attendo gli invii in corso...')
+        finally:
+            disp.ferma()
@@ -0,0 +1,174 @@
+"""Test del dispatcher dei messaggi WhatsApp in uscita (outbox).
+
+Le chiamate Graph vanno a un server HTTP locale che risponde con gli
+status scritti dal test, cosi' si prova il trasporto vero (Session,
+retry, rate limit) senza toccare Meta.
+
+Esecuzione: python manage.py test apps.clients
+"""
+import json
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from apps.messaggi.models import MessaggioInUscita, MessaggioWhatsApp
+
+from . import wa_dispatcher
+from .wa_dispatcher import Dispatcher, accoda
+
+
+class _GraphFinto(BaseHTTPRequestHandler):
+    def do_POST(self):
+        corpo = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        server.ricevuti.append(corpo)
+        status = server.risposte.pop(0) if server.risposte else 200
+        if status < 400:
+            risposta = {'messages': [{'id': f'wamid.{len(server.ricevuti)}'}]}
+        else:
+            risposta = {'error': {'code': 131000 if status >= 500 else 100,
+                                  'message': 'errore finto'}}
+        dati = json.dumps(risposta).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(dati)))
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(META_WHATSAPP_PHONE_ID='123', META_WHATSAPP_ACCESS_TOKEN='x',
+                   META_WHATSAPP_BUSINESS_ACCOUNT_ID='', WHATSAPP_ENABLED=True,
+                   WA_INVII_AL_SECONDO=100, WA_INTERVALLO_STESSO_NUMERO_SEC=1,
+                   WA_MAX_TENTATIVI=4)
+class DispatcherTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _GraphFinto)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.ricevuti = []
+        self.server.risposte = []
+        self.disp = Dispatcher(workers=1,
+                               graph_url=f'http://127.0.0.1:{self.server.server_port}')
+        patcher = mock.patch.object(wa_dispatcher, 'BACKOFF_BASE_SEC', 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_notifiche_prima_delle_campagne(self):
+        accoda('+393330000001', 'promo', ['Mario'],
+               priorita=MessaggioInUscita.PRIORITA_CAMPAGNA, origine='campagna')
+        accoda('+393330000002', 'auto_pronta', ['Luigi'])
+
+        self.assertEqual(self.disp.svuota(timeout=10), 2)
+        self.assertEqual([r['to'] for r in self.server.ricevuti],
+                         ['393330000002', '393330000001'])
+        self.assertEqual(MessaggioWhatsApp.objects.count(), 2)
+
+    def test_ritenta_429_e_5xx(self):
+        self.server.risposte = [429, 500]
+        msg = accoda('+393330000001', 'auto_pronta', ['Mario'])
+
+        self.disp.svuota(timeout=10)
+        msg.refresh_from_db()
+        self.assertEqual((msg.stato, msg.tentativi), ('inviato', 3))
+        self.assertEqual(msg.wa_message_id, 'wamid.3')
+
+    def test_400_fallisce_subito(self):
+        self.server.risposte = [400]
+        msg = accoda('+393330000001', 'auto_pronta', ['Mario'])
+
+        self.disp.svuota(timeout=10)
+        msg.refresh_from_db()
+        self.assertEqual((msg.stato, msg.tentativi), ('fallito', 1))
+        self.assertTrue(msg.errore)
+        self.assertEqual(len(self.server.ricevuti), 1)
+
+    def test_invia_subito_salta_la_coda(self):
+        accoda('+393330000001', 'promo', priorita=MessaggioInUscita.PRIORITA_CAMPAGNA)
+
+        esito = self.disp.invia_subito('+393330000002', tipo='text', testo='Ciao')
+        self.assertTrue(esito.ok)
+        self.assertFalse(esito.accodato)
+        riga = MessaggioInUscita.objects.get(numero_e164='+393330000002')
+        self.assertEqual((riga.stato, riga.tentativi), ('inviato', 1))
+        self.assertEqual(
+            MessaggioInUscita.objects.get(numero_e164='+393330000001').stato, 'in_coda')
+
+    def test_invia_subito_non_ritenta_nella_request(self):
+        self.server.risposte = [503]
+        with mock.patch.object(wa_dispatcher.time, 'sleep') as dorme:
+            esito = self.disp.invia_subito('+393330000002', tipo='text', testo='Ciao')
+        dorme.assert_not_called()
+        self.assertTrue(esito.accodato)
+        riga = MessaggioInUscita.objects.get(numero_e164='+393330000002')
+        self.assertEqual((riga.stato, riga.tentativi), ('in_coda', 1))
+
+        # il ritentativo lo fa il worker
+        self.disp.svuota(timeout=10)
+        riga.refresh_from_db()
+        self.assertEqual((riga.stato, riga.tentativi), ('inviato', 2))
+        self.assertEqual(len(self.server.ricevuti), 2)
+
+    @override_settings(WA_INTERVALLO_STESSO_NUMERO_SEC=600)
+    def test_invia_subito_oltre_il_limite_va_in_coda(self):
+        for _ in range(wa_dispatcher.RAFFICA_STESSO_NUMERO):
+            self.assertTrue(self.disp.invia_subito('+393330000002', tipo='text', testo='x').ok)
+
+        # anche un altro Dispatcher (altro processo) vede le prese sul DB
+        altro = Dispatcher(workers=1, graph_url=self.disp.graph_url)
+        esito = altro.invia_subito('+393330000002', tipo='text', testo='x')
+        self.assertTrue(esito.accodato)
+        self.assertEqual(len(self.server.ricevuti), wa_dispatcher.RAFFICA_STESSO_NUMERO)
+        riga = MessaggioInUscita.objects.get(stato='in_coda')
+        self.assertEqual(riga.tentativi, 0)
+        self.assertGreater(riga.prossimo_tentativo_il,
+                           timezone.now() + timedelta(seconds=60))
+
+    @override_settings(WA_INVII_AL_SECONDO=2)
+    def test_limite_globale(self):
+        for i in range(3):
+            accoda(f'+39333000000{i}', 'auto_pronta')
+        for _ in range(3):
+            self.disp.elabora(self.disp.preleva())
+        self.assertEqual(len(self.server.ricevuti), 2)
+        rimandato = MessaggioInUscita.objects.get(stato='in_coda')
+        self.assertEqual(rimandato.tentativi, 0)
+        self.assertLessEqual(rimandato.prossimo_tentativo_il,
+                             timezone.now() + timedelta(seconds=1))
+
+    @override_settings(WA_DISPATCHER_NEL_WEB=False)
+    def test_accoda_non_avvia_thread_nel_web(self):
+        with mock.patch.object(wa_dispatcher, 'dispatcher') as singleton, \
+                self.captureOnCommitCallbacks(execute=True):
+            accoda('+393330000001', 'auto_pronta')
+        singleton.assert_not_called()
+
+    @override_settings(WA_INTERVALLO_STESSO_NUMERO_SEC=600)
+    def test_stesso_numero_rimandato_senza_consumare_tentativi(self):
+        for _ in range(wa_dispatcher.RAFFICA_STESSO_NUMERO + 1):
+            accoda('+393330000001', 'auto_pronta')
+
+        for _ in range(wa_dispatcher.RAFFICA_STESSO_NUMERO + 1):
+            self.disp.elabora(self.disp.preleva())
+
+        self.assertEqual(len(self.server.ricevuti), wa_dispatcher.RAFFICA_STESSO_NUMERO)
+        rimandato = MessaggioInUscita.objects.get(stato='in_coda')
+        self.assertEqual(rimandato.tentativi, 0)
+        self.assertGreater(rimandato.prossimo_tentativo_il,
+                           timezone.now() + timedelta(seconds=60))
+        self.assertIsNone(self.disp.preleva())
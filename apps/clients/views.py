@@ -5,6 +5,7 @@
 - Dashboard cliente
 - Flusso prenotazione (catalogo + slot picker + conferma)
 """
+import hashlib
 import json
 from datetime import datetime, timedelta
 
@@ -13,18 +14,19 @@ from django.contrib import messages
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.decorators.http import require_POST
 
 from apps.clienti.models import Cliente
 from apps.core.models import ServizioProdotto, Categoria
-from apps.prenotazioni.models import (
-    Prenotazione, SlotPrenotazione, ConfigurazioneSlot,
-)
+from apps.prenotazioni.models import Prenotazione, SlotPrenotazione
+from apps.prenotazioni.disponibilita import disponibilita_periodo, slot_prenotabili
 
 from .forms import RegistrazioneClienteForm
 
@@ -222,7 +224,12 @@ def booking(request):
 
 
 def slot_disponibili_pub(request):
-    """API JSON: slot disponibili per data (riusa logica esistente)."""
+    """API JSON: slot prenotabili dal sito per una data.
+
+    Legge la riga dell'indice DisponibilitaGiorno (vedi
+    apps/prenotazioni/disponibilita.py): lato cliente ogni slot e'
+    esclusivo, quindi ci sono solo gli slot senza prenotazioni attive.
+    """
     data_str = request.GET.get('data')
     if not data_str:
         return JsonResponse({'error': 'Parametro data mancante'}, status=400)
@@ -231,35 +238,51 @@ def slot_disponibili_pub(request):
     except ValueError:
         return JsonResponse({'error': 'Data non valida'}, status=400)
 
-    # Genera slot da configurazione se non esistono
-    giorno_settimana = data_richiesta.weekday()
-    for config in ConfigurazioneSlot.objects.filter(
-        giorno_settimana=giorno_settimana, attivo=True
-    ):
-        config.genera_slot_per_data(data_richiesta)
-
-    now = timezone.localtime(timezone.now())
-    is_oggi = data_richiesta == now.date()
-
-    slot_qs = SlotPrenotazione.objects.filter(
-        data=data_richiesta, disponibile=True
-    ).order_by('ora_inizio')
-    out = []
-    for s in slot_qs:
-        # Lato cliente: ogni slot e' esclusivo. Se gia esiste UNA
-        # prenotazione attiva per quella fascia oraria, non e' piu
-        # selezionabile (indipendentemente da max_prenotazioni interno).
-        if s.prenotazioni_attuali > 0:
-            continue
-        is_past = is_oggi and s.ora_inizio < now.time()
-        if is_past:
-            continue
-        out.append({
-            'id': s.id,
-            'ora_inizio': s.ora_inizio.strftime('%H:%M'),
-            'ora_fine': s.ora_fine.strftime('%H:%M'),
-        })
-    return JsonResponse({'slot': out})
+    riga = disponibilita_periodo(data_richiesta, 1)[0]
+    if riga.chiuso:
+        # Giorno chiuso (ferie, festivi): nessuno slot prenotabile
+        return JsonResponse({'slot': [], 'chiuso': True})
+    return JsonResponse({'slot': slot_prenotabili(riga)})
+
+
+def disponibilita_pub(request):
+    """API JSON: disponibilita' dei prossimi GIORNI_PUBBLICI giorni in
+    una risposta sola, per il wizard di prenotazione.
+
+    GET /app/api/disponibilita/
+    Risposta:
+      {"dal": "YYYY-MM-DD",
+       "giorni": {"YYYY-MM-DD": {"chiuso": false,
+                                 "slot": [{id, ora_inizio, ora_fine}, ...]}}}
+
+    Con ETag e Last-Modified: il telefono rivalida con If-None-Match /
+    If-Modified-Since e riceve 304 se nulla e' cambiato.
+    """
+    adesso = timezone.localtime()
+    righe = disponibilita_periodo(adesso.date())
+    corpo = json.dumps({
+        'dal': adesso.date().isoformat(),
+        'giorni': {
+            r.data.isoformat(): {'chiuso': r.chiuso,
+                                 'slot': slot_prenotabili(r, adesso)}
+            for r in righe
+        },
+    }, separators=(',', ':'))
+    etag = quote_etag(hashlib.md5(corpo.encode()).hexdigest())
+    ultima_modifica = max((r.aggiornato_il for r in righe), default=None)
+    last_modified = (int(ultima_modifica.timestamp())
+                     if ultima_modifica else None)
+
+    risposta = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if risposta is None:
+        risposta = HttpResponse(corpo, content_type='application/json')
+    risposta.headers['ETag'] = etag
+    if last_modified:
+        risposta.headers['Last-Modified'] = http_date(last_modified)
+    # Il browser puo' tenerla ma deve sempre rivalidare
+    patch_cache_control(risposta, private=True, no_cache=True)
+    return risposta
 
 
 def catalogo_upsell(request):
@@ -0,0 +1,406 @@
+"""Dispatcher unico dei messaggi WhatsApp in uscita.
+
+Prima ogni template partiva in un thread daemon nuovo con una
+requests.post senza Session (handshake TLS a ogni messaggio) e la coda
+campagne inviava in serie con time.sleep dentro un thread del web
+process. Un riavvio di Daphne a meta' batch perdeva gli invii.
+
+Ora tutto passa dall'outbox MessaggioInUscita (apps.messaggi.models):
+
+- accoda(): scrive la riga. Usato per le notifiche fire-and-forget e
+  per le campagne (che arrivano gia' distanziate nel tempo via
+  prossimo_tentativo_il);
+- invia_subito(): per chi vuole l'esito (auto pronta, risposta dalla
+  inbox, promemoria dal cron): scrive la riga gia' "presa" e fa un solo
+  tentativo nel thread chiamante, saltando la coda, cosi' le notifiche
+  transazionali non aspettano dietro il traffico campagne. Non dorme
+  mai: se il rate limit chiede di aspettare, o Meta risponde con un
+  errore ritentabile, la riga va in coda e l'esito torna `accodato`;
+- i worker girano in un processo solo, `manage.py dispatcher_whatsapp`
+  (servizio dedicato), che trova le righe nuove interrogando la coda
+  ogni ATTESA_CODA_VUOTA_SEC. Il web non avvia thread propri, salvo
+  WA_DISPATCHER_NEL_WEB (sviluppo in locale). Il claim e' atomico
+  (UPDATE ... WHERE stato='in_coda'): il cron delle campagne puo'
+  svuotare la stessa outbox senza doppi invii;
+- i worker prelevano le righe scadute per priorita' (0 notifiche, 10
+  campagne), con una Session requests e pool keep-alive verso
+  graph.facebook.com;
+- rate limit globale (WA_INVII_AL_SECONDO) e per numero
+  (WA_INTERVALLO_STESSO_NUMERO_SEC, con piccola raffica) calcolato
+  sulle righe gia' prese dell'outbox (preso_il), quindi uguale per
+  tutti i processi che inviano. Tra la verifica e l'invio di due
+  processi diversi puo' scappare un messaggio in piu': il limite e'
+  di cortesia verso Meta, che comunque risponde 429/131056 (ritentati);
+- 429, 5xx, errori di rete e i codici Meta di throttling vengono
+  ritentati con backoff esponenziale + jitter fino a WA_MAX_TENTATIVI.
+
+Costruzione del payload e scrittura nella inbox restano in whatsapp.py;
+qui c'e' solo il trasporto.
+"""
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = 8  # secondi
+BACKOFF_BASE_SEC = 5
+BACKOFF_MAX_SEC = 15 * 60
+PRESA_SCADUTA_SEC = 5 * 60
+ATTESA_CODA_VUOTA_SEC = 2
+RAFFICA_STESSO_NUMERO = 3
+# Righe che contano per il rate limit: gia' passate (o in corso) a Meta
+_STATI_PRESI = ('in_invio', 'inviato', 'fallito')
+
+# Codici Meta di throttling: vanno ritentati come un 429
+_CODICI_META_RITENTABILI = {4, 80007, 130429, 131056}
+
+# origine della riga -> funzione(messaggio, esito) chiamata all'esito
+# finale (inviato o fallito definitivo)
+GESTORI_ESITO = {
+    'campagna': 'apps.marketing.services.invio.esito_invio',
+}
+
+
+@dataclass
+class Esito:
+    ok: bool
+    wa_message_id: str = ''
+    status: int | None = None
+    risposta: str = ''
+    errore: str = ''
+    ritentabile: bool = False
+    attesa: float | None = None  # Retry-After, se Meta lo indica
+    # invia_subito: non partito ora, la riga e' in coda e la mandano i worker
+    accodato: bool = False
+
+
+def _prese_prima(msg):
+    """Righe dell'outbox prese prima di `msg` (a pari preso_il decide il pk)."""
+    from apps.messaggi.models import MessaggioInUscita
+    return MessaggioInUscita.objects.filter(stato__in=_STATI_PRESI).filter(
+        Q(preso_il__lt=msg.preso_il) | Q(preso_il=msg.preso_il, pk__lt=msg.pk))
+
+
+def _attesa_finestra(prese, quante: int, secondi: float, adesso) -> float:
+    """Finestra scorrevole: al massimo `quante` prese negli ultimi
+    `secondi`. Ritorna i secondi da aspettare (0 = si puo' partire)."""
+    recenti = list(prese.filter(preso_il__gt=adesso - timedelta(seconds=secondi))
+                   .order_by('-preso_il').values_list('preso_il', flat=True)[:quante])
+    if len(recenti) < quante:
+        return 0.0
+    return max(0.0, (recenti[-1] - adesso).total_seconds() + secondi)
+
+
+def attesa_rate_limit(msg) -> float:
+    """Secondi prima che `msg` (gia' preso) possa partire, per il limite
+    globale e per quello sul suo numero. 0 = subito."""
+    prese = _prese_prima(msg)
+    quante = max(1, int(settings.WA_INVII_AL_SECONDO))
+    globale = _attesa_finestra(
+        prese, quante, quante / settings.WA_INVII_AL_SECONDO, msg.preso_il)
+    if globale:
+        return globale
+    return _attesa_finestra(
+        prese.filter(numero_e164=msg.numero_e164), RAFFICA_STESSO_NUMERO,
+        RAFFICA_STESSO_NUMERO * settings.WA_INTERVALLO_STESSO_NUMERO_SEC,
+        msg.preso_il)
+
+
+def _sveglia_al_commit():
+    if settings.WA_DISPATCHER_NEL_WEB:
+        transaction.on_commit(lambda: dispatcher().sveglia())
+
+
+def _codice_meta(testo: str):
+    import json
+    try:
+        return (json.loads(testo).get('error') or {}).get('code')
+    except (ValueError, AttributeError):
+        return None
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
+
+
+def _backoff(tentativi: int, minimo=None) -> float:
+    attesa = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** max(0, tentativi - 1))
+    attesa *= random.uniform(0.8, 1.2)
+    return max(attesa, minimo or 0)
+
+
+def nuova_sessione(pool: int) -> requests.Session:
+    sessione = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(pool, 2))
+    sessione.mount('https://', adapter)
+    sessione.mount('http://', adapter)
+    return sessione
+
+
+class Dispatcher:
+    def __init__(self, workers=None, graph_url=None):
+        self.workers = workers or settings.WA_DISPATCHER_WORKERS
+        self.graph_url = (graph_url or settings.META_GRAPH_URL).rstrip('/')
+        # +1: anche i thread delle view (invia_subito) usano il pool
+        self.sessione = nuova_sessione(self.workers + 1)
+        self._lock = threading.Lock()
+        self._sveglia = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._ultimo_recupero = 0.0
+
+    # ----- HTTP -------------------------------------------------------
+
+    def url(self, percorso: str) -> str:
+        return f'{self.graph_url}/{settings.META_WHATSAPP_API_VERSION}/{percorso}'
+
+    def _post(self, payload) -> Esito:
+        try:
+            r = self.sessione.post(
+                self.url(f'{settings.META_WHATSAPP_PHONE_ID}/messages'),
+                json=payload,
+                headers={'Authorization': f'Bearer {settings.META_WHATSAPP_ACCESS_TOKEN}'},
+                timeout=REQUEST_TIMEOUT,
+            )
+        except requests.RequestException as e:
+            return Esito(False, errore=f'errore di rete verso Meta: {str(e)[:120]}',
+                         ritentabile=True)
+        if r.status_code >= 400:
+            ritentabile = (r.status_code == 429 or r.status_code >= 500
+                           or _codice_meta(r.text) in _CODICI_META_RITENTABILI)
+            return Esito(False, status=r.status_code, risposta=r.text[:1000],
+                         ritentabile=ritentabile, attesa=_retry_after(r))
+        wa_id = ''
+        try:
+            wa_id = r.json()['messages'][0]['id']
+        except (KeyError, IndexError, TypeError, ValueError):
+            pass
+        return Esito(True, wa_message_id=wa_id, status=r.status_code)
+
+    # ----- elaborazione di una riga -----------------------------------
+
+    def _invia_riga(self, msg) -> Esito:
+        from . import whatsapp as wa
+        esito = self._post(wa.payload_messaggio(msg))
+        if not esito.ok and not esito.errore:
+            esito.errore = wa._errore_meta_leggibile(esito.risposta)
+        return esito
+
+    def _chiudi(self, msg, esito: Esito):
+        from apps.messaggi.models import MessaggioInUscita
+        from . import whatsapp as wa
+
+        msg.stato = 'inviato' if esito.ok else 'fallito'
+        msg.wa_message_id = esito.wa_message_id
+        msg.errore = esito.errore[:255]
+        msg.inviato_il = timezone.now() if esito.ok else None
+        MessaggioInUscita.objects.filter(pk=msg.pk).update(
+            stato=msg.stato, wa_message_id=msg.wa_message_id,
+            errore=msg.errore, inviato_il=msg.inviato_il,
+            tentativi=msg.tentativi)
+        if esito.ok:
+            wa.dopo_invio(msg, esito)
+        else:
+            wa.dopo_fallimento(msg, esito)
+        if msg.origine in GESTORI_ESITO:
+            try:
+                import_string(GESTORI_ESITO[msg.origine])(msg, esito)
+            except Exception:
+                logger.exception('Gestore esito %s fallito per outbox %s',
+                                 msg.origine, msg.pk)
+
+    def _rimanda(self, msg, secondi: float, conta_tentativo=True):
+        from apps.messaggi.models import MessaggioInUscita
+        if conta_tentativo:
+            msg.tentativi += 1
+        MessaggioInUscita.objects.filter(pk=msg.pk).update(
+            stato='in_coda', preso_il=None, tentativi=msg.tentativi,
+            prossimo_tentativo_il=timezone.now() + timedelta(seconds=secondi))
+
+    def elabora(self, msg):
+        """Invia una riga gia' presa (stato in_invio) dalla coda."""
+        attesa = attesa_rate_limit(msg)
+        if attesa > 0:
+            # Limite globale o numero appena contattato: la riga torna in
+            # coda senza consumare un tentativo, il worker passa alla prossima.
+            self._rimanda(msg, attesa, conta_tentativo=False)
+            return None
+        esito = self._invia_riga(msg)
+        if (not esito.ok and esito.ritentabile
+                and msg.tentativi + 1 < settings.WA_MAX_TENTATIVI):
+            self._rimanda(msg, _backoff(msg.tentativi + 1, esito.attesa))
+            logger.info('Outbox %s rimandato (tentativo %s): %s',
+                        msg.pk, msg.tentativi, esito.errore)
+            return esito
+        msg.tentativi += 1
+        self._chiudi(msg, esito)
+        return esito
+
+    def invia_subito(self, numero_e164, tipo='template', template='',
+                     parametri=None, testo='',
+                     priorita=None) -> Esito:
+        """Un tentativo nel thread chiamante, senza attese. Se non puo'
+        partire ora (rate limit) o va ritentato, la riga resta in coda
+        per i worker e l'esito ha accodato=True. La riga resta
+        nell'outbox come storico."""
+        from apps.messaggi.models import MessaggioInUscita
+
+        msg = MessaggioInUscita.objects.create(
+            numero_e164=numero_e164, tipo=tipo, template=template,
+            parametri=list(parametri or []), testo=testo,
+            priorita=MessaggioInUscita.PRIORITA_NOTIFICA if priorita is None else priorita,
+            stato='in_invio', preso_il=timezone.now(),
+        )
+        attesa = attesa_rate_limit(msg)
+        if attesa > 0:
+            self._rimanda(msg, attesa, conta_tentativo=False)
+            _sveglia_al_commit()
+            return Esito(False, errore='rate limit: messaggio in coda', accodato=True)
+        esito = self._invia_riga(msg)
+        if (not esito.ok and esito.ritentabile
+                and msg.tentativi + 1 < settings.WA_MAX_TENTATIVI):
+            self._rimanda(msg, _backoff(msg.tentativi + 1, esito.attesa))
+            _sveglia_al_commit()
+            logger.info('Outbox %s (invio immediato) in coda per un nuovo tentativo: %s',
+                        msg.pk, esito.errore)
+            esito.accodato = True
+            return esito
+        msg.tentativi += 1
+        self._chiudi(msg, esito)
+        return esito
+
+    # ----- coda -------------------------------------------------------
+
+    def recupera_prese_scadute(self) -> int:
+        """Righe 'in_invio' di un processo morto tornano in coda."""
+        from apps.messaggi.models import MessaggioInUscita
+        limite = timezone.now() - timedelta(seconds=PRESA_SCADUTA_SEC)
+        return MessaggioInUscita.objects.filter(
+            stato='in_invio', preso_il__lt=limite,
+        ).update(stato='in_coda', preso_il=None)
+
+    def preleva(self):
+        """Claim atomico della prossima riga scaduta (None se nessuna)."""
+        from apps.messaggi.models import MessaggioInUscita
+
+        if time.monotonic() - self._ultimo_recupero > 60:
+            self._ultimo_recupero = time.monotonic()
+            self.recupera_prese_scadute()
+        adesso = timezone.now()
+        candidati = list(
+            MessaggioInUscita.objects
+            .filter(stato='in_coda', prossimo_tentativo_il__lte=adesso)
+            .order_by('priorita', 'prossimo_tentativo_il', 'pk')
+            .values_list('pk', flat=True)[:self.workers * 2]
+        )
+        for pk in candidati:
+            if MessaggioInUscita.objects.filter(pk=pk, stato='in_coda').update(
+                    stato='in_invio', preso_il=adesso):
+                return MessaggioInUscita.objects.get(pk=pk)
+        return None
+
+    def _ciclo(self):
+        while not self._stop.is_set():
+            try:
+                msg = self.preleva()
+                if msg is None:
+                    self._sveglia.wait(ATTESA_CODA_VUOTA_SEC)
+                    self._sveglia.clear()
+                    continue
+                self.elabora(msg)
+            except Exception:
+                logger.exception('Errore nel worker outbox WhatsApp')
+                time.sleep(1)
+            finally:
+                close_old_connections()
+
+    def avvia(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self._ciclo, name=f'wa-outbox-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for t in self._threads:
+                t.start()
+
+    def sveglia(self):
+        self.avvia()
+        self._sveglia.set()
+
+    def ferma(self, timeout=REQUEST_TIMEOUT + 2):
+        """Ferma i worker lasciando finire l'invio in corso."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        self._stop.set()
+        self._sveglia.set()
+        for t in threads:
+            t.join(timeout)
+
+    def svuota(self, timeout: float = 60) -> int:
+        """Lavora la coda nel thread chiamante finche' non resta nulla
+        in coda (anche programmato piu' avanti) o scade il timeout.
+        Per i cron e i test. Ritorna le righe elaborate."""
+        from apps.messaggi.models import MessaggioInUscita
+
+        fine = time.monotonic() + timeout
+        elaborate = 0
+        while time.monotonic() < fine:
+            msg = self.preleva()
+            if msg is not None:
+                self.elabora(msg)
+                elaborate += 1
+                continue
+            prossimo = (MessaggioInUscita.objects.filter(stato='in_coda')
+                        .order_by('prossimo_tentativo_il')
+                        .values_list('prossimo_tentativo_il', flat=True).first())
+            if prossimo is None:
+                break
+            attesa = (prossimo - timezone.now()).total_seconds()
+            time.sleep(min(max(attesa, 0.05), max(0, fine - time.monotonic())))
+        return elaborate
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def dispatcher() -> Dispatcher:
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher()
+        return _dispatcher
+
+
+def accoda(numero_e164, template='', parametri=None, tipo='template', testo='',
+           priorita=None, origine='', riferimento_id=None, quando=None):
+    """Mette un messaggio nell'outbox (la manda il processo dispatcher)."""
+    from apps.messaggi.models import MessaggioInUscita
+
+    msg = MessaggioInUscita.objects.create(
+        numero_e164=numero_e164, tipo=tipo, template=template,
+        parametri=list(parametri or []), testo=testo,
+        priorita=MessaggioInUscita.PRIORITA_NOTIFICA if priorita is None else priorita,
+        origine=origine, riferimento_id=riferimento_id,
+        prossimo_tentativo_il=quando or timezone.now(),
+    )
+    _sveglia_al_commit()
+    return msg
@@ -1,9 +1,12 @@
 """Notifiche WhatsApp via Meta Cloud API.
 
 Wrapper paralleli a `notifications.py` (email). Strategia:
-- Tutte le chiamate sono fire-and-forget in daemon thread (come
-  `apps/api/notify.py::_send_in_background`): la view ritorna entro
-  pochi ms anche se Meta risponde lento o e' down.
+- Il trasporto HTTP e' del dispatcher (wa_dispatcher.py): outbox su DB,
+  worker con Session keep-alive, rate limit e retry. Le notifiche
+  fire-and-forget vanno in coda (la view ritorna subito anche se Meta
+  e' lenta o down); chi ha bisogno dell'esito usa le *_blocking, che
+  fanno un solo tentativo e, se il messaggio non puo' partire subito,
+  lo lasciano in coda e ritornano successo con wa_message_id vuoto.
 - Senza env vars Meta configurate, le funzioni ritornano False senza
   effetti; il chiamante (in `notifications.py::notifica_*`) cade su
   email come fallback.
@@ -16,16 +19,15 @@ permette solo template. I nomi template sono in settings
 Setup esterno: docs/WHATSAPP_SETUP.md
 """
 import logging
-import threading
 
 import phonenumbers
 import requests
 from django.conf import settings
 
-logger = logging.getLogger(__name__)
+from .wa_dispatcher import REQUEST_TIMEOUT as _REQUEST_TIMEOUT
+from .wa_dispatcher import accoda, dispatcher
 
-_GRAPH_URL = 'https://graph.facebook.com'
-_REQUEST_TIMEOUT = 8  # secondi
+logger = logging.getLogger(__name__)
 
 
 # Testo "umano" dei template approvati, per renderizzare la bubble nella
@@ -95,25 +97,21 @@ def _fetch_template_body(template_name: str) -> str | None:
     placeholder '[Template: nome]' invece del vero messaggio.
     """
     import re
-    from django.core.cache import cache
+    from apps.core import cache as cache_condivisa
 
     waba_id = getattr(settings, 'META_WHATSAPP_BUSINESS_ACCOUNT_ID', '')
     if not waba_id or not settings.META_WHATSAPP_ACCESS_TOKEN:
         return None
 
     cache_key = f'wa_tpl_body:{template_name}'
-    cached = cache.get(cache_key)
+    cached = cache_condivisa.leggi(cache_key)
     if cached is not None:
         return cached or None  # '' cached = "non trovato", evita retry a raffica
 
     body = None
     try:
-        url = (
-            f"{_GRAPH_URL}/{settings.META_WHATSAPP_API_VERSION}"
-            f"/{waba_id}/message_templates"
-        )
-        r = requests.get(
-            url,
+        r = dispatcher().sessione.get(
+            dispatcher().url(f'{waba_id}/message_templates'),
             params={'name': template_name, 'fields': 'name,components,language'},
             headers={'Authorization': f'Bearer {settings.META_WHATSAPP_ACCESS_TOKEN}'},
             timeout=_REQUEST_TIMEOUT,
@@ -142,7 +140,7 @@ def _fetch_template_body(template_name: str) -> str | None:
         # Non cachare gli errori di rete: riprova al prossimo invio
         return None
 
-    cache.set(cache_key, body or '', 60 * 60 * 24)
+    cache_condivisa.scrivi(cache_key, body or '', 60 * 60 * 24)
     return body
 
 
@@ -202,19 +200,18 @@ def _log_outgoing_msg(to_e164: str, corpo: str, wa_message_id: str) -> None:
     """
     try:
         from apps.messaggi.models import ConversazioneWhatsApp, MessaggioWhatsApp
-        from apps.clienti.models import Cliente
+        from apps.clienti.utils import cliente_per_e164
         from apps.api.notify import notify_group
 
         conv, created = ConversazioneWhatsApp.objects.get_or_create(
             numero_e164=to_e164,
         )
-        # Match cliente per numero (solo se conv appena creata e senza cliente)
+        # Match cliente per numero (solo se conv appena creata e senza
+        # cliente): una query sulla colonna indicizzata telefono_e164
         if created and not conv.cliente:
-            for c in Cliente.objects.exclude(telefono='').only('id', 'telefono'):
-                if _to_e164(c.telefono) == to_e164:
-                    conv.cliente = c
-                    conv.save(update_fields=['cliente'])
-                    break
+            conv.cliente = cliente_per_e164(to_e164)
+            if conv.cliente:
+                conv.save(update_fields=['cliente'])
 
         # Dedup su wa_message_id (caso raro: stesso send invocato 2 volte)
         if wa_message_id and MessaggioWhatsApp.objects.filter(
@@ -229,8 +226,7 @@ def _log_outgoing_msg(to_e164: str, corpo: str, wa_message_id: str) -> None:
             wa_message_id=wa_message_id or '',
             stato='sent',
         )
-        # ultimo_messaggio_il aggiornato automaticamente da auto_now
-        conv.save(update_fields=['ultimo_messaggio_il'])
+        # ultimo messaggio della conversazione aggiornato dalla create()
 
         notify_group('messaggi_wa', {
             'type': 'nuovo_messaggio_wa',
@@ -313,6 +309,99 @@ def _errore_meta_leggibile(response_text: str) -> str:
     return f'{dettaglio[:130]} [Meta {codice}]' if codice else dettaglio[:150]
 
 
+def _parametri_body(template_name: str, params: list[str]) -> list[dict]:
+    """Parametri body del template, tronchi a 60 char ognuno per
+    rispettare i limiti Meta sul body parameter (1024 totali)."""
+    # Test mode: skippa i parametri body per compatibilita' con template
+    # Meta pre-approvati senza variabili (es. hello_world). Vedi
+    # settings.META_WA_OMIT_BODY_PARAMS.
+    if settings.META_WA_OMIT_BODY_PARAMS:
+        return []
+    # Adatta i parametri alle variabili REALI del template: Meta
+    # rifiuta l'invio se il conteggio non corrisponde. Cosi' un
+    # template senza variabili (o con la sola {{1}} nome) funziona
+    # anche se il chiamante passa piu' parametri (es. il richiamo
+    # automatico ne passa sempre 2: nome e giorni dall'ultimo).
+    params_effettivi = list(params)
+    n_var = _conta_variabili_template(template_name)
+    if n_var is not None and len(params_effettivi) > n_var:
+        params_effettivi = params_effettivi[:n_var]
+    return [
+        {'type': 'text', 'text': (str(p) if p is not None else '')[:60]}
+        for p in params_effettivi
+    ]
+
+
+def payload_messaggio(msg) -> dict:
+    """Payload Graph API per una riga MessaggioInUscita (usato dal
+    dispatcher)."""
+    payload = {
+        'messaging_product': 'whatsapp',
+        'to': msg.numero_e164.lstrip('+'),  # Meta vuole solo cifre, no +
+    }
+    if msg.tipo == 'text':
+        payload.update(type='text', text={'body': (msg.testo or '')[:4096]})
+        return payload
+    body_params = _parametri_body(msg.template, msg.parametri)
+    payload.update(type='template', template={
+        'name': msg.template,
+        'language': {'code': settings.META_WHATSAPP_TEMPLATE_LANG},
+        'components': [
+            {'type': 'body', 'parameters': body_params}
+        ] if body_params else [],
+    })
+    return payload
+
+
+def dopo_invio(msg, esito) -> None:
+    """Invio riuscito: per i template salva la bubble nella inbox
+    (i testi liberi li registra la view che risponde)."""
+    if msg.tipo == 'text':
+        logger.info('WhatsApp text inviato to=%s id=%s', msg.numero_e164, esito.wa_message_id)
+        _aggancia_testo_accodato(msg, wa_message_id=esito.wa_message_id)
+        return
+    logger.info('WhatsApp inviato to=%s template=%s', msg.numero_e164, msg.template)
+    # Ricostruisce il corpo "umano" del template con le variabili
+    # sostituite e crea il MessaggioWhatsApp.
+    _log_outgoing_msg(msg.numero_e164, _format_preview(msg.template, msg.parametri),
+                      esito.wa_message_id)
+
+
+def dopo_fallimento(msg, esito) -> None:
+    logger.warning(
+        'WhatsApp send fallito (%s) to=%s template=%s: %s',
+        esito.status or 'rete', msg.numero_e164, msg.template or '-',
+        esito.risposta[:300] or esito.errore,
+    )
+    # 132000 = conteggio parametri sbagliato: spesso il body in
+    # cache (24h) e' di una versione vecchia del template (es.
+    # appena modificato su Meta per aggiungere {{1}}). Butta la
+    # cache cosi' il prossimo tentativo rilegge il template vero.
+    if msg.tipo == 'template' and '132000' in esito.risposta:
+        from apps.core.cache import invalida
+        invalida(f'wa_tpl_body:{msg.template}')
+    if msg.tipo == 'text':
+        _aggancia_testo_accodato(msg, stato='failed')
+
+
+def _aggancia_testo_accodato(msg, **campi) -> None:
+    """Un testo libero finito in coda (invia_subito accodato) e' gia'
+    nella inbox, registrato dalla view senza id Meta: all'esito la
+    bubble prende id o stato 'failed'."""
+    from apps.messaggi.models import MessaggioWhatsApp
+
+    bubble = (MessaggioWhatsApp.objects
+              .filter(conversazione__numero_e164=msg.numero_e164, direzione='out',
+                      corpo=msg.testo, wa_message_id='', stato='sent',
+                      creato_il__gte=msg.creato_il)
+              .order_by('-pk').first())
+    if bubble is None:
+        return
+    for campo, valore in campi.items():
+        setattr(bubble, campo, valore)
+    bubble.save(update_fields=list(campi))
+
+
 def _send_template_blocking(to_e164: str, template_name: str, params: list[str]) -> tuple[bool, str]:
     """Come _send_template_blocking_ex ma senza il motivo di errore
     (firma storica: usata dalle notifiche prenotazioni/auto pronta)."""
@@ -320,12 +409,11 @@ def _send_template_blocking(to_e164: str, template_name: str, params: list[str])
     return ok, wa_id
 
 
-def _send_template_blocking_ex(to_e164: str, template_name: str, params: list[str]) -> tuple[bool, str, str]:
-    """Invio sincrono di un template Meta (chiamato dal thread daemon).
+def _send_template_blocking_ex(to_e164: str, template_name: str, params: list[str],
+                               priorita=None) -> tuple[bool, str, str]:
+    """Invio sincrono di un template Meta (dispatcher.invia_subito).
 
     `params` sono i valori per {{1}}, {{2}}, ... del body template.
-    Tutti i parametri sono stringhe; tronca a 60 char ognuno per
-    rispettare i limiti Meta sul body parameter (1024 totali).
 
     Ritorna `(success, wa_message_id, errore)`. wa_message_id e' l'id
     Meta del messaggio (es. 'wamid.HBg...') utile per agganciarlo lato
@@ -335,76 +423,12 @@ def _send_template_blocking_ex(to_e164: str, template_name: str, params: list[st
     """
     if not settings.WHATSAPP_ENABLED:
         return False, '', 'WhatsApp non configurato (variabili META_* mancanti)'
-    url = (
-        f"{_GRAPH_URL}/{settings.META_WHATSAPP_API_VERSION}"
-        f"/{settings.META_WHATSAPP_PHONE_ID}/messages"
-    )
-    headers = {
-        'Authorization': f'Bearer {settings.META_WHATSAPP_ACCESS_TOKEN}',
-        'Content-Type': 'application/json',
-    }
-    # Test mode: skippa i parametri body per compatibilita' con template
-    # Meta pre-approvati senza variabili (es. hello_world). Vedi
-    # settings.META_WA_OMIT_BODY_PARAMS.
-    if settings.META_WA_OMIT_BODY_PARAMS:
-        body_params = []
-    else:
-        # Adatta i parametri alle variabili REALI del template: Meta
-        # rifiuta l'invio se il conteggio non corrisponde. Cosi' un
-        # template senza variabili (o con la sola {{1}} nome) funziona
-        # anche se il chiamante passa piu' parametri (es. il richiamo
-        # automatico ne passa sempre 2: nome e giorni dall'ultimo).
-        params_effettivi = list(params)
-        n_var = _conta_variabili_template(template_name)
-        if n_var is not None and len(params_effettivi) > n_var:
-            params_effettivi = params_effettivi[:n_var]
-        body_params = [
-            {'type': 'text', 'text': (str(p) if p is not None else '')[:60]}
-            for p in params_effettivi
-        ]
-    payload = {
-        'messaging_product': 'whatsapp',
-        'to': to_e164.lstrip('+'),  # Meta vuole solo cifre, no +
-        'type': 'template',
-        'template': {
-            'name': template_name,
-            'language': {'code': settings.META_WHATSAPP_TEMPLATE_LANG},
-            'components': [
-                {'type': 'body', 'parameters': body_params}
-            ] if body_params else [],
-        },
-    }
-    try:
-        r = requests.post(url, json=payload, headers=headers, timeout=_REQUEST_TIMEOUT)
-        if r.status_code >= 400:
-            logger.warning(
-                'WhatsApp send fallito (%s) to=%s template=%s: %s',
-                r.status_code, to_e164, template_name, r.text[:300],
-            )
-            # 132000 = conteggio parametri sbagliato: spesso il body in
-            # cache (24h) e' di una versione vecchia del template (es.
-            # appena modificato su Meta per aggiungere {{1}}). Butta la
-            # cache cosi' il prossimo tentativo rilegge il template vero.
-            if '132000' in r.text:
-                from django.core.cache import cache as _cache
-                _cache.delete(f'wa_tpl_body:{template_name}')
-            return False, '', _errore_meta_leggibile(r.text)
-        logger.info('WhatsApp inviato to=%s template=%s', to_e164, template_name)
-        # Salva nel storico inbox: ricostruisce il corpo "umano" del
-        # template con le variabili sostituite e crea il MessaggioWhatsApp.
-        wa_id = ''
-        try:
-            wa_id = r.json()['messages'][0]['id']
-        except (KeyError, IndexError, TypeError, ValueError):
-            pass
-        _log_outgoing_msg(to_e164, _format_preview(template_name, params), wa_id)
-        return True, wa_id, ''
-    except requests.RequestException as e:
-        logger.warning(
-            'WhatsApp request error to=%s template=%s: %s',
-            to_e164, template_name, e,
-        )
-        return False, '', f'errore di rete verso Meta: {str(e)[:120]}'
+    esito = dispatcher().invia_subito(
+        to_e164, template=template_name, parametri=params, priorita=priorita)
+    if esito.accodato:
+        # Partira' dalla coda: la bubble la salva il dispatcher all'invio
+        return True, '', ''
+    return esito.ok, esito.wa_message_id, esito.errore
 
 
 def _send_text_blocking(to_e164: str, text: str) -> tuple[bool, str]:
@@ -415,62 +439,36 @@ def _send_text_blocking(to_e164: str, text: str) -> tuple[bool, str]:
     "re-engagement required" (132047) e bisogna usare un template.
 
     Usato dalla view di risposta nell'inbox: vogliamo riportare in UI
-    l'esito immediatamente, quindi semantica sincrona (no thread).
+    l'esito immediatamente, quindi semantica sincrona.
 
     Ritorna `(success, wa_message_id_o_errore)`:
-    - successo: True, id messaggio Meta (es. "wamid.HBg...")
+    - successo: True, id messaggio Meta (es. "wamid.HBg...");
+    - accodato (rate limit o errore ritentabile): True, '' (la bubble
+      registrata dal chiamante prende l'id quando parte);
     - fallimento: False, descrizione errore (es. "400 132047 ...")
     """
     if not settings.WHATSAPP_ENABLED:
         return False, 'WHATSAPP_ENABLED=False'
-    url = (
-        f"{_GRAPH_URL}/{settings.META_WHATSAPP_API_VERSION}"
-        f"/{settings.META_WHATSAPP_PHONE_ID}/messages"
-    )
-    headers = {
-        'Authorization': f'Bearer {settings.META_WHATSAPP_ACCESS_TOKEN}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        'messaging_product': 'whatsapp',
-        'to': to_e164.lstrip('+'),
-        'type': 'text',
-        'text': {'body': (text or '')[:4096]},
-    }
-    try:
-        r = requests.post(url, json=payload, headers=headers, timeout=_REQUEST_TIMEOUT)
-        if r.status_code >= 400:
-            logger.warning(
-                'WhatsApp text fallito (%s) to=%s: %s',
-                r.status_code, to_e164, r.text[:300],
-            )
-            return False, f'HTTP {r.status_code}: {r.text[:200]}'
-        data = r.json()
-        wa_id = ''
-        try:
-            wa_id = data['messages'][0]['id']
-        except (KeyError, IndexError, TypeError):
-            pass
-        logger.info('WhatsApp text inviato to=%s id=%s', to_e164, wa_id)
-        return True, wa_id
-    except requests.RequestException as e:
-        logger.warning('WhatsApp text request error to=%s: %s', to_e164, e)
-        return False, str(e)
+    esito = dispatcher().invia_subito(to_e164, tipo='text', testo=text)
+    if esito.accodato:
+        return True, ''
+    if esito.ok:
+        return True, esito.wa_message_id
+    if esito.status:
+        return False, f'HTTP {esito.status}: {esito.risposta[:200]}'
+    return False, esito.errore
 
 
 def _send_template(to_e164: str, template_name: str, params: list[str]) -> bool:
-    """Fire-and-forget: avvia thread daemon e ritorna subito True.
+    """Fire-and-forget: mette il template nell'outbox e ritorna subito.
 
-    True == thread avviato. La response di Meta arriva nel log; non
-    aspettiamo qui per non bloccare la view HTTP. Se vuoi semantica
-    sync usa direttamente `_send_template_blocking`.
+    True == messaggio accodato (i worker del dispatcher lo mandano,
+    con retry). False se WhatsApp non e' configurato: il chiamante cade
+    sull'email. Se vuoi semantica sync usa `_send_template_blocking`.
     """
-    thread = threading.Thread(
-        target=_send_template_blocking,
-        args=(to_e164, template_name, params),
-        daemon=True,
-    )
-    thread.start()
+    if not settings.WHATSAPP_ENABLED:
+        return False
+    accoda(to_e164, template_name, params)
     return True
 
 
@@ -573,13 +571,11 @@ def whatsapp_prenotazione_promemoria(prenotazione) -> bool:
     nome = _nome_cliente(prenotazione)
     _data, ora = _data_ora(prenotazione)
     # Chiamato dal management command `invia_promemoria_prenotazioni`
-    # (cron service): NON usare fire-and-forget, perche' il processo
-    # Python termina appena il command finisce e i thread daemon
-    # vengono killati prima di salvare il messaggio in inbox (Meta
-    # riceve, il cliente ottiene il template, ma la bubble outgoing
-    # non compare in /messaggi/). Usiamo la versione blocking che
-    # attende la response di Meta e poi chiama _log_outgoing_msg in
-    # modo sincrono.
+    # (cron service): versione blocking, un solo tentativo tramite il
+    # dispatcher, cosi' la bubble outgoing e' gia' in /messaggi/ quando
+    # il comando finisce. Se il messaggio non puo' partire subito resta
+    # nell'outbox su DB e lo manda il servizio dispatcher: la fine del
+    # processo non lo perde (come succedeva coi vecchi thread daemon).
     ok, _wa_id = _send_template_blocking(
         to,
         settings.META_WA_TEMPLATE_PROMEMORIA,
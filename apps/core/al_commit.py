@@ -0,0 +1,57 @@
+"""Lavoro da fare una volta sola al commit, per chiave.
+
+Prima i signal che volevano ricalcolare/pubblicare qualcosa al commit
+registravano un on_commit a ogni save: un ordine con N item e un
+pagamento pubblicava N+2 delta uguali, e per evitarlo cq scorreva la
+coda on_commit privata della connessione.
+
+Qui ogni CodaAlCommit tiene un insieme di chiavi in attesa per thread
+e alias DB (le connessioni Django sono per thread). aggiungi() mette la
+chiave nell'insieme e registra un callback leggero; il primo callback
+che parte al commit svuota l'insieme e chiama `elabora` una volta con
+tutte le chiavi, gli altri lo trovano vuoto e non fanno niente.
+
+Un callback per aggiunta (e non uno solo per transazione) perche' Django
+scarta in silenzio quelli di un savepoint o di una transazione
+annullati: con un solo callback le chiavi resterebbero nell'insieme
+senza piu' nessuno che le elabori. Una chiave rimasta da un rollback
+parte col commit successivo: chi elabora rilegge lo stato dal DB.
+"""
+import logging
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class CodaAlCommit:
+    def __init__(self, elabora, nome: str = ''):
+        """`elabora(chiavi)` riceve la lista delle chiavi in attesa."""
+        self.elabora = elabora
+        self.nome = nome or getattr(elabora, '__qualname__', 'coda')
+        self._locale = threading.local()
+
+    def _pendenti(self, alias) -> set:
+        per_alias = getattr(self._locale, 'per_alias', None)
+        if per_alias is None:
+            per_alias = self._locale.per_alias = {}
+        return per_alias.setdefault(alias, set())
+
+    def aggiungi(self, *chiavi, using=None):
+        alias = using or DEFAULT_DB_ALIAS
+        self._pendenti(alias).update(chiavi)
+        transaction.on_commit(lambda: self.svuota(alias), using=alias)
+
+    def svuota(self, alias=DEFAULT_DB_ALIAS):
+        pendenti = self._pendenti(alias)
+        if not pendenti:
+            return
+        chiavi = sorted(pendenti)
+        pendenti.clear()
+        try:
+            self.elabora(chiavi)
+        except Exception:
+            # Il commit e' gia' avvenuto: non si fa fallire la view
+            logger.exception('%s: elaborazione al commit fallita per %s',
+                             self.nome, chiavi)
@@ -0,0 +1,240 @@
+"""Cache condivisa tra i processi (worker Daphne, cron, mqtt_listener).
+
+settings.CACHES punta a Redis (lo stesso REDIS_URL dei channels) o,
+senza Redis, a una cache su file nella cartella del progetto: in
+entrambi i casi un valore scritto da un processo e' visto da tutti, e
+una chiave invalidata sparisce ovunque (con la LocMemCache di default
+ogni processo ricalcolava per conto suo e un delete valeva solo li').
+
+Le chiamate passano da qui invece che da django.core.cache per:
+- contatori hit/miss per prefisso di chiave (la parte prima dei ':'),
+  accumulati in memoria e riversati nella cache ogni FLUSH_SEC, cosi'
+  statistiche() vede il totale di tutti i processi;
+- degradare senza errori se Redis non risponde: la lettura torna un
+  miss, la scrittura viene saltata, e il chiamante ricalcola.
+
+add e incr sono atomici tra processi solo su Redis: sulla cache su
+file sono una lettura seguita da una scrittura. aggiungi() va bene per
+i token di versione (due processi che scrivono insieme costano al
+peggio un ricalcolo in piu'), non come lock. incrementa(), che deve
+dare valori mai ripetuti, senza Redis passa da una riga
+ContatoreCondiviso nel DB (e valore_contatore() la legge).
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SEC = 30
+_PREFISSO_STATS = 'cache_stats'
+_VOCI = ('hit', 'miss', 'errori')
+_MANCANTE = object()
+
+_lock = threading.Lock()
+_contatori = defaultdict(lambda: dict.fromkeys(_VOCI, 0))
+_ultimo_flush = time.monotonic()
+
+
+def prefisso_di(chiave: str) -> str:
+    return chiave.split(':', 1)[0]
+
+
+def _conta(chiave, voce):
+    with _lock:
+        _contatori[prefisso_di(chiave)][voce] += 1
+        scaduto = time.monotonic() - _ultimo_flush > FLUSH_SEC
+    if scaduto:
+        flush_statistiche()
+
+
+def flush_statistiche():
+    """Riversa i contatori locali nella cache condivisa."""
+    global _ultimo_flush
+    with _lock:
+        locali = {p: dict(v) for p, v in _contatori.items()}
+        _contatori.clear()
+        _ultimo_flush = time.monotonic()
+    if not locali:
+        return
+    try:
+        prefissi = set(cache.get(f'{_PREFISSO_STATS}:prefissi') or ())
+        for prefisso, voci in locali.items():
+            for voce, n in voci.items():
+                if not n:
+                    continue
+                chiave = f'{_PREFISSO_STATS}:{prefisso}:{voce}'
+                if not cache.add(chiave, n, None):
+                    cache.incr(chiave, n)
+        if not set(locali) <= prefissi:
+            cache.set(f'{_PREFISSO_STATS}:prefissi', prefissi | set(locali), None)
+    except Exception as e:
+        logger.warning('Flush statistiche cache fallito: %s', e)
+
+
+def statistiche() -> dict:
+    """{prefisso: {'hit', 'miss', 'errori', 'hit_rate'}} di tutti i processi."""
+    flush_statistiche()
+    out = {}
+    try:
+        prefissi = sorted(cache.get(f'{_PREFISSO_STATS}:prefissi') or ())
+        chiavi = [f'{_PREFISSO_STATS}:{p}:{v}' for p in prefissi for v in _VOCI]
+        valori = cache.get_many(chiavi)
+    except Exception as e:
+        logger.warning('Lettura statistiche cache fallita: %s', e)
+        return out
+    for prefisso in prefissi:
+        voci = {v: valori.get(f'{_PREFISSO_STATS}:{prefisso}:{v}', 0) for v in _VOCI}
+        letture = voci['hit'] + voci['miss']
+        voci['hit_rate'] = round(voci['hit'] / letture, 3) if letture else None
+        out[prefisso] = voci
+    return out
+
+
+def azzera_statistiche():
+    with _lock:
+        _contatori.clear()
+    try:
+        prefissi = cache.get(f'{_PREFISSO_STATS}:prefissi') or ()
+        cache.delete_many([f'{_PREFISSO_STATS}:{p}:{v}'
+                           for p in prefissi for v in _VOCI])
+        cache.delete(f'{_PREFISSO_STATS}:prefissi')
+    except Exception as e:
+        logger.warning('Azzeramento statistiche cache fallito: %s', e)
+
+
+def leggi(chiave: str, default=None):
+    """cache.get con conteggio hit/miss. Errore backend = miss."""
+    try:
+        valore = cache.get(chiave, _MANCANTE)
+    except Exception as e:
+        logger.warning('Cache get %s fallita: %s', chiave, e)
+        _conta(chiave, 'errori')
+        return default
+    if valore is _MANCANTE:
+        _conta(chiave, 'miss')
+        return default
+    _conta(chiave, 'hit')
+    return valore
+
+
+def scrivi(chiave: str, valore, timeout=None):
+    """cache.set; timeout None = senza scadenza (come Django)."""
+    try:
+        cache.set(chiave, valore, timeout)
+    except Exception as e:
+        logger.warning('Cache set %s fallita: %s', chiave, e)
+        _conta(chiave, 'errori')
+
+
+def aggiungi(chiave: str, valore, timeout=None) -> bool:
+    """cache.add: scrive solo se la chiave non esiste. Atomico tra
+    processi solo su Redis (vedi sopra): non usarlo come lock."""
+    try:
+        return cache.add(chiave, valore, timeout)
+    except Exception as e:
+        logger.warning('Cache add %s fallita: %s', chiave, e)
+        _conta(chiave, 'errori')
+        return False
+
+
+def invalida(*chiavi: str):
+    """Cancella le chiavi per tutti i processi."""
+    try:
+        cache.delete_many(chiavi)
+    except Exception as e:
+        logger.warning('Cache delete %s fallita: %s', chiavi, e)
+        for chiave in chiavi:
+            _conta(chiave, 'errori')
+
+
+def leggi_molti(chiavi) -> dict:
+    """cache.get_many: {chiave: valore} delle sole chiavi presenti."""
+    chiavi = list(chiavi)
+    try:
+        valori = cache.get_many(chiavi)
+    except Exception as e:
+        logger.warning('Cache get_many (%s chiavi) fallita: %s', len(chiavi), e)
+        for chiave in chiavi:
+            _conta(chiave, 'errori')
+        return {}
+    for chiave in chiavi:
+        _conta(chiave, 'hit' if chiave in valori else 'miss')
+    return valori
+
+
+def condivisa_atomica() -> bool:
+    """True se add/incr del backend sono atomici tra processi (Redis)."""
+    from django.core.cache.backends.redis import RedisCache
+    return isinstance(cache, RedisCache) or isinstance(
+        getattr(cache, '_wrapped', None), RedisCache)
+
+
+def _incrementa_db(chiave: str):
+    from .models import ContatoreCondiviso
+
+    if (connection.vendor in ('postgresql', 'sqlite')
+            and connection.features.can_return_columns_from_insert):
+        tabella = connection.ops.quote_name(ContatoreCondiviso._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {tabella} SET valore = valore + 1 '
+                f'WHERE chiave = %s RETURNING valore', [chiave])
+            riga = cursor.fetchone()
+        return riga[0] if riga else None
+    contatore = ContatoreCondiviso.objects.filter(chiave=chiave)
+    if not contatore.update(valore=F('valore') + 1):
+        return None
+    return contatore.values_list('valore', flat=True).get()
+
+
+def _contatore_db(chiave: str, iniziale: int):
+    from .models import ContatoreCondiviso
+
+    # savepoint: un errore non rovina la transazione del chiamante
+    with transaction.atomic():
+        valore = _incrementa_db(chiave)
+        if valore is None:
+            ContatoreCondiviso.objects.bulk_create(
+                [ContatoreCondiviso(chiave=chiave, valore=iniziale - 1)],
+                ignore_conflicts=True)
+            valore = _incrementa_db(chiave)
+    return valore
+
+
+def incrementa(chiave: str, iniziale: int = 1):
+    """Contatore atomico condiviso: +1, oppure `iniziale` se la chiave
+    non esiste. INCR su Redis, senza Redis una riga ContatoreCondiviso.
+    None se il backend non risponde."""
+    try:
+        if not condivisa_atomica():
+            return _contatore_db(chiave, iniziale)
+        if cache.add(chiave, iniziale, None):
+            return iniziale
+        return cache.incr(chiave)
+    except ValueError:
+        # sparita tra add e incr (eviction): si riparte
+        return incrementa(chiave, iniziale)
+    except Exception as e:
+        logger.warning('Cache incr %s fallita: %s', chiave, e)
+        _conta(chiave, 'errori')
+        return None
+
+
+def valore_contatore(chiave: str, default=None):
+    """Ultimo valore dato da incrementa() (default se mai incrementato)."""
+    if condivisa_atomica():
+        return leggi(chiave, default)
+    from .models import ContatoreCondiviso
+    try:
+        valore = ContatoreCondiviso.objects.filter(chiave=chiave).values_list(
+            'valore', flat=True).first()
+    except Exception as e:
+        logger.warning('Lettura contatore %s fallita: %s', chiave, e)
+        return default
+    return default if valore is None else valore
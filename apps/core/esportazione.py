@@ -0,0 +1,143 @@
+"""Export CSV/XLSX in streaming, condiviso dalle view di export.
+
+Prima ogni export (clienti, campagne e segmenti marketing, analytics
+CQ) scriveva tutte le righe in un HttpResponse: l'intero file stava in
+memoria prima del primo byte, e analytics CQ si fermava a 5000 righe
+per non esplodere.
+
+Qui un export e' intestazione + un iterabile di righe (liste di
+valori), consumato solo mentre il client scarica:
+
+- CSV: StreamingHttpResponse su un generatore che scrive una riga alla
+  volta (csv.writer su un buffer "eco" che ritorna la riga invece di
+  accumularla); BOM iniziale per Excel dove serve;
+- XLSX: openpyxl in modalita' write-only, che scrive le righe del
+  foglio su un file temporaneo invece di tenere le celle in memoria
+  (restano solo le stringhe distinte, nella shared strings table); il
+  file finito parte a blocchi da BLOCCO_XLSX. Il lavoro comincia solo
+  quando il server inizia a servire la risposta, ma il primo byte
+  arriva a foglio finito: per export enormi il CSV resta il formato
+  giusto.
+
+Il server e' Daphne (ASGI): Django 4.2 servirebbe un generatore sync
+con sync_to_async(list), cioe' tutto il file in memoria prima del primo
+byte (e un warning a ogni export). RispostaInStreaming lo legge invece
+a blocchi di BLOCCO_ASGI byte, un sync_to_async per blocco; sotto WSGI
+(e col Client dei test) resta l'iterazione sync normale.
+
+Le righe da queryset vanno prese con righe_da_queryset() (iterator()
+a chunk, niente cache del queryset). esporta() sceglie il formato dal
+parametro ?formato=csv|xlsx della richiesta.
+"""
+import csv
+import tempfile
+
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse
+
+CHUNK_QUERYSET = 2000
+BLOCCO_XLSX = 64 * 1024
+BLOCCO_ASGI = 64 * 1024
+FORMATI = ('csv', 'xlsx')
+TIPO_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class _Eco:
+    """Pseudo-file per csv.writer: write() ritorna la riga scritta."""
+
+    def write(self, valore):
+        return valore
+
+
+def _prossimo_blocco(parti) -> bytes:
+    """Parti (bytes) dall'iteratore fino a BLOCCO_ASGI byte; b'' alla fine."""
+    blocco, dimensione = [], 0
+    for parte in parti:
+        blocco.append(parte)
+        dimensione += len(parte)
+        if dimensione >= BLOCCO_ASGI:
+            break
+    return b''.join(blocco)
+
+
+class RispostaInStreaming(StreamingHttpResponse):
+    """StreamingHttpResponse su un generatore sync che sotto ASGI parte
+    a blocchi invece di essere letto tutto con sync_to_async(list)."""
+
+    async def __aiter__(self):
+        if self.is_async:
+            async for parte in super().__aiter__():
+                yield parte
+            return
+        parti = self.streaming_content
+        # thread_sensitive (il default): il generatore, e il cursore del
+        # queryset dietro, restano sempre sullo stesso thread
+        prossimo = sync_to_async(_prossimo_blocco)
+        while True:
+            blocco = await prossimo(parti)
+            if not blocco:
+                return
+            yield blocco
+
+
+def righe_da_queryset(qs, riga, chunk_size: int = CHUNK_QUERYSET):
+    """riga(obj) per ogni oggetto di `qs`, letto a chunk con iterator()."""
+    for obj in qs.iterator(chunk_size=chunk_size):
+        yield riga(obj)
+
+
+def righe_csv(intestazione, righe, delimiter=';', bom=True):
+    """Le righe del CSV come stringhe, una alla volta."""
+    writer = csv.writer(_Eco(), delimiter=delimiter)
+    if bom:
+        yield '\ufeff'
+    yield writer.writerow(intestazione)
+    for riga in righe:
+        yield writer.writerow(riga)
+
+
+def blocchi_xlsx(intestazione, righe, foglio: str = 'Export'):
+    """Il file XLSX a blocchi di bytes (openpyxl write-only)."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=foglio[:31])
+    ws.append(list(intestazione))
+    for riga in righe:
+        ws.append(list(riga))
+    with tempfile.TemporaryFile() as f:
+        wb.save(f)
+        f.seek(0)
+        while True:
+            blocco = f.read(BLOCCO_XLSX)
+            if not blocco:
+                break
+            yield blocco
+
+
+def risposta_csv(nome_file: str, intestazione, righe, delimiter=';', bom=True):
+    response = RispostaInStreaming(righe_csv(intestazione, righe, delimiter, bom),
+                                     content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{nome_file}.csv"'
+    return response
+
+
+def risposta_xlsx(nome_file: str, intestazione, righe, foglio: str = 'Export'):
+    response = RispostaInStreaming(blocchi_xlsx(intestazione, righe, foglio),
+                                     content_type=TIPO_XLSX)
+    response['Content-Disposition'] = f'attachment; filename="{nome_file}.xlsx"'
+    return response
+
+
+def formato_richiesto(request, default: str = 'csv') -> str:
+    formato = (request.GET.get('formato') or default).lower()
+    return formato if formato in FORMATI else default
+
+
+def esporta(request, nome_file: str, intestazione, righe, delimiter=';', bom=True,
+            foglio: str = 'Export'):
+    """Risposta in streaming nel formato chiesto (?formato=csv|xlsx).
+    `nome_file` senza estensione; delimiter/bom valgono per il CSV."""
+    if formato_richiesto(request) == 'xlsx':
+        return risposta_xlsx(nome_file, intestazione, righe, foglio)
+    return risposta_csv(nome_file, intestazione, righe, delimiter, bom)
@@ -0,0 +1,33 @@
+"""Hit/miss della cache condivisa per prefisso di chiave (tutti i processi).
+
+Uso:
+    python manage.py statistiche_cache
+    python manage.py statistiche_cache --azzera
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.core import cache as cache_condivisa
+
+
+class Command(BaseCommand):
+    help = 'Mostra i contatori hit/miss della cache condivisa per prefisso.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--azzera', action='store_true',
+                            help='Azzera i contatori dopo averli mostrati.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Backend: {settings.CACHES['default']['BACKEND']}")
+        stats = cache_condivisa.statistiche()
+        if not stats:
+            self.stdout.write('Nessuna lettura registrata.')
+        for prefisso, voci in stats.items():
+            rate = (f"{voci['hit_rate']:.0%}" if voci['hit_rate'] is not None
+                    else '-')
+            self.stdout.write(
+                f"{prefisso:<30} hit {voci['hit']:>7}  miss {voci['miss']:>7}  "
+                f"errori {voci['errori']:>5}  hit rate {rate}")
+        if options['azzera']:
+            cache_condivisa.azzera_statistiche()
+            self.stdout.write(self.style.SUCCESS('Contatori azzerati.'))
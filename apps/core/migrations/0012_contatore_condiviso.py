@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_servizio_ordine_gruppo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContatoreCondiviso',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chiave', models.CharField(max_length=150, unique=True)),
+                ('valore', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Contatore condiviso',
+                'verbose_name_plural': 'Contatori condivisi',
+            },
+        ),
+    ]
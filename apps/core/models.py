@@ -316,4 +316,22 @@ class MovimentoScorte(models.Model):
         verbose_name_plural = "Movimenti Scorte"
     
     def __str__(self):
-        return f"{self.prodotto.titolo} - {self.get_tipo_display()} ({self.quantita})"
\ No newline at end of file
+        return f"{self.prodotto.titolo} - {self.get_tipo_display()} ({self.quantita})"
+
+class ContatoreCondiviso(models.Model):
+    """Contatore tra processi quando la cache non e' Redis.
+
+    Su cache su file add/incr non sono atomici tra processi: per i
+    contatori che non devono mai dare due volte lo stesso valore (es. la
+    seq del flusso ordini) apps.core.cache.incrementa usa questa riga,
+    con un UPDATE atomico come apps.ordini.numerazione.
+    """
+    chiave = models.CharField(max_length=150, unique=True)
+    valore = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Contatore condiviso'
+        verbose_name_plural = 'Contatori condivisi'
+
+    def __str__(self):
+        return f"{self.chiave}: {self.valore}"
@@ -0,0 +1,178 @@
+"""Test del motore di export in streaming (esportazione.py): 200k righe
+CSV sintetiche sotto un tetto di memoria fisso (scaricate con async for,
+come fa Daphne), XLSX valido, export clienti. Test del wrapper della
+cache condivisa (cache.py): contatori, backend che non risponde,
+contatore su DB senza Redis.
+
+Esecuzione: python manage.py test apps.core
+"""
+import io
+import tracemalloc
+import warnings
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from apps.clienti.models import Cliente
+
+from . import cache as cache_condivisa
+from . import esportazione
+from .models import ContatoreCondiviso
+
+N_RIGHE = 200_000
+# Il file CSV completo e' ~15 MB: se finisse tutto in memoria il picco
+# sarebbe sopra. openpyxl da solo (import, stili) ne prende ~5.5.
+TETTO_MEMORIA = 8 * 1024 * 1024
+INTESTAZIONE = ['Id', 'Nome', 'Email', 'Telefono', 'Importo']
+
+
+def _righe(n=N_RIGHE):
+    for i in range(n):
+        yield [i, f'Cliente {i}', f'cliente{i}@example.com', f'333{i:07d}', f'{i % 997}.50']
+
+
+async def _scarica(response):
+    # come ASGIHandler.send_response di Daphne: async for sulla risposta
+    totale = 0
+    async for blocco in response:
+        totale += len(blocco)
+    return totale
+
+
+def _consuma(response):
+    """Scarica la risposta come fa Daphne: byte totali e picco di
+    memoria allocata nel frattempo (niente warning sync -> async)."""
+    tracemalloc.start()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            totale = async_to_sync(_scarica)(response)
+        _, picco = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return totale, picco
+
+
+class EsportazioneTest(TestCase):
+    def test_csv_200k_righe_sotto_tetto(self):
+        response = esportazione.risposta_csv('prova', INTESTAZIONE, _righe())
+        self.assertIsInstance(response, StreamingHttpResponse)
+        totale, picco = _consuma(response)
+        self.assertGreater(totale, 10 * 1024 * 1024)
+        self.assertLess(picco, TETTO_MEMORIA)
+
+    def test_csv_sync_uguale_ad_asgi(self):
+        # sotto WSGI (e col Client dei test) l'iterazione resta sync
+        sync = b''.join(esportazione.risposta_csv('prova', INTESTAZIONE, _righe(5000)))
+        asgi = []
+
+        async def raccogli(response):
+            async for blocco in response:
+                asgi.append(blocco)
+
+        async_to_sync(raccogli)(esportazione.risposta_csv('prova', INTESTAZIONE, _righe(5000)))
+        self.assertEqual(b''.join(asgi), sync)
+        self.assertGreater(len(asgi), 1)
+
+    def test_xlsx_sotto_tetto(self):
+        # openpyxl e' ~10 volte piu' lento del csv: bastano 20k righe
+        # (le stringhe distinte restano comunque nella shared strings table)
+        response = esportazione.risposta_xlsx('prova', INTESTAZIONE, _righe(20_000))
+        totale, picco = _consuma(response)
+        self.assertGreater(totale, 0)
+        self.assertLess(picco, TETTO_MEMORIA)
+
+    def test_xlsx_valido(self):
+        from openpyxl import load_workbook
+
+        request = RequestFactory().get('/', {'formato': 'xlsx'})
+        response = esportazione.esporta(request, 'prova', INTESTAZIONE, _righe(10),
+                                        foglio='Clienti')
+        self.assertEqual(response['Content-Type'], esportazione.TIPO_XLSX)
+        self.assertIn('prova.xlsx', response['Content-Disposition'])
+        wb = load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+        righe = list(wb['Clienti'].values)
+        self.assertEqual(list(righe[0]), INTESTAZIONE)
+        self.assertEqual(len(righe), 11)
+        self.assertEqual(righe[3][1], 'Cliente 2')
+
+    def test_csv_bom_e_delimitatore(self):
+        request = RequestFactory().get('/', {'formato': 'sconosciuto'})
+        response = esportazione.esporta(request, 'prova', ['a', 'b'], [[1, 'x;y']])
+        testo = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(testo, '﻿a;b\r\n1;"x;y"\r\n')
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ExportClientiTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('export', is_staff=True))
+        Cliente.objects.bulk_create([
+            Cliente(tipo='privato', nome=f'Cliente {i}', telefono=f'333{i:07d}')
+            for i in range(30)
+        ])
+
+    def test_export_clienti_in_streaming(self):
+        response = self.client.get(reverse('clienti:export-clienti-csv'))
+        self.assertTrue(response.streaming)
+        righe = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(righe), 31)
+
+    def test_export_clienti_xlsx(self):
+        response = self.client.get(reverse('clienti:export-clienti-csv'), {'formato': 'xlsx'})
+        self.assertEqual(response['Content-Type'], esportazione.TIPO_XLSX)
+
+
+class CacheCondivisaTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache_condivisa.azzera_statistiche()
+
+    def test_hit_miss_per_prefisso(self):
+        cache_condivisa.scrivi('meteo:oggi', {'t': 20})
+        self.assertEqual(cache_condivisa.leggi('meteo:oggi'), {'t': 20})
+        self.assertEqual(cache_condivisa.leggi('meteo:domani', 'x'), 'x')
+        voci = cache_condivisa.statistiche()['meteo']
+        self.assertEqual((voci['hit'], voci['miss'], voci['errori']), (1, 1, 0))
+        self.assertEqual(voci['hit_rate'], 0.5)
+
+    def test_backend_che_non_risponde_degrada(self):
+        errore = ConnectionError('redis giu')
+        # niente flush a meta' test: fallirebbe anche lui
+        with mock.patch.object(cache_condivisa, 'FLUSH_SEC', 10 ** 6), \
+                mock.patch.object(cache, 'get', side_effect=errore), \
+                mock.patch.object(cache, 'set', side_effect=errore), \
+                mock.patch.object(cache, 'add', side_effect=errore), \
+                mock.patch.object(cache, 'delete_many', side_effect=errore), \
+                mock.patch.object(cache, 'get_many', side_effect=errore):
+            self.assertEqual(cache_condivisa.leggi('meteo:oggi', 'default'), 'default')
+            cache_condivisa.scrivi('meteo:oggi', 1)
+            self.assertFalse(cache_condivisa.aggiungi('meteo:oggi', 1))
+            cache_condivisa.invalida('meteo:oggi')
+            self.assertEqual(cache_condivisa.leggi_molti(['meteo:oggi']), {})
+        self.assertEqual(cache_condivisa.statistiche()['meteo']['errori'], 5)
+
+    def test_incrementa_senza_redis_usa_il_db(self):
+        self.assertFalse(cache_condivisa.condivisa_atomica())
+        self.assertIsNone(cache_condivisa.valore_contatore('seq:prova'))
+        self.assertEqual(cache_condivisa.incrementa('seq:prova', iniziale=100), 100)
+        self.assertEqual(cache_condivisa.incrementa('seq:prova', iniziale=100), 101)
+        self.assertEqual(ContatoreCondiviso.objects.get(chiave='seq:prova').valore, 101)
+        self.assertEqual(cache_condivisa.valore_contatore('seq:prova'), 101)
+        # la cache non c'entra: svuotarla non fa ripartire il contatore
+        cache.clear()
+        self.assertEqual(cache_condivisa.incrementa('seq:prova', iniziale=100), 102)
+
+    def test_incrementa_con_redis_usa_la_cache(self):
+        with mock.patch.object(cache_condivisa, 'condivisa_atomica', return_value=True):
+            self.assertEqual(cache_condivisa.incrementa('seq:prova', iniziale=5), 5)
+            self.assertEqual(cache_condivisa.incrementa('seq:prova', iniziale=5), 6)
+            self.assertEqual(cache_condivisa.valore_contatore('seq:prova'), 6)
+            with mock.patch.object(cache, 'add', side_effect=ConnectionError('giu')):
+                self.assertIsNone(cache_condivisa.incrementa('seq:prova'))
+        self.assertFalse(ContatoreCondiviso.objects.exists())
@@ -0,0 +1,239 @@
+"""Motore SQL della dashboard analytics CQ (/cq/analytics/).
+
+Prima analytics_cq caricava tutti i DifettoCQ e le SegnalazioneDifetto
+del periodo (e del periodo precedente) come istanze con ordine, cliente
+e operatore, li filtrava con list comprehension e contava KPI, Pareto,
+trend e heatmap in Python: un anno di range erano decine di migliaia di
+oggetti per ogni apertura della pagina.
+
+Qui le due fonti diventano un'unica "vista" SQL:
+
+- vista() e' la UNION ALL di due values() queryset, uno per fonte, con
+  le stesse colonne normalizzate (COLONNE). Periodo e filtri
+  (postazione, gravita', operatore, categoria, sorgente) sono gia' nei
+  WHERE di ogni ramo, il filtro sorgente toglie proprio il ramo;
+- gli aggregati (totali, Pareto, zone, postazioni, trend, heatmap,
+  ricorrenti, operatori) sono GROUP BY sulla vista: poche righe
+  tornano in Python, mai i difetti;
+- la tabella di dettaglio e l'export CSV usano la stessa vista
+  ordinata: la pagina e' un LIMIT/OFFSET, il CSV scorre con iterator()
+  e ordini/operatori arrivano a blocchi (in_bulk) per ogni chunk.
+
+Giorno, ora e giorno della settimana sono calcolati nel DB nel fuso
+corrente (TruncDate/ExtractHour), come faceva la view con localtime.
+"""
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Case, CharField, F, IntegerField, Value, When
+from django.db.models.functions import ExtractHour, ExtractIsoWeekDay, TruncDate
+from django.utils import timezone
+
+from .models import DifettoCQ, TipoDifettoConfig
+
+# Colonne della vista, nello stesso ordine in entrambi i rami. Nei rami
+# hanno il prefisso u_ (le annotazioni non possono avere il nome di un
+# campo del modello, es. zona o data_ora); _sql_vista() lo toglie.
+COLONNE = ('pk', 'data_ora', 'giorno', 'ora', 'giorno_settimana', 'zona', 'tipo',
+           'gravita', 'postazione', 'azione', 'implementata', 'compilatore_id',
+           'ordine_id', 'sorgente')
+CHUNK_EXPORT = 2000
+
+
+@dataclass
+class FiltriDifetti:
+    postazione: str = ''
+    gravita: str = ''
+    operatore_id: int = None
+    categoria_id: str = ''
+    sorgente: str = ''
+
+    @classmethod
+    def da_querystring(cls, get) -> 'FiltriDifetti':
+        try:
+            operatore_id = int(get.get('operatore') or '')
+        except ValueError:
+            operatore_id = None
+        return cls(postazione=get.get('postazione') or '',
+                   gravita=get.get('gravita') or '',
+                   operatore_id=operatore_id,
+                   categoria_id=get.get('categoria_difetto') or '',
+                   sorgente=get.get('sorgente') or '')
+
+
+def _intervallo(data_da, data_a):
+    """[inizio, fine) in datetime aware: usa l'indice su data_ora invece
+    del __date (che converte ogni riga)."""
+    inizio = timezone.make_aware(datetime.combine(data_da, time.min))
+    fine = timezone.make_aware(datetime.combine(data_a + timedelta(days=1), time.min))
+    return inizio, fine
+
+
+def _ramo(qs, campo_data, **espressioni):
+    espressioni.update(
+        pk=F('pk'),
+        data_ora=F(campo_data),
+        giorno=TruncDate(campo_data),
+        ora=ExtractHour(campo_data),
+        giorno_settimana=ExtractIsoWeekDay(campo_data),
+        zona=F('zona'),
+        tipo=F('tipo_difetto'),
+        gravita=F('gravita'),
+    )
+    alias = {f'u_{c}': espressioni[c] for c in COLONNE}
+    return qs.order_by().annotate(**alias).values(*alias)
+
+
+def _ramo_schede(inizio, fine, filtri):
+    qs = DifettoCQ.objects.filter(scheda__data_ora__gte=inizio, scheda__data_ora__lt=fine)
+    if filtri.postazione:
+        qs = qs.filter(postazione_responsabile=filtri.postazione)
+    if filtri.operatore_id is not None:
+        qs = qs.filter(scheda__compilata_da_id=filtri.operatore_id)
+    return _ramo(
+        qs, 'scheda__data_ora',
+        postazione=F('postazione_responsabile'),
+        azione=F('azione_correttiva'),
+        implementata=Case(When(azione_correttiva='sistemato', then=1), default=0,
+                          output_field=IntegerField()),
+        compilatore_id=F('scheda__compilata_da_id'),
+        ordine_id=F('scheda__ordine_id'),
+        sorgente=Value('scheda_cq', output_field=CharField()),
+    )
+
+
+def _ramo_turni(inizio, fine, filtri):
+    from apps.turni.models import SegnalazioneDifetto
+
+    qs = SegnalazioneDifetto.objects.filter(data_ora__gte=inizio, data_ora__lt=fine)
+    if filtri.postazione:
+        qs = qs.filter(postazione_produttore=filtri.postazione)
+    if filtri.operatore_id is not None:
+        qs = qs.filter(operatore_id=filtri.operatore_id)
+    return _ramo(
+        qs, 'data_ora',
+        postazione=F('postazione_produttore'),
+        azione=F('azione'),
+        implementata=Case(When(azione='corretto', then=1), default=0,
+                          output_field=IntegerField()),
+        compilatore_id=F('operatore_id'),
+        ordine_id=F('ordine_id'),
+        sorgente=Value('turno', output_field=CharField()),
+    )
+
+
+def vista(data_da, data_a, filtri: FiltriDifetti):
+    """I difetti delle due fonti nel periodo, filtrati, come UNION ALL di
+    values() (colonne u_*). Un filtro sorgente sconosciuto non esclude
+    niente, come prima."""
+    inizio, fine = _intervallo(data_da, data_a)
+    rami = {'scheda_cq': _ramo_schede, 'turno': _ramo_turni}
+    if filtri.sorgente in rami:
+        rami = {filtri.sorgente: rami[filtri.sorgente]}
+    querysets = []
+    for costruttore in rami.values():
+        qs = costruttore(inizio, fine, filtri)
+        if filtri.gravita:
+            qs = qs.filter(gravita=filtri.gravita)
+        if filtri.categoria_id:
+            qs = qs.filter(tipo_difetto__in=TipoDifettoConfig.objects.filter(
+                categoria_id=filtri.categoria_id, attivo=True).values('codice'))
+        querysets.append(qs)
+    if len(querysets) == 1:
+        return querysets[0]
+    return querysets[0].union(*querysets[1:], all=True)
+
+
+# --- aggregati --------------------------------------------------------
+
+def _sql_vista(qs):
+    sql, params = qs.query.sql_with_params()
+    colonne = ', '.join(f'u_{c} AS {c}' for c in COLONNE)
+    return f'SELECT {colonne} FROM ({sql}) u', params
+
+
+def _aggrega(qs, select: str, resto: str = '') -> list:
+    """SELECT <select> FROM <vista> <resto> (GROUP BY/ORDER BY/LIMIT)."""
+    sql, params = _sql_vista(qs)
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {select} FROM ({sql}) difetti {resto}', params)
+        return cursor.fetchall()
+
+
+def per_sorgente(qs) -> dict:
+    """{sorgente: (difetti, azioni implementate)}."""
+    righe = _aggrega(qs, 'sorgente, COUNT(*), SUM(implementata)', 'GROUP BY sorgente')
+    return {s: (n, int(impl or 0)) for s, n, impl in righe}
+
+
+def conteggi(qs, colonna: str, limite: int = None, escludi_vuoti: bool = False) -> list:
+    """[(valore, n)] per `colonna`, dal piu' frequente."""
+    if colonna not in COLONNE:
+        raise ValueError(f'Colonna sconosciuta: {colonna}')
+    resto = f"WHERE {colonna} <> '' " if escludi_vuoti else ''
+    resto += f'GROUP BY {colonna} ORDER BY COUNT(*) DESC, {colonna}'
+    if limite:
+        resto += f' LIMIT {int(limite)}'
+    return _aggrega(qs, f'{colonna}, COUNT(*)', resto)
+
+
+def per_giorno(qs) -> dict:
+    """{date: n}. Su SQLite TruncDate in SQL grezzo torna una stringa."""
+    righe = _aggrega(qs, 'giorno, COUNT(*)', 'GROUP BY giorno')
+    return {(g if not isinstance(g, str) else datetime.strptime(g[:10], '%Y-%m-%d').date()): n
+            for g, n in righe if g is not None}
+
+
+def heatmap(qs) -> list:
+    """7 x 24 (lunedi' = 0) dei difetti per giorno della settimana e ora."""
+    griglia = [[0] * 24 for _ in range(7)]
+    for gs, ora, n in _aggrega(qs, 'giorno_settimana, ora, COUNT(*)',
+                               'GROUP BY giorno_settimana, ora'):
+        if gs is not None and ora is not None:
+            griglia[int(gs) - 1][int(ora)] += n
+    return griglia
+
+
+def ricorrenti(qs, limite: int = 15) -> list:
+    """[(zona, tipo, postazione, n)] ripetuti almeno due volte."""
+    return _aggrega(qs, 'zona, tipo, postazione, COUNT(*)',
+                    'GROUP BY zona, tipo, postazione HAVING COUNT(*) > 1 '
+                    f'ORDER BY COUNT(*) DESC, zona, tipo, postazione LIMIT {int(limite)}')
+
+
+# --- righe di dettaglio -----------------------------------------------
+
+def ordinata(qs):
+    """La vista dal difetto piu' recente (per tabella ed export)."""
+    return qs.order_by('-u_data_ora', 'u_sorgente', '-u_pk')
+
+
+def con_dettagli(righe) -> list:
+    """Aggiunge 'ordine' e 'compilatore' (oggetti) a un blocco di righe
+    della vista: due query per blocco, qualunque sia la sua lunghezza."""
+    from apps.ordini.models import Ordine
+
+    righe = [{c: r[f'u_{c}'] for c in COLONNE} for r in righe]
+    ordini = Ordine.objects.select_related('cliente').in_bulk(
+        {r['ordine_id'] for r in righe if r['ordine_id']})
+    utenti = User.objects.only('username', 'first_name', 'last_name').in_bulk(
+        {r['compilatore_id'] for r in righe if r['compilatore_id']})
+    for r in righe:
+        r['ordine'] = ordini.get(r['ordine_id'])
+        r['compilatore'] = utenti.get(r['compilatore_id'])
+    return righe
+
+
+def scorri_con_dettagli(qs, chunk_size: int = CHUNK_EXPORT):
+    """Tutte le righe di `qs` (vista ordinata) con i dettagli, a blocchi:
+    in memoria c'e' un chunk alla volta."""
+    blocco = []
+    for riga in qs.iterator(chunk_size=chunk_size):
+        blocco.append(riga)
+        if len(blocco) >= chunk_size:
+            yield from con_dettagli(blocco)
+            blocco = []
+    if blocco:
+        yield from con_dettagli(blocco)
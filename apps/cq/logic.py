@@ -2,8 +2,13 @@
 Logica di calcolo per il sistema premi e sanzioni CQ.
 Implementa le regole della sezione 7.2 del manuale operativo.
 """
+import time
 from decimal import Decimal
 
+from django.db import transaction
+
+from apps.core.al_commit import CodaAlCommit
+
 
 # ---------------------------------------------------------------------------
 # Mappa zone → responsabilità postazioni
@@ -198,129 +203,177 @@ def tipo_rilevatore(rilevato_da: str) -> str:
     return 'interno' if rilevato_da in RILEVATORI_INTERNI else 'esterno'
 
 
-def calcola_e_assegna_punteggi(scheda):
+# Campi di un PunteggioCQ che il ricalcolo puo' cambiare senza ricrearlo
+CAMPI_AGGIORNABILI = ['punti', 'mese', 'anno', 'motivazione']
+
+
+def calcola_e_assegna_punteggi(scheda) -> dict:
+    """
+    Allinea i PunteggioCQ della scheda a quelli attesi.
+
+    Prima cancellava e ricreava tutti i punteggi, riga per riga, a ogni
+    salvataggio della scheda e di ogni difetto (una scheda con 8 difetti
+    = 9 ricostruzioni). Ora i punteggi attesi si calcolano in memoria
+    (punteggi_attesi) e si confrontano con quelli esistenti: partono solo
+    bulk_create / bulk_update / delete delle differenze. Le righe
+    invariate restano com'erano (pk e data_ora compresi).
+
+    I signal non la chiamano piu' direttamente: ricalcola_al_commit().
+    Ritorna {'inseriti', 'aggiornati', 'cancellati'}.
     """
-    Ricalcola tutti i PunteggioCQ per una scheda.
-    Chiamata su post_save di SchedaCQ (esito ok) e dopo ogni DifettoCQ.
-    Cancella i punteggi precedenti prima di ricalcolare.
+    from apps.cq.models import PunteggioCQ
+
+    esistenti = {}
+    for p in PunteggioCQ.objects.filter(scheda=scheda).order_by('pk'):
+        esistenti.setdefault((p.difetto_id, p.operatore_id, p.tipo), []).append(p)
+
+    nuovi, modificati = [], []
+    for atteso in punteggi_attesi(scheda):
+        coda = esistenti.get((atteso['difetto_id'], atteso['operatore_id'], atteso['tipo']))
+        if not coda:
+            nuovi.append(PunteggioCQ(scheda=scheda, **atteso))
+            continue
+        p = coda.pop(0)
+        if any(getattr(p, campo) != atteso[campo] for campo in CAMPI_AGGIORNABILI):
+            for campo in CAMPI_AGGIORNABILI:
+                setattr(p, campo, atteso[campo])
+            modificati.append(p)
+    da_cancellare = [p.pk for coda in esistenti.values() for p in coda]
+
+    if da_cancellare:
+        PunteggioCQ.objects.filter(pk__in=da_cancellare).delete()
+    if modificati:
+        PunteggioCQ.objects.bulk_update(modificati, CAMPI_AGGIORNABILI)
+    if nuovi:
+        PunteggioCQ.objects.bulk_create(nuovi)
+    if nuovi or modificati or da_cancellare:
+        segna_modifica_report()
+    return {'inseriti': len(nuovi), 'aggiornati': len(modificati),
+            'cancellati': len(da_cancellare)}
+
+
+def _ricalcola_schede(schede_ids):
+    from apps.cq.models import SchedaCQ
+
+    # Le schede cancellate nella stessa transazione non ci sono piu'
+    for scheda in SchedaCQ.objects.select_related('ordine').filter(pk__in=schede_ids):
+        calcola_e_assegna_punteggi(scheda)
+
+
+_coda_ricalcolo = CodaAlCommit(_ricalcola_schede, 'Ricalcolo punteggi CQ')
+
+
+def ricalcola_al_commit(scheda_id):
+    """
+    Ricalcolo dei punteggi al commit, una volta sola per scheda e
+    transazione: la vista che salva scheda + turno + N difetti in un
+    atomic fa un solo calcolo, sullo stato finale.
+
+    Le schede in attesa le tiene la CodaAlCommit (apps/core/al_commit.py),
+    non la coda on_commit privata della connessione.
     """
-    from apps.cq.models import PunteggioCQ, TipoPunteggio
+    _coda_ricalcolo.aggiungi(scheda_id)
 
-    # Cancella punteggi precedenti legati a questa scheda
-    PunteggioCQ.objects.filter(scheda=scheda).delete()
 
+def punteggi_attesi(scheda) -> list:
+    """I punteggi che la scheda deve avere, come dict di campi (nessuna
+    scrittura). Regole: _punteggi_ok / _punteggi_non_ok."""
     mese = scheda.data_ora.month
     anno = scheda.data_ora.year
-
     if scheda.esito == 'ok':
-        _assegna_punteggi_ok(scheda, mese, anno)
+        punteggi = _punteggi_ok(scheda)
     else:
-        _assegna_punteggi_non_ok(scheda, mese, anno)
+        punteggi = _punteggi_non_ok(scheda)
+    for p in punteggi:
+        p['mese'] = mese
+        p['anno'] = anno
+    return punteggi
 
 
-def _assegna_punteggi_ok(scheda, mese, anno):
+def _punteggi_ok(scheda):
     """CQ senza difetti: +2 a tutti gli operatori in turno."""
-    from apps.cq.models import PunteggioCQ, TipoPunteggio
-
-    operatori_turno = scheda.ordine.operatori_turno.select_related('operatore').all()
-    operatori_unici = {ot.operatore for ot in operatori_turno}
+    from apps.cq.models import TipoPunteggio
 
-    for operatore in operatori_unici:
-        PunteggioCQ.objects.create(
-            scheda=scheda,
-            difetto=None,
-            operatore=operatore,
-            punti=2,
-            tipo=TipoPunteggio.POSITIVO,
-            mese=mese,
-            anno=anno,
-            motivazione=f"CQ ordine {scheda.ordine.numero_progressivo} senza difetti — +2 a tutto il turno",
-        )
+    operatori_unici = sorted(set(
+        scheda.ordine.operatori_turno.values_list('operatore_id', flat=True)))
+    return [{
+        'difetto_id': None,
+        'operatore_id': operatore_id,
+        'punti': 2,
+        'tipo': TipoPunteggio.POSITIVO,
+        'motivazione': f"CQ ordine {scheda.ordine.numero_progressivo} senza difetti — +2 a tutto il turno",
+    } for operatore_id in operatori_unici]
 
 
-def _assegna_punteggi_non_ok(scheda, mese, anno):
+def _punteggi_non_ok(scheda):
     """CQ con difetti: calcola punteggi negativi per ogni difetto."""
-    from apps.cq.models import PunteggioCQ, TipoPunteggio, ZonaConfig
+    from apps.cq.models import Gravita, TipoPunteggio, ZonaConfig
 
     tipo_rilev = tipo_rilevatore(scheda.rilevato_da)
     turno = _mappa_turno(scheda.ordine)
+    gravita_display = dict(Gravita.choices)
+
+    # Precarica zona_codice → (nome, postazioni_catena) dal DB
+    zone = {z.codice: (z.nome, z.postazioni_catena)
+            for z in ZonaConfig.objects.only('codice', 'nome', 'postazioni_catena').order_by()}
+
+    punteggi = []
+
+    def aggiungi(difetto, operatore_id, punti, tipo, ruolo):
+        zona_nome = zone.get(difetto.zona, (difetto.zona,))[0]
+        punteggi.append({
+            'difetto_id': difetto.pk,
+            'operatore_id': operatore_id,
+            'punti': punti,
+            'tipo': tipo,
+            'motivazione': (
+                f"Difetto: {zona_nome} "
+                f"({gravita_display.get(difetto.gravita, difetto.gravita)}) — {ruolo}"
+            ),
+        })
 
-    # Precarica mappa zona_codice → postazioni_catena dal DB
-    zona_catena_map = {z.codice: z.postazioni_catena for z in ZonaConfig.objects.all()}
-
-    for difetto in scheda.difetti.all():
+    for difetto in scheda.difetti.order_by('pk'):
         punteggio_base = PUNTEGGI_NEGATIVI.get((difetto.gravita, tipo_rilev), 0)
         postazione_produttore = difetto.postazione_responsabile  # come indicato sulla scheda
-        catena = list(zona_catena_map.get(difetto.zona, []))
+        catena = list(zone.get(difetto.zona, (None, []))[1] or [])
 
         # 1. Punteggio al produttore del difetto
         operatore_produttore = turno.get(postazione_produttore)
         if operatore_produttore:
-            PunteggioCQ.objects.create(
-                scheda=scheda,
-                difetto=difetto,
-                operatore=operatore_produttore,
-                punti=punteggio_base,
-                tipo=TipoPunteggio.NEG_PRODUTTORE,
-                mese=mese,
-                anno=anno,
-                motivazione=(
-                    f"Difetto: {difetto.zona_nome} "
-                    f"({difetto.get_gravita_display()}) — produttore"
-                ),
-            )
+            aggiungi(difetto, operatore_produttore, punteggio_base,
+                     TipoPunteggio.NEG_PRODUTTORE, 'produttore')
 
         # 2. Catena intermedia (50%) — escludi il produttore e controllo_finale
         catena_intermedia = [p for p in catena if p != postazione_produttore and p != 'controllo_finale']
         for postazione in catena_intermedia:
             operatore = turno.get(postazione)
             if operatore and operatore != operatore_produttore:
-                PunteggioCQ.objects.create(
-                    scheda=scheda,
-                    difetto=difetto,
-                    operatore=operatore,
-                    punti=round(punteggio_base * 0.5),
-                    tipo=TipoPunteggio.NEG_CATENA,
-                    mese=mese,
-                    anno=anno,
-                    motivazione=(
-                        f"Difetto: {difetto.zona_nome} "
-                        f"({difetto.get_gravita_display()}) — catena ({postazione})"
-                    ),
-                )
+                aggiungi(difetto, operatore, round(punteggio_base * 0.5),
+                         TipoPunteggio.NEG_CATENA, f'catena ({postazione})')
 
         # 3. Controllo finale
         operatore_cf = turno.get('controllo_finale')
-        if operatore_cf:
-            if tipo_rilev == 'esterno':
-                # Il difetto ha superato il controllo finale: punteggio pieno
-                # Se l'op. del CF è già il produttore, non duplicare
-                if operatore_cf != operatore_produttore:
-                    PunteggioCQ.objects.create(
-                        scheda=scheda,
-                        difetto=difetto,
-                        operatore=operatore_cf,
-                        punti=punteggio_base,
-                        tipo=TipoPunteggio.NEG_RESPONSABILE,
-                        mese=mese,
-                        anno=anno,
-                        motivazione=(
-                            f"Difetto: {difetto.zona_nome} "
-                            f"({difetto.get_gravita_display()}) — controllo finale fallito"
-                        ),
-                    )
-            # Se rilevatore interno: il compilatore ha intercettato, CF non paga
+        if operatore_cf and tipo_rilev == 'esterno':
+            # Il difetto ha superato il controllo finale: punteggio pieno.
+            # Se l'op. del CF è già il produttore, non duplicare
+            if operatore_cf != operatore_produttore:
+                aggiungi(difetto, operatore_cf, punteggio_base,
+                         TipoPunteggio.NEG_RESPONSABILE, 'controllo finale fallito')
+        # Se rilevatore interno: il compilatore ha intercettato, CF non paga
+
+    return punteggi
 
 
 def _mappa_turno(ordine) -> dict:
     """
-    Restituisce {postazione: operatore_user} per l'ordine dato.
+    Restituisce {postazione: operatore_id} per l'ordine dato.
     Se una postazione ha più operatori prende il primo (non previsto normalmente).
     """
     mappa = {}
-    for opt in ordine.operatori_turno.select_related('operatore').all():
-        if opt.postazione not in mappa:
-            mappa[opt.postazione] = opt.operatore
+    turno = ordine.operatori_turno.order_by('postazione', 'pk')
+    for postazione, operatore_id in turno.values_list('postazione', 'operatore_id'):
+        if postazione not in mappa:
+            mappa[postazione] = operatore_id
     return mappa
 
 
@@ -328,102 +381,94 @@ def _mappa_turno(ordine) -> dict:
 # Calcolo indici e premi mensili
 # ---------------------------------------------------------------------------
 
-def calcola_saldo_grezzo(operatore, anno, mese) -> int:
-    """Somma tutti i PunteggioCQ + ModificaPunteggio per operatore/mese."""
-    from apps.cq.models import PunteggioCQ, ModificaPunteggio
+# Report mensile: prima calcola_report_mensile faceva, per ogni
+# operatore, due aggregate per il saldo e un count distinct per i
+# turni, e il report del titolare rifaceva tutto a ogni apertura. Ora:
+# - registro_mensile: saldo, turni e indice di TUTTI gli operatori con
+#   tre query raggruppate (punteggi, modifiche, turni), qualunque sia il
+#   numero di operatori;
+# - il risultato sta in cache per (anno, mese, versione), se la cache
+#   e' condivisa (stesso criterio della board ordini): la versione
+#   cambia a ogni scrittura di PunteggioCQ / ModificaPunteggio / turni /
+#   monte premi (segna_modifica_report, dai signal e dal ricalcolo
+#   punteggi che usa bulk_* senza signal);
+# - alla validazione del mese il report viene congelato in SaldoMensileCQ
+#   e da li' in poi letto da tabella.
 
-    punti_cq = PunteggioCQ.objects.filter(
-        operatore=operatore, anno=anno, mese=mese
-    ).aggregate(totale=models.Sum('punti'))['totale'] or 0
+CHIAVE_VERSIONE_REPORT = 'cq_report:versione'
+REPORT_TTL = 60 * 60
 
-    modifiche = ModificaPunteggio.objects.filter(
-        operatore=operatore, anno=anno, mese=mese
-    ).aggregate(totale=models.Sum('punti'))['totale'] or 0
 
-    return punti_cq + modifiche
+def _versione_report():
+    from apps.core import cache as cache_condivisa
 
+    token = cache_condivisa.leggi(CHIAVE_VERSIONE_REPORT)
+    if token is None:
+        token = time.time_ns()
+        if not cache_condivisa.aggiungi(CHIAVE_VERSIONE_REPORT, token, None):
+            token = cache_condivisa.leggi(CHIAVE_VERSIONE_REPORT, token)
+    return token
 
-def calcola_turni(operatore, anno, mese) -> int:
-    """
-    Conta i turni lavorati: ordini unici in cui l'operatore
-    era registrato in OperatorePostazioneTurno nel mese.
-    """
-    from apps.cq.models import OperatorePostazioneTurno
 
-    return (
-        OperatorePostazioneTurno.objects
-        .filter(
-            operatore=operatore,
-            ordine__data_ora__year=anno,
-            ordine__data_ora__month=mese,
-        )
-        .values('ordine')
-        .distinct()
-        .count()
-    )
+def _scrivi_versione_report():
+    from apps.core import cache as cache_condivisa
 
+    cache_condivisa.scrivi(CHIAVE_VERSIONE_REPORT, time.time_ns(), None)
 
-def calcola_indice_mensile(operatore, anno, mese):
-    """
-    Indice mensile = saldo_grezzo / turni_lavorati.
-    Restituisce None se l'operatore non ha turni nel mese.
-    """
-    turni = calcola_turni(operatore, anno, mese)
-    if turni == 0:
-        return None
-    saldo = calcola_saldo_grezzo(operatore, anno, mese)
-    return round(saldo / turni, 4)
 
+def segna_modifica_report():
+    """Invalida i report mensili in cache (al commit, come la board ordini)."""
+    transaction.on_commit(_scrivi_versione_report)
 
-def calcola_report_mensile(anno, mese, monte_premi=None):
-    """
-    Calcola il report mensile per tutti gli operatori attivi nel mese.
 
-    Restituisce una lista di dict:
-    {
-        'operatore': User,
-        'turni': int,
-        'saldo_grezzo': int,
-        'indice': float|None,
-        'premio': Decimal|None,   # None se indice ≤ 0 o monte_premi non impostato
-    }
+def registro_mensile(anno, mese) -> dict:
     """
-    from django.contrib.auth.models import User
-    from apps.cq.models import OperatorePostazioneTurno, ImpostazionePremioMensile, ModificaPunteggio
+    {operatore_id: {'turni', 'saldo_grezzo', 'indice'}} per gli operatori
+    presenti nel mese (chi ha turni, punteggi CQ o modifiche manuali),
+    in tre query raggruppate. Chi ha solo punteggi compare con 0 turni e
+    indice None, ma con il suo saldo.
+    """
+    from apps.cq.models import ModificaPunteggio, OperatorePostazioneTurno, PunteggioCQ
 
-    # Operatori presenti nel mese: chi ha turni OPPURE chi ha modifiche manuali
-    ids_turni = set(
-        OperatorePostazioneTurno.objects
-        .filter(ordine__data_ora__year=anno, ordine__data_ora__month=mese)
-        .values_list('operatore_id', flat=True)
+    punti = dict(
+        PunteggioCQ.objects.filter(anno=anno, mese=mese).order_by()
+        .values_list('operatore_id').annotate(models.Sum('punti'))
     )
-    ids_modifiche = set(
-        ModificaPunteggio.objects
-        .filter(anno=anno, mese=mese)
-        .values_list('operatore_id', flat=True)
+    modifiche = dict(
+        ModificaPunteggio.objects.filter(anno=anno, mese=mese).order_by()
+        .values_list('operatore_id').annotate(models.Sum('punti'))
+    )
+    turni = dict(
+        OperatorePostazioneTurno.objects
+        .filter(ordine__data_ora__year=anno, ordine__data_ora__month=mese).order_by()
+        .values_list('operatore_id').annotate(models.Count('ordine', distinct=True))
     )
-    operatori = User.objects.filter(pk__in=ids_turni | ids_modifiche)
-
-    risultati = []
-    for op in operatori:
-        saldo = calcola_saldo_grezzo(op, anno, mese)
-        turni = calcola_turni(op, anno, mese)
-        indice = round(saldo / turni, 4) if turni > 0 else None
-        risultati.append({
-            'operatore': op,
-            'turni': turni,
+
+    registro = {}
+    for operatore_id in set(turni) | set(punti) | set(modifiche):
+        saldo = punti.get(operatore_id, 0) + modifiche.get(operatore_id, 0)
+        n_turni = turni.get(operatore_id, 0)
+        registro[operatore_id] = {
+            'turni': n_turni,
             'saldo_grezzo': saldo,
-            'indice': indice,
-            'premio': None,
-        })
+            'indice': round(saldo / n_turni, 4) if n_turni > 0 else None,
+        }
+    return registro
+
+
+def _calcola_report(anno, mese, monte_premi=None):
+    from django.contrib.auth.models import User
+    from apps.cq.models import ImpostazionePremioMensile
+
+    registro = registro_mensile(anno, mese)
+    operatori = User.objects.in_bulk(list(registro))
+    risultati = [{'operatore': operatori[op_id], **riga, 'premio': None}
+                 for op_id, riga in registro.items() if op_id in operatori]
 
     # Calcola premi
     if monte_premi is None:
-        try:
-            imp = ImpostazionePremioMensile.objects.get(anno=anno, mese=mese)
-            monte_premi = imp.monte_premi
-        except ImpostazionePremioMensile.DoesNotExist:
-            monte_premi = None
+        monte_premi = (ImpostazionePremioMensile.objects.filter(anno=anno, mese=mese)
+                       .values_list('monte_premi', flat=True).first())
 
     if monte_premi is not None:
         positivi = [r for r in risultati if r['indice'] is not None and r['indice'] > 0]
@@ -439,5 +484,80 @@ def calcola_report_mensile(anno, mese, monte_premi=None):
     return risultati
 
 
-# Import necessario per Sum nella funzione calcola_saldo_grezzo
+def _report_congelato(anno, mese):
+    from apps.cq.models import SaldoMensileCQ
+
+    righe = SaldoMensileCQ.objects.filter(anno=anno, mese=mese).select_related('operatore')
+    risultati = [{'operatore': r.operatore, 'turni': r.turni,
+                  'saldo_grezzo': r.saldo_grezzo, 'indice': r.indice,
+                  'premio': r.premio} for r in righe]
+    risultati.sort(key=lambda r: (r['indice'] or -9999), reverse=True)
+    return risultati
+
+
+def calcola_report_mensile(anno, mese, monte_premi=None):
+    """
+    Calcola il report mensile per tutti gli operatori attivi nel mese.
+
+    Restituisce una lista di dict:
+    {
+        'operatore': User,
+        'turni': int,
+        'saldo_grezzo': int,
+        'indice': float|None,
+        'premio': Decimal|None,   # None se indice ≤ 0 o monte_premi non impostato
+    }
+
+    Mese validato -> righe congelate; altrimenti dalla cache se nessun
+    punteggio e' cambiato. Con monte_premi esplicito (simulazione) si
+    calcola sempre.
+    """
+    from apps.core import cache as cache_condivisa
+    from apps.cq.models import ImpostazionePremioMensile
+    from apps.ordini.board import cache_abilitata
+
+    if monte_premi is not None:
+        return _calcola_report(anno, mese, monte_premi)
+    if ImpostazionePremioMensile.objects.filter(anno=anno, mese=mese, validato=True).exists():
+        congelato = _report_congelato(anno, mese)
+        if congelato:
+            return congelato
+
+    if not cache_abilitata():
+        return _calcola_report(anno, mese)
+    chiave = f'cq_report:{anno}:{mese}:{_versione_report()}'
+    report = cache_condivisa.leggi(chiave)
+    if report is None:
+        report = _calcola_report(anno, mese)
+        cache_condivisa.scrivi(chiave, report, REPORT_TTL)
+    return report
+
+
+def riga_report_mensile(operatore, anno, mese) -> dict:
+    """La riga dell'operatore nel report del mese (zeri se assente)."""
+    for riga in calcola_report_mensile(anno, mese):
+        if riga['operatore'].pk == operatore.pk:
+            return riga
+    return {'operatore': operatore, 'turni': 0, 'saldo_grezzo': 0,
+            'indice': None, 'premio': None}
+
+
+def congela_report_mensile(anno, mese) -> int:
+    """Scrive il report del mese (calcolato ora, senza cache) in
+    SaldoMensileCQ. Chiamata da valida_mese. Ritorna le righe scritte."""
+    from apps.cq.models import SaldoMensileCQ
+
+    report = _calcola_report(anno, mese)
+    with transaction.atomic():
+        SaldoMensileCQ.objects.filter(anno=anno, mese=mese).delete()
+        SaldoMensileCQ.objects.bulk_create([
+            SaldoMensileCQ(anno=anno, mese=mese, operatore=r['operatore'],
+                           turni=r['turni'], saldo_grezzo=r['saldo_grezzo'],
+                           indice=r['indice'], premio=r['premio'])
+            for r in report
+        ])
+    return len(report)
+
+
+# Import necessario per Sum/Count in registro_mensile
 from django.db import models
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cq', '0010_esito_3_livelli'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SaldoMensileCQ',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('anno', models.PositiveSmallIntegerField()),
+                ('mese', models.PositiveSmallIntegerField()),
+                ('turni', models.PositiveIntegerField()),
+                ('saldo_grezzo', models.IntegerField()),
+                ('indice', models.FloatField(blank=True, null=True)),
+                ('premio', models.DecimalField(blank=True, decimal_places=2, max_digits=8, null=True)),
+                ('congelato_il', models.DateTimeField(auto_now_add=True)),
+                ('operatore', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='saldi_cq', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Saldo mensile CQ',
+                'verbose_name_plural': 'Saldi mensili CQ',
+                'ordering': ['-anno', '-mese'],
+                'unique_together': {('anno', 'mese', 'operatore')},
+            },
+        ),
+    ]
@@ -642,3 +642,32 @@ class ImpostazionePremioMensile(models.Model):
 
     def __str__(self):
         return f"Premio {self.mese}/{self.anno} — €{self.monte_premi}"
+
+
+class SaldoMensileCQ(models.Model):
+    """
+    Riga del report mensile congelata alla validazione del mese
+    (logic.congela_report_mensile): da quel momento il report del mese
+    si legge da qui e non si ricalcola piu'.
+    """
+    anno = models.PositiveSmallIntegerField()
+    mese = models.PositiveSmallIntegerField()
+    operatore = models.ForeignKey(
+        User,
+        on_delete=models.PROTECT,
+        related_name='saldi_cq',
+    )
+    turni = models.PositiveIntegerField()
+    saldo_grezzo = models.IntegerField()
+    indice = models.FloatField(null=True, blank=True)
+    premio = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True)
+    congelato_il = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Saldo mensile CQ'
+        verbose_name_plural = 'Saldi mensili CQ'
+        unique_together = [('anno', 'mese', 'operatore')]
+        ordering = ['-anno', '-mese']
+
+    def __str__(self):
+        return f"{self.operatore.username} {self.mese}/{self.anno}: {self.saldo_grezzo}"
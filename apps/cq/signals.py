@@ -1,17 +1,35 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 
 @receiver(post_save, sender='cq.SchedaCQ')
 def ricalcola_punteggi_scheda(sender, instance, **kwargs):
-    """Ricalcola i punteggi ogni volta che la scheda CQ viene salvata."""
+    """Ricalcola i punteggi (al commit) quando la scheda CQ viene salvata."""
     # Importazione lazy per evitare circular import
-    from apps.cq.logic import calcola_e_assegna_punteggi
-    calcola_e_assegna_punteggi(instance)
+    from apps.cq.logic import ricalcola_al_commit
+    ricalcola_al_commit(instance.pk)
 
 
 @receiver(post_save, sender='cq.DifettoCQ')
+@receiver(post_delete, sender='cq.DifettoCQ')
 def ricalcola_punteggi_difetto(sender, instance, **kwargs):
-    """Ricalcola i punteggi quando un difetto viene aggiunto/modificato."""
-    from apps.cq.logic import calcola_e_assegna_punteggi
-    calcola_e_assegna_punteggi(instance.scheda)
+    """Ricalcola i punteggi (al commit) quando un difetto viene
+    aggiunto, modificato o tolto. Piu' difetti nella stessa transazione
+    = un solo ricalcolo (vedi logic.ricalcola_al_commit)."""
+    from apps.cq.logic import ricalcola_al_commit
+    ricalcola_al_commit(instance.scheda_id)
+
+
+@receiver(post_save, sender='cq.PunteggioCQ')
+@receiver(post_delete, sender='cq.PunteggioCQ')
+@receiver(post_save, sender='cq.ModificaPunteggio')
+@receiver(post_delete, sender='cq.ModificaPunteggio')
+@receiver(post_save, sender='cq.OperatorePostazioneTurno')
+@receiver(post_delete, sender='cq.OperatorePostazioneTurno')
+@receiver(post_save, sender='cq.ImpostazionePremioMensile')
+@receiver(post_delete, sender='cq.ImpostazionePremioMensile')
+def invalida_report_mensile(sender, instance, **kwargs):
+    """Saldi, turni o monte premi cambiati: i report mensili in cache
+    non valgono piu' (vedi logic.calcola_report_mensile)."""
+    from apps.cq.logic import segna_modifica_report
+    segna_modifica_report()
@@ -0,0 +1,237 @@
+"""Test del ricalcolo incrementale dei punteggi CQ, del report
+mensile per insiemi, in cache e congelato alla validazione (logic.py),
+e degli aggregati SQL della dashboard analytics (analytics.py).
+
+Esecuzione: python manage.py test apps.cq
+"""
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.ordini.models import Ordine
+
+from . import analytics, logic
+from .logic import calcola_report_mensile, congela_report_mensile
+from .models import (CategoriaZona, DifettoCQ, ImpostazionePremioMensile,
+                     ModificaPunteggio, OperatorePostazioneTurno, PostazioneCQ,
+                     PunteggioCQ, SaldoMensileCQ, SchedaCQ, ZonaConfig)
+
+
+class PunteggiCQTest(TestCase):
+    def setUp(self):
+        self.ops = {p: User.objects.create_user(p) for p in
+                    ('post1', 'post2', 'post4', 'controllo_finale')}
+        self.ordine = Ordine.objects.create(totale=Decimal('10'), totale_finale=Decimal('10'))
+        for postazione, op in self.ops.items():
+            OperatorePostazioneTurno.objects.create(ordine=self.ordine,
+                                                    postazione=postazione, operatore=op)
+        categoria, _ = CategoriaZona.objects.get_or_create(nome='Esterno')
+        ZonaConfig.objects.update_or_create(codice='parabrezza_esterno', defaults={
+            'categoria': categoria, 'nome': 'Parabrezza',
+            'postazioni_catena': ['post2', 'post4']})
+
+    def _scheda(self, esito='non_ok', difetti=0):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            scheda = SchedaCQ.objects.create(ordine=self.ordine, rilevato_da='cliente',
+                                             compilata_da=self.ops['post1'], esito=esito)
+            for _ in range(difetti):
+                DifettoCQ.objects.create(scheda=scheda, zona='parabrezza_esterno',
+                                         tipo_difetto='fango', gravita='media',
+                                         postazione_responsabile='post1',
+                                         azione_correttiva='sistemato')
+        return scheda, callbacks
+
+    def _punti(self, scheda):
+        return sorted(PunteggioCQ.objects.filter(scheda=scheda)
+                      .values_list('operatore__username', 'punti'))
+
+    def test_un_ricalcolo_per_transazione(self):
+        with mock.patch.object(logic, 'calcola_e_assegna_punteggi',
+                               wraps=logic.calcola_e_assegna_punteggi) as calcolo:
+            scheda, _ = self._scheda(difetti=8)
+        calcolo.assert_called_once()
+        self.assertEqual(calcolo.call_args.args[0].pk, scheda.pk)
+        # Per difetto: produttore -4, catena post2/post4 -2, CF esterno -4
+        self.assertEqual(PunteggioCQ.objects.filter(scheda=scheda).count(), 32)
+        self.assertEqual(sum(p for _, p in self._punti(scheda)), 8 * -12)
+
+    def test_solo_le_differenze(self):
+        scheda, _ = self._scheda(difetti=2)
+        prima = set(PunteggioCQ.objects.values_list('pk', flat=True))
+        difetto = scheda.difetti.order_by('pk').first()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            difetto.gravita = 'alta'
+            difetto.save()
+        self.assertEqual(set(PunteggioCQ.objects.values_list('pk', flat=True)), prima)
+        self.assertEqual(sorted(PunteggioCQ.objects.filter(difetto=difetto)
+                                .values_list('punti', flat=True)), [-8, -8, -4, -4])
+
+        with self.assertNumQueries(4):  # punteggi esistenti, turno, zone, difetti
+            esito = self._ricalcolo_diretto(scheda)
+        self.assertEqual(esito, {'inseriti': 0, 'aggiornati': 0, 'cancellati': 0})
+
+    def _ricalcolo_diretto(self, scheda):
+        from .logic import calcola_e_assegna_punteggi
+        return calcola_e_assegna_punteggi(scheda)
+
+    def test_esito_ok_sostituisce_i_negativi(self):
+        scheda, _ = self._scheda(difetti=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            scheda.difetti.all().delete()
+            scheda.esito = 'ok'
+            scheda.save()
+        self.assertEqual(self._punti(scheda), [(u, 2) for u in sorted(self.ops)])
+
+
+@override_settings(ORDINI_BOARD_CACHE=True, CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'report-cq'}})
+class ReportMensileTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.adesso = timezone.now()
+        self.titolare = User.objects.create_user('titolare')
+
+    def _operatori(self, n, da=0):
+        for i in range(da, da + n):
+            op = User.objects.create_user(f'op{i}')
+            ordine = Ordine.objects.create(totale=Decimal('10'), totale_finale=Decimal('10'))
+            OperatorePostazioneTurno.objects.create(ordine=ordine, postazione='post1',
+                                                    operatore=op)
+            ModificaPunteggio.objects.create(operatore=op, anno=self.adesso.year,
+                                             mese=self.adesso.month, punti=i + 1,
+                                             creato_da=self.titolare)
+
+    def _query_report(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            report = calcola_report_mensile(self.adesso.year, self.adesso.month)
+        return report, len(ctx)
+
+    def test_query_non_crescono_con_gli_operatori(self):
+        self._operatori(2)
+        _, poche = self._query_report()
+        self._operatori(10, da=2)
+        report, tante = self._query_report()
+        self.assertEqual(tante, poche)
+        self.assertEqual(len(report), 12)
+        self.assertEqual((report[0]['operatore'].username, report[0]['indice']), ('op11', 12))
+
+    def test_cache_invalidata_dalle_modifiche(self):
+        self._operatori(1)
+        anno, mese = self.adesso.year, self.adesso.month
+        calcola_report_mensile(anno, mese)
+        with self.assertNumQueries(1):  # solo il controllo "mese validato"
+            calcola_report_mensile(anno, mese)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ModificaPunteggio.objects.create(operatore=User.objects.get(username='op0'),
+                                             anno=anno, mese=mese, punti=5,
+                                             creato_da=self.titolare)
+        self.assertEqual(calcola_report_mensile(anno, mese)[0]['saldo_grezzo'], 6)
+
+    def test_mese_validato_letto_dal_congelato(self):
+        self._operatori(2)
+        anno, mese = self.adesso.year, self.adesso.month
+        ImpostazionePremioMensile.objects.create(anno=anno, mese=mese, validato=True,
+                                                 monte_premi=Decimal('300'),
+                                                 creato_da=self.titolare)
+        self.assertEqual(congela_report_mensile(anno, mese), 2)
+        self.assertEqual(sorted(SaldoMensileCQ.objects.values_list('premio', flat=True)),
+                         [Decimal('100.00'), Decimal('200.00')])
+
+        ModificaPunteggio.objects.create(operatore=User.objects.get(username='op0'),
+                                         anno=anno, mese=mese, punti=50,
+                                         creato_da=self.titolare)
+        report = calcola_report_mensile(anno, mese)
+        self.assertEqual([r['saldo_grezzo'] for r in report], [2, 1])
+
+
+    @override_settings(
+        STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_operatore_con_soli_punteggi(self):
+        # niente turni ne' modifiche nel mese: il saldo viene dai PunteggioCQ
+        op = User.objects.create_superuser('solo_punteggi')
+        ordine = Ordine.objects.create(totale=Decimal('10'), totale_finale=Decimal('10'))
+        scheda = SchedaCQ.objects.create(ordine=ordine, rilevato_da='cliente',
+                                         compilata_da=self.titolare, esito='ok')
+        PunteggioCQ.objects.create(scheda=scheda, operatore=op, punti=3,
+                                   tipo='positivo', anno=self.adesso.year,
+                                   mese=self.adesso.month)
+        report = calcola_report_mensile(self.adesso.year, self.adesso.month)
+        self.assertEqual([(r['operatore'], r['saldo_grezzo'], r['turni'], r['indice'])
+                          for r in report], [(op, 3, 0, None)])
+
+        self.client.force_login(op)
+        risposta = self.client.get(reverse('cq:mio_punteggio'), {
+            'anno': self.adesso.year, 'mese': self.adesso.month})
+        self.assertEqual(risposta.context['saldo_grezzo'], 3)
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AnalyticsCQTest(TestCase):
+    def setUp(self):
+        from apps.turni.models import SegnalazioneDifetto
+
+        self.titolare = User.objects.create_user('titolare', is_staff=True)
+        self.op = User.objects.create_user('op', first_name='Ugo', last_name='Rossi')
+        for i, gravita in enumerate(('alta', 'media')):
+            ordine = Ordine.objects.create(totale=Decimal('10'), totale_finale=Decimal('10'))
+            scheda = SchedaCQ.objects.create(ordine=ordine, rilevato_da='cliente',
+                                             compilata_da=self.titolare, esito='non_ok')
+            for _ in range(i + 1):
+                DifettoCQ.objects.create(scheda=scheda, zona='cerchi', tipo_difetto='fango',
+                                         gravita=gravita, postazione_responsabile='post1',
+                                         azione_correttiva='sistemato')
+        postazione_cq = PostazioneCQ.objects.first() or PostazioneCQ.objects.create(
+            codice='cq1', nome='CQ 1')
+        SegnalazioneDifetto.objects.create(
+            ordine=ordine, zona='cerchi', tipo_difetto='aloni', gravita='alta',
+            azione='segnalato', postazione_produttore='post2',
+            postazione_cq=postazione_cq, operatore=self.op)
+        self.client.force_login(self.titolare)
+        self.oggi = timezone.localdate()
+
+    def test_aggregati_sulla_vista_unificata(self):
+        difetti = analytics.vista(self.oggi, self.oggi, analytics.FiltriDifetti())
+        self.assertEqual(analytics.per_sorgente(difetti),
+                         {'scheda_cq': (3, 3), 'turno': (1, 0)})
+        self.assertEqual(analytics.conteggi(difetti, 'tipo'), [('fango', 3), ('aloni', 1)])
+        self.assertEqual(analytics.per_giorno(difetti), {self.oggi: 4})
+        self.assertEqual(analytics.ricorrenti(difetti), [('cerchi', 'fango', 'post1', 3)])
+        self.assertEqual(sum(map(sum, analytics.heatmap(difetti))), 4)
+
+        filtri = analytics.FiltriDifetti(gravita='alta', sorgente='scheda_cq')
+        difetti = analytics.vista(self.oggi, self.oggi, filtri)
+        self.assertEqual(analytics.per_sorgente(difetti), {'scheda_cq': (1, 1)})
+
+    def test_pagina_con_filtri(self):
+        url = reverse('cq:analytics')
+        risposta = self.client.get(url, {'operatore': self.op.pk})
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(risposta.context['totale_difetti'], 1)
+        self.assertEqual([r['compilatore'] for r in risposta.context['table_rows']],
+                         ['Ugo Rossi'])
+
+        risposta = self.client.get(url)
+        self.assertEqual((risposta.context['n_da_schede'], risposta.context['n_da_turno'],
+                          risposta.context['num_ricorrenti']), (3, 1, 1))
+        self.assertEqual(risposta.context['page_obj'].paginator.count, 4)
+
+    def test_export_csv_in_streaming(self):
+        with mock.patch.object(analytics, 'CHUNK_EXPORT', 2):
+            risposta = self.client.get(reverse('cq:analytics'), {'export': 'csv'})
+        self.assertTrue(risposta.streaming)
+        righe = b''.join(risposta.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(len(righe), 5)
+        self.assertEqual(sorted(r.split(';')[2] for r in righe[1:]),
+                         ['Scheda CQ'] * 3 + ['Turno'])
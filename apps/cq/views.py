@@ -16,8 +16,7 @@ from apps.cq.forms import (
     ImpostazionePremioForm, OperatoriTurnoForm,
 )
 from apps.cq.logic import (
-    calcola_indice_mensile, calcola_report_mensile, calcola_saldo_grezzo,
-    calcola_turni,
+    calcola_report_mensile, congela_report_mensile, riga_report_mensile,
 )
 from apps.cq.models import (
     SchedaCQ, DifettoCQ, OperatorePostazioneTurno, PunteggioCQ,
@@ -556,11 +555,14 @@ def valida_mese(request, anno, mese):
     if not utente_nel_gruppo(request.user, 'titolare'):
         return HttpResponseForbidden()
 
-    imp = get_object_or_404(ImpostazionePremioMensile, anno=anno, mese=mese)
-    imp.validato = True
-    imp.validato_da = request.user
-    imp.validato_il = timezone.now()
-    imp.save()
+    with transaction.atomic():
+        imp = get_object_or_404(ImpostazionePremioMensile, anno=anno, mese=mese)
+        imp.validato = True
+        imp.validato_da = request.user
+        imp.validato_il = timezone.now()
+        imp.save()
+        # Da qui il report del mese si legge dalle righe congelate
+        congela_report_mensile(anno, mese)
     messages.success(request, f'Mese {mese}/{anno} validato e congelato.')
     return redirect('cq:report_mensile', anno=anno, mese=mese)
 
@@ -579,9 +581,7 @@ class MioPunteggioView(QualsivogliaOperatoreMixin, TemplateView):
         anno = int(self.request.GET.get('anno', oggi.year))
         mese = int(self.request.GET.get('mese', oggi.month))
 
-        saldo = calcola_saldo_grezzo(operatore, anno, mese)
-        turni = calcola_turni(operatore, anno, mese)
-        indice = calcola_indice_mensile(operatore, anno, mese)
+        riga = riga_report_mensile(operatore, anno, mese)
 
         punteggi = (
             PunteggioCQ.objects
@@ -598,9 +598,9 @@ class MioPunteggioView(QualsivogliaOperatoreMixin, TemplateView):
             'operatore': operatore,
             'anno': anno,
             'mese': mese,
-            'saldo_grezzo': saldo,
-            'turni': turni,
-            'indice': indice,
+            'saldo_grezzo': riga['saldo_grezzo'],
+            'turni': riga['turni'],
+            'indice': riga['indice'],
             'punteggi': punteggi,
             'modifiche': modifiche,
             'mesi': [
@@ -1114,14 +1114,14 @@ def analytics_cq(request):
       - gravita (bassa|media|alta)
       - operatore (User.id)
       - sorgente (scheda_cq|turno|'')
-      - export=csv
+      - export=csv (con formato=xlsx per il file Excel)
+
+    Filtri e aggregati girano in SQL sulla vista unificata (apps/cq/analytics.py).
     """
     from datetime import datetime, timedelta
-    from collections import Counter, defaultdict
-    import csv
-    from django.http import HttpResponse
     from apps.ordini.models import Ordine
-    from apps.turni.models import SegnalazioneDifetto
+    from apps.cq import analytics
+    from apps.core import esportazione
 
     today = timezone.now().date()
 
@@ -1133,93 +1133,19 @@ def analytics_cq(request):
 
     data_da = _parse_d(request.GET.get('data_da'), today.replace(day=1))
     data_a = _parse_d(request.GET.get('data_a'), today)
-    postazione_filter = request.GET.get('postazione') or ''
-    categoria_difetto_id = request.GET.get('categoria_difetto') or ''
-    gravita_filter = request.GET.get('gravita') or ''
+    filtri = analytics.FiltriDifetti.da_querystring(request.GET)
+    postazione_filter = filtri.postazione
+    categoria_difetto_id = filtri.categoria_id
+    gravita_filter = filtri.gravita
     operatore_id = request.GET.get('operatore') or ''
-    sorgente_filter = request.GET.get('sorgente') or ''
+    sorgente_filter = filtri.sorgente
 
     delta_days = (data_a - data_da).days + 1
     data_da_prev = data_da - timedelta(days=delta_days)
     data_a_prev = data_da - timedelta(days=1)
 
-    # Filtro categoria difetto: ricava codici tipo
-    codici_tipi_filtro = None
-    if categoria_difetto_id:
-        codici_tipi_filtro = set(
-            TipoDifettoConfig.objects.filter(
-                categoria_id=categoria_difetto_id, attivo=True
-            ).values_list('codice', flat=True)
-        )
-
-    # ------------------------------------------------------------------
-    # Helper: carica e normalizza difetti del periodo specificato
-    # ------------------------------------------------------------------
-    def _load_defects(d_da, d_a):
-        out = []
-        # 1. DifettoCQ
-        cq_qs = DifettoCQ.objects.filter(
-            scheda__data_ora__date__gte=d_da, scheda__data_ora__date__lte=d_a,
-        ).select_related(
-            'scheda', 'scheda__ordine', 'scheda__ordine__cliente',
-            'scheda__compilata_da',
-        )
-        for d in cq_qs:
-            sc = d.scheda
-            out.append({
-                'data_ora': sc.data_ora,
-                'zona': d.zona,
-                'tipo': d.tipo_difetto,
-                'gravita': d.gravita,
-                'postazione': d.postazione_responsabile or '',
-                'azione': d.azione_correttiva,
-                'azione_implementata': d.azione_correttiva == 'sistemato',
-                'compilatore_id': sc.compilata_da_id,
-                'compilatore_nome': _full_name_or_username(sc.compilata_da),
-                'ordine': sc.ordine,
-                'sorgente': 'scheda_cq',
-            })
-
-        # 2. SegnalazioneDifetto (turni)
-        sg_qs = SegnalazioneDifetto.objects.filter(
-            data_ora__date__gte=d_da, data_ora__date__lte=d_a,
-        ).select_related('ordine', 'ordine__cliente', 'operatore', 'postazione_cq')
-        for s in sg_qs:
-            out.append({
-                'data_ora': s.data_ora,
-                'zona': s.zona,
-                'tipo': s.tipo_difetto,
-                'gravita': s.gravita,
-                'postazione': s.postazione_produttore or '',
-                'azione': s.azione,
-                'azione_implementata': s.azione == 'corretto',
-                'compilatore_id': s.operatore_id,
-                'compilatore_nome': _full_name_or_username(s.operatore),
-                'ordine': s.ordine,
-                'sorgente': 'turno',
-            })
-        return out
-
-    def _apply_filters(items):
-        out = items
-        if sorgente_filter:
-            out = [d for d in out if d['sorgente'] == sorgente_filter]
-        if postazione_filter:
-            out = [d for d in out if d['postazione'] == postazione_filter]
-        if gravita_filter:
-            out = [d for d in out if d['gravita'] == gravita_filter]
-        if operatore_id:
-            try:
-                op_id_int = int(operatore_id)
-                out = [d for d in out if d['compilatore_id'] == op_id_int]
-            except (TypeError, ValueError):
-                pass
-        if codici_tipi_filtro is not None:
-            out = [d for d in out if d['tipo'] in codici_tipi_filtro]
-        return out
-
-    defects = _apply_filters(_load_defects(data_da, data_a))
-    defects_prev = _apply_filters(_load_defects(data_da_prev, data_a_prev))
+    defects = analytics.vista(data_da, data_a, filtri)
+    defects_prev = analytics.vista(data_da_prev, data_a_prev, filtri)
 
     # ------------------------------------------------------------------
     # Schede CQ (per FTR / % OK) - solo SchedaCQ
@@ -1227,34 +1153,23 @@ def analytics_cq(request):
     schede_qs = SchedaCQ.objects.filter(
         data_ora__date__gte=data_da, data_ora__date__lte=data_a,
     )
-    if operatore_id:
-        try:
-            schede_qs = schede_qs.filter(compilata_da_id=int(operatore_id))
-        except (TypeError, ValueError):
-            pass
+    if filtri.operatore_id is not None:
+        schede_qs = schede_qs.filter(compilata_da_id=filtri.operatore_id)
+
+    zone_dict = {z.codice: z.nome for z in ZonaConfig.objects.all()}
+    tipi_dict = {t.codice: t.nome for t in TipoDifettoConfig.objects.all()}
+    post_dict = {p.codice: p.nome for p in PostazioneCQ.objects.all()}
 
     # ------------------------------------------------------------------
-    # Export CSV
+    # Export CSV (in streaming, un chunk della vista alla volta)
     # ------------------------------------------------------------------
     if request.GET.get('export') == 'csv':
-        zone_dict = {z.codice: z.nome for z in ZonaConfig.objects.all()}
-        tipi_dict = {t.codice: t.nome for t in TipoDifettoConfig.objects.all()}
-        post_dict = {p.codice: p.nome for p in PostazioneCQ.objects.all()}
-        response = HttpResponse(content_type='text/csv; charset=utf-8')
-        response['Content-Disposition'] = (
-            f'attachment; filename="analytics_cq_{data_da}_{data_a}.csv"'
-        )
-        response.write('\ufeff')
-        writer = csv.writer(response, delimiter=';')
-        writer.writerow([
-            'Data', 'Ora', 'Fonte', 'Ordine', 'Cliente', 'Zona', 'Tipo Difetto',
-            'Gravita', 'Postazione', 'Azione', 'Compilatore/Rilevatore',
-        ])
-        for d in sorted(defects, key=lambda x: x['data_ora'], reverse=True)[:5000]:
+        def _riga(d):
             ord_obj = d['ordine']
-            writer.writerow([
-                d['data_ora'].strftime('%d/%m/%Y'),
-                d['data_ora'].strftime('%H:%M'),
+            data_ora = timezone.localtime(d['data_ora'])
+            return [
+                data_ora.strftime('%d/%m/%Y'),
+                data_ora.strftime('%H:%M'),
                 'Scheda CQ' if d['sorgente'] == 'scheda_cq' else 'Turno',
                 ord_obj.numero_progressivo if ord_obj else '',
                 str(ord_obj.cliente) if ord_obj and ord_obj.cliente else '',
@@ -1263,15 +1178,22 @@ def analytics_cq(request):
                 d['gravita'],
                 post_dict.get(d['postazione'], d['postazione']),
                 d['azione'],
-                d['compilatore_nome'],
-            ])
-        return response
+                _full_name_or_username(d['compilatore']),
+            ]
+
+        return esportazione.esporta(request, f'analytics_cq_{data_da}_{data_a}', [
+            'Data', 'Ora', 'Fonte', 'Ordine', 'Cliente', 'Zona', 'Tipo Difetto',
+            'Gravita', 'Postazione', 'Azione', 'Compilatore/Rilevatore',
+        ], map(_riga, analytics.scorri_con_dettagli(analytics.ordinata(defects))),
+            foglio='Difetti CQ')
 
     # ------------------------------------------------------------------
     # KPI
     # ------------------------------------------------------------------
-    totale_difetti = len(defects)
-    totale_difetti_prev = len(defects_prev)
+    per_sorgente = analytics.per_sorgente(defects)
+    totale_difetti = sum(n for n, _ in per_sorgente.values())
+    trend_prev = analytics.per_giorno(defects_prev)
+    totale_difetti_prev = sum(trend_prev.values())
     totale_schede = schede_qs.count()
     schede_ok = schede_qs.filter(esito='ok').count()
     schede_non_ok = schede_qs.filter(esito='non_ok').count()
@@ -1297,9 +1219,9 @@ def analytics_cq(request):
     dpmo = round(totale_difetti / opportunita * 1_000_000) if opportunita > 0 else 0
 
     # ------------------------------------------------------------------
-    # Aggregazioni
+    # Aggregazioni (GROUP BY sulla vista)
     # ------------------------------------------------------------------
-    grav_count = Counter(d['gravita'] for d in defects)
+    grav_count = dict(analytics.conteggi(defects, 'gravita'))
     grav_data = {
         'bassa': grav_count.get('bassa', 0),
         'media': grav_count.get('media', 0),
@@ -1307,8 +1229,7 @@ def analytics_cq(request):
     }
 
     # Pareto top 10 tipi
-    tipi_dict = {t.codice: t.nome for t in TipoDifettoConfig.objects.all()}
-    tipi_count = Counter(d['tipo'] for d in defects).most_common(10)
+    tipi_count = analytics.conteggi(defects, 'tipo', limite=10)
     totale_top = sum(c for _, c in tipi_count) or 1
     cumulativo = 0
     pareto_data = []
@@ -1322,22 +1243,15 @@ def analytics_cq(request):
         })
 
     # Top zone
-    zone_dict = {z.codice: z.nome for z in ZonaConfig.objects.all()}
-    zone_count = Counter(d['zona'] for d in defects).most_common(10)
+    zone_count = analytics.conteggi(defects, 'zona', limite=10)
     zone_chart = [{'zona': zone_dict.get(z, z), 'count': n} for z, n in zone_count]
 
     # Postazioni
-    post_dict = {p.codice: p.nome for p in PostazioneCQ.objects.all()}
-    post_count = Counter(d['postazione'] for d in defects if d['postazione']).most_common()
+    post_count = analytics.conteggi(defects, 'postazione', escludi_vuoti=True)
     post_chart = [{'postazione': post_dict.get(p, p), 'count': n} for p, n in post_count]
 
     # Trend giornaliero (corrente + precedente)
-    trend_curr = defaultdict(int)
-    for d in defects:
-        trend_curr[d['data_ora'].date()] += 1
-    trend_prev = defaultdict(int)
-    for d in defects_prev:
-        trend_prev[d['data_ora'].date()] += 1
+    trend_curr = analytics.per_giorno(defects)
     trend_labels, trend_values = [], []
     cur = data_da
     while cur <= data_a:
@@ -1351,56 +1265,39 @@ def analytics_cq(request):
         cur += timedelta(days=1)
 
     # Heatmap giorno settimana x ora
-    heatmap = [[0] * 24 for _ in range(7)]
-    for d in defects:
-        dt = d['data_ora']
-        if dt:
-            wd = dt.weekday()
-            hr = timezone.localtime(dt).hour if timezone.is_aware(dt) else dt.hour
-            heatmap[wd][hr] += 1
+    heatmap = analytics.heatmap(defects)
     heatmap_max = max((max(row) for row in heatmap), default=0)
 
     # Difetti ricorrenti: stessa (zona, tipo, postazione)
-    rec_keys = Counter(
-        (d['zona'], d['tipo'], d['postazione']) for d in defects
-    )
-    ricorrenti = []
-    for (z, t, p), n in sorted(rec_keys.items(), key=lambda x: -x[1]):
-        if n <= 1:
-            continue
-        ricorrenti.append({
-            'zona_nome': zone_dict.get(z, z),
-            'tipo_nome': tipi_dict.get(t, t),
-            'post_nome': post_dict.get(p, p),
-            'n': n,
-        })
-        if len(ricorrenti) >= 15:
-            break
+    ricorrenti = [{
+        'zona_nome': zone_dict.get(z, z),
+        'tipo_nome': tipi_dict.get(t, t),
+        'post_nome': post_dict.get(p, p),
+        'n': n,
+    } for z, t, p, n in analytics.ricorrenti(defects)]
     num_ricorrenti = len(ricorrenti)
 
     # % azioni implementate (sistemato + corretto)
-    sistemati = sum(1 for d in defects if d['azione_implementata'])
+    sistemati = sum(impl for _, impl in per_sorgente.values())
     perc_implementate = (sistemati / totale_difetti * 100) if totale_difetti else 0
 
     # Per operatore
-    op_count = Counter(
-        (d['compilatore_id'], d['compilatore_nome']) for d in defects
-    ).most_common(15)
+    op_count = analytics.conteggi(defects, 'compilatore_id', limite=15)
+    utenti = User.objects.in_bulk([op_id for op_id, _ in op_count if op_id])
     operatori_chart = [
-        {'operatore': nome or '-', 'count': n}
-        for (_id, nome), n in op_count
+        {'operatore': _full_name_or_username(utenti.get(op_id)) or '-', 'count': n}
+        for op_id, n in op_count
     ]
 
     # ------------------------------------------------------------------
-    # Tabella dettagli (paginata)
+    # Tabella dettagli (paginata: LIMIT/OFFSET sulla vista)
     # ------------------------------------------------------------------
     from django.core.paginator import Paginator
-    sorted_defects = sorted(defects, key=lambda x: x['data_ora'], reverse=True)
-    paginator = Paginator(sorted_defects, 25)
+    paginator = Paginator(analytics.ordinata(defects), 25)
     page = int(request.GET.get('page', 1) or 1)
     page_obj = paginator.get_page(page)
     table_rows = []
-    for d in page_obj:
+    for d in analytics.con_dettagli(page_obj.object_list):
         ord_obj = d['ordine']
         table_rows.append({
             'data': d['data_ora'],
@@ -1412,7 +1309,7 @@ def analytics_cq(request):
             'gravita': d['gravita'],
             'postazione': post_dict.get(d['postazione'], d['postazione']),
             'azione': d['azione'],
-            'compilatore': d['compilatore_nome'],
+            'compilatore': _full_name_or_username(d['compilatore']),
             'ordine_pk': ord_obj.pk if ord_obj else None,
         })
 
@@ -1442,8 +1339,8 @@ def analytics_cq(request):
     }
 
     # Counts per fonte (info pannello)
-    n_da_schede = sum(1 for d in defects if d['sorgente'] == 'scheda_cq')
-    n_da_turno = sum(1 for d in defects if d['sorgente'] == 'turno')
+    n_da_schede = per_sorgente.get('scheda_cq', (0, 0))[0]
+    n_da_turno = per_sorgente.get('turno', (0, 0))[0]
 
     # ------------------------------------------------------------------
     # Filtri options
@@ -5,34 +5,42 @@
 - Festivita: il fatturato si concentra su pre-festivo? Post-festivo?
   Festivita stesse?
 
-Tutto in puro Python (no scipy/pandas).
+Calcoli su array NumPy: le serie si convertono una volta (None -> NaN)
+e ogni lag e' una coppia di slice, senza liste Python per punto.
 """
 from __future__ import annotations
 from datetime import date, timedelta
 
+import numpy as np
+
 
 # ---------------------------------------------------------------------------
 # Pearson + lag correlation
 # ---------------------------------------------------------------------------
 
-def _pearson(xs: list[float], ys: list[float]) -> float | None:
-    pairs = [(x, y) for x, y in zip(xs, ys) if x is not None and y is not None]
-    if len(pairs) < 3:
+def _array(series) -> np.ndarray:
+    """Lista con eventuali None -> array float con NaN."""
+    if isinstance(series, np.ndarray):
+        return series.astype(float, copy=False)
+    return np.array([np.nan if v is None else v for v in series], dtype=float)
+
+
+def _pearson(xs, ys) -> float | None:
+    x, y = _array(xs), _array(ys)
+    n = min(len(x), len(y))
+    x, y = x[:n], y[:n]
+    validi = ~(np.isnan(x) | np.isnan(y))
+    if validi.sum() < 3:
         return None
-    n = len(pairs)
-    mean_x = sum(p[0] for p in pairs) / n
-    mean_y = sum(p[1] for p in pairs) / n
-    cov = sum((p[0] - mean_x) * (p[1] - mean_y) for p in pairs)
-    var_x = sum((p[0] - mean_x) ** 2 for p in pairs) ** 0.5
-    var_y = sum((p[1] - mean_y) ** 2 for p in pairs) ** 0.5
-    if var_x == 0 or var_y == 0:
+    x = x[validi] - x[validi].mean()
+    y = y[validi] - y[validi].mean()
+    den = np.sqrt((x * x).sum()) * np.sqrt((y * y).sum())
+    if den == 0:
         return None
-    return round(cov / (var_x * var_y), 3)
+    return round(float((x * y).sum() / den), 3)
 
 
-def lag_correlation(driver_series: list[float | None],
-                    revenue_series: list[float | None],
-                    lag: int) -> float | None:
+def lag_correlation(driver_series, revenue_series, lag: int) -> float | None:
     """Correlazione fra revenue di oggi e driver di N giorni fa.
 
     lag=0  : stesso giorno
@@ -41,27 +49,23 @@ def lag_correlation(driver_series: list[float | None],
     """
     if len(driver_series) != len(revenue_series):
         return None
-    n = len(driver_series)
-    if lag == 0:
-        return _pearson(driver_series, revenue_series)
+    driver, revenue = _array(driver_series), _array(revenue_series)
+    n = len(driver)
+    if abs(lag) >= n and lag != 0:
+        return None
     if lag > 0:
-        if lag >= n:
-            return None
-        return _pearson(driver_series[:n - lag], revenue_series[lag:])
+        return _pearson(driver[:n - lag], revenue[lag:])
     if lag < 0:
-        k = -lag
-        if k >= n:
-            return None
-        return _pearson(driver_series[k:], revenue_series[:n - k])
-    return None
+        return _pearson(driver[-lag:], revenue[:n + lag])
+    return _pearson(driver, revenue)
 
 
-def lag_correlation_series(driver_series: list[float | None],
-                           revenue_series: list[float | None],
+def lag_correlation_series(driver_series, revenue_series,
                            lags: list[int]) -> list[dict]:
     """Ritorna [{lag: int, corr: float|None}, ...] per ogni lag richiesto."""
+    driver, revenue = _array(driver_series), _array(revenue_series)
     return [
-        {'lag': lag, 'corr': lag_correlation(driver_series, revenue_series, lag)}
+        {'lag': lag, 'corr': lag_correlation(driver, revenue, lag)}
         for lag in lags
     ]
 
@@ -166,29 +170,29 @@ def analyze_holidays(data_inizio: date, data_fine: date,
         }
     """
     holidays = italian_holidays_in_range(data_inizio, data_fine)
-    cats = {k: {'count': 0, 'totale': 0.0, 'max': 0.0} for k in CATEGORY_LABELS}
-
-    d = data_inizio
-    is_holiday_series = []
-    for i in range(len(fatturato_per_giorno)):
-        cur = data_inizio + timedelta(days=i)
-        cat = classify_day(cur, holidays)
-        cats[cat]['count'] += 1
-        cats[cat]['totale'] += fatturato_per_giorno[i]
-        cats[cat]['max'] = max(cats[cat]['max'], fatturato_per_giorno[i])
-        is_holiday_series.append(1.0 if cur in holidays else 0.0)
+    fatturato = _array(fatturato_per_giorno)
+    ordine = ['feriale', 'sabato', 'domenica', 'pre_festivo', 'festivo', 'post_festivo']
+    giorni = [data_inizio + timedelta(days=i) for i in range(len(fatturato))]
+    idx_cat = np.array([ordine.index(classify_day(g, holidays)) for g in giorni],
+                       dtype=int)
+    is_holiday_series = np.array([g in holidays for g in giorni], dtype=float)
+
+    count = np.bincount(idx_cat, minlength=len(ordine))
+    totale = np.bincount(idx_cat, weights=fatturato, minlength=len(ordine))
+    massimo = np.zeros(len(ordine))
+    if len(fatturato):
+        np.maximum.at(massimo, idx_cat, fatturato)
 
     categories_out = []
-    for k in ['feriale', 'sabato', 'domenica', 'pre_festivo', 'festivo', 'post_festivo']:
-        c = cats[k]
-        media = c['totale'] / c['count'] if c['count'] > 0 else 0.0
+    for i, k in enumerate(ordine):
+        media = totale[i] / count[i] if count[i] > 0 else 0.0
         categories_out.append({
             'key': k,
             'label': CATEGORY_LABELS[k],
-            'count': c['count'],
-            'totale': round(c['totale'], 2),
-            'media': round(media, 2),
-            'max': round(c['max'], 2),
+            'count': int(count[i]),
+            'totale': round(float(totale[i]), 2),
+            'media': round(float(media), 2),
+            'max': round(float(massimo[i]), 2),
         })
 
     # Lista festivita nel periodo con fatturato
@@ -0,0 +1,157 @@
+"""Test delle serie di periodo (analitica.py), del report periodo e
+della lag analysis vettoriale.
+
+Esecuzione: python manage.py test apps.finanze
+"""
+import json
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.core.models import Categoria, ServizioProdotto
+from apps.ordini.models import ItemOrdine, Ordine, Pagamento
+
+from .analitica import serie_periodo
+from .lag_analysis import _pearson, analyze_holidays, lag_correlation_series
+from .models import Cassa, ChiusuraCassaAutomatica, QuadraturaGiornaliera
+
+LUNEDI = date(2026, 3, 2)
+
+
+def _alle(giorno, ora=10):
+    return timezone.make_aware(datetime.combine(giorno, time(ora)))
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class SeriePeriodoTest(TestCase):
+    def setUp(self):
+        cat = Categoria.objects.create(nome='Lavaggi')
+        self.completo = ServizioProdotto.objects.create(
+            titolo='Lavaggio completo', prezzo=Decimal('20'), categoria=cat,
+            descrizione='-', durata_minuti=20)
+        portale = Cassa.objects.create(nome='Portale', tipo='automatica',
+                                       tracking_washcycles=True)
+        gettoni = Cassa.objects.create(nome='Gettoni', tipo='automatica')
+        registratore = Cassa.objects.create(nome='Registratore', tipo='automatica',
+                                            modalita_registratore=True)
+
+        for i, giorno in enumerate((LUNEDI, LUNEDI + timedelta(days=1))):
+            ordine = Ordine.objects.create(
+                totale=Decimal('20.00'), totale_finale=Decimal('20.00'),
+                stato='completato', stato_pagamento='pagato',
+                importo_pagato=Decimal('20.00'))
+            ItemOrdine.objects.create(ordine=ordine, servizio_prodotto=self.completo,
+                                      prezzo_unitario=Decimal('20.00'))
+            pagamento = Pagamento.objects.create(
+                ordine=ordine, importo=Decimal('20.00'), metodo='carta')
+            Ordine.objects.filter(pk=ordine.pk).update(data_ora=_alle(giorno, 9 + i))
+            Pagamento.objects.filter(pk=pagamento.pk).update(
+                data_pagamento=_alle(giorno, 9 + i))
+            ChiusuraCassaAutomatica.objects.create(
+                cassa=portale, data=giorno, vendita_contante=Decimal('30.00'),
+                wash_cycles=3)
+            ChiusuraCassaAutomatica.objects.create(
+                cassa=gettoni, data=giorno, vendita_contante=Decimal('10.00'))
+            ChiusuraCassaAutomatica.objects.create(
+                cassa=registratore, data=giorno, incasso_totale=Decimal('99.00'))
+
+        annullato = Ordine.objects.create(
+            totale=Decimal('50.00'), totale_finale=Decimal('50.00'), stato='annullato')
+        Ordine.objects.filter(pk=annullato.pk).update(data_ora=_alle(LUNEDI))
+        non_pagato = Ordine.objects.create(
+            totale=Decimal('15.00'), totale_finale=Decimal('15.00'),
+            stato_pagamento='parziale', importo_pagato=Decimal('5.00'))
+        Ordine.objects.filter(pk=non_pagato.pk).update(data_ora=_alle(LUNEDI))
+
+        # lunedi' quadra (20 + 30 + 10), martedi' mancano 2 euro
+        QuadraturaGiornaliera.objects.create(data=LUNEDI, contanti_totali=Decimal('60.00'))
+        QuadraturaGiornaliera.objects.create(
+            data=LUNEDI + timedelta(days=1), contanti_totali=Decimal('58.00'))
+
+    def test_serie_giornaliere(self):
+        s = serie_periodo(LUNEDI, LUNEDI + timedelta(days=6))
+        self.assertEqual(s.ordini.tolist()[:3], [3500, 2000, 0])
+        self.assertEqual(s.num_ordini.tolist()[:2], [2, 1])
+        self.assertEqual(s.non_pagato.tolist()[0], 1000)
+        self.assertEqual(s.pagamenti_metodo['carta'].tolist()[:2], [2000, 2000])
+        self.assertEqual(s.portali.tolist()[:2], [3000, 3000])
+        self.assertEqual(s.cambia.tolist()[:2], [1000, 1000])
+        self.assertEqual(s.registratore.tolist()[:2], [9900, 9900])
+        self.assertEqual(s.wash_cycles.tolist()[:2], [3, 3])
+        self.assertEqual(s.wc_servito.tolist()[:2], [1, 1])
+        self.assertEqual(s.per_giorno_settimana(s.wash_cycles).tolist(),
+                         [3, 3, 0, 0, 0, 0, 0])
+
+        quadratura = s.quadratura_aggregata()
+        self.assertEqual((quadratura['giorni_ok'], quadratura['giorni_diff']), (1, 1))
+        self.assertEqual(quadratura['differenza_cumulativa'], Decimal('-2'))
+        self.assertEqual(quadratura['giorno_peggiore']['data'], LUNEDI + timedelta(days=1))
+
+        martedi = s.finestra(LUNEDI + timedelta(days=1), LUNEDI + timedelta(days=1))
+        self.assertEqual(martedi.ordini.tolist(), [2000])
+
+    @mock.patch('apps.finanze.weather.fetch_weather_range', return_value=None)
+    def test_report_periodo_query_costanti(self, _meteo):
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        url = reverse('finanze:report_periodo')
+
+        def report(data_fine):
+            with CaptureQueriesContext(connection) as ctx:
+                risposta = self.client.get(url, {
+                    'data_inizio': LUNEDI.isoformat(), 'data_fine': data_fine.isoformat()})
+            return risposta.context, len(ctx)
+
+        ctx, query_settimana = report(LUNEDI + timedelta(days=6))
+        # servito ordinato (20 + 20 + 15) + self-service (2 x 40)
+        self.assertEqual(ctx['fatturato_totale'], Decimal('135.00'))
+        self.assertEqual(ctx['totale_non_pagato'], Decimal('10.00'))
+        self.assertEqual(ctx['totale_corrispettivi'], Decimal('278.00'))
+        self.assertEqual(ctx['giorni_ok'], 1)
+        self.assertEqual(json.loads(ctx['trend_wc_self_json'])[:2], [2, 2])
+        self.assertEqual(ctx['top_servizi'][0]['quantita'], 2)
+
+        _, query_anno = report(LUNEDI + timedelta(days=364))
+        self.assertEqual(query_anno, query_settimana)
+
+    def test_analisi_vendite(self):
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        ctx = self.client.get(reverse('finanze:analisi_vendite'), {
+            'periodo': 'personalizzato',
+            'data_inizio': (LUNEDI + timedelta(days=1)).isoformat(),
+            'data_fine': (LUNEDI + timedelta(days=1)).isoformat()}).context
+        self.assertEqual(ctx['totale_carte'], Decimal('20.00'))
+        self.assertEqual(ctx['totale_precedente'], Decimal('20.00'))
+        servizio = ctx['servizi_per_categoria']['Lavaggi'][0]
+        self.assertEqual((servizio['quantita'], servizio['prezzo_medio']),
+                         (1, Decimal('20.00')))
+
+
+class LagAnalysisTest(TestCase):
+    def test_pearson_ignora_i_buchi(self):
+        self.assertEqual(_pearson([1, 2, None, 4], [2, 4, 100, 8]), 1.0)
+        self.assertIsNone(_pearson([1, 1, 1], [1, 2, 3]))
+
+    def test_lag(self):
+        driver = [0, 1, 0, 0, 1, 0, 0, 1, 0, 0]
+        fatturato = [0, 0, 1, 0, 0, 1, 0, 0, 1, 0]  # il giorno dopo
+        corr = {r['lag']: r['corr'] for r in
+                lag_correlation_series(driver, fatturato, [0, 1, 2])}
+        self.assertEqual(corr[1], 1.0)
+        self.assertLess(corr[0], 0)
+
+    def test_festivita(self):
+        giorni = 10
+        ris = analyze_holidays(date(2026, 12, 20), date(2026, 12, 29),
+                               [100.0] * giorni)
+        categorie = {c['key']: c for c in ris['categories']}
+        self.assertEqual(categorie['festivo']['count'], 2)  # 25 e 26
+        self.assertEqual(sum(c['count'] for c in ris['categories']), giorni)
+        self.assertEqual(categorie['festivo']['totale'], 200.0)
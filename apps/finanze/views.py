@@ -8,6 +8,8 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 import json
 
+import numpy as np
+
 from .models import ChiusuraCassa, MovimentoCassa, Cassa, ChiusuraCassaAutomatica, QuadraturaGiornaliera
 from apps.ordini.models import Pagamento, Ordine, ItemOrdine
 from apps.core.models import Categoria
@@ -535,19 +537,29 @@ def analisi_vendite(request):
         data_inizio = oggi
         data_fine = oggi
 
-    # Pagamenti nel periodo
-    pagamenti_periodo = Pagamento.objects.filter(
-        data_pagamento__date__gte=data_inizio,
-        data_pagamento__date__lte=data_fine
-    ).select_related('ordine', 'operatore')
+    if data_fine < data_inizio:
+        data_inizio, data_fine = data_fine, data_inizio
+
+    # Serie giornaliere di periodo + periodo precedente (stessa durata)
+    # in una passata: vedi analitica.py.
+    from .analitica import euro, serie_periodo, vendite_per_servizio
+    giorni_periodo = (data_fine - data_inizio).days + 1
+    data_inizio_precedente = data_inizio - timedelta(days=giorni_periodo)
+    data_fine_precedente = data_inizio - timedelta(days=1)
+    tutto = serie_periodo(data_inizio_precedente, data_fine)
+    serie = tutto.finestra(data_inizio, data_fine)
 
     # Totali per metodo
-    totale_contanti = pagamenti_periodo.filter(metodo='contanti').aggregate(Sum('importo'))['importo__sum'] or Decimal('0.00')
-    totale_carte = pagamenti_periodo.filter(metodo='carta').aggregate(Sum('importo'))['importo__sum'] or Decimal('0.00')
-    totale_bancomat = pagamenti_periodo.filter(metodo='bancomat').aggregate(Sum('importo'))['importo__sum'] or Decimal('0.00')
-    totale_bonifici = pagamenti_periodo.filter(metodo='bonifico').aggregate(Sum('importo'))['importo__sum'] or Decimal('0.00')
-    totale_assegni = pagamenti_periodo.filter(metodo='assegno').aggregate(Sum('importo'))['importo__sum'] or Decimal('0.00')
-    totale_abbonamenti = pagamenti_periodo.filter(metodo='abbonamento').aggregate(Sum('importo'))['importo__sum'] or Decimal('0.00')
+    def totale_metodo(metodo):
+        valori = serie.pagamenti_metodo.get(metodo)
+        return euro(valori.sum()) if valori is not None else Decimal('0.00')
+
+    totale_contanti = totale_metodo('contanti')
+    totale_carte = totale_metodo('carta')
+    totale_bancomat = totale_metodo('bancomat')
+    totale_bonifici = totale_metodo('bonifico')
+    totale_assegni = totale_metodo('assegno')
+    totale_abbonamenti = totale_metodo('abbonamento')
 
     # Totale generale
     totale_periodo = (
@@ -556,91 +568,36 @@ def analisi_vendite(request):
     )
 
     # Statistiche generali
-    num_transazioni = pagamenti_periodo.count()
+    num_transazioni = int(serie.num_pagamenti.sum())
     scontrino_medio = totale_periodo / num_transazioni if num_transazioni > 0 else Decimal('0.00')
 
-    # Calcola range date
-    giorni_periodo = (data_fine - data_inizio).days + 1
     media_giornaliera = totale_periodo / giorni_periodo if giorni_periodo > 0 else Decimal('0.00')
 
-    # Analisi per categoria
-    items_periodo = ItemOrdine.objects.filter(
-        ordine__data_ora__date__gte=data_inizio,
-        ordine__data_ora__date__lte=data_fine,
-        ordine__stato_pagamento='pagato'
-    ).select_related('servizio_prodotto__categoria')
-
-    categorie_stats = {}
-    for item in items_periodo:
-        categoria_nome = item.servizio_prodotto.categoria.nome
-        if categoria_nome not in categorie_stats:
-            categorie_stats[categoria_nome] = {
-                'nome': categoria_nome,
-                'quantita': 0,
-                'fatturato': Decimal('0.00')
-            }
-        categorie_stats[categoria_nome]['quantita'] += item.quantita
-        categorie_stats[categoria_nome]['fatturato'] += item.subtotale
-
-    categorie_report = sorted(
-        categorie_stats.values(),
-        key=lambda x: x['fatturato'],
-        reverse=True
-    )
-
-    # Analisi servizi per categoria
-    servizi_stats = {}
-    for item in items_periodo:
-        servizio_nome = item.servizio_prodotto.titolo
-        if servizio_nome not in servizi_stats:
-            servizi_stats[servizio_nome] = {
-                'nome': servizio_nome,
-                'categoria': item.servizio_prodotto.categoria.nome,
-                'quantita': 0,
-                'fatturato': Decimal('0.00'),
-                'prezzo_medio': item.prezzo_unitario
-            }
-        servizi_stats[servizio_nome]['quantita'] += item.quantita
-        servizi_stats[servizio_nome]['fatturato'] += item.subtotale
-
-    # Raggruppa per categoria
+    # Analisi per categoria e servizi per categoria (GROUP BY servizio)
+    servizi, categorie_report = vendite_per_servizio(data_inizio, data_fine)
     servizi_per_categoria = {}
-    for servizio_nome, servizio_data in servizi_stats.items():
-        cat_nome = servizio_data['categoria']
-        if cat_nome not in servizi_per_categoria:
-            servizi_per_categoria[cat_nome] = []
-        servizi_per_categoria[cat_nome].append(servizio_data)
+    for servizio_data in servizi:
+        servizio_data['prezzo_medio'] = (
+            servizio_data['fatturato'] / servizio_data['quantita']
+            if servizio_data['quantita'] else Decimal('0.00'))
+        servizi_per_categoria.setdefault(servizio_data['categoria'], []).append(servizio_data)
 
     for cat_nome in servizi_per_categoria:
         servizi_per_categoria[cat_nome].sort(key=lambda x: x['quantita'], reverse=True)
 
     # Confronto con periodo precedente
-    data_inizio_precedente = data_inizio - timedelta(days=giorni_periodo)
-    data_fine_precedente = data_inizio - timedelta(days=1)
-
-    pagamenti_precedente = Pagamento.objects.filter(
-        data_pagamento__date__gte=data_inizio_precedente,
-        data_pagamento__date__lte=data_fine_precedente
-    )
-    totale_precedente = pagamenti_precedente.aggregate(Sum('importo'))['importo__sum'] or Decimal('0.00')
+    totale_precedente = euro(
+        tutto.finestra(data_inizio_precedente, data_fine_precedente).pagamenti.sum())
 
     variazione_percentuale = None
     if totale_precedente > 0:
         variazione_percentuale = ((totale_periodo - totale_precedente) / totale_precedente) * 100
 
     # Analisi giornaliera (per grafici trend)
-    giorni_trend = []
-    data_corrente = data_inizio
-    while data_corrente <= data_fine:
-        totale_giorno = Pagamento.objects.filter(
-            data_pagamento__date=data_corrente
-        ).aggregate(Sum('importo'))['importo__sum'] or Decimal('0.00')
-
-        giorni_trend.append({
-            'data': data_corrente,
-            'totale': totale_giorno
-        })
-        data_corrente += timedelta(days=1)
+    giorni_trend = [
+        {'data': d, 'totale': euro(cent)}
+        for d, cent in zip(serie.date, serie.pagamenti.tolist())
+    ]
 
     context = {
         'periodo_tipo': periodo_tipo,
@@ -1241,33 +1198,29 @@ def report_periodo(request):
 
     giorni_periodo = (data_fine - data_inizio).days + 1
 
+    # Tutte le serie giornaliere (periodo + periodo precedente per il
+    # confronto) in poche GROUP BY, come array NumPy: vedi analitica.py.
+    from .analitica import euro, pagamenti_per_ora, serie_periodo, vendite_per_servizio
+    data_inizio_prev = data_inizio - timedelta(days=giorni_periodo)
+    data_fine_prev = data_inizio - timedelta(days=1)
+    tutto = serie_periodo(data_inizio_prev, data_fine)
+    serie = tutto.finestra(data_inizio, data_fine)
+    prev = tutto.finestra(data_inizio_prev, data_fine_prev)
+
     # ==================== AGGREGATI ORDINI ====================
-    ordini_qs = Ordine.objects.filter(
-        data_ora__date__gte=data_inizio,
-        data_ora__date__lte=data_fine,
-    ).exclude(stato='annullato')
-    num_ordini = ordini_qs.count()
-    totale_servito_ordinato = ordini_qs.aggregate(s=Sum('totale_finale'))['s'] or Decimal('0.00')
+    num_ordini = int(serie.num_ordini.sum())
+    totale_servito_ordinato = euro(serie.ordini.sum())
 
     # Non pagati
-    non_pagati_qs = ordini_qs.filter(stato_pagamento__in=['non_pagato', 'parziale', 'differito'])
-    num_non_pagati = non_pagati_qs.count()
-    totale_non_pagato = Decimal('0.00')
-    for o in non_pagati_qs:
-        totale_non_pagato += o.saldo_dovuto
+    num_non_pagati = int(serie.num_non_pagati.sum())
+    totale_non_pagato = euro(serie.non_pagato.sum())
 
     # ==================== AGGREGATI PAGAMENTI ====================
-    pagamenti_qs = Pagamento.objects.filter(
-        data_pagamento__date__gte=data_inizio,
-        data_pagamento__date__lte=data_fine,
-    )
-    totale_servito_pagato = pagamenti_qs.aggregate(s=Sum('importo'))['s'] or Decimal('0.00')
-    num_transazioni = pagamenti_qs.count()
+    totale_servito_pagato = euro(serie.pagamenti.sum())
+    num_transazioni = int(serie.num_pagamenti.sum())
 
     # Metodi pagamento
-    metodi_totali = {}
-    for p in pagamenti_qs.values('metodo').annotate(tot=Sum('importo')):
-        metodi_totali[p['metodo'] or 'altro'] = p['tot'] or Decimal('0.00')
+    metodi_totali = {m: euro(v.sum()) for m, v in serie.pagamenti_metodo.items() if v.any()}
 
     metodi_labels = {
         'contanti': 'Contanti', 'carta': 'Carta', 'bancomat': 'Bancomat',
@@ -1280,27 +1233,11 @@ def report_periodo(request):
     )
 
     # ==================== AGGREGATI CHIUSURE AUTOMATICHE ====================
-    chiusure_qs = ChiusuraCassaAutomatica.objects.filter(
-        data__gte=data_inizio, data__lte=data_fine,
-    ).select_related('cassa')
-
-    totale_portali = Decimal('0.00')
-    totale_cambia_gettoni = Decimal('0.00')
-    totale_registratore = Decimal('0.00')
-    totale_wash_cycles = 0
-    vendita_self_service = Decimal('0.00')
-
-    for c in chiusure_qs:
-        if c.cassa.modalita_registratore:
-            totale_registratore += c.incasso_totale
-            continue
-        vendita_self_service += c.vendita_totale
-        if c.cassa.tracking_washcycles:
-            totale_portali += c.vendita_totale
-            if c.wash_cycles:
-                totale_wash_cycles += c.wash_cycles
-        else:
-            totale_cambia_gettoni += c.vendita_totale
+    totale_portali = euro(serie.portali.sum())
+    totale_cambia_gettoni = euro(serie.cambia.sum())
+    totale_registratore = euro(serie.registratore.sum())
+    totale_wash_cycles = int(serie.wash_cycles.sum())
+    vendita_self_service = totale_portali + totale_cambia_gettoni
 
     totale_self_service = totale_portali + totale_cambia_gettoni
 
@@ -1316,14 +1253,8 @@ def report_periodo(request):
     # ==================== RILEVATO REALE (quadrature giornaliere) ====================
     # Somma delle Quadrature giornaliere nel periodo. Usa la stessa
     # formula del report giornata: contanti + lettore carte - fondo cassa.
-    quadrature_qs = QuadraturaGiornaliera.objects.filter(
-        data__gte=data_inizio, data__lte=data_fine,
-    )
-    totale_rilevato_reale = Decimal('0.00')
-    num_quadrature = 0
-    for q in quadrature_qs:
-        totale_rilevato_reale += q.totale_reale
-        num_quadrature += 1
+    totale_rilevato_reale = euro(serie.quadratura.sum())
+    num_quadrature = int(serie.ha_quadratura.sum())
     # Differenza vs teorico (= fatturato_totale incassato)
     diff_rilevato_vs_teorico = totale_rilevato_reale - fatturato_totale
 
@@ -1342,124 +1273,32 @@ def report_periodo(request):
     pct_incasso = float(totale_incassato / fatturato_totale * 100) if fatturato_totale > 0 else 100.0
 
     # ==================== CONFRONTO PERIODO PRECEDENTE ====================
-    data_inizio_prev = data_inizio - timedelta(days=giorni_periodo)
-    data_fine_prev = data_inizio - timedelta(days=1)
-    fatturato_prev_ordini = Ordine.objects.filter(
-        data_ora__date__gte=data_inizio_prev,
-        data_ora__date__lte=data_fine_prev,
-    ).exclude(stato='annullato').aggregate(s=Sum('totale_finale'))['s'] or Decimal('0.00')
-    vendita_prev_auto = Decimal('0.00')
-    for c in ChiusuraCassaAutomatica.objects.filter(
-        data__gte=data_inizio_prev, data__lte=data_fine_prev,
-    ).select_related('cassa'):
-        if not c.cassa.modalita_registratore:
-            vendita_prev_auto += c.vendita_totale
-    fatturato_prev = fatturato_prev_ordini + vendita_prev_auto
+    fatturato_prev = euro(prev.ordini.sum() + prev.self_service.sum())
     variazione_pct = float((fatturato_totale - fatturato_prev) / fatturato_prev * 100) if fatturato_prev > 0 else None
 
     # ==================== QUADRATURA AGGREGATA ====================
-    quadrature_qs = QuadraturaGiornaliera.objects.filter(
-        data__gte=data_inizio, data__lte=data_fine,
-    )
-    giorni_ok = 0
-    giorni_diff = 0
-    giorni_rilevati = 0
-    differenza_cumulativa = Decimal('0.00')
-    giorno_peggiore = None
-    peggiore_abs = Decimal('0.00')
-
-    # Indice pre-calcolato: teorico per giorno
-    for q in quadrature_qs:
-        # Ricalcola teorico per quel giorno
-        day_ordini = Ordine.objects.filter(
-            data_ora__date=q.data
-        ).exclude(stato='annullato').aggregate(s=Sum('totale_finale'))['s'] or Decimal('0.00')
-        day_pag = Pagamento.objects.filter(
-            data_pagamento__date=q.data
-        ).aggregate(s=Sum('importo'))['s'] or Decimal('0.00')
-        day_self = Decimal('0.00')
-        for c in ChiusuraCassaAutomatica.objects.filter(data=q.data).select_related('cassa'):
-            if not c.cassa.modalita_registratore:
-                day_self += c.vendita_totale
-        day_teorico = day_self + day_pag
-        day_diff = q.totale_reale - day_teorico
-        differenza_cumulativa += day_diff
-        giorni_rilevati += 1
-        if abs(day_diff) < Decimal('0.50'):
-            giorni_ok += 1
-        else:
-            giorni_diff += 1
-            if abs(day_diff) > peggiore_abs:
-                peggiore_abs = abs(day_diff)
-                giorno_peggiore = {'data': q.data, 'differenza': day_diff}
-    giorni_non_rilevati = giorni_periodo - giorni_rilevati
+    # Per giorno: reale - (pagamenti + self-service), su maschera
+    quadratura = serie.quadratura_aggregata()
+    giorni_ok = quadratura['giorni_ok']
+    giorni_diff = quadratura['giorni_diff']
+    differenza_cumulativa = quadratura['differenza_cumulativa']
+    giorno_peggiore = quadratura['giorno_peggiore']
+    giorni_non_rilevati = giorni_periodo - quadratura['giorni_rilevati']
 
     # ==================== TOP SERVIZI E CATEGORIE ====================
-    items_qs = ItemOrdine.objects.filter(
-        ordine__data_ora__date__gte=data_inizio,
-        ordine__data_ora__date__lte=data_fine,
-        ordine__stato_pagamento='pagato',
-    ).select_related('servizio_prodotto__categoria')
-
-    servizi_stats = {}
-    categorie_stats = {}
-    for item in items_qs:
-        sp = item.servizio_prodotto
-        servizi_stats.setdefault(sp.titolo, {
-            'nome': sp.titolo,
-            'categoria': sp.categoria.nome if sp.categoria else '—',
-            'quantita': 0, 'fatturato': Decimal('0.00'),
-        })
-        servizi_stats[sp.titolo]['quantita'] += item.quantita
-        servizi_stats[sp.titolo]['fatturato'] += item.subtotale
-        if sp.categoria:
-            categorie_stats.setdefault(sp.categoria.nome, {
-                'nome': sp.categoria.nome, 'quantita': 0, 'fatturato': Decimal('0.00'),
-            })
-            categorie_stats[sp.categoria.nome]['quantita'] += item.quantita
-            categorie_stats[sp.categoria.nome]['fatturato'] += item.subtotale
-
-    top_servizi = sorted(servizi_stats.values(), key=lambda x: -x['fatturato'])[:10]
-    top_categorie = sorted(categorie_stats.values(), key=lambda x: -x['fatturato'])
+    servizi, top_categorie = vendite_per_servizio(data_inizio, data_fine)
+    top_servizi = servizi[:10]
     categorie_chart = [
         {'nome': c['nome'], 'fatturato': float(c['fatturato']), 'quantita': c['quantita']}
         for c in top_categorie
     ]
 
     # ==================== TREND GIORNALIERO ====================
-    trend_labels = []
-    trend_servito = []
-    trend_portali = []
-    trend_cambia = []
-    trend_washcycles = []
-
-    # Pre-indicizza per data
-    ord_by_day = {}
-    for row in ordini_qs.values('data_ora__date').annotate(s=Sum('totale_finale')):
-        ord_by_day[row['data_ora__date']] = row['s'] or Decimal('0.00')
-
-    auto_by_day = {}  # {date: {'portali': X, 'cambia': Y, 'washcycles': Z}}
-    for c in chiusure_qs:
-        if c.cassa.modalita_registratore:
-            continue
-        d = c.data
-        auto_by_day.setdefault(d, {'portali': Decimal('0.00'), 'cambia': Decimal('0.00'), 'washcycles': 0})
-        if c.cassa.tracking_washcycles:
-            auto_by_day[d]['portali'] += c.vendita_totale
-            if c.wash_cycles:
-                auto_by_day[d]['washcycles'] += c.wash_cycles
-        else:
-            auto_by_day[d]['cambia'] += c.vendita_totale
-
-    d = data_inizio
-    while d <= data_fine:
-        trend_labels.append(d.strftime('%d/%m'))
-        trend_servito.append(float(ord_by_day.get(d, Decimal('0.00'))))
-        a = auto_by_day.get(d, {'portali': Decimal('0.00'), 'cambia': Decimal('0.00'), 'washcycles': 0})
-        trend_portali.append(float(a['portali']))
-        trend_cambia.append(float(a['cambia']))
-        trend_washcycles.append(a['washcycles'])
-        d += timedelta(days=1)
+    trend_labels = [d.strftime('%d/%m') for d in serie.date]
+    trend_servito = (serie.ordini / 100).tolist()
+    trend_portali = (serie.portali / 100).tolist()
+    trend_cambia = (serie.cambia / 100).tolist()
+    trend_washcycles = serie.wash_cycles.tolist()
 
     # ==================== WASHCYCLES: AGGREGATO / SERVITO / SELF ====================
     # Aggregato = totale wash_cycles erogati dai portali (trend_washcycles)
@@ -1468,47 +1307,19 @@ def report_periodo(request):
     #             clienti che hanno ordinato un lavaggio completo)
     # Self      = aggregato - servito (clienti che hanno usato il portale
     #             autonomamente con token/abbonamento)
-    # ItemOrdine e' gia importato a top file (riga 12)
-    servito_by_day = {}
-    servito_items_qs = (
-        ItemOrdine.objects.filter(
-            ordine__data_ora__date__gte=data_inizio,
-            ordine__data_ora__date__lte=data_fine,
-            servizio_prodotto__titolo__icontains='lavaggio completo',
-        )
-        .exclude(ordine__stato='annullato')
-        .values('ordine__data_ora__date')
-        .annotate(qty=Sum('quantita'))
-    )
-    for row in servito_items_qs:
-        d = row['ordine__data_ora__date']
-        servito_by_day[d] = int(row['qty'] or 0)
-
+    wc_self = np.maximum(0, serie.wash_cycles - serie.wc_servito)
     trend_wc_aggregato = list(trend_washcycles)  # alias semantico
-    trend_wc_servito = []
-    trend_wc_self = []
-    d = data_inizio
-    while d <= data_fine:
-        agg = servito_by_day.get(d, 0)
-        trend_wc_servito.append(agg)
-        d += timedelta(days=1)
-    for i in range(len(trend_wc_aggregato)):
-        trend_wc_self.append(max(0, trend_wc_aggregato[i] - trend_wc_servito[i]))
+    trend_wc_servito = serie.wc_servito.tolist()
+    trend_wc_self = wc_self.tolist()
 
     totale_wc_aggregato = sum(trend_wc_aggregato)
     totale_wc_servito = sum(trend_wc_servito)
     totale_wc_self = sum(trend_wc_self)
 
     # Per giorno della settimana (0=lun ... 6=dom)
-    gs_wc_aggregato = [0] * 7
-    gs_wc_servito = [0] * 7
-    gs_wc_self = [0] * 7
-    for i in range(len(trend_labels)):
-        d_date = data_inizio + timedelta(days=i)
-        wd = d_date.weekday()
-        gs_wc_aggregato[wd] += trend_wc_aggregato[i]
-        gs_wc_servito[wd] += trend_wc_servito[i]
-        gs_wc_self[wd] += trend_wc_self[i]
+    gs_wc_aggregato = serie.per_giorno_settimana(serie.wash_cycles).astype(int).tolist()
+    gs_wc_servito = serie.per_giorno_settimana(serie.wc_servito).astype(int).tolist()
+    gs_wc_self = serie.per_giorno_settimana(wc_self).astype(int).tolist()
 
     # ==================== METEO LICATA + LAG ANALYSIS ====================
     # Tenta di recuperare dati meteo Open-Meteo. Best-effort: se l'API
@@ -1516,10 +1327,8 @@ def report_periodo(request):
     from .weather import fetch_weather_range, correlate_revenue_weather
     from .lag_analysis import lag_correlation_series
     weather = fetch_weather_range(data_inizio, data_fine)
-    fatturato_per_giorno = [
-        trend_servito[i] + trend_portali[i] + trend_cambia[i]
-        for i in range(len(trend_labels))
-    ]
+    fatturato_giorno = serie.ordini + serie.self_service
+    fatturato_per_giorno = (fatturato_giorno / 100).tolist()
     weather_corr = correlate_revenue_weather(fatturato_per_giorno, weather) if weather else {}
 
     # Allinea le serie meteo all'array trend_labels (giorno per giorno).
@@ -1531,12 +1340,10 @@ def report_periodo(request):
         wmap_tmax = dict(zip(weather['dates'], weather['temp_max']))
         wmap_pr = dict(zip(weather['dates'], weather['precipitation']))
         wmap_sun = dict(zip(weather['dates'], weather['sunshine_hours']))
-        d = data_inizio
-        while d <= data_fine:
+        for d in serie.date:
             weather_temp_max.append(wmap_tmax.get(d))
             weather_precip.append(wmap_pr.get(d))
             weather_sun.append(wmap_sun.get(d))
-            d += timedelta(days=1)
 
     # Lag analysis meteo: correlazione fatturato di oggi vs meteo di N
     # giorni fa. Lag 0..7.
@@ -1552,10 +1359,7 @@ def report_periodo(request):
 
     # ==================== CAMBIA GETTONI (piste + accessori) ====================
     # Fatturato per giorno settimana
-    gs_cambia = [0.0] * 7
-    for i in range(len(trend_labels)):
-        d_date = data_inizio + timedelta(days=i)
-        gs_cambia[d_date.weekday()] += trend_cambia[i]
+    gs_cambia = (serie.per_giorno_settimana(serie.cambia) / 100).tolist()
 
     media_cambia_giornaliera = (
         float(totale_cambia_gettoni) / giorni_periodo if giorni_periodo > 0 else 0.0
@@ -1572,28 +1376,18 @@ def report_periodo(request):
     # ==================== FATTURATO PER GIORNO SETTIMANA ====================
     # 0=lun ... 6=dom
     giorni_settimana_labels = ['Lun', 'Mar', 'Mer', 'Gio', 'Ven', 'Sab', 'Dom']
-    giorni_settimana_tot = [0.0] * 7
-    for i, label in enumerate(trend_labels):
-        d_date = data_inizio + timedelta(days=i)
-        giorni_settimana_tot[d_date.weekday()] += trend_servito[i] + trend_portali[i] + trend_cambia[i]
+    giorni_settimana_tot = (serie.per_giorno_settimana(fatturato_giorno) / 100).tolist()
 
     # Giorno di picco
-    max_idx = trend_servito and max(range(len(trend_servito)),
-        key=lambda i: trend_servito[i] + trend_portali[i] + trend_cambia[i])
     giorno_picco = None
-    if trend_servito:
-        pk_date = data_inizio + timedelta(days=max_idx)
-        pk_tot = trend_servito[max_idx] + trend_portali[max_idx] + trend_cambia[max_idx]
-        if pk_tot > 0:
-            giorno_picco = {'data': pk_date, 'totale': pk_tot}
+    if giorni_periodo and fatturato_giorno.max() > 0:
+        max_idx = int(np.argmax(fatturato_giorno))
+        giorno_picco = {'data': data_inizio + timedelta(days=max_idx),
+                        'totale': fatturato_per_giorno[max_idx]}
 
     # ==================== DISTRIBUZIONE ORARIA MEDIA ====================
-    # Usa l'ora locale (timezone Europe/Rome), non UTC come e' nel DB
-    ore_buckets = [0.0] * 24
-    for p in pagamenti_qs:
-        dt = p.data_pagamento
-        local_hour = timezone.localtime(dt).hour if timezone.is_aware(dt) else dt.hour
-        ore_buckets[local_hour] += float(p.importo)
+    # Ora locale (timezone Europe/Rome), non UTC come e' nel DB
+    ore_buckets = (pagamenti_per_ora(data_inizio, data_fine) / 100).tolist()
     ora_picco = None
     if any(ore_buckets):
         h = ore_buckets.index(max(ore_buckets))
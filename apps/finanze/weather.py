@@ -6,7 +6,7 @@ API: https://open-meteo.com
   gli ultimi giorni che l'archive non ha ancora consolidato)
 
 Coordinate predefinite: Licata (AG), Sicilia.
-Cache locale (Django cache framework) per evitare chiamate ripetute.
+Cache condivisa (apps.core.cache) per evitare chiamate ripetute.
 """
 import logging
 from datetime import date, timedelta
@@ -14,7 +14,7 @@ from urllib.parse import urlencode
 from urllib.request import urlopen, Request
 import json as _json
 
-from django.core.cache import cache
+from apps.core import cache as cache_condivisa
 
 logger = logging.getLogger(__name__)
 
@@ -22,7 +22,7 @@ logger = logging.getLogger(__name__)
 LICATA_LAT = 37.1037
 LICATA_LON = 13.9388
 
-_CACHE_PREFIX = 'weather_licata_v1_'
+_CACHE_PREFIX = 'weather_licata_v1:'
 _CACHE_TTL = 60 * 60 * 24  # 24h
 
 
@@ -55,7 +55,7 @@ def fetch_weather_range(data_inizio: date, data_fine: date,
     None se l'API e' irraggiungibile.
     """
     cache_key = f'{_CACHE_PREFIX}{lat}_{lon}_{data_inizio.isoformat()}_{data_fine.isoformat()}'
-    cached = cache.get(cache_key)
+    cached = cache_condivisa.leggi(cache_key)
     if cached is not None:
         return cached
 
@@ -125,7 +125,7 @@ def fetch_weather_range(data_inizio: date, data_fine: date,
     if not result['dates']:
         return None
 
-    cache.set(cache_key, result, _CACHE_TTL)
+    cache_condivisa.scrivi(cache_key, result, _CACHE_TTL)
     return result
 
 
@@ -137,27 +137,13 @@ def correlate_revenue_weather(fatturato_per_giorno: list[float], weather: dict)
     giorno con data_inizio + i giorni).
     weather: output di fetch_weather_range.
 
-    NB: per semplicita non importiamo numpy/scipy. Usiamo formula nativa.
+    Pearson vettoriale di lag_analysis (None nelle serie meteo = NaN).
     """
+    from .lag_analysis import _pearson
+
     if not weather or not fatturato_per_giorno:
         return {}
 
-    def _pearson(xs, ys):
-        clean = [(x, y) for x, y in zip(xs, ys) if x is not None and y is not None]
-        if len(clean) < 3:
-            return None
-        n = len(clean)
-        sum_x = sum(x for x, _ in clean)
-        sum_y = sum(y for _, y in clean)
-        mean_x = sum_x / n
-        mean_y = sum_y / n
-        cov = sum((x - mean_x) * (y - mean_y) for x, y in clean)
-        var_x = sum((x - mean_x) ** 2 for x, _ in clean) ** 0.5
-        var_y = sum((y - mean_y) ** 2 for _, y in clean) ** 0.5
-        if var_x == 0 or var_y == 0:
-            return None
-        return round(cov / (var_x * var_y), 3)
-
     return {
         'temp_max': _pearson(weather.get('temp_max') or [], fatturato_per_giorno),
         'precipitation': _pearson(weather.get('precipitation') or [], fatturato_per_giorno),
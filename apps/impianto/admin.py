@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import EventoImpianto
+from .models import AggregatoImpianto, EventoImpianto
 
 
 @admin.register(EventoImpianto)
@@ -16,3 +16,19 @@ class EventoImpiantoAdmin(admin.ModelAdmin):
 
     def has_change_permission(self, request, obj=None):
         return False
+
+
+@admin.register(AggregatoImpianto)
+class AggregatoImpiantoAdmin(admin.ModelAdmin):
+    """Aggregati orari/giornalieri per nodo (li scrive impianto_serie)."""
+    list_display = ('inizio', 'periodo', 'nodo', 'impulsi', 'minuti_online', 'eventi')
+    list_filter = ('periodo', 'nodo')
+    date_hierarchy = 'inizio'
+    readonly_fields = ('nodo', 'periodo', 'inizio', 'impulsi', 'minuti_online', 'eventi',
+                       'contatore_fine', 'online_fine', 'riepilogo', 'aggiornato_il')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
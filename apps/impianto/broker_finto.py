@@ -0,0 +1,124 @@
+"""Broker MQTT 3.1.1 minimale in-process, per test e benchmark.
+
+Implementa solo quello che serve al publisher del CRM: CONNECT/CONNACK,
+PUBLISH QoS 0/1 con PUBACK, SUBSCRIBE/SUBACK (senza inoltro),
+PINGREQ e DISCONNECT. Ogni PUBLISH ricevuto finisce in `pubblicati`
+come (istante, topic, payload).
+
+`rtt_ms` ritarda ogni risposta del broker (CONNACK, PUBACK, ...) per
+simulare la latenza di rete verso Mosquitto su Railway; `ack = False`
+smette di confermare i PUBLISH (per provare i timeout).
+
+    broker = BrokerFinto(rtt_ms=20).avvia()
+    ... MQTT_HOST='127.0.0.1', MQTT_PORT=broker.porta ...
+    broker.ferma()
+"""
+import socketserver
+import struct
+import threading
+import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 12, 13, 14
+
+
+def _leggi_esatti(sock, n: int) -> bytes:
+    dati = b''
+    while len(dati) < n:
+        pezzo = sock.recv(n - len(dati))
+        if not pezzo:
+            raise ConnectionError('connessione chiusa')
+        dati += pezzo
+    return dati
+
+
+def _leggi_pacchetto(sock):
+    primo = _leggi_esatti(sock, 1)[0]
+    lunghezza, moltiplicatore = 0, 1
+    while True:
+        b = _leggi_esatti(sock, 1)[0]
+        lunghezza += (b & 0x7F) * moltiplicatore
+        if not b & 0x80:
+            break
+        moltiplicatore *= 128
+    return primo >> 4, primo & 0x0F, _leggi_esatti(sock, lunghezza)
+
+
+class _Sessione(socketserver.BaseRequestHandler):
+    def _invia(self, dati: bytes):
+        with self.lock_invio:
+            try:
+                self.request.sendall(dati)
+            except OSError:
+                pass
+
+    def _rispondi(self, dati: bytes):
+        # Con la latenza simulata le risposte partono da un timer: i
+        # pacchetti in volo sulla stessa connessione si sovrappongono
+        # come su una rete vera invece di mettersi in fila.
+        if self.server.rtt_ms:
+            threading.Timer(self.server.rtt_ms / 1000, self._invia, (dati,)).start()
+        else:
+            self._invia(dati)
+
+    def handle(self):
+        server = self.server
+        self.lock_invio = threading.Lock()
+        with server.lock:
+            server.connessioni += 1
+        try:
+            while True:
+                tipo, flags, corpo = _leggi_pacchetto(self.request)
+                if tipo == CONNECT:
+                    self._rispondi(bytes((CONNACK << 4, 2, 0, 0)))
+                elif tipo == PUBLISH:
+                    qos = (flags >> 1) & 3
+                    (n,) = struct.unpack('!H', corpo[:2])
+                    topic = corpo[2:2 + n].decode()
+                    resto = corpo[2 + n:]
+                    mid = resto[:2] if qos else b''
+                    with server.lock:
+                        server.pubblicati.append(
+                            (time.monotonic(), topic, resto[len(mid):]))
+                    if qos and server.ack:
+                        self._rispondi(bytes((PUBACK << 4, 2)) + mid)
+                elif tipo == SUBSCRIBE:
+                    # packet id + (topic, qos)*: concede QoS 0 a tutto
+                    n_topic, i = 0, 2
+                    while i < len(corpo):
+                        (n,) = struct.unpack('!H', corpo[i:i + 2])
+                        i += 2 + n + 1
+                        n_topic += 1
+                    self._rispondi(bytes((SUBACK << 4, 2 + n_topic)) + corpo[:2]
+                                   + bytes(n_topic))
+                elif tipo == PINGREQ:
+                    self._rispondi(bytes((PINGRESP << 4, 0)))
+                elif tipo == DISCONNECT:
+                    return
+        except (ConnectionError, OSError):
+            return
+
+
+class BrokerFinto(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, rtt_ms: float = 0, porta: int = 0):
+        super().__init__(('127.0.0.1', porta), _Sessione)
+        self.rtt_ms = rtt_ms
+        self.ack = True
+        self.lock = threading.Lock()
+        self.pubblicati = []
+        self.connessioni = 0
+
+    @property
+    def porta(self) -> int:
+        return self.server_address[1]
+
+    def avvia(self) -> 'BrokerFinto':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def ferma(self):
+        self.shutdown()
+        self.server_close()
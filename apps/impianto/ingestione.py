@@ -0,0 +1,296 @@
+"""Pipeline di ingestione dei messaggi MQTT del listener impianto.
+
+Prima il callback on_message faceva tutto nel thread di rete paho: per
+ogni NotifyStatus una SELECT dell'ultimo contatore, una INSERT e
+aggiorna_verifiche(). Con il DB lento il socket MQTT si fermava (paho
+manda il PUBACK QoS 1 solo dopo il callback) e con piu' nodi
+(portali, piste, cambia gettoni) non si stava dietro al traffico.
+
+Ora il callback fa solo accoda(): mette (topic, payload) in una coda
+in memoria limitata (MQTT_CODA_MAX) e torna subito. Un thread scrittore
+preleva lotti ogni MQTT_LOTTO_MS (o appena ha MQTT_LOTTO_MAX messaggi) e
+per ogni lotto:
+
+- fa il parse e scarta i contatori invariati confrontandoli con una
+  cache in memoria dell'ultimo valore per nodo (caricata una volta
+  all'avvio, niente SELECT per messaggio);
+- scrive gli eventi nuovi con un'unica bulk_create e aggiorna
+  ContatoreNodo (ultimo totale per nodo, upsert);
+- aggiorna lo stato online e chiama aggiorna_verifiche() una volta per
+  nodo, con l'ultimo totale del lotto.
+
+Coda piena: accoda() aspetta fino ad ATTESA_CODA_PIENA_SEC (il thread
+paho rallenta e il broker trattiene i messaggi QoS 1: backpressure),
+poi scarta. Perdere un contatore e' innocuo, e' un totale assoluto che
+lo Shelly ripubblica ogni minuto. attese e scartati finiscono nelle
+statistiche, loggate ogni STATISTICHE_OGNI_SEC.
+
+Il listener e' un processo unico (mqtt_listener): la cache degli
+ultimi valori e' valida finche' nessun altro scrive contatori per gli
+stessi nodi.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+logger = logging.getLogger('apps.impianto.mqtt')
+
+ATTESA_CODA_PIENA_SEC = 0.5
+STATISTICHE_OGNI_SEC = 60
+# Un lotto che non si riesce a scrivere (DB giu') viene ritentato con
+# backoff prima di essere perso: intanto la coda fa da buffer.
+TENTATIVI_LOTTO = 5
+BACKOFF_LOTTO_SEC = 1
+
+# Tipi di evento per cui si salvano solo i cambi di valore
+TIPI_DEDUP = ('contatore', 'online')
+
+
+def nodo_da_topic(topic: str) -> str:
+    # autolavaggio/<nodo>/events/rpc oppure autolavaggio/<nodo>/online
+    parti = topic.split('/')
+    return parti[1] if len(parti) > 1 else '?'
+
+
+class Ingestore:
+    """Coda limitata + thread scrittore a lotti verso EventoImpianto."""
+
+    def __init__(self, coda_max: int = None, lotto_ms: int = None,
+                 lotto_max: int = None):
+        self.coda = queue.Queue(maxsize=coda_max or settings.MQTT_CODA_MAX)
+        self.lotto_sec = (lotto_ms or settings.MQTT_LOTTO_MS) / 1000
+        self.lotto_max = lotto_max or settings.MQTT_LOTTO_MAX
+        self.contatori = Counter()
+        self._lock = threading.Lock()
+        self._ultimi = None  # (nodo, tipo_evento) -> valore
+        self._ferma = threading.Event()
+        self._thread = None
+        self._ultimo_scarto_loggato = 0.0
+        self._ultime_statistiche = time.monotonic()
+
+    # --- lato paho -------------------------------------------------
+
+    def accoda(self, topic: str, payload: bytes) -> bool:
+        """Mette il messaggio in coda. False se e' stato scartato."""
+        self._conta('ricevuti')
+        try:
+            self.coda.put_nowait((topic, payload))
+            return True
+        except queue.Full:
+            pass
+        self._conta('attese')
+        try:
+            self.coda.put((topic, payload), timeout=ATTESA_CODA_PIENA_SEC)
+            return True
+        except queue.Full:
+            self._conta('scartati')
+            ora = time.monotonic()
+            if ora - self._ultimo_scarto_loggato > 10:
+                self._ultimo_scarto_loggato = ora
+                logger.warning('Coda ingestione piena (%s): messaggi scartati '
+                               'finora %s', self.coda.maxsize,
+                               self.contatori['scartati'])
+            return False
+
+    def on_message(self, client, userdata, msg):
+        """Callback on_message paho: solo accodamento."""
+        self.accoda(msg.topic, msg.payload)
+
+    # --- thread scrittore ------------------------------------------
+
+    def avvia(self):
+        self._ferma.clear()
+        self._thread = threading.Thread(target=self._ciclo, name='mqtt-ingestione',
+                                        daemon=True)
+        self._thread.start()
+
+    def ferma(self, timeout: float = 30):
+        """Ferma lo scrittore dopo aver scritto quello che e' in coda."""
+        self._ferma.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def svuota(self) -> int:
+        """Scrive nel thread chiamante tutto quello che e' in coda."""
+        scritti = 0
+        while True:
+            lotto = self.preleva_lotto(attesa=0)
+            if not lotto:
+                return scritti
+            scritti += self.scrivi_lotto(lotto)
+
+    def _ciclo(self):
+        while not (self._ferma.is_set() and self.coda.empty()):
+            lotto = self.preleva_lotto(attesa=self.lotto_sec)
+            if lotto:
+                self._scrivi_con_ritentativi(lotto)
+            if time.monotonic() - self._ultime_statistiche >= STATISTICHE_OGNI_SEC:
+                self._ultime_statistiche = time.monotonic()
+                logger.info('Ingestione MQTT: %s', self.statistiche())
+        close_old_connections()
+
+    def preleva_lotto(self, attesa: float) -> list:
+        """Fino a lotto_max messaggi: aspetta il primo al massimo
+        `attesa` secondi, poi raccoglie quello che arriva entro la
+        finestra del lotto."""
+        try:
+            lotto = [self.coda.get(timeout=attesa) if attesa else self.coda.get_nowait()]
+        except queue.Empty:
+            return []
+        scadenza = time.monotonic() + (self.lotto_sec if attesa else 0)
+        while len(lotto) < self.lotto_max:
+            resta = scadenza - time.monotonic()
+            try:
+                lotto.append(self.coda.get(timeout=resta) if resta > 0
+                             else self.coda.get_nowait())
+            except queue.Empty:
+                break
+        return lotto
+
+    def _scrivi_con_ritentativi(self, lotto: list):
+        for tentativo in range(1, TENTATIVI_LOTTO + 1):
+            try:
+                self.scrivi_lotto(lotto)
+                return
+            except Exception:
+                logger.exception('Scrittura lotto di %s messaggi fallita '
+                                 '(tentativo %s/%s)', len(lotto), tentativo,
+                                 TENTATIVI_LOTTO)
+                if tentativo < TENTATIVI_LOTTO and not self._ferma.is_set():
+                    time.sleep(BACKOFF_LOTTO_SEC * 2 ** (tentativo - 1))
+        self._conta('persi', len(lotto))
+
+    def scrivi_lotto(self, lotto: list) -> int:
+        """Parse + dedup + bulk_create di un lotto. Ritorna gli eventi
+        scritti. La cache degli ultimi valori si aggiorna solo se la
+        scrittura va a buon fine (un lotto ritentato rifa' il dedup)."""
+        from apps.monete.models import NodoImpianto
+
+        from .models import ContatoreNodo, EventoImpianto
+        from .mqtt import estrai_eventi
+
+        close_old_connections()
+        if self._ultimi is None:
+            self._ultimi = self._carica_ultimi()
+
+        ultimi = {}
+        nuovi = []
+        stati_online = {}   # nodo -> ultimo stato del lotto
+        totali = {}         # nodo -> ultimo totale contatore del lotto
+        invariati = non_validi = 0
+
+        def cambiato(nodo, tipo, valore):
+            chiave = (nodo, tipo)
+            precedente = ultimi.get(chiave, self._ultimi.get(chiave))
+            ultimi[chiave] = valore
+            return precedente != valore
+
+        for topic, payload_raw in lotto:
+            nodo = nodo_da_topic(topic)
+            if topic.endswith('/online'):
+                stato = payload_raw.decode('utf-8', 'ignore').strip().lower() == 'true'
+                stati_online[nodo] = stato
+                if cambiato(nodo, 'online', int(stato)):
+                    nuovi.append(EventoImpianto(
+                        nodo=nodo, tipo_evento='online', valore=int(stato),
+                        payload={'online': stato}))
+                else:
+                    invariati += 1
+                continue
+
+            try:
+                payload = json.loads(payload_raw.decode('utf-8'))
+            except (ValueError, UnicodeDecodeError):
+                logger.warning('[%s] payload non JSON su %s: %r',
+                               nodo, topic, payload_raw[:200])
+                non_validi += 1
+                continue
+            if not isinstance(payload, dict):
+                non_validi += 1
+                continue
+
+            for tipo_evento, valore in estrai_eventi(payload):
+                # Lo Shelly ripubblica il contatore ogni minuto anche a
+                # valore invariato: salviamo solo i CAMBI.
+                if tipo_evento == 'contatore':
+                    if not cambiato(nodo, 'contatore', valore):
+                        invariati += 1
+                        continue
+                    totali[nodo] = valore
+                nuovi.append(EventoImpianto(
+                    nodo=nodo, tipo_evento=tipo_evento, valore=valore,
+                    payload=payload))
+
+        with transaction.atomic():
+            EventoImpianto.objects.bulk_create(nuovi)
+            if totali:
+                ContatoreNodo.objects.bulk_create(
+                    [ContatoreNodo(nodo=nodo, valore=totale)
+                     for nodo, totale in totali.items()],
+                    update_conflicts=True, unique_fields=['nodo'],
+                    update_fields=['valore', 'aggiornato_il'])
+        self._ultimi.update(ultimi)
+
+        for ev in nuovi:
+            logger.info('[%s] %s%s', ev.nodo, ev.tipo_evento,
+                        f' = {ev.valore}' if ev.valore is not None else '')
+
+        if stati_online:
+            adesso = timezone.now()
+            for nodo, stato in stati_online.items():
+                NodoImpianto.objects.filter(slug=nodo).update(
+                    online=stato, online_aggiornato_il=adesso)
+
+        # Riconciliazione monete: un nuovo totale del contatore puo'
+        # confermare i lavaggi in attesa di verifica
+        if totali:
+            from apps.monete.services.verifica import aggiorna_verifiche
+            for nodo, totale in totali.items():
+                try:
+                    aggiorna_verifiche(nodo, totale)
+                except Exception:
+                    logger.exception('[%s] errore verifica lavaggi', nodo)
+
+        with self._lock:
+            self.contatori['lotti'] += 1
+            self.contatori['elaborati'] += len(lotto)
+            self.contatori['scritti'] += len(nuovi)
+            self.contatori['invariati'] += invariati
+            self.contatori['non_validi'] += non_validi
+        return len(nuovi)
+
+    def _carica_ultimi(self) -> dict:
+        """Ultimo valore per (nodo, tipo) dei tipi deduplicati: due query."""
+        from .models import EventoImpianto
+
+        pks = (EventoImpianto.objects
+               .filter(tipo_evento__in=TIPI_DEDUP)
+               .values('nodo', 'tipo_evento').annotate(ultimo=Max('pk'))
+               .values_list('ultimo', flat=True))
+        return {(nodo, tipo): valore for nodo, tipo, valore in
+                EventoImpianto.objects.filter(pk__in=list(pks))
+                .values_list('nodo', 'tipo_evento', 'valore')}
+
+    # --- statistiche -----------------------------------------------
+
+    def _conta(self, chiave: str, n: int = 1):
+        with self._lock:
+            self.contatori[chiave] += n
+
+    def statistiche(self) -> dict:
+        with self._lock:
+            stats = {k: self.contatori[k] for k in (
+                'ricevuti', 'elaborati', 'scritti', 'invariati', 'non_validi',
+                'lotti', 'attese', 'scartati', 'persi')}
+        stats['in_coda'] = self.coda.qsize()
+        stats['coda_max'] = self.coda.maxsize
+        return stats
@@ -0,0 +1,158 @@
+"""Benchmark del publisher MQTT: connessione usa-e-getta vs persistente.
+
+Di default parte un broker finto in-process (broker_finto.py) con
+--rtt-ms di latenza simulata su ogni risposta (CONNACK, PUBACK); con
+--broker HOST:PORTA si misura contro un Mosquitto vero (es. quello di
+mosquitto-broker/ lanciato in locale), con le credenziali MQTT_* dei
+settings.
+
+Misura:
+1. latenza di avvio di un gettone (dal comando al PUBACK), --avvii
+   volte: il metodo di prima (client nuovo, CONNECT, publish, disconnect)
+   contro la sequenza sul publisher persistente;
+2. --nodi avvii contemporanei da --impulsi gettoni ciascuno: prima un
+   thread bloccato per tutta la sequenza per ogni avvio, ora un solo
+   scheduler. Riporta quanto resta occupato il chiamante, il tempo
+   totale e la pausa minima osservata tra due impulsi sullo stesso nodo.
+
+Uso:
+    python manage.py bench_mqtt_publisher
+    python manage.py bench_mqtt_publisher --rtt-ms 40 --nodi 12 --impulsi 5
+    python manage.py bench_mqtt_publisher --broker 127.0.0.1:1883
+"""
+import json
+import statistics
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.impianto.broker_finto import BrokerFinto
+from apps.impianto.mqtt import _nuovo_client
+from apps.impianto.publisher import PAUSA_MINIMA_SEC, Publisher
+
+PAYLOAD = json.dumps({'id': 1, 'src': 'crm', 'method': 'Switch.Set',
+                      'params': {'id': 1, 'on': True}})
+
+
+def avvio_usa_e_getta(host, porta, nodo, impulsi, pausa_s):
+    """Il moneta_virtuale di prima: client nuovo per ogni avvio."""
+    client = _nuovo_client(f'crm-pub-{uuid.uuid4().hex[:8]}')
+    try:
+        client.connect(host, porta, keepalive=30)
+        client.loop_start()
+        for i in range(impulsi):
+            info = client.publish(f'autolavaggio/{nodo}/rpc', PAYLOAD, qos=1)
+            info.wait_for_publish(timeout=10)
+            if not info.is_published():
+                return False
+            if i < impulsi - 1:
+                time.sleep(pausa_s)
+        return True
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+
+def _ms(valori):
+    valori = sorted(valori)
+    p95 = valori[min(len(valori) - 1, int(len(valori) * 0.95))]
+    return f'mediana {statistics.median(valori) * 1000:7.1f} ms, p95 {p95 * 1000:7.1f} ms'
+
+
+class Command(BaseCommand):
+    help = 'Misura latenza e concorrenza degli avvii: connessione usa-e-getta vs publisher persistente.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--broker', default='', help='HOST:PORTA di un broker vero.')
+        parser.add_argument('--rtt-ms', type=float, default=20,
+                            help='Latenza simulata del broker finto (default 20 ms).')
+        parser.add_argument('--avvii', type=int, default=20)
+        parser.add_argument('--nodi', type=int, default=8)
+        parser.add_argument('--impulsi', type=int, default=3)
+        parser.add_argument('--pausa', type=float, default=PAUSA_MINIMA_SEC)
+
+    def handle(self, *args, **options):
+        broker = None
+        if options['broker']:
+            host, _, porta = options['broker'].partition(':')
+            if not porta.isdigit():
+                raise CommandError('--broker deve essere HOST:PORTA.')
+            porta = int(porta)
+            self.stdout.write(f'Broker {host}:{porta}')
+        else:
+            broker = BrokerFinto(rtt_ms=options['rtt_ms']).avvia()
+            host, porta = '127.0.0.1', broker.porta
+            self.stdout.write(f'Broker finto in-process, RTT simulato {options["rtt_ms"]:g} ms')
+
+        pub = Publisher(host, porta)
+        try:
+            self._latenza(host, porta, pub, options['avvii'])
+            self._concorrenza(host, porta, pub, options['nodi'], options['impulsi'],
+                              options['pausa'], broker)
+        finally:
+            pub.ferma()
+            if broker:
+                broker.ferma()
+
+    def _latenza(self, host, porta, pub, avvii):
+        prima, ora = [], []
+        for i in range(avvii):
+            t0 = time.perf_counter()
+            avvio_usa_e_getta(host, porta, f'bench{i}', 1, 0)
+            prima.append(time.perf_counter() - t0)
+        pub.avvia_sequenza('bench-riscaldamento', 1).attendi(30)
+        for i in range(avvii):
+            t0 = time.perf_counter()
+            ok, msg, _ = pub.avvia_sequenza(f'bench{i}', 1).attendi(30)
+            ora.append(time.perf_counter() - t0)
+            if not ok:
+                raise CommandError(msg)
+        self.stdout.write(f'Avvio di 1 gettone ({avvii} avvii):')
+        self.stdout.write(f'  connessione usa-e-getta  {_ms(prima)}')
+        self.stdout.write(f'  publisher persistente    {_ms(ora)}')
+
+    def _concorrenza(self, host, porta, pub, nodi, impulsi, pausa, broker):
+        self.stdout.write(f'{nodi} avvii contemporanei da {impulsi} gettoni '
+                          f'(pausa {pausa:g} s):')
+
+        occupato = []
+
+        def worker(nodo):
+            t0 = time.perf_counter()
+            avvio_usa_e_getta(host, porta, nodo, impulsi, pausa)
+            occupato.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(f'prima{i}',)) for i in range(nodi)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        totale = time.perf_counter() - t0
+        self.stdout.write(f'  connessione usa-e-getta  totale {totale:5.2f} s, '
+                          f'worker occupato {statistics.mean(occupato):5.2f} s per avvio')
+
+        if broker:
+            broker.pubblicati.clear()
+        t0 = time.perf_counter()
+        sequenze = [pub.avvia_sequenza(f'ora{i}', impulsi, pausa_s=pausa) for i in range(nodi)]
+        ritorno = (time.perf_counter() - t0) / nodi
+        esiti = [s.attendi(60) for s in sequenze]
+        totale = time.perf_counter() - t0
+        falliti = [m for ok, m, _ in esiti if not ok]
+        self.stdout.write(f'  publisher persistente    totale {totale:5.2f} s, '
+                          f'chiamante occupato {ritorno * 1e6:5.0f} µs per avvio')
+        if falliti:
+            self.stdout.write(self.style.ERROR(f'  {len(falliti)} sequenze fallite: {falliti[0]}'))
+
+        if broker:
+            istanti = defaultdict(list)
+            for t, topic, _ in broker.pubblicati:
+                istanti[topic].append(t)
+            pause = [b - a for ts in istanti.values() for a, b in zip(ts, ts[1:])]
+            if pause:
+                self.stdout.write(f'  pausa minima tra impulsi sullo stesso nodo: '
+                                  f'{min(pause):.2f} s (richiesta {max(pausa, PAUSA_MINIMA_SEC):g} s)')
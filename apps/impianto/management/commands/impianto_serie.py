@@ -0,0 +1,84 @@
+"""Rollup e retention degli eventi impianto (apps/impianto/serie.py).
+
+Da cron ogni ora: aggrega le ore complete dall'ultimo giro (per nodo:
+impulsi, minuti online, eventi), somma i giorni, poi cancella gli
+eventi grezzi oltre IMPIANTO_EVENTI_GIORNI e gli aggregati orari oltre
+IMPIANTO_AGGREGATI_ORARI_GIORNI. Con --da rifa' il rollup da una data
+(backfill, o dopo aver corretto degli eventi): le ore gia' potate non
+vengono toccate.
+
+--partiziona (solo Postgres, una tantum, col mqtt_listener fermo)
+converte la tabella eventi in partizioni mensili: da li' la retention
+e' un DROP dei mesi vecchi e ogni giro crea le partizioni dei mesi a
+venire.
+
+Uso:
+    python manage.py impianto_serie
+    python manage.py impianto_serie --da 2025-01-01 --senza-pulizia
+    python manage.py impianto_serie --dry-run
+    python manage.py impianto_serie --partiziona
+"""
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from apps.impianto import serie
+
+
+class Command(BaseCommand):
+    help = 'Aggrega gli eventi impianto per ora/giorno e pota gli eventi vecchi.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--da', default='',
+                            help='Rifa il rollup da questa data (YYYY-MM-DD).')
+        parser.add_argument('--senza-pulizia', action='store_true',
+                            help='Solo rollup, nessuna cancellazione.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Mostra cosa verrebbe aggregato e cancellato.')
+        parser.add_argument('--partiziona', action='store_true',
+                            help='Postgres: converte la tabella eventi in partizioni mensili.')
+
+    def handle(self, *args, **options):
+        if options['partiziona']:
+            if connection.vendor != 'postgresql':
+                raise CommandError('Il partizionamento e\' disponibile solo su Postgres.')
+            create = serie.partiziona()
+            if create:
+                self.stdout.write(self.style.SUCCESS(
+                    f'Tabella eventi partizionata: {len(create)} partizioni mensili.'))
+            else:
+                self.stdout.write('Tabella eventi gia\' partizionata.')
+            return
+
+        da = None
+        if options['da']:
+            try:
+                da = timezone.make_aware(datetime.strptime(options['da'], '%Y-%m-%d'))
+            except ValueError:
+                raise CommandError('--da deve essere nel formato YYYY-MM-DD.')
+
+        nuove = [] if options['dry_run'] else serie.mantieni_partizioni()
+        if nuove:
+            self.stdout.write(f'Partizioni create: {", ".join(nuove)}')
+
+        esito = serie.manutenzione(da=da, pulizia=not options['senza_pulizia'],
+                                   dry_run=options['dry_run'])
+        prefisso = '[dry-run] ' if options['dry_run'] else ''
+        self.stdout.write(
+            f'{prefisso}Rollup {timezone.localtime(esito["da"]):%d/%m/%Y %H:%M} -> '
+            f'{timezone.localtime(esito["a"]):%d/%m/%Y %H:%M}: '
+            f'{esito["orari_scritti"]} aggregati orari, {esito["giorni_scritti"]} giornalieri.')
+        if options['senza_pulizia']:
+            return
+        if esito['soglia_eventi'] is None:
+            self.stdout.write(f'{prefisso}Nessun aggregato ancora: eventi non potati.')
+        else:
+            self.stdout.write(
+                f'{prefisso}Eventi prima del '
+                f'{timezone.localtime(esito["soglia_eventi"]):%d/%m/%Y %H:%M}: '
+                f'{esito["eventi"]} cancellati'
+                + (f' (+ partizioni {", ".join(esito["partizioni"])})'
+                   if esito['partizioni'] else '') + '.')
+        self.stdout.write(f'{prefisso}Aggregati orari cancellati: {esito["orari"]}.')
@@ -5,7 +5,8 @@ Su Railway: nuovo servizio dallo stesso repo del CRM con start command
 e le stesse variabili d'ambiente (DATABASE_URL, MQTT_*).
 
 Si sottoscrive a autolavaggio/+/events/rpc e salva gli eventi
-(contatore impulsi, eventi input) in EventoImpianto. La riconnessione
+(contatore impulsi, eventi input) in EventoImpianto, a lotti tramite
+l'Ingestore (apps/impianto/ingestione.py). La riconnessione
 e' automatica con backoff (gestita da paho); se anche la PRIMA
 connessione fallisce, ritenta da solo.
 """
@@ -14,6 +15,7 @@ import logging
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from apps.impianto.ingestione import Ingestore
 from apps.impianto.mqtt import crea_listener, mqtt_configurato
 
 
@@ -37,7 +39,9 @@ class Command(BaseCommand):
             f'Listener MQTT verso {settings.MQTT_HOST}:{settings.MQTT_PORT} '
             f'(utente {settings.MQTT_USER})...')
 
-        client = crea_listener()
+        ingestore = Ingestore()
+        ingestore.avvia()
+        client = crea_listener(ingestore)
         # connect_async + loop_forever: se il broker non e' raggiungibile
         # alla partenza, paho ritenta con lo stesso backoff delle
         # riconnessioni invece di crashare il servizio.
@@ -48,3 +52,7 @@ class Command(BaseCommand):
         except KeyboardInterrupt:
             self.stdout.write('Arresto listener...')
             client.disconnect()
+        finally:
+            # Scrive quello che e' ancora in coda prima di uscire
+            ingestore.ferma()
+            self.stdout.write(f'Ingestione: {ingestore.statistiche()}')
@@ -0,0 +1,150 @@
+"""Rigioca una cattura di topic MQTT attraverso la pipeline del listener.
+
+Serve a misurare l'ingestione (messaggi/secondo, tempo nel callback,
+lotti, scarti) senza broker: i messaggi entrano da Ingestore.accoda()
+come farebbe il thread paho, il thread scrittore li salva a lotti.
+
+La cattura e' quella registrata dalla spia:
+    python mosquitto-broker/spia_topics.py HOST PORTA UTENTE PASSWORD cattura.jsonl
+(va bene anche l'output testuale della spia copiato in un file). Senza
+file, --sintetico N genera il traffico di N nodi: contatori che
+avanzano, ripubblicazioni a valore invariato, eventi input, online.
+
+I nodi vengono rinominati con --prefisso (default 'replay-', e una
+copia per ogni --ripeti): non si toccano contatori e verifiche dei nodi
+veri. Gli eventi scritti vengono cancellati alla fine, salvo --tieni.
+
+Uso:
+    python manage.py mqtt_replay cattura.jsonl
+    python manage.py mqtt_replay cattura.jsonl --ripeti 20 --lotto-ms 100
+    python manage.py mqtt_replay --sintetico 30 --messaggi 20000 --coda-max 2000
+"""
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.impianto.ingestione import Ingestore
+from apps.impianto.models import EventoImpianto
+
+
+def leggi_cattura(percorso: str) -> list:
+    """[(topic, payload bytes)] da una cattura JSONL o dal testo della spia."""
+    messaggi = []
+    with open(percorso, encoding='utf-8') as f:
+        righe = f.read().splitlines()
+    topic = None
+    for riga in righe:
+        if riga.startswith('{'):
+            try:
+                dato = json.loads(riga)
+            except ValueError:
+                continue
+            if 'topic' in dato:
+                messaggi.append((dato['topic'], str(dato.get('payload', '')).encode()))
+        elif riga.startswith('>>> '):
+            topic = riga[4:].strip()
+        elif topic and riga.strip():
+            messaggi.append((topic, riga.strip().encode()))
+            topic = None
+    return messaggi
+
+
+def cattura_sintetica(nodi: int, n_messaggi: int, seed: int = 1) -> list:
+    """Traffico verosimile: per lo piu' NotifyStatus col contatore (che
+    avanza una volta su cinque), qualche NotifyEvent e qualche online."""
+    rnd = random.Random(seed)
+    totali = {f'nodo{i}': rnd.randint(0, 50000) for i in range(nodi)}
+    messaggi = []
+    for _ in range(n_messaggi):
+        nodo = rnd.choice(list(totali))
+        caso = rnd.random()
+        if caso < 0.02:
+            messaggi.append((f'autolavaggio/{nodo}/online',
+                             rnd.choice((b'true', b'false'))))
+            continue
+        if caso < 0.10:
+            payload = {'method': 'NotifyEvent', 'params': {'events': [
+                {'component': 'input:2', 'event': 'single_push'}]}}
+        else:
+            if rnd.random() < 0.2:
+                totali[nodo] += 1
+            payload = {'method': 'NotifyStatus', 'params': {
+                'ts': time.time(), 'input:2': {'id': 2, 'counts': {'total': totali[nodo]}}}}
+        messaggi.append((f'autolavaggio/{nodo}/events/rpc', json.dumps(payload).encode()))
+    return messaggi
+
+
+def rinomina(topic: str, prefisso: str) -> str:
+    parti = topic.split('/')
+    if len(parti) > 1:
+        parti[1] = prefisso + parti[1]
+    return '/'.join(parti)
+
+
+class Command(BaseCommand):
+    help = 'Rigioca una cattura MQTT nell\'ingestione del listener e ne misura il throughput.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('cattura', nargs='?', help='File registrato dalla spia.')
+        parser.add_argument('--sintetico', type=int, metavar='NODI',
+                            help='Genera il traffico di NODI nodi invece di leggere un file.')
+        parser.add_argument('--messaggi', type=int, default=10000,
+                            help='Messaggi del traffico sintetico (default 10000).')
+        parser.add_argument('--ripeti', type=int, default=1,
+                            help='Copie della cattura, ognuna su nodi distinti.')
+        parser.add_argument('--prefisso', default='replay-')
+        parser.add_argument('--coda-max', type=int, default=None)
+        parser.add_argument('--lotto-ms', type=int, default=None)
+        parser.add_argument('--lotto-max', type=int, default=None)
+        parser.add_argument('--tieni', action='store_true',
+                            help='Non cancellare gli eventi scritti.')
+
+    def handle(self, *args, **options):
+        prefisso = options['prefisso']
+        if not prefisso:
+            raise CommandError('Serve un --prefisso non vuoto: i nodi veri non vanno toccati.')
+        if options['sintetico']:
+            base = cattura_sintetica(options['sintetico'], options['messaggi'])
+        elif options['cattura']:
+            base = leggi_cattura(options['cattura'])
+        else:
+            raise CommandError('Indica un file di cattura oppure --sintetico NODI.')
+        if not base:
+            raise CommandError('Nessun messaggio nella cattura.')
+
+        messaggi = []
+        for k in range(options['ripeti']):
+            p = f'{prefisso}{k}-' if options['ripeti'] > 1 else prefisso
+            messaggi.extend((rinomina(t, p), payload) for t, payload in base)
+
+        ingestore = Ingestore(coda_max=options['coda_max'], lotto_ms=options['lotto_ms'],
+                              lotto_max=options['lotto_max'])
+        ingestore.avvia()
+        t0 = time.perf_counter()
+        for topic, payload in messaggi:
+            ingestore.accoda(topic, payload)
+        t_callback = time.perf_counter() - t0
+        ingestore.ferma(timeout=600)
+        t_totale = time.perf_counter() - t0
+
+        stats = ingestore.statistiche()
+        n = len(messaggi)
+        self.stdout.write(
+            f'{n} messaggi in {t_totale:.2f}s: {n / t_totale:,.0f} msg/s '
+            f'(coda {stats["coda_max"]}, lotti da max {ingestore.lotto_max} '
+            f'ogni {ingestore.lotto_sec * 1000:.0f} ms)')
+        self.stdout.write(
+            f'  tempo medio nel callback: {t_callback / n * 1e6:.1f} µs/msg')
+        self.stdout.write(
+            f'  lotti {stats["lotti"]}, eventi scritti {stats["scritti"]}, '
+            f'invariati {stats["invariati"]}, non validi {stats["non_validi"]}')
+        stile = self.style.WARNING if stats['scartati'] or stats['persi'] else self.style.SUCCESS
+        self.stdout.write(stile(
+            f'  coda piena: attese {stats["attese"]}, scartati {stats["scartati"]}, '
+            f'persi in scrittura {stats["persi"]}'))
+
+        if not options['tieni']:
+            cancellati, _ = EventoImpianto.objects.filter(nodo__startswith=prefisso).delete()
+            self.stdout.write(f'Cancellati {cancellati} eventi {prefisso}*.')
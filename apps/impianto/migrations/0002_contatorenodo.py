@@ -0,0 +1,46 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:18
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def popola_contatori(apps, schema_editor):
+    """Ultimo evento 'contatore' di ogni nodo -> ContatoreNodo."""
+    EventoImpianto = apps.get_model('impianto', 'EventoImpianto')
+    ContatoreNodo = apps.get_model('impianto', 'ContatoreNodo')
+    ultimi = (EventoImpianto.objects.filter(tipo_evento='contatore')
+              .values('nodo').annotate(ultimo=Max('pk'))
+              .values_list('ultimo', flat=True))
+    ContatoreNodo.objects.bulk_create([
+        ContatoreNodo(nodo=nodo, valore=valore)
+        for nodo, valore in EventoImpianto.objects.filter(
+            pk__in=list(ultimi), valore__isnull=False).values_list('nodo', 'valore')
+    ])
+
+
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('impianto', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContatoreNodo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nodo', models.CharField(max_length=50, unique=True)),
+                ('valore', models.BigIntegerField()),
+                ('aggiornato_il', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Contatore nodo',
+                'verbose_name_plural': 'Contatori nodi',
+            },
+        ),
+        migrations.RunPython(popola_contatori, noop),
+    ]
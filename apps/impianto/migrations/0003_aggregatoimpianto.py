@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('impianto', '0002_contatorenodo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregatoImpianto',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nodo', models.CharField(max_length=50)),
+                ('periodo', models.CharField(choices=[('ora', 'Ora'), ('giorno', 'Giorno')], max_length=10)),
+                ('inizio', models.DateTimeField()),
+                ('impulsi', models.BigIntegerField(default=0)),
+                ('minuti_online', models.PositiveIntegerField(default=0)),
+                ('eventi', models.PositiveIntegerField(default=0)),
+                ('contatore_fine', models.BigIntegerField(blank=True, null=True)),
+                ('online_fine', models.BooleanField(blank=True, null=True)),
+                ('riepilogo', models.JSONField(blank=True, default=dict)),
+                ('aggiornato_il', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Aggregato impianto',
+                'verbose_name_plural': 'Aggregati impianto',
+                'ordering': ['-inizio'],
+                'indexes': [models.Index(fields=['periodo', 'inizio'], name='idx_aggregato_periodo')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='aggregatoimpianto',
+            constraint=models.UniqueConstraint(fields=('nodo', 'periodo', 'inizio'), name='uniq_aggregato_nodo_periodo'),
+        ),
+    ]
@@ -38,3 +38,67 @@ class EventoImpianto(models.Model):
     def __str__(self):
         val = f' = {self.valore}' if self.valore is not None else ''
         return f'[{self.nodo}] {self.tipo_evento}{val} @ {self.timestamp:%d/%m %H:%M:%S}'
+
+
+class ContatoreNodo(models.Model):
+    """Ultimo totale del contatore impulsi per nodo.
+
+    Copia di "l'ultimo EventoImpianto 'contatore' del nodo" tenuta dal
+    listener (Ingestore) a ogni lotto: baseline dell'avvio lavaggio e
+    riconciliazione monete la leggono con una lookup per chiave invece
+    di un ORDER BY sulla tabella eventi, che cresce di continuo.
+    """
+    nodo = models.CharField(max_length=50, unique=True)
+    valore = models.BigIntegerField()
+    aggiornato_il = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Contatore nodo'
+        verbose_name_plural = 'Contatori nodi'
+
+    def __str__(self):
+        return f'[{self.nodo}] {self.valore}'
+
+
+class AggregatoImpianto(models.Model):
+    """Riassunto per nodo di un'ora o di un giorno di EventoImpianto.
+
+    Lo scrive il rollup (serie.py, comando impianto_serie): gli eventi
+    grezzi restano IMPIANTO_EVENTI_GIORNI giorni, gli aggregati orari
+    IMPIANTO_AGGREGATI_ORARI_GIORNI, i giornalieri per sempre. I report
+    che contano i cicli per nodo leggono qui, non gli eventi.
+    """
+    PERIODI = [('ora', 'Ora'), ('giorno', 'Giorno')]
+
+    nodo = models.CharField(max_length=50)
+    periodo = models.CharField(max_length=10, choices=PERIODI)
+    # Inizio dell'ora (UTC) o mezzanotte locale del giorno
+    inizio = models.DateTimeField()
+
+    # Impulsi gettoniera contati: somma degli incrementi del contatore
+    impulsi = models.BigIntegerField(default=0)
+    minuti_online = models.PositiveIntegerField(default=0)
+    eventi = models.PositiveIntegerField(default=0)
+    # Stato a fine periodo: punto di partenza del rollup successivo
+    # quando gli eventi grezzi sono gia' stati potati
+    contatore_fine = models.BigIntegerField(null=True, blank=True)
+    online_fine = models.BooleanField(null=True, blank=True)
+    # Payload compattato: {tipo_evento: quanti} del periodo
+    riepilogo = models.JSONField(default=dict, blank=True)
+
+    aggiornato_il = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-inizio']
+        verbose_name = 'Aggregato impianto'
+        verbose_name_plural = 'Aggregati impianto'
+        constraints = [
+            models.UniqueConstraint(fields=['nodo', 'periodo', 'inizio'],
+                                    name='uniq_aggregato_nodo_periodo'),
+        ]
+        indexes = [
+            models.Index(fields=['periodo', 'inizio'], name='idx_aggregato_periodo'),
+        ]
+
+    def __str__(self):
+        return f'[{self.nodo}] {self.periodo} {self.inizio:%d/%m %H:%M}: {self.impulsi} impulsi'
@@ -5,24 +5,24 @@ Due ruoli distinti:
 1. LISTENER (`crea_listener` + comando `mqtt_listener`): si sottoscrive
    a `autolavaggio/+/events/rpc`, estrae dal payload RPC Shelly gli
    aggiornamenti del contatore impulsi e li salva in EventoImpianto.
+   Il callback accoda soltanto: parse e scrittura a lotti sono nel
+   thread dell'Ingestore (ingestione.py).
    Va eseguito come processo dedicato (`python manage.py mqtt_listener`).
 
-2. PUBLISHER (`moneta_virtuale`): apre una connessione usa-e-getta,
-   pubblica il comando RPC `Switch.Set` su `autolavaggio/<nodo>/rpc` e
-   chiude. Su OUT1 dello Shelly e' attivo un auto-off hardware di 1 s:
-   basta accendere, si spegne da solo -> NON inviamo mai lo spegnimento.
+2. PUBLISHER (`moneta_virtuale`, publisher.py): una connessione
+   persistente per processo pubblica il comando RPC `Switch.Set` su
+   `autolavaggio/<nodo>/rpc`, con gli impulsi distanziati da timer
+   invece che da sleep nel thread chiamante. Su OUT1 dello Shelly e'
+   attivo un auto-off hardware di 1 s: basta accendere, si spegne da
+   solo -> NON inviamo mai lo spegnimento.
 
 Configurazione da variabili d'ambiente (vedi config/settings.py):
 MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASSWORD. La riconnessione del
 listener e' automatica con backoff esponenziale (1s -> 120s).
 """
-import json
 import logging
-import time
-import uuid
 
 from django.conf import settings
-from django.db import close_old_connections
 
 import paho.mqtt.client as mqtt
 
@@ -95,98 +95,12 @@ def estrai_eventi(payload: dict) -> list:
     return eventi
 
 
-def _gestisci_online(nodo: str, payload_raw: bytes):
-    """Aggiorna lo stato online del NodoImpianto (se censito) e logga
-    il cambio in EventoImpianto (dedup sui replay retained)."""
-    from django.utils import timezone
-
-    from apps.monete.models import NodoImpianto
-
-    from .models import EventoImpianto
-
-    stato = payload_raw.decode('utf-8', 'ignore').strip().lower() == 'true'
-    close_old_connections()
-    aggiornati = NodoImpianto.objects.filter(slug=nodo).update(
-        online=stato, online_aggiornato_il=timezone.now())
-    if aggiornati:
-        logger.info('[%s] nodo %s', nodo, 'ONLINE' if stato else 'OFFLINE')
-
-    ultimo = (EventoImpianto.objects
-              .filter(nodo=nodo, tipo_evento='online')
-              .order_by('-pk').values_list('valore', flat=True).first())
-    if ultimo != int(stato):
-        EventoImpianto.objects.create(
-            nodo=nodo, tipo_evento='online', valore=int(stato),
-            payload={'online': stato})
-
-
-def _gestisci_messaggio(client, userdata, msg):
-    """Callback on_message del listener: parse + salvataggio evento."""
-    from .models import EventoImpianto
-
-    # Topic: autolavaggio/<nodo>/events/rpc oppure autolavaggio/<nodo>/online
-    parti = msg.topic.split('/')
-    nodo = parti[1] if len(parti) > 1 else '?'
-
-    if parti[-1] == 'online':
-        try:
-            _gestisci_online(nodo, msg.payload)
-        except Exception:
-            logger.exception('[%s] errore gestione stato online', nodo)
-        return
-
-    try:
-        payload = json.loads(msg.payload.decode('utf-8'))
-    except (ValueError, UnicodeDecodeError):
-        logger.warning('[%s] payload non JSON su %s: %r',
-                       nodo, msg.topic, msg.payload[:200])
-        return
-
-    eventi = estrai_eventi(payload)
-    if not eventi:
-        logger.debug('[%s] notifica senza eventi riconosciuti (method=%s)',
-                     nodo, payload.get('method'))
-        return
-
-    # Il callback gira nel thread di rete paho: chiudi eventuali
-    # connessioni DB stantie prima di scrivere (pattern Django safe
-    # fuori dal ciclo request/response).
-    close_old_connections()
-    for tipo_evento, valore in eventi:
-        # Lo Shelly ripubblica il contatore ogni minuto anche a valore
-        # invariato: salviamo solo i CAMBI, altrimenti ~1.400 righe
-        # identiche al giorno per nodo.
-        if tipo_evento == 'contatore':
-            ultimo = (EventoImpianto.objects
-                      .filter(nodo=nodo, tipo_evento='contatore')
-                      .order_by('-pk')
-                      .values_list('valore', flat=True)
-                      .first())
-            if ultimo == valore:
-                continue
-        EventoImpianto.objects.create(
-            nodo=nodo,
-            tipo_evento=tipo_evento,
-            valore=valore,
-            payload=payload,
-        )
-        logger.info('[%s] %s%s', nodo, tipo_evento,
-                    f' = {valore}' if valore is not None else '')
-
-        # Riconciliazione monete: un nuovo totale del contatore puo'
-        # confermare i lavaggi in attesa di verifica
-        if tipo_evento == 'contatore' and valore is not None:
-            try:
-                from apps.monete.services.verifica import aggiorna_verifiche
-                aggiorna_verifiche(nodo, valore)
-            except Exception:
-                logger.exception('[%s] errore verifica lavaggi', nodo)
-
-
-def crea_listener() -> mqtt.Client:
+def crea_listener(ingestore) -> mqtt.Client:
     """Costruisce il client listener (senza avviare il loop).
 
-    Il chiamante (management command mqtt_listener) fa connect +
+    I messaggi vanno nella coda di `ingestore` (ingestione.Ingestore):
+    il thread di rete paho non tocca mai il DB. Il chiamante (management
+    command mqtt_listener) avvia l'ingestore e fa connect +
     loop_forever: paho gestisce da solo le riconnessioni col backoff
     impostato in _nuovo_client.
     """
@@ -210,7 +124,7 @@ def crea_listener() -> mqtt.Client:
 
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
-    client.on_message = _gestisci_messaggio
+    client.on_message = ingestore.on_message
     return client
 
 
@@ -220,7 +134,7 @@ def crea_listener() -> mqtt.Client:
 
 def moneta_virtuale(nodo: str, impulsi: int = 1, switch_id: int = 1,
                     pausa_s: float = 2.0) -> tuple:
-    """Simula l'inserimento di monete sul nodo indicato.
+    """Simula l'inserimento di monete sul nodo indicato (bloccante).
 
     Pubblica su autolavaggio/<nodo>/rpc il comando RPC Shelly
     Switch.Set(on=true) sull'uscita `switch_id`. Sulla pista2 il rele'
@@ -237,48 +151,17 @@ def moneta_virtuale(nodo: str, impulsi: int = 1, switch_id: int = 1,
     effettivamente confermati dal broker, indispensabile al modulo
     monete per stornare gli impulsi non partiti in caso di errore a
     meta' sequenza.
+
+    Passa dal publisher persistente del processo (publisher.py) e
+    aspetta la fine della sequenza: chi non deve tenere fermo il thread
+    (le view) usa direttamente publisher().avvia_sequenza().
     """
     if not mqtt_configurato():
         return False, 'MQTT non configurato (MQTT_HOST/MQTT_USER mancanti).', 0
     if impulsi < 1:
         return False, 'Il numero di impulsi deve essere >= 1.', 0
 
-    topic = f'autolavaggio/{nodo}/rpc'
-    payload = json.dumps({
-        'id': 1,
-        'src': 'crm',
-        'method': 'Switch.Set',
-        'params': {'id': switch_id, 'on': True},
-    })
-
-    # Connessione usa-e-getta: funziona da qualunque processo (web,
-    # shell) senza dipendere dal listener. client_id univoco per non
-    # scalzare la sessione del listener che usa l'utente 'crm'.
-    client = _nuovo_client(f'crm-pub-{uuid.uuid4().hex[:8]}')
-    inviati = 0
-    try:
-        client.connect(settings.MQTT_HOST, settings.MQTT_PORT, keepalive=30)
-        client.loop_start()
-        for i in range(impulsi):
-            info = client.publish(topic, payload, qos=1)
-            info.wait_for_publish(timeout=10)
-            if not info.is_published():
-                return False, (f'Impulso {i + 1}/{impulsi} NON confermato dal '
-                               f'broker (timeout).'), inviati
-            inviati += 1
-            logger.info('moneta_virtuale: impulso %s/%s inviato a %s',
-                        i + 1, impulsi, topic)
-            if i < impulsi - 1:
-                # lascia all'auto-off il tempo di RIAPRIRE il rele':
-                # senza gap di off gli impulsi si fondono
-                time.sleep(max(pausa_s, 1.2))
-        return True, f'{impulsi} impulso/i inviato/i a {topic}.', inviati
-    except Exception as exc:  # rete giu', DNS, auth: riporta l'errore
-        logger.error('moneta_virtuale fallita: %s', exc)
-        return False, f'Errore di pubblicazione: {exc}', inviati
-    finally:
-        client.loop_stop()
-        try:
-            client.disconnect()
-        except Exception:
-            pass
+    from .publisher import publisher
+    seq = publisher().avvia_sequenza(nodo, impulsi, switch_id=switch_id,
+                                     pausa_s=pausa_s)
+    return seq.attendi()
@@ -0,0 +1,330 @@
+"""Publisher MQTT persistente per i comandi verso i nodi (moneta virtuale).
+
+Prima moneta_virtuale apriva un client paho nuovo a ogni avvio (TCP
+connect + CONNECT/CONNACK), poi pubblicava gli impulsi con time.sleep
+tra uno e l'altro dentro la richiesta web: 5 gettoni tenevano occupato
+un worker Daphne/gunicorn per ~10 secondi.
+
+Qui c'e' un'unica connessione autenticata per processo (publisher()),
+tenuta su dal loop di rete paho con la riconnessione automatica di
+_nuovo_client, e un thread "scheduler" che fa partire gli impulsi da un
+heap di timer:
+
+- avvia_sequenza() ritorna subito una SequenzaImpulsi: il chiamante
+  puo' attendi() (bloccante, con timeout) oppure lasciar fare e farsi
+  chiamare `osservatore(seq)` a ogni impulso confermato e alla fine;
+- un impulso conta come inviato quando arriva il PUBACK QoS 1
+  (on_publish, girato allo scheduler via coda: la callback paho gira
+  col mutex dei messaggi in uscita, non ci si prende altri lock li');
+- il prossimo impulso parte `pausa_s` dopo il PUBACK del precedente
+  (deve superare l'auto-off dello Shelly, vedi moneta_virtuale);
+- due sequenze sullo stesso nodo non si sovrappongono (gli impulsi si
+  fonderebbero): la seconda aspetta che il nodo sia libero. Nodi
+  diversi vanno in parallelo sulla stessa connessione;
+- se un PUBACK non arriva entro TIMEOUT_ACK_SEC il client viene
+  ricreato prima di chiudere la sequenza (_scarta_in_volo): altrimenti
+  paho rimanderebbe l'impulso alla riconnessione, dopo il rimborso.
+
+Gli osservatori girano in un executor a un solo thread (in ordine, fuori
+dallo scheduler): possono toccare il DB senza rallentare i timer.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger('apps.impianto.mqtt')
+
+PAUSA_MINIMA_SEC = 1.2
+TIMEOUT_ACK_SEC = 10
+TIMEOUT_CONNESSIONE_SEC = 10
+# Ogni quanto lo scheduler ricontrolla un impulso in attesa della
+# connessione o del nodo libero
+RICONTROLLO_SEC = 0.05
+
+
+class SequenzaImpulsi:
+    """Handle di una sequenza di impulsi su un nodo."""
+
+    def __init__(self, nodo: str, impulsi: int, switch_id: int = 1,
+                 pausa_s: float = 2.0, osservatore=None):
+        self.nodo = nodo
+        self.topic = f'autolavaggio/{nodo}/rpc'
+        self.impulsi = impulsi
+        self.switch_id = switch_id
+        self.pausa_s = max(pausa_s, PAUSA_MINIMA_SEC)
+        self.osservatore = osservatore
+        self.creata = time.monotonic()
+        self.inviati = 0
+        self.ok = None          # None finche' in corso
+        self.messaggio = ''
+        self.risultato = None   # valore ritornato dall'osservatore finale
+        self.completata = threading.Event()
+        self._in_volo = None    # indice dell'impulso pubblicato in attesa di PUBACK
+        self._mid = None        # e il suo mid paho
+
+    @property
+    def terminata(self) -> bool:
+        return self.ok is not None
+
+    def attendi(self, timeout: float = None) -> tuple:
+        """Blocca fino alla fine (osservatore finale compreso).
+        Ritorna (ok, messaggio, inviati) come moneta_virtuale."""
+        if not self.completata.wait(timeout):
+            return False, 'Sequenza ancora in corso (timeout attesa).', self.inviati
+        return self.ok, self.messaggio, self.inviati
+
+    def stato(self) -> dict:
+        return {'nodo': self.nodo, 'impulsi': self.impulsi, 'inviati': self.inviati,
+                'terminata': self.terminata, 'ok': self.ok,
+                'messaggio': self.messaggio}
+
+
+class Publisher:
+    """Connessione persistente + scheduler degli impulsi."""
+
+    def __init__(self, host: str = None, porta: int = None):
+        self.host = host or settings.MQTT_HOST
+        self.porta = porta or settings.MQTT_PORT
+        self._client = None
+        self._connesso = threading.Event()
+        self._eventi = queue.Queue()
+        self._timer = []                    # heap (quando, n, azione, seq)
+        self._n = itertools.count()
+        self._in_volo = {}                  # mid -> seq
+        self._nodo_libero_dal = {}          # nodo -> monotonic
+        self._osservatori = ThreadPoolExecutor(1, thread_name_prefix='mqtt-esiti')
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # --- API ---------------------------------------------------------
+
+    def avvia_sequenza(self, nodo: str, impulsi: int, switch_id: int = 1,
+                       pausa_s: float = 2.0, osservatore=None) -> SequenzaImpulsi:
+        seq = SequenzaImpulsi(nodo, impulsi, switch_id, pausa_s, osservatore)
+        self._avvia()
+        self._eventi.put(('nuova', seq))
+        return seq
+
+    def connesso(self) -> bool:
+        return self._connesso.is_set()
+
+    def ferma(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._eventi.put(('stop', None))
+            self._thread.join(5)
+            self._thread = None
+            self._chiudi_client()
+
+    # --- connessione -------------------------------------------------
+
+    def _avvia(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._apri_client()
+            self._thread = threading.Thread(target=self._ciclo, name='mqtt-publisher',
+                                            daemon=True)
+            self._thread.start()
+
+    def _apri_client(self):
+        from .mqtt import _nuovo_client
+        # client_id univoco per processo: non scalza il listener
+        # ('crm') ne' i publisher degli altri worker
+        client = _nuovo_client(f'crm-pub-{os.getpid()}-{uuid.uuid4().hex[:6]}')
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        client.connect_async(self.host, self.porta, keepalive=60)
+        client.loop_start()
+        self._client = client
+
+    def _chiudi_client(self):
+        # Prima disconnect: con un PUBLISH QoS 1 senza PUBACK il loop
+        # paho non esce finche' il messaggio non e' confermato.
+        try:
+            self._client.disconnect()
+        except Exception:
+            pass
+        self._client.loop_stop()
+        self._client = None
+        self._connesso.clear()
+
+    def _scarta_in_volo(self, scaduta: SequenzaImpulsi, messaggio: str):
+        """PUBACK scaduto: butta via il client con i suoi PUBLISH pendenti
+        e ne apre uno nuovo, PRIMA di chiudere (e rimborsare) le sequenze.
+
+        Il client paho si riconnette da solo e alla riconnessione rimanda
+        i QoS 1 non confermati (DUP), anche con clean_session: il rele'
+        scatterebbe per gettoni gia' restituiti. paho non ha un modo
+        pubblico per scartare un solo messaggio, quindi si ricrea il
+        client e falliscono anche le altre sequenze con un impulso in
+        volo, che non avrebbero piu' il loro PUBACK.
+        """
+        self._chiudi_client()
+        self._apri_client()
+        in_volo, self._in_volo = self._in_volo, {}
+        self._termina(scaduta, False, messaggio)
+        for seq in set(in_volo.values()) - {scaduta}:
+            if not seq.terminata:
+                self._termina(seq, False, (
+                    f'Impulso {seq._in_volo + 1}/{seq.impulsi} annullato: connessione '
+                    f'MQTT ricreata per un altro nodo senza conferma.'))
+
+    def _on_connect(self, cl, userdata, flags, reason_code, properties):
+        if reason_code == 0:
+            logger.info('Publisher connesso al broker %s:%s', self.host, self.porta)
+            self._connesso.set()
+        else:
+            logger.error('Publisher: connessione rifiutata dal broker: %s', reason_code)
+
+    def _on_disconnect(self, cl, userdata, flags, reason_code, properties):
+        self._connesso.clear()
+        log = logger.warning if reason_code.is_failure else logger.info
+        log('Publisher disconnesso dal broker (%s)', reason_code)
+
+    def _on_publish(self, cl, userdata, mid, reason_code, properties):
+        self._eventi.put(('ack', (cl, mid)))
+
+    # --- scheduler ---------------------------------------------------
+
+    def _programma(self, quando: float, azione: str, seq: SequenzaImpulsi, *args):
+        heapq.heappush(self._timer, (quando, next(self._n), azione, seq, args))
+
+    def _ciclo(self):
+        while True:
+            attesa = None
+            if self._timer:
+                attesa = max(0.0, self._timer[0][0] - time.monotonic())
+            try:
+                tipo, dato = self._eventi.get(timeout=attesa)
+            except queue.Empty:
+                tipo = None
+            if tipo == 'stop':
+                return
+            if tipo == 'nuova':
+                self._programma(time.monotonic(), 'impulso', dato)
+            elif tipo == 'ack':
+                client, mid = dato
+                # i mid ripartono da 1 a ogni client: gli ack di un
+                # client gia' scartato non valgono
+                if client is self._client:
+                    self._confermato(mid)
+
+            adesso = time.monotonic()
+            while self._timer and self._timer[0][0] <= adesso:
+                _, _, azione, seq, args = heapq.heappop(self._timer)
+                if seq.terminata:
+                    continue
+                try:
+                    if azione == 'impulso':
+                        self._impulso(seq)
+                    elif azione == 'scadenza_ack' and seq._in_volo == args[0]:
+                        self._scarta_in_volo(seq, (
+                            f'Impulso {args[0] + 1}/{seq.impulsi} NON confermato dal '
+                            f'broker (timeout).'))
+                except Exception as exc:
+                    logger.exception('Sequenza impulsi su %s fallita', seq.nodo)
+                    self._termina(seq, False, f'Errore di pubblicazione: {exc}')
+
+    def _impulso(self, seq: SequenzaImpulsi):
+        adesso = time.monotonic()
+        if not self._connesso.is_set():
+            if adesso - seq.creata > TIMEOUT_CONNESSIONE_SEC:
+                self._termina(seq, False, 'Broker MQTT non raggiungibile (timeout connessione).')
+            else:
+                self._programma(adesso + RICONTROLLO_SEC, 'impulso', seq)
+            return
+        libero_dal = self._nodo_libero_dal.get(seq.nodo, 0)
+        if adesso < libero_dal:
+            self._programma(min(libero_dal, adesso + RICONTROLLO_SEC), 'impulso', seq)
+            return
+
+        payload = json.dumps({
+            'id': 1,
+            'src': 'crm',
+            'method': 'Switch.Set',
+            'params': {'id': seq.switch_id, 'on': True},
+        })
+        info = self._client.publish(seq.topic, payload, qos=1)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self._termina(seq, False, f'Errore di pubblicazione: {mqtt.error_string(info.rc)}')
+            return
+        seq._in_volo, seq._mid = seq.inviati, info.mid
+        self._in_volo[info.mid] = seq
+        # Nodo occupato finche' non arriva il PUBACK (+ pausa)
+        self._nodo_libero_dal[seq.nodo] = float('inf')
+        self._programma(adesso + TIMEOUT_ACK_SEC, 'scadenza_ack', seq, seq.inviati)
+
+    def _confermato(self, mid: int):
+        seq = self._in_volo.pop(mid, None)
+        if seq is None or seq.terminata:
+            return
+        seq._in_volo = seq._mid = None
+        seq.inviati += 1
+        adesso = time.monotonic()
+        self._nodo_libero_dal[seq.nodo] = adesso + seq.pausa_s
+        logger.info('moneta_virtuale: impulso %s/%s inviato a %s',
+                    seq.inviati, seq.impulsi, seq.topic)
+        if seq.inviati >= seq.impulsi:
+            self._termina(seq, True, f'{seq.impulsi} impulso/i inviato/i a {seq.topic}.')
+        else:
+            # lascia all'auto-off il tempo di RIAPRIRE il rele'
+            self._programma(adesso + seq.pausa_s, 'impulso', seq)
+            self._notifica(seq)
+
+    def _termina(self, seq: SequenzaImpulsi, ok: bool, messaggio: str):
+        seq.ok, seq.messaggio = ok, messaggio
+        if not ok:
+            logger.error('Sequenza impulsi su %s fallita: %s', seq.nodo, messaggio)
+            if seq._in_volo is not None:
+                self._in_volo.pop(seq._mid, None)
+                seq._in_volo = seq._mid = None
+                self._nodo_libero_dal[seq.nodo] = time.monotonic() + seq.pausa_s
+        self._notifica(seq, finale=True)
+
+    def _notifica(self, seq: SequenzaImpulsi, finale: bool = False):
+        if seq.osservatore is None:
+            if finale:
+                seq.completata.set()
+            return
+        self._osservatori.submit(self._chiama_osservatore, seq, finale)
+
+    @staticmethod
+    def _chiama_osservatore(seq: SequenzaImpulsi, finale: bool):
+        close_old_connections()
+        try:
+            risultato = seq.osservatore(seq)
+            if finale:
+                seq.risultato = risultato
+        except Exception:
+            logger.exception('Osservatore sequenza impulsi su %s fallito', seq.nodo)
+        finally:
+            if finale:
+                seq.completata.set()
+                close_old_connections()
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def publisher() -> Publisher:
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher()
+        return _publisher
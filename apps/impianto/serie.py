@@ -0,0 +1,391 @@
+"""Serie storica degli eventi impianto: aggregati, retention, partizioni.
+
+EventoImpianto tiene ogni cambio di contatore, ogni online/offline e
+ogni evento input col payload grezzo: e' la tabella che cresce di piu',
+ma oltre le ultime settimane serve solo per contare i cicli. Qui:
+
+- rollup_orario(da, a): per ogni nodo e ogni ora completa un
+  AggregatoImpianto 'ora' con gli impulsi contati (somma degli
+  incrementi del contatore; un calo e' un reset dello Shelly), i minuti
+  online, il numero di eventi e un riepilogo {tipo_evento: quanti} al
+  posto dei payload. E' un upsert su (nodo, periodo, inizio): rifarlo
+  su ore gia' aggregate riscrive le stesse righe;
+- rollup_giornaliero(da, a): somma le ore nei giorni (data locale);
+- pota(): cancella gli eventi grezzi piu' vecchi di IMPIANTO_EVENTI_GIORNI
+  e gli aggregati orari piu' vecchi di IMPIANTO_AGGREGATI_ORARI_GIORNI
+  (i giornalieri restano). Mai oltre l'ultima ora aggregata. Su Postgres
+  con la tabella partizionata per mese (partiziona(), una tantum) i mesi
+  interamente fuori finestra sono un DROP della partizione invece di un
+  DELETE riga per riga;
+- manutenzione(): rollup dall'ultima ora aggregata ad adesso, poi pota.
+
+Lo stato a cavallo delle ore (ultimo contatore, online si/no) si prende
+dall'ultimo evento grezzo prima dell'intervallo o, se e' gia' stato
+potato, da contatore_fine/online_fine dell'ultimo aggregato orario.
+Un'ora e' sempre o tutta presente o tutta potata (soglia allineata
+all'ora): il rollup non riparte mai da prima del primo evento rimasto,
+cosi' non riscrive con dati monchi ore gia' aggregate.
+
+Baseline dell'avvio e riconciliazione monete leggono ContatoreNodo, non
+gli eventi: la potatura non li tocca. Se sparisce l'ultimo evento di un
+nodo fermo da piu' della finestra, il listener al riavvio riscrive un
+evento uguale al primo messaggio (innocuo).
+"""
+import logging
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Min, OuterRef, Subquery
+from django.utils import timezone
+
+from .ingestione import TIPI_DEDUP
+from .models import AggregatoImpianto, EventoImpianto
+
+logger = logging.getLogger('apps.impianto.serie')
+
+ORA = timedelta(hours=1)
+# Il backfill procede a blocchi di un giorno: memoria limitata anche
+# su mesi di eventi
+BLOCCO_ROLLUP = timedelta(days=1)
+CAMPI_AGGREGATO = ['impulsi', 'minuti_online', 'eventi', 'contatore_fine',
+                   'online_fine', 'riepilogo', 'aggiornato_il']
+TABELLA = EventoImpianto._meta.db_table
+
+
+def tronca_ora(t: datetime) -> datetime:
+    return t.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _upsert(righe: list):
+    AggregatoImpianto.objects.bulk_create(
+        righe, batch_size=1000, update_conflicts=True,
+        unique_fields=['nodo', 'periodo', 'inizio'], update_fields=CAMPI_AGGREGATO)
+
+
+# --- rollup --------------------------------------------------------
+
+def _stato_iniziale(da: datetime) -> dict:
+    """nodo -> {'contatore': int|None, 'online': bool|None} all'istante `da`."""
+    stato = defaultdict(lambda: {'contatore': None, 'online': None})
+
+    ultimo = (AggregatoImpianto.objects
+              .filter(periodo='ora', nodo=OuterRef('nodo'), inizio__lt=da)
+              .order_by('-inizio').values('pk')[:1])
+    for nodo, contatore, online in (AggregatoImpianto.objects
+                                    .filter(periodo='ora', pk=Subquery(ultimo))
+                                    .values_list('nodo', 'contatore_fine', 'online_fine')):
+        stato[nodo].update(contatore=contatore, online=online)
+
+    # L'evento grezzo, se c'e' ancora, e' la fonte esatta
+    pks = (EventoImpianto.objects
+           .filter(tipo_evento__in=TIPI_DEDUP, timestamp__lt=da)
+           .values('nodo', 'tipo_evento').annotate(ultimo=Max('pk'))
+           .values_list('ultimo', flat=True))
+    for nodo, tipo, valore in (EventoImpianto.objects.filter(pk__in=list(pks))
+                               .values_list('nodo', 'tipo_evento', 'valore')):
+        if valore is None:
+            continue
+        if tipo == 'contatore':
+            stato[nodo]['contatore'] = valore
+        else:
+            stato[nodo]['online'] = bool(valore)
+    return stato
+
+
+def _minuti_online(online: bool, transizioni: list, da: datetime, a: datetime):
+    """Per ogni ora in [da, a): (inizio, minuti online, online a fine ora)."""
+    i = 0
+    inizio = da
+    while inizio < a:
+        fine = inizio + ORA
+        secondi, t = 0.0, inizio
+        while i < len(transizioni) and transizioni[i][0] < fine:
+            if online:
+                secondi += (transizioni[i][0] - t).total_seconds()
+            t, online = transizioni[i]
+            i += 1
+        if online:
+            secondi += (fine - t).total_seconds()
+        yield inizio, round(secondi / 60), online
+        inizio = fine
+
+
+def rollup_orario(da: datetime, a: datetime) -> int:
+    """Aggrega le ore complete in [da, a). Ritorna le righe scritte."""
+    da, a = tronca_ora(da), tronca_ora(a)
+    primo = EventoImpianto.objects.aggregate(t=Min('timestamp'))['t']
+    if primo is None:
+        return 0
+    da = max(da, tronca_ora(primo))
+    if da >= a:
+        return 0
+
+    iniziale = _stato_iniziale(da)
+    contatori = {nodo: s['contatore'] for nodo, s in iniziale.items()}
+    transizioni = defaultdict(list)     # nodo -> [(istante, online)]
+    righe = {}                          # (nodo, inizio) -> AggregatoImpianto
+
+    def riga(nodo, inizio):
+        r = righe.get((nodo, inizio))
+        if r is None:
+            r = righe[(nodo, inizio)] = AggregatoImpianto(
+                nodo=nodo, periodo='ora', inizio=inizio, riepilogo={})
+        return r
+
+    eventi = (EventoImpianto.objects
+              .filter(timestamp__gte=da, timestamp__lt=a)
+              .order_by('timestamp', 'pk')
+              .values_list('nodo', 'tipo_evento', 'valore', 'timestamp'))
+    for nodo, tipo, valore, istante in eventi.iterator(chunk_size=2000):
+        r = riga(nodo, tronca_ora(istante))
+        r.eventi += 1
+        r.riepilogo[tipo] = r.riepilogo.get(tipo, 0) + 1
+        if valore is None:
+            continue
+        if tipo == 'contatore':
+            precedente = contatori.get(nodo)
+            if precedente is not None:
+                r.impulsi += valore - precedente if valore >= precedente else valore
+            contatori[nodo] = valore
+            r.contatore_fine = valore
+        elif tipo == 'online':
+            transizioni[nodo].append((istante, bool(valore)))
+
+    # Minuti online ora per ora (anche le ore senza eventi di un nodo
+    # rimasto acceso) e stato di fine ora riportato in avanti
+    for nodo in set(iniziale) | {n for n, _ in righe}:
+        online = iniziale[nodo]['online'] if nodo in iniziale else None
+        contatore = iniziale[nodo]['contatore'] if nodo in iniziale else None
+        for inizio, minuti, online_fine in _minuti_online(
+                bool(online), transizioni.get(nodo, []), da, a):
+            r = righe.get((nodo, inizio))
+            if r is None and not minuti:
+                continue
+            r = r or riga(nodo, inizio)
+            r.minuti_online = minuti
+            if online is not None or transizioni.get(nodo):
+                r.online_fine = online_fine
+            if r.contatore_fine is None:
+                r.contatore_fine = contatore
+            contatore = r.contatore_fine
+
+    _upsert(list(righe.values()))
+    return len(righe)
+
+
+def _mezzanotte(giorno: date) -> datetime:
+    return timezone.make_aware(datetime.combine(giorno, time.min))
+
+
+def rollup_giornaliero(da: date, a: date) -> int:
+    """Somma gli aggregati orari nei giorni locali da `da` ad `a` inclusi."""
+    giorni = {}
+    ore = (AggregatoImpianto.objects
+           .filter(periodo='ora', inizio__gte=_mezzanotte(da),
+                   inizio__lt=_mezzanotte(a + timedelta(days=1)))
+           .order_by('inizio'))
+    for ora in ore.iterator(chunk_size=2000):
+        inizio = _mezzanotte(timezone.localtime(ora.inizio).date())
+        g = giorni.get((ora.nodo, inizio))
+        if g is None:
+            g = giorni[(ora.nodo, inizio)] = AggregatoImpianto(
+                nodo=ora.nodo, periodo='giorno', inizio=inizio, riepilogo={})
+        g.impulsi += ora.impulsi
+        g.minuti_online += ora.minuti_online
+        g.eventi += ora.eventi
+        for tipo, n in ora.riepilogo.items():
+            g.riepilogo[tipo] = g.riepilogo.get(tipo, 0) + n
+        g.contatore_fine = ora.contatore_fine
+        g.online_fine = ora.online_fine
+    _upsert(list(giorni.values()))
+    return len(giorni)
+
+
+# --- retention -----------------------------------------------------
+
+def ultima_ora_aggregata():
+    return (AggregatoImpianto.objects.filter(periodo='ora')
+            .aggregate(t=Max('inizio'))['t'])
+
+
+def pota(adesso: datetime = None, dry_run: bool = False) -> dict:
+    """Cancella eventi grezzi e aggregati orari fuori finestra."""
+    adesso = adesso or timezone.now()
+    soglia = tronca_ora(adesso - timedelta(days=settings.IMPIANTO_EVENTI_GIORNI))
+    # Mai eventi non ancora aggregati: l'ora dell'ultimo aggregato
+    # viene riaggregata al prossimo giro, quindi resta
+    ultima = ultima_ora_aggregata()
+    soglia = min(soglia, ultima) if ultima else None
+    soglia_orari = adesso - timedelta(days=settings.IMPIANTO_AGGREGATI_ORARI_GIORNI)
+
+    esito = {'soglia_eventi': soglia, 'partizioni': [], 'eventi': 0, 'orari': 0}
+    orari = AggregatoImpianto.objects.filter(periodo='ora', inizio__lt=soglia_orari)
+    if dry_run:
+        esito['orari'] = orari.count()
+        if soglia:
+            esito['eventi'] = EventoImpianto.objects.filter(timestamp__lt=soglia).count()
+        return esito
+
+    if soglia:
+        if tabella_partizionata():
+            esito['partizioni'] = _elimina_partizioni(soglia)
+        esito['eventi'], _ = EventoImpianto.objects.filter(timestamp__lt=soglia).delete()
+    esito['orari'], _ = orari.delete()
+    return esito
+
+
+def manutenzione(da: datetime = None, adesso: datetime = None, pulizia: bool = True,
+                 dry_run: bool = False) -> dict:
+    """Rollup orario e giornaliero fino all'ultima ora completa, poi pota.
+
+    Senza `da` riparte dall'ultima ora gia' aggregata (o dal primo
+    evento): il comando puo' girare da cron ogni ora.
+    """
+    adesso = adesso or timezone.now()
+    fine = tronca_ora(adesso)
+    if da is None:
+        da = ultima_ora_aggregata()
+    # Prima del primo evento rimasto le ore sono gia' aggregate (e
+    # potate): non si riaggregano, ne' le ore ne' i loro giorni
+    primo = EventoImpianto.objects.aggregate(t=Min('timestamp'))['t'] or fine
+    da = tronca_ora(max(da, primo) if da else primo)
+
+    esito = {'da': da, 'a': fine, 'orari_scritti': 0, 'giorni_scritti': 0}
+    if not dry_run:
+        blocco = da
+        while blocco < fine:
+            esito['orari_scritti'] += rollup_orario(blocco, min(blocco + BLOCCO_ROLLUP, fine))
+            blocco += BLOCCO_ROLLUP
+        if da < fine:
+            esito['giorni_scritti'] = rollup_giornaliero(
+                timezone.localtime(da).date(), timezone.localtime(fine).date())
+    if pulizia:
+        esito.update(pota(adesso, dry_run=dry_run))
+    return esito
+
+
+# --- partizioni (solo Postgres) ------------------------------------
+
+def tabella_partizionata() -> bool:
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT 1 FROM pg_partitioned_table p
+            JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = %s AND pg_table_is_visible(c.oid)""", [TABELLA])
+        return cur.fetchone() is not None
+
+
+def _mese_successivo(mese: date) -> date:
+    return (mese.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def _nome_partizione(mese: date) -> str:
+    return f'{TABELLA}_p{mese:%Y%m}'
+
+
+def crea_partizioni(da: date, a: date) -> list:
+    """Partizioni mensili (UTC) da `da` ad `a` compresi, se mancano."""
+    create = []
+    mese = da.replace(day=1)
+    with connection.cursor() as cur:
+        while mese <= a:
+            nome = _nome_partizione(mese)
+            cur.execute("SELECT to_regclass(%s)", [nome])
+            if cur.fetchone()[0] is None:
+                cur.execute(
+                    f'CREATE TABLE {nome} PARTITION OF {TABELLA} '
+                    f"FOR VALUES FROM ('{mese:%Y-%m-%d} 00:00:00+00') "
+                    f"TO ('{_mese_successivo(mese):%Y-%m-%d} 00:00:00+00')")
+                create.append(nome)
+            mese = _mese_successivo(mese)
+    return create
+
+
+def _elimina_partizioni(soglia: datetime) -> list:
+    """DROP delle partizioni mensili che finiscono entro `soglia`."""
+    eliminate = []
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = %s ORDER BY c.relname""", [TABELLA])
+        for (nome,) in cur.fetchall():
+            suffisso = nome[len(TABELLA) + 2:]
+            if not (nome.startswith(f'{TABELLA}_p') and suffisso.isdigit()):
+                continue    # partizione di default
+            mese = date(int(suffisso[:4]), int(suffisso[4:]), 1)
+            fine = datetime.combine(_mese_successivo(mese), time.min, tzinfo=dt_timezone.utc)
+            if fine <= soglia:
+                cur.execute(f'DROP TABLE {nome}')
+                eliminate.append(nome)
+    return eliminate
+
+
+def mantieni_partizioni() -> list:
+    """Crea le partizioni dei prossimi IMPIANTO_PARTIZIONI_AVANTI mesi."""
+    if not tabella_partizionata():
+        return []
+    oggi = timezone.now().date()
+    fino_a = oggi
+    for _ in range(settings.IMPIANTO_PARTIZIONI_AVANTI):
+        fino_a = _mese_successivo(fino_a.replace(day=1))
+    return crea_partizioni(oggi, fino_a)
+
+
+def partiziona() -> list:
+    """Converte EventoImpianto in tabella partizionata per mese sul
+    timestamp (Postgres, una tantum, col listener fermo).
+
+    La chiave primaria diventa (id, timestamp), come vuole Postgres per
+    le tabelle partizionate: per Django id resta la pk. Gli indici
+    vengono ricreati con gli stessi nomi, cosi' le migrazioni future li
+    ritrovano. Una partizione di default raccoglie eventuali righe fuori
+    dai mesi creati (mantieni_partizioni() la tiene vuota).
+    """
+    if connection.vendor != 'postgresql':
+        raise RuntimeError('Il partizionamento e\' disponibile solo su Postgres.')
+    if tabella_partizionata():
+        return []
+    vecchia = f'{TABELLA}_vecchia'
+    with transaction.atomic(), connection.cursor() as cur:
+        cur.execute(f'LOCK TABLE {TABELLA} IN ACCESS EXCLUSIVE MODE')
+        cur.execute("""
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE tablename = %s AND indexname <> %s""", [TABELLA, f'{TABELLA}_pkey'])
+        indici = cur.fetchall()
+        cur.execute("""
+            SELECT is_identity = 'YES', pg_get_serial_sequence(%s, 'id')
+            FROM information_schema.columns
+            WHERE table_name = %s AND column_name = 'id'""", [TABELLA, TABELLA])
+        identity, sequenza = cur.fetchone()
+        cur.execute(f'SELECT min("timestamp") FROM {TABELLA}')
+        primo = cur.fetchone()[0] or timezone.now()
+
+        cur.execute(f'ALTER TABLE {TABELLA} RENAME TO {vecchia}')
+        cur.execute(f'ALTER TABLE {vecchia} RENAME CONSTRAINT {TABELLA}_pkey TO {vecchia}_pkey')
+        cur.execute(f'CREATE TABLE {TABELLA} (LIKE {vecchia} INCLUDING DEFAULTS '
+                    f'INCLUDING IDENTITY) PARTITION BY RANGE ("timestamp")')
+        cur.execute(f'ALTER TABLE {TABELLA} ADD CONSTRAINT {TABELLA}_pkey '
+                    f'PRIMARY KEY (id, "timestamp")')
+        cur.execute(f'CREATE TABLE {TABELLA}_default PARTITION OF {TABELLA} DEFAULT')
+        create = crea_partizioni(primo.astimezone(dt_timezone.utc).date(), timezone.now().date())
+        create += mantieni_partizioni()
+
+        cur.execute(f'INSERT INTO {TABELLA} SELECT * FROM {vecchia}')
+        if not identity and sequenza:
+            # Colonna serial: la sequenza e' della tabella vecchia, la
+            # si passa alla nuova prima del DROP
+            cur.execute(f'ALTER SEQUENCE {sequenza} OWNED BY {TABELLA}.id')
+        cur.execute(f'DROP TABLE {vecchia}')
+        for _, definizione in indici:
+            cur.execute(definizione)
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{TABELLA}', 'id'), "
+                    f'coalesce(max(id), 0) + 1, false) FROM {TABELLA}')
+    logger.info('%s partizionata: %s partizioni', TABELLA, len(create))
+    return create
@@ -0,0 +1,213 @@
+"""Test della pipeline di ingestione MQTT (ingestione.py), del
+publisher persistente (publisher.py) contro il broker finto in-process
+e di rollup/retention della serie eventi (serie.py).
+
+Esecuzione: python manage.py test apps.impianto
+"""
+import json
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from apps.clienti.models import Cliente
+from apps.monete.models import MovimentoMoneta, NodoImpianto
+from apps.monete.services.verifica import aggiorna_verifiche
+
+from . import ingestione, publisher, serie
+from .broker_finto import BrokerFinto
+from .ingestione import Ingestore
+from .models import AggregatoImpianto, ContatoreNodo, EventoImpianto
+from .publisher import Publisher
+
+
+def _contatore(nodo, totale):
+    payload = {'method': 'NotifyStatus', 'params': {
+        'input:2': {'id': 2, 'counts': {'total': totale}}}}
+    return f'autolavaggio/{nodo}/events/rpc', json.dumps(payload).encode()
+
+
+class IngestoreTest(TestCase):
+    def setUp(self):
+        self.ing = Ingestore(coda_max=1000, lotto_ms=10, lotto_max=100)
+
+    def _scrivi(self, messaggi):
+        for topic, payload in messaggi:
+            self.ing.accoda(topic, payload)
+        return self.ing.svuota()
+
+    def test_solo_i_cambi_del_contatore(self):
+        EventoImpianto.objects.create(nodo='pista2', tipo_evento='contatore', valore=10)
+        scritti = self._scrivi([_contatore('pista2', v) for v in (10, 10, 11, 11, 12)]
+                               + [('autolavaggio/pista2/events/rpc', b'non json')])
+        self.assertEqual(scritti, 2)
+        self.assertEqual(list(EventoImpianto.objects.filter(tipo_evento='contatore')
+                              .order_by('pk').values_list('valore', flat=True)),
+                         [10, 11, 12])
+        stats = self.ing.statistiche()
+        self.assertEqual((stats['invariati'], stats['non_validi']), (3, 1))
+        self.assertEqual(ContatoreNodo.objects.get(nodo='pista2').valore, 12)
+
+    def test_query_non_crescono_coi_messaggi(self):
+        def query_lotto(n, base):
+            for i in range(n):
+                self.ing.accoda(*_contatore(f'nodo{i % 5}', base + i))
+            with CaptureQueriesContext(connection) as ctx:
+                self.ing.svuota()
+            return len(ctx)
+
+        query_lotto(5, 0)  # carica la cache degli ultimi valori
+        self.assertEqual(query_lotto(10, 100), query_lotto(90, 1000))
+
+    def test_online_e_verifiche_una_volta_per_nodo(self):
+        cliente = Cliente.objects.create(tipo='privato', telefono='3330000000')
+        nodo = NodoImpianto.objects.create(slug='pista2', nome='Pista 2')
+        mv = MovimentoMoneta.objects.create(
+            cliente=cliente, tipo='lavaggio', monete=-2, saldo_dopo=0,
+            descrizione='Lavaggio', nodo=nodo, impulsi=2,
+            contatore_prima=10, contatore_atteso=12, verifica='in_attesa')
+
+        with mock.patch('apps.monete.services.verifica.aggiorna_verifiche',
+                        wraps=aggiorna_verifiche) as aggiorna:
+            self._scrivi([('autolavaggio/pista2/online', b'true'),
+                          ('autolavaggio/pista2/online', b'true')]
+                         + [_contatore('pista2', v) for v in (11, 12)])
+        aggiorna.assert_called_once_with('pista2', 12)
+
+        mv.refresh_from_db()
+        self.assertEqual((mv.verifica, mv.impulsi_contati), ('ok', 2))
+        nodo.refresh_from_db()
+        self.assertTrue(nodo.online)
+        self.assertEqual(EventoImpianto.objects.filter(tipo_evento='online').count(), 1)
+
+    def test_coda_piena_scarta_e_conta(self):
+        ing = Ingestore(coda_max=2)
+        with mock.patch.object(ingestione, 'ATTESA_CODA_PIENA_SEC', 0.01):
+            esiti = [ing.accoda(*_contatore('pista2', v)) for v in range(4)]
+        self.assertEqual(esiti, [True, True, False, False])
+        stats = ing.statistiche()
+        self.assertEqual((stats['ricevuti'], stats['attese'], stats['scartati']), (4, 2, 2))
+
+    def test_thread_scrittore_svuota_alla_fermata(self):
+        with mock.patch.object(self.ing, 'scrivi_lotto', return_value=0) as scrivi:
+            self.ing.avvia()
+            for v in range(250):
+                self.ing.accoda(*_contatore('pista2', v))
+            self.ing.ferma()
+        self.assertEqual(sum(len(c.args[0]) for c in scrivi.call_args_list), 250)
+        self.assertTrue(all(len(c.args[0]) <= 100 for c in scrivi.call_args_list))
+
+
+class PublisherTest(SimpleTestCase):
+    def setUp(self):
+        self.broker = BrokerFinto().avvia()
+        self.addCleanup(self.broker.ferma)
+        self.pub = Publisher('127.0.0.1', self.broker.porta)
+        self.addCleanup(self.pub.ferma)
+        for nome, valore in (('PAUSA_MINIMA_SEC', 0.05), ('TIMEOUT_ACK_SEC', 0.3)):
+            patcher = mock.patch.object(publisher, nome, valore)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sequenza_su_una_connessione(self):
+        esiti = [self.pub.avvia_sequenza(f'pista{i}', 3, pausa_s=0.05).attendi(5)
+                 for i in range(3)]
+        self.assertEqual([(ok, inviati) for ok, _, inviati in esiti], [(True, 3)] * 3)
+        self.assertEqual(self.broker.connessioni, 1)
+        _, topic, payload = self.broker.pubblicati[0]
+        self.assertEqual(topic, 'autolavaggio/pista0/rpc')
+        self.assertEqual(json.loads(payload)['params'], {'id': 1, 'on': True})
+
+    def test_stesso_nodo_non_si_sovrappone(self):
+        sequenze = [self.pub.avvia_sequenza('pista2', 2, pausa_s=0.1) for _ in range(2)]
+        self.assertTrue(all(s.attendi(5)[0] for s in sequenze))
+        istanti = [t for t, _, _ in self.broker.pubblicati]
+        self.assertEqual(len(istanti), 4)
+        self.assertGreaterEqual(min(b - a for a, b in zip(istanti, istanti[1:])), 0.09)
+
+    def test_puback_mancante(self):
+        self.broker.ack = False
+        ok, messaggio, inviati = self.pub.avvia_sequenza('pista2', 2).attendi(5)
+        self.assertEqual((ok, inviati), (False, 0))
+        self.assertIn('NON confermato', messaggio)
+        # il PUBLISH pendente e' stato scartato col suo client: non
+        # riparte alla riconnessione e il mid non resta in volo
+        self.assertEqual(self.pub._in_volo, {})
+        self.broker.ack = True
+        self.assertTrue(self.pub.avvia_sequenza('pista3', 1).attendi(5)[0])
+        topic = [t for _, t, _ in self.broker.pubblicati]
+        self.assertEqual(topic.count('autolavaggio/pista2/rpc'), 1)
+        self.assertEqual(self.broker.connessioni, 2)
+
+    def test_osservatore_a_ogni_impulso(self):
+        visti = []
+        seq = self.pub.avvia_sequenza(
+            'pista2', 2, pausa_s=0.05,
+            osservatore=lambda s: visti.append((s.inviati, s.terminata)) or 'fatto')
+        seq.attendi(5)
+        self.assertEqual(visti, [(1, False), (2, True)])
+        self.assertEqual(seq.risultato, 'fatto')
+
+
+@override_settings(IMPIANTO_EVENTI_GIORNI=30, IMPIANTO_AGGREGATI_ORARI_GIORNI=400)
+class SerieEventiTest(TestCase):
+    def setUp(self):
+        self.t0 = timezone.make_aware(datetime(2026, 3, 10, 8, 0))
+
+    def _evento(self, minuti, nodo, tipo, valore=None):
+        ev = EventoImpianto.objects.create(nodo=nodo, tipo_evento=tipo, valore=valore)
+        EventoImpianto.objects.filter(pk=ev.pk).update(
+            timestamp=self.t0 + timedelta(minutes=minuti))
+
+    def _ore(self, nodo):
+        return list(AggregatoImpianto.objects.filter(periodo='ora', nodo=nodo)
+                    .order_by('inizio')
+                    .values_list('impulsi', 'minuti_online', 'eventi'))
+
+    def _scenario(self):
+        self._evento(-10, 'pista2', 'contatore', 100)
+        self._evento(0, 'pista2', 'online', 1)
+        self._evento(5, 'pista2', 'contatore', 103)
+        self._evento(20, 'pista2', 'input:2:single_push')
+        self._evento(70, 'pista2', 'contatore', 2)     # reset dello Shelly
+        self._evento(90, 'pista2', 'online', 0)
+
+    def test_rollup_orario_e_giornaliero(self):
+        self._scenario()
+        a = self.t0 + timedelta(hours=3)
+        serie.rollup_orario(self.t0 - timedelta(hours=1), a)
+        self.assertEqual(self._ore('pista2'), [(0, 0, 1), (3, 60, 3), (2, 30, 2)])
+        ora = AggregatoImpianto.objects.get(periodo='ora', inizio=self.t0)
+        self.assertEqual(ora.riepilogo, {'online': 1, 'contatore': 1,
+                                         'input:2:single_push': 1})
+
+        # Idempotente
+        serie.rollup_orario(self.t0 - timedelta(hours=1), a)
+        self.assertEqual(len(self._ore('pista2')), 3)
+
+        serie.rollup_giornaliero(self.t0.date(), self.t0.date())
+        giorno = AggregatoImpianto.objects.get(periodo='giorno', nodo='pista2')
+        self.assertEqual((giorno.impulsi, giorno.minuti_online, giorno.eventi,
+                          giorno.contatore_fine), (5, 90, 6, 2))
+
+    def test_pota_solo_gli_eventi_aggregati(self):
+        self._scenario()
+        adesso = self.t0 + timedelta(days=31)
+        # Senza rollup non si cancella niente
+        self.assertEqual(serie.pota(adesso)['eventi'], 0)
+
+        self._evento(60 * 24 * 31 - 30, 'pista2', 'contatore', 10)
+        esito = serie.manutenzione(adesso=adesso)
+        self.assertEqual(esito['eventi'], 6)
+        self.assertEqual(EventoImpianto.objects.count(), 1)
+
+        # Rifare il rollup dall'inizio non tocca le ore gia' potate e
+        # l'ora nuova parte dal contatore_fine dell'ultimo aggregato
+        serie.manutenzione(da=self.t0 - timedelta(days=1), adesso=adesso,
+                           pulizia=False)
+        self.assertEqual(self._ore('pista2')[:3], [(0, 0, 1), (3, 60, 3), (2, 30, 2)])
+        ultima = AggregatoImpianto.objects.filter(periodo='ora').order_by('-inizio')[0]
+        self.assertEqual((ultima.impulsi, ultima.contatore_fine), (8, 10))
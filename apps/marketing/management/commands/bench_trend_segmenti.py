@@ -0,0 +1,128 @@
+"""Benchmark del trend segmenti: passaggio incrementale vs un aggregato
+per punto.
+
+Genera uno storico sintetico (--clienti clienti con cadenze diverse su
+--anni anni di ordini completati) dentro una transazione che viene
+annullata alla fine: il DB reale non cambia. Poi misura sulla stessa
+griglia di punti:
+
+1. il metodo di prima: statistiche_clienti(alla_data=...) per ogni
+   punto (conteggi_al_punto);
+2. il passaggio unico a freddo (calcola_valori senza stato in cache);
+3. il giorno dopo: stesso calcolo con ora +1 giorno, che riparte dallo
+   stato in cache e scorre solo gli ordini nuovi.
+
+e verifica che i conteggi coincidano punto per punto.
+
+Uso:
+    python manage.py bench_trend_segmenti
+    python manage.py bench_trend_segmenti --clienti 3000 --anni 4 --punti 60 --passo 14
+"""
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from apps.clienti.models import Cliente
+from apps.core import cache as cache_condivisa
+from apps.marketing.models import ImpostazioniMarketing, SegmentoPersonalizzato
+from apps.marketing.services.trend import (_punti_griglia, calcola_valori,
+                                           conteggi_al_punto)
+from apps.ordini.models import Ordine
+
+TAG_BENCH = 'bench'
+
+
+class Command(BaseCommand):
+    help = 'Confronta il trend segmenti incrementale con il ricalcolo per punto.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clienti', type=int, default=2000)
+        parser.add_argument('--anni', type=int, default=3)
+        parser.add_argument('--punti', type=int, default=52)
+        parser.add_argument('--passo', type=int, default=7)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        with transaction.atomic():
+            n_ordini = self._storico(options['clienti'], options['anni'])
+            self.stdout.write(f'Storico sintetico: {options["clienti"]} clienti, '
+                              f'{n_ordini} ordini su {options["anni"]} anni.')
+            self._misura(options['punti'], options['passo'])
+            transaction.set_rollback(True)
+
+    def _storico(self, n_clienti, anni) -> int:
+        clienti = Cliente.objects.bulk_create([
+            Cliente(tipo='privato', nome=f'Bench {i}', telefono=f'399{i:07d}')
+            for i in range(n_clienti)
+        ])
+        ora = timezone.now()
+        inizio = ora - timedelta(days=365 * anni)
+        ordini, date = [], []
+        for c in clienti:
+            # Cadenza per cliente: habitue' settimanali, mensili, sporadici.
+            cadenza = random.choice((7, 14, 30, 60, 120))
+            quando = inizio + timedelta(days=random.uniform(0, 365 * anni))
+            uscita = quando + timedelta(days=random.uniform(0, 365 * anni))
+            while quando < min(ora, uscita):
+                totale = Decimal(random.choice(('12.00', '18.50', '25.00', '40.00')))
+                ordini.append(Ordine(
+                    cliente=c, stato='completato', totale=totale,
+                    totale_finale=totale,
+                    numero_progressivo=f'BENCH-{len(ordini):08d}'))
+                date.append(quando)
+                quando += timedelta(days=cadenza * random.uniform(0.6, 1.6))
+        creati = Ordine.objects.bulk_create(ordini, batch_size=2000)
+        # data_ora e' auto_now_add: la data storica va messa dopo.
+        for o, quando in zip(creati, date):
+            o.data_ora = quando
+        Ordine.objects.bulk_update(creati, ['data_ora'], batch_size=2000)
+        return len(creati)
+
+    def _misura(self, n_punti, passo):
+        cfg = ImpostazioniMarketing.get_solo()
+        custom = list(SegmentoPersonalizzato.objects.filter(attivo=True))
+        ora = timezone.localtime(timezone.now())
+        punti = _punti_griglia(ora, n_punti - 1, passo)
+        chiave_stato = f'mkt_trend_stato:{passo}:{TAG_BENCH}'
+        cache_condivisa.invalida(chiave_stato)
+
+        t0 = time.perf_counter()
+        with CaptureQueriesContext(connection) as q_vecchio:
+            vecchio = [conteggi_al_punto(p, cfg, custom) for p in punti + [ora]]
+        t_vecchio = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with CaptureQueriesContext(connection) as q_freddo:
+            nuovo = calcola_valori(punti, passo, ora, cfg, custom, TAG_BENCH)
+        t_freddo = time.perf_counter() - t0
+
+        domani = ora + timedelta(days=1)
+        t0 = time.perf_counter()
+        with CaptureQueriesContext(connection) as q_domani:
+            calcola_valori(_punti_griglia(domani, n_punti - 1, passo), passo,
+                           domani, cfg, custom, TAG_BENCH)
+        t_domani = time.perf_counter() - t0
+        cache_condivisa.invalida(chiave_stato)
+
+        self.stdout.write(f'{n_punti} punti, passo {passo} giorni, backend {connection.vendor}:')
+        for nome, t, q in (('aggregato per punto', t_vecchio, q_vecchio),
+                           ('passaggio unico (freddo)', t_freddo, q_freddo),
+                           ('giorno dopo (incrementale)', t_domani, q_domani)):
+            self.stdout.write(f'  {nome:<28} {t:7.2f}s  {len(q):4d} query')
+        self.stdout.write(f'  speedup a freddo x{t_vecchio / t_freddo:.1f}, '
+                          f'incrementale x{t_vecchio / t_domani:.1f}')
+
+        diversi = [i for i, (a, b) in enumerate(zip(vecchio, nuovo)) if a != b]
+        if diversi:
+            self.stdout.write(self.style.ERROR(
+                f'{len(diversi)} punti con conteggi diversi (es. punto {diversi[0]}: '
+                f'{vecchio[diversi[0]]} vs {nuovo[diversi[0]]})'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Conteggi identici su tutti i punti.'))
@@ -18,12 +18,19 @@ pattern di invia_promemoria_prenotazioni). Ogni run:
    - massimo --max-batch invii per run (default 8)
    - pausa casuale tra intervallo_min e intervallo_max secondi
    Per ogni invio: ri-verifica eleggibilita', risolve i placeholder
-   con dati freschi, invia e collega il MessaggioWhatsApp.
+   con dati freschi e lo passa all'outbox WhatsApp; le pause diventano
+   orari di partenza (prossimo_tentativo_il).
+
+3. OUTBOX: il cron non ha worker in background, quindi lavora lui
+   l'outbox (notifiche comprese) finche' non si svuota o scade
+   --attendi-invii secondi; quello che resta lo finisce il prossimo
+   run o un processo dispatcher_whatsapp.
 
 Uso:
     python manage.py esegui_campagne_marketing
     python manage.py esegui_campagne_marketing --dry-run
     python manage.py esegui_campagne_marketing --max-batch 5
+    python manage.py esegui_campagne_marketing --attendi-invii 120
 """
 from django.core.management.base import BaseCommand
 
@@ -43,6 +50,10 @@ class Command(BaseCommand):
             '--dry-run', action='store_true',
             help='Mostra cosa verrebbe fatto senza inviare nulla.',
         )
+        parser.add_argument(
+            '--attendi-invii', type=int, default=600,
+            help='Secondi massimi per svuotare l\'outbox WhatsApp (default 600).',
+        )
 
     def handle(self, *args, **options):
         cfg = ImpostazioniMarketing.get_solo()
@@ -51,6 +62,8 @@ class Command(BaseCommand):
 
         aggiorna_flussi_continui(log=self.stdout.write, dry=dry)
         self._processa_coda(cfg, dry, max_batch)
+        if not dry:
+            self._svuota_outbox(options['attendi_invii'])
 
     def _processa_coda(self, cfg, dry, max_batch):
         # Logica in apps/marketing/services/invio.py: condivisa col
@@ -58,3 +71,8 @@ class Command(BaseCommand):
         # per-riga rende sicura l'esecuzione concorrente cron+web.
         from apps.marketing.services.invio import processa_coda
         processa_coda(max_batch=max_batch, log=self.stdout.write, dry=dry)
+
+    def _svuota_outbox(self, timeout):
+        from apps.clients.wa_dispatcher import dispatcher
+        elaborati = dispatcher().svuota(timeout=timeout)
+        self.stdout.write(f'Outbox WhatsApp: {elaborati} messaggi elaborati.')
@@ -24,7 +24,8 @@ import logging
 
 import requests
 from django.conf import settings
-from django.core.cache import cache
+
+from apps.core import cache as cache_condivisa
 
 logger = logging.getLogger(__name__)
 
@@ -58,7 +59,7 @@ def template_approvati() -> list[dict]:
         return []
 
     cache_key = 'wa_templates_approvati'
-    cached = cache.get(cache_key)
+    cached = cache_condivisa.leggi(cache_key)
     if cached is not None:
         return cached
 
@@ -96,7 +97,7 @@ def template_approvati() -> list[dict]:
         logger.warning('listing template Meta errore: %s', e)
         return []
 
-    cache.set(cache_key, out, 60 * 60)
+    cache_condivisa.scrivi(cache_key, out, 60 * 60)
     return out
 
 
@@ -185,10 +186,21 @@ def report_vendite() -> dict:
         non_pagati = Ordine.objects.filter(
             stato_pagamento__in=['non_pagato', 'parziale', 'differito']
         ).exclude(stato='annullato')
+        # Impulsi gettoniera per nodo dagli aggregati giornalieri del
+        # listener (non dagli eventi grezzi, che vengono potati)
+        from apps.impianto.models import AggregatoImpianto
+        impulsi_nodi = {
+            r['nodo']: r['tot'] or 0
+            for r in AggregatoImpianto.objects
+            .filter(periodo='giorno', inizio__date__gte=da)
+            .values('nodo').annotate(tot=_Sum('impulsi'))
+        }
+
         finanze_30 = {
             'self_service_portali': round(portali, 2),
             'self_service_cambia_gettoni': round(cambia_gettoni, 2),
             'cicli_lavaggio_portali': wash_cycles,
+            'impulsi_gettoniera_per_nodo': impulsi_nodi,
             'registratore_cassa': round(registratore, 2),
             'incassi_per_metodo_pagamento': metodi,
             'ordini_non_pagati': non_pagati.count(),
@@ -51,6 +51,52 @@ class EsitoEleggibilita:
     motivo: str = ''
 
 
+def esiti_eleggibilita(clienti, cfg: ImpostazioniMarketing | None = None,
+                       escludi_campagna: Campagna | None = None) -> dict:
+    """Versione in blocco di verifica_eleggibilita: {cliente_id: EsitoEleggibilita}.
+
+    Stesse regole e stessi motivi, ma le regole 3 e 4 sono due query
+    raggruppate su tutta la lista invece di due EXISTS per cliente
+    (l'anteprima di un segmento da 3.000 clienti faceva 6.000+ query).
+    Le regole 1 e 2 sono sui campi del cliente: chi le viola non entra
+    nemmeno nelle query.
+    """
+    cfg = cfg or ImpostazioniMarketing.get_solo()
+    esiti, da_verificare = {}, []
+    for c in clienti:
+        if not (c.telefono or '').strip():
+            esiti[c.pk] = EsitoEleggibilita(False, 'telefono mancante')
+        elif c.blocca_marketing:
+            esiti[c.pk] = EsitoEleggibilita(False, 'opt-out (non contattare)')
+        else:
+            da_verificare.append(c.pk)
+    if not da_verificare:
+        return esiti
+
+    da = timezone.now() - timedelta(days=cfg.finestra_no_ricontatto_giorni)
+    contattati = set(InvioCampagna.objects.filter(
+        cliente_id__in=da_verificare, stato='inviato', inviato_il__gte=da,
+    ).values_list('cliente_id', flat=True).distinct())
+
+    in_coda = InvioCampagna.objects.filter(
+        cliente_id__in=da_verificare, stato='in_coda',
+        campagna__stato__in=['in_coda', 'in_corso'],
+    )
+    if escludi_campagna is not None:
+        in_coda = in_coda.exclude(campagna=escludi_campagna)
+    in_altra_campagna = set(in_coda.values_list('cliente_id', flat=True).distinct())
+
+    for pk in da_verificare:
+        if pk in contattati:
+            esiti[pk] = EsitoEleggibilita(
+                False, f'contattato negli ultimi {cfg.finestra_no_ricontatto_giorni} giorni')
+        elif pk in in_altra_campagna:
+            esiti[pk] = EsitoEleggibilita(False, "gia' in un'altra campagna attiva")
+        else:
+            esiti[pk] = EsitoEleggibilita(True)
+    return esiti
+
+
 def verifica_eleggibilita(cliente: Cliente,
                           cfg: ImpostazioniMarketing | None = None,
                           escludi_campagna: Campagna | None = None) -> EsitoEleggibilita:
@@ -65,31 +111,10 @@ def verifica_eleggibilita(cliente: Cliente,
     `escludi_campagna`: al re-check in fase di invio, la campagna
     corrente non deve auto-escludersi (il suo stesso invio in_coda
     farebbe scattare la regola 4).
-    """
-    cfg = cfg or ImpostazioniMarketing.get_solo()
 
-    if not (cliente.telefono or '').strip():
-        return EsitoEleggibilita(False, 'telefono mancante')
-    if cliente.blocca_marketing:
-        return EsitoEleggibilita(False, 'opt-out (non contattare)')
-
-    da = timezone.now() - timedelta(days=cfg.finestra_no_ricontatto_giorni)
-    if InvioCampagna.objects.filter(
-        cliente=cliente, stato='inviato', inviato_il__gte=da,
-    ).exists():
-        return EsitoEleggibilita(
-            False, f'contattato negli ultimi {cfg.finestra_no_ricontatto_giorni} giorni')
-
-    in_coda = InvioCampagna.objects.filter(
-        cliente=cliente, stato='in_coda',
-        campagna__stato__in=['in_coda', 'in_corso'],
-    )
-    if escludi_campagna is not None:
-        in_coda = in_coda.exclude(campagna=escludi_campagna)
-    if in_coda.exists():
-        return EsitoEleggibilita(False, "gia' in un'altra campagna attiva")
-
-    return EsitoEleggibilita(True)
+    Per liste di clienti usare esiti_eleggibilita.
+    """
+    return esiti_eleggibilita([cliente], cfg, escludi_campagna)[cliente.pk]
 
 
 def prepara_destinatari(cliente_ids: list[int]) -> tuple[list, list]:
@@ -97,10 +122,11 @@ def prepara_destinatari(cliente_ids: list[int]) -> tuple[list, list]:
 
     Ritorna ([Cliente], [(Cliente, motivo)]).
     """
-    cfg = ImpostazioniMarketing.get_solo()
+    clienti = list(Cliente.objects.filter(pk__in=cliente_ids))
+    esiti = esiti_eleggibilita(clienti)
     eleggibili, esclusi = [], []
-    for c in Cliente.objects.filter(pk__in=cliente_ids):
-        esito = verifica_eleggibilita(c, cfg)
+    for c in clienti:
+        esito = esiti[c.pk]
         if esito.eleggibile:
             eleggibili.append(c)
         else:
@@ -136,9 +162,11 @@ def crea_campagna(nome: str, template_meta: str, template_params: list,
         creata_da=user,
         lanciata_il=timezone.now(),
     )
+    clienti = list(Cliente.objects.filter(pk__in=cliente_ids_selezionati))
+    esiti = esiti_eleggibilita(clienti, cfg, escludi_campagna=campagna)
     invii = []
-    for c in Cliente.objects.filter(pk__in=cliente_ids_selezionati):
-        esito = verifica_eleggibilita(c, cfg, escludi_campagna=campagna)
+    for c in clienti:
+        esito = esiti[c.pk]
         invii.append(InvioCampagna(
             campagna=campagna,
             cliente=c,
@@ -182,52 +210,53 @@ def aggiorna_flussi_continui(log=None, dry: bool = False) -> dict:
             continue
 
         ids_segmento = set(_risolvi_destinatari_da_segmenti(chiavi))
-        esistenti = {i.cliente_id: i for i in campagna.invii.all()}
+        esistenti = {i.cliente_id: i
+                     for i in campagna.invii.select_related('cliente')}
         nuovi = ritentati = riagganci = 0
 
-        for cid in ids_segmento:
-            invio = esistenti.get(cid)
-
-            if invio is None:
-                cliente = Cliente.objects.filter(pk=cid).first()
-                if cliente is None:
-                    continue
-                esito = verifica_eleggibilita(cliente, cfg,
-                                              escludi_campagna=campagna)
-                if dry:
-                    log(f'[dry-run] flusso "{campagna.nome}": {cliente} -> '
-                        f'{"in_coda" if esito.eleggibile else "saltato: " + esito.motivo}')
-                    continue
-                InvioCampagna.objects.create(
-                    campagna=campagna, cliente=cliente,
-                    stato='in_coda' if esito.eleggibile else 'saltato',
-                    motivo_salto='' if esito.eleggibile else esito.motivo,
-                )
-                nuovi += 1
-                continue
-
-            # Saltato per un motivo temporaneo: ritenta appena eleggibile.
-            # L'opt-out resta bloccato dalla verifica stessa.
+        # Chi va (ri)valutato: clienti nuovi nel segmento, saltati per un
+        # motivo temporaneo (l'opt-out resta bloccato dalla verifica
+        # stessa) e inviati abbastanza tempo fa per il riaggancio
+        # ciclico. Una sola valutazione in blocco per campagna: il giro
+        # tocca solo gli invii di questa campagna, che la regola 4 gia'
+        # esclude, quindi gli esiti restano validi per tutto il ciclo.
+        limite_riaggancio = ora - timedelta(days=campagna.riaggancio_giorni)
+        da_ritentare, da_riagganciare = [], []
+        for cid in ids_segmento & esistenti.keys():
+            invio = esistenti[cid]
             if invio.stato == 'saltato':
-                esito = verifica_eleggibilita(invio.cliente, cfg,
-                                              escludi_campagna=campagna)
-                if esito.eleggibile and not dry:
-                    InvioCampagna.objects.filter(pk=invio.pk).update(
-                        stato='in_coda', inviato_il=None, motivo_salto='')
-                    ritentati += 1
-                continue
-
-            # Riaggancio ciclico: gia' inviato, ma abbastanza tempo fa.
-            if (campagna.riaggancio_giorni and invio.stato == 'inviato'
+                da_ritentare.append(invio)
+            elif (campagna.riaggancio_giorni and invio.stato == 'inviato'
                     and invio.inviato_il is not None
-                    and invio.inviato_il <= ora - timedelta(
-                        days=campagna.riaggancio_giorni)):
-                esito = verifica_eleggibilita(invio.cliente, cfg,
-                                              escludi_campagna=campagna)
-                if esito.eleggibile and not dry:
-                    InvioCampagna.objects.filter(pk=invio.pk).update(
-                        stato='in_coda', inviato_il=None, motivo_salto='')
-                    riagganci += 1
+                    and invio.inviato_il <= limite_riaggancio):
+                da_riagganciare.append(invio)
+        clienti_nuovi = list(Cliente.objects.filter(
+            pk__in=ids_segmento - esistenti.keys()))
+        esiti = esiti_eleggibilita(
+            clienti_nuovi + [i.cliente for i in da_ritentare + da_riagganciare],
+            cfg, escludi_campagna=campagna)
+
+        invii = []
+        for cliente in clienti_nuovi:
+            esito = esiti[cliente.pk]
+            if dry:
+                log(f'[dry-run] flusso "{campagna.nome}": {cliente} -> '
+                    f'{"in_coda" if esito.eleggibile else "saltato: " + esito.motivo}')
+                continue
+            invii.append(InvioCampagna(
+                campagna=campagna, cliente=cliente,
+                stato='in_coda' if esito.eleggibile else 'saltato',
+                motivo_salto='' if esito.eleggibile else esito.motivo,
+            ))
+
+        if not dry:
+            nuovi = len(InvioCampagna.objects.bulk_create(invii))
+            ritentati = InvioCampagna.objects.filter(pk__in=[
+                i.pk for i in da_ritentare if esiti[i.cliente_id].eleggibile
+            ]).update(stato='in_coda', inviato_il=None, motivo_salto='')
+            riagganci = InvioCampagna.objects.filter(pk__in=[
+                i.pk for i in da_riagganciare if esiti[i.cliente_id].eleggibile
+            ]).update(stato='in_coda', inviato_il=None, motivo_salto='')
 
         if nuovi or ritentati or riagganci:
             log(f'Flusso "{campagna.nome}": +{nuovi} nuovi, '
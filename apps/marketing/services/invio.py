@@ -4,6 +4,13 @@ Unico punto d'ingresso `processa_coda()`, usato da:
 - management command esegui_campagne_marketing (cron Railway)
 - bottone "Processa coda ora" nella UI (thread daemon dal web process)
 
+Gli invii non partono da qui: ogni InvioCampagna del batch diventa una
+riga dell'outbox WhatsApp (apps/clients/wa_dispatcher.py) a priorita'
+campagna, con prossimo_tentativo_il distanziato dalle pause casuali.
+Niente piu' time.sleep nel thread web, le notifiche transazionali
+passano davanti e un riavvio non perde il batch. L'esito arriva in
+esito_invio() dal dispatcher.
+
 Concurrency-safety su due livelli:
 - lock in-process (threading.Lock non bloccante): se il bottone viene
   premuto due volte, il secondo run esce subito;
@@ -14,19 +21,23 @@ Concurrency-safety su due livelli:
 """
 import random
 import threading
-import time
+from collections import defaultdict
+from datetime import timedelta
 
+from django.conf import settings
+from django.db.models import Q
 from django.utils import timezone
 
 from apps.marketing.models import Campagna, ImpostazioniMarketing, InvioCampagna
-from .campagne import risolvi_params, verifica_eleggibilita
+from .campagne import esiti_eleggibilita, risolvi_params, verifica_eleggibilita
 
 _LOCK = threading.Lock()
 
 
 def processa_coda(max_batch: int = 8, log=None, dry: bool = False) -> dict:
-    """Invia fino a max_batch messaggi dalla coda, rispettando il tetto
-    giornaliero e le pause casuali. Ritorna contatori.
+    """Passa all'outbox WhatsApp fino a max_batch messaggi della coda,
+    rispettando il tetto giornaliero e le pause casuali. Ritorna
+    contatori.
     """
     log = log or (lambda m: None)
 
@@ -42,7 +53,7 @@ def processa_coda(max_batch: int = 8, log=None, dry: bool = False) -> dict:
 
 def _processa(max_batch, log, dry):
     cfg = ImpostazioniMarketing.get_solo()
-    esiti = {'inviati': 0, 'falliti': 0, 'saltati': 0}
+    esiti = {'accodati': 0, 'falliti': 0, 'saltati': 0}
 
     # Fascia oraria di invio: fuori orario la coda non parte proprio
     # (gli invii restano in_coda e ripartono al prossimo run utile).
@@ -53,11 +64,14 @@ def _processa(max_batch, log, dry):
             f'{cfg.orario_invio_a:%H:%M}): rimando al prossimo run.')
         return esiti
 
-    # Budget giornaliero: tetto - inviati oggi (tutte le campagne)
+    # Budget giornaliero: tetto - inviati oggi (tutte le campagne),
+    # contando anche quelli gia' passati all'outbox e non ancora partiti
+    # (in_coda con inviato_il valorizzato = claimati).
     inizio_oggi = timezone.localtime(timezone.now()).replace(
         hour=0, minute=0, second=0, microsecond=0)
     inviati_oggi = InvioCampagna.objects.filter(
-        stato='inviato', inviato_il__gte=inizio_oggi).count()
+        Q(stato='inviato') | Q(stato='in_coda'),
+        inviato_il__gte=inizio_oggi).count()
     budget = max(0, cfg.max_invii_giorno - inviati_oggi)
     if budget == 0:
         log(f'Tetto giornaliero raggiunto ({inviati_oggi}/{cfg.max_invii_giorno}): stop.')
@@ -79,9 +93,25 @@ def _processa(max_batch, log, dry):
     log(f'Processo {len(in_coda)} invii (budget residuo {budget}, batch {max_batch}).')
 
     from apps.clients import whatsapp as wa
-    from apps.messaggi.models import MessaggioWhatsApp
-
-    for idx, invio in enumerate(in_coda):
+    from apps.clients.wa_dispatcher import accoda
+    from apps.messaggi.models import MessaggioInUscita
+
+    # Eleggibilita' di tutto il batch in blocco, una valutazione per
+    # campagna (ognuna esclude se stessa dalla regola "gia' in
+    # un'altra campagna attiva").
+    per_campagna = defaultdict(list)
+    for invio in in_coda:
+        per_campagna[invio.campagna_id].append(invio)
+    esiti_batch = {}
+    if not dry:
+        for righe in per_campagna.values():
+            esiti_c = esiti_eleggibilita([i.cliente for i in righe], cfg,
+                                         escludi_campagna=righe[0].campagna)
+            esiti_batch.update({i.pk: esiti_c[i.cliente_id] for i in righe})
+    visti = set()
+
+    ritardo = 0
+    for invio in in_coda:
         campagna = invio.campagna
         cliente = invio.cliente
 
@@ -100,8 +130,15 @@ def _processa(max_batch, log, dry):
             campagna.stato = 'in_corso'
             campagna.save(update_fields=['stato'])
 
-        # Re-check eleggibilita' al momento dell'invio
-        esito = verifica_eleggibilita(cliente, cfg, escludi_campagna=campagna)
+        # Re-check eleggibilita' al momento dell'accodamento. Se lo
+        # stesso cliente e' gia' passato in questo batch (per un'altra
+        # campagna) la sua riga precedente puo' aver cambiato la regola
+        # 4: si rivaluta da solo.
+        if cliente.pk in visti:
+            esito = verifica_eleggibilita(cliente, cfg, escludi_campagna=campagna)
+        else:
+            esito = esiti_batch[invio.pk]
+        visti.add(cliente.pk)
         if not esito.eleggibile:
             InvioCampagna.objects.filter(pk=invio.pk).update(
                 stato='saltato', motivo_salto=esito.motivo, inviato_il=None)
@@ -116,30 +153,24 @@ def _processa(max_batch, log, dry):
             esiti['saltati'] += 1
             continue
 
-        params = risolvi_params(campagna.template_params, cliente)
-        ok, wa_id, errore = wa._send_template_blocking_ex(
-            to_e164, campagna.template_meta, params)
-
-        if ok:
-            msg = MessaggioWhatsApp.objects.filter(wa_message_id=wa_id).first() if wa_id else None
+        if not settings.WHATSAPP_ENABLED:
             InvioCampagna.objects.filter(pk=invio.pk).update(
-                stato='inviato', inviato_il=timezone.now(),
-                messaggio_wa=msg)
-            esiti['inviati'] += 1
-            log(f'Inviato a {cliente}')
-        else:
-            # Il motivo del fallimento (errore Meta tradotto) finisce
-            # nella colonna Note del dettaglio campagna.
-            InvioCampagna.objects.filter(pk=invio.pk).update(
-                stato='fallito', motivo_salto=(errore or 'errore sconosciuto')[:200])
+                stato='fallito',
+                motivo_salto='WhatsApp non configurato (variabili META_* mancanti)')
             esiti['falliti'] += 1
-            log(f'FALLITO invio a {cliente}: {errore}')
+            continue
 
-        # Pausa casuale tra invii (non dopo l'ultimo)
-        if idx < len(in_coda) - 1:
-            pausa = random.randint(cfg.intervallo_min_secondi, cfg.intervallo_max_secondi)
-            log(f'  pausa {pausa}s...')
-            time.sleep(pausa)
+        # Pausa casuale tra invii (non prima del primo): diventa
+        # l'orario di partenza della riga nell'outbox.
+        if esiti['accodati']:
+            ritardo += random.randint(cfg.intervallo_min_secondi, cfg.intervallo_max_secondi)
+        params = risolvi_params(campagna.template_params, cliente)
+        accoda(to_e164, campagna.template_meta, params,
+               priorita=MessaggioInUscita.PRIORITA_CAMPAGNA,
+               origine='campagna', riferimento_id=invio.pk,
+               quando=timezone.now() + timedelta(seconds=ritardo))
+        esiti['accodati'] += 1
+        log(f'Accodato invio a {cliente} (parte tra {ritardo}s)')
 
     # Chiudi le campagne manuali esaurite. I flussi continui NON si
     # auto-completano mai: restano attivi finche' l'operatore non li
@@ -147,15 +178,47 @@ def _processa(max_batch, log, dry):
     if not dry:
         for campagna in Campagna.objects.filter(
                 stato='in_corso', tipo='manuale', flusso_continuo=False):
-            if not campagna.invii.filter(stato='in_coda').exists():
-                campagna.stato = 'completata'
-                campagna.completata_il = timezone.now()
-                campagna.save(update_fields=['stato', 'completata_il'])
+            if _chiudi_se_esaurita(campagna):
                 log(f'Campagna "{campagna.nome}" completata.')
 
     return esiti
 
 
+def _chiudi_se_esaurita(campagna) -> bool:
+    """Completa una campagna manuale senza piu' invii in coda (i
+    flussi continui restano aperti)."""
+    if campagna.tipo != 'manuale' or campagna.flusso_continuo \
+            or campagna.stato != 'in_corso' \
+            or campagna.invii.filter(stato='in_coda').exists():
+        return False
+    campagna.stato = 'completata'
+    campagna.completata_il = timezone.now()
+    campagna.save(update_fields=['stato', 'completata_il'])
+    return True
+
+
+def esito_invio(messaggio, esito) -> None:
+    """Esito finale di un invio campagna, chiamato dal dispatcher
+    (messaggio = riga MessaggioInUscita con riferimento_id = InvioCampagna)."""
+    from apps.messaggi.models import MessaggioWhatsApp
+
+    invio = InvioCampagna.objects.select_related('campagna').filter(
+        pk=messaggio.riferimento_id).first()
+    if invio is None:
+        return
+    if esito.ok:
+        msg = (MessaggioWhatsApp.objects.filter(wa_message_id=esito.wa_message_id).first()
+               if esito.wa_message_id else None)
+        InvioCampagna.objects.filter(pk=invio.pk).update(
+            stato='inviato', inviato_il=timezone.now(), messaggio_wa=msg)
+    else:
+        # Il motivo del fallimento (errore Meta tradotto) finisce
+        # nella colonna Note del dettaglio campagna.
+        InvioCampagna.objects.filter(pk=invio.pk).update(
+            stato='fallito', motivo_salto=(esito.errore or 'errore sconosciuto')[:200])
+    _chiudi_se_esaurita(invio.campagna)
+
+
 def invia_singolo(invio) -> tuple:
     """Invio manuale immediato a UN destinatario (bottone per-riga UI).
 
@@ -168,8 +231,6 @@ def invia_singolo(invio) -> tuple:
 
     Ritorna (ok, messaggio_per_operatore).
     """
-    from django.db.models import Q
-
     campagna = invio.campagna
     cliente = invio.cliente
 
@@ -219,12 +280,7 @@ def invia_singolo(invio) -> tuple:
     # Se era l'ultimo invio pendente di una campagna manuale, chiudila
     # (stessa regola di fine batch in _processa; i flussi continui
     # restano aperti).
-    if campagna.tipo == 'manuale' and not campagna.flusso_continuo \
-            and campagna.stato == 'in_corso' \
-            and not campagna.invii.filter(stato='in_coda').exists():
-        campagna.stato = 'completata'
-        campagna.completata_il = timezone.now()
-        campagna.save(update_fields=['stato', 'completata_il'])
+    _chiudi_se_esaurita(campagna)
 
     return True, f'Messaggio inviato a {cliente}.'
 
@@ -232,8 +288,8 @@ def invia_singolo(invio) -> tuple:
 def avvia_processamento_background(max_batch: int = 8) -> None:
     """Lancia processa_coda in thread daemon (per il bottone UI).
 
-    Il web process (daphne) resta vivo dopo la response, quindi il
-    thread ha tempo di completare gli invii con le pause. Il logging va
+    processa_coda ora si limita ad accodare: gli invii (con le pause)
+    li fanno i worker del dispatcher (manage.py dispatcher_whatsapp). Il logging va
     sul logger Python (visibile nei log Railway).
     """
     import logging
@@ -108,25 +108,34 @@ def statistiche_clienti(alla_data=None) -> list[ClienteSegmentato]:
     for c in stats:
         if not c.n_lavaggi or c.ultimo is None:
             continue  # nessun lavaggio entro alla_data
-        if c.n_lavaggi == 1:
-            freq = None
-        else:
-            span = (c.ultimo - c.primo).days
-            freq = span / (c.n_lavaggi - 1) if span > 0 else 1.0
-        speso = c.speso or Decimal('0')
-        out.append(ClienteSegmentato(
-            cliente=c,
-            ultimo_lavaggio=c.ultimo,
-            totale_lavaggi=c.n_lavaggi,
-            frequenza_media_giorni=freq,
-            giorni_da_ultimo=(oggi - c.ultimo).days,
-            totale_speso=speso,
-            spesa_media=(speso / c.n_lavaggi).quantize(Decimal('0.01'))
-                        if c.n_lavaggi else Decimal('0'),
-        ))
+        out.append(cliente_segmentato(c, c.n_lavaggi, c.primo, c.ultimo,
+                                      c.speso, oggi))
     return out
 
 
+def cliente_segmentato(cliente, n_lavaggi, primo, ultimo, speso,
+                       oggi) -> ClienteSegmentato:
+    """Statistica di un cliente dai suoi aggregati (n. lavaggi,
+    primo/ultimo, spesa) riferita a `oggi`. Condivisa con il motore dei
+    trend, che gli aggregati li tiene a mano scorrendo gli ordini."""
+    if n_lavaggi == 1:
+        freq = None
+    else:
+        span = (ultimo - primo).days
+        freq = span / (n_lavaggi - 1) if span > 0 else 1.0
+    speso = speso or Decimal('0')
+    return ClienteSegmentato(
+        cliente=cliente,
+        ultimo_lavaggio=ultimo,
+        totale_lavaggi=n_lavaggi,
+        frequenza_media_giorni=freq,
+        giorni_da_ultimo=(oggi - ultimo).days,
+        totale_speso=speso,
+        spesa_media=(speso / n_lavaggi).quantize(Decimal('0.01'))
+                    if n_lavaggi else Decimal('0'),
+    )
+
+
 def segmenta_clienti(cfg: ImpostazioniMarketing | None = None,
                      stats: list[ClienteSegmentato] | None = None,
                      adesso=None) -> RisultatoSegmentazione:
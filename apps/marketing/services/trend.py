@@ -1,24 +1,38 @@
 """Trend storici dei segmenti clienti (KPI).
 
 La segmentazione dipende SOLO dallo storico ordini completati, quindi
-il passato e' ricostruibile esattamente: per ogni data campione si
-rifanno le statistiche "come se fosse quel giorno"
-(statistiche_clienti(alla_data=...) + segmenta_clienti(adesso=...)).
-Niente snapshot da accumulare: i trend sono disponibili da subito su
-tutta la storia.
-
-Costo: un punto = 1 query aggregata + loop Python. Con 26 punti
-settimanali e' qualche secondo la prima volta, poi cache (1 ora,
-invalidata da cambi di soglie o di segmenti personalizzati).
+il passato e' ricostruibile esattamente. Niente snapshot da
+accumulare: i trend sono disponibili da subito su tutta la storia.
+
+Prima ogni punto del grafico rifaceva statistiche_clienti(alla_data=...)
+da capo (26-60 aggregati Cliente x Ordine). Ora un solo passaggio in
+ordine di data sugli ordini completati tiene per ogni cliente n.
+lavaggi, primo/ultimo e spesa (StatoTrend); a ogni data campione si
+fotografano gli aggregati e si riusano segmenta_clienti e
+filtra_segmento_personalizzato, quindi i numeri sono gli stessi di
+prima (conteggi_al_punto resta come riferimento per test e benchmark).
+
+Le date campione stanno su una griglia fissa (fine dei giorni con
+ordinale multiplo del passo) piu' l'ultimo punto = adesso: il giorno
+dopo i punti vecchi sono gli stessi. Lo stato del passaggio e i valori
+dei punti gia' assestati (piu' vecchi di ASSESTAMENTO_GIORNI, per gli
+ordini completati in ritardo) restano in cache: il ricalcolo scorre
+solo gli ordini nuovi e aggiunge i punti nuovi. Una ricostruzione
+completa avviene quando cambiano soglie o segmenti personalizzati
+(tag nella chiave) e comunque ogni RICOSTRUZIONE_GIORNI.
+
+Benchmark: python manage.py bench_trend_segmenti.
 """
-from datetime import timedelta
+from datetime import datetime, time, timedelta
 
-from django.core.cache import cache
+from apps.core import cache as cache_condivisa
 from django.utils import timezone
 
+from apps.clienti.models import Cliente
 from apps.marketing.models import ImpostazioniMarketing, SegmentoPersonalizzato
 
-from .segmentazione import (SEGMENTI_LABEL, filtra_segmento_personalizzato,
+from .segmentazione import (SEGMENTI_LABEL, cliente_segmentato,
+                            filtra_segmento_personalizzato,
                             segmenta_clienti, statistiche_clienti)
 
 CHIAVI_AUTO = ('attivi', 'rallentamento', 'dormienti', 'one_shot')
@@ -34,6 +48,9 @@ PERIODI_TREND = {
 }
 PERIODO_DEFAULT = 26
 
+ASSESTAMENTO_GIORNI = 2
+RICOSTRUZIONE_GIORNI = 7
+
 # Semantica KPI: crescere e' un bene o un male?
 # +1 = crescita positiva (verde), -1 = crescita negativa (rosso),
 # 0 = neutra (i segmenti personalizzati: dipende dal filtro).
@@ -52,18 +69,152 @@ COLORI_AUTO = {
 }
 
 
-def _chiave_cache(n_punti, passo_giorni):
-    """La cache si invalida da sola se cambiano soglie o segmenti
-    custom (timestamp nel nome della chiave) o al cambio di giorno."""
-    cfg = ImpostazioniMarketing.get_solo()
+def _tag_configurazione(cfg, custom) -> str:
+    """Soglie e segmenti custom attivi: se cambiano, cambia il tag e
+    con lui le chiavi di cache (serie e stato del passaggio)."""
     ultimo_custom = (SegmentoPersonalizzato.objects
                      .order_by('-aggiornato_il')
                      .values_list('aggiornato_il', flat=True).first())
-    oggi = timezone.localtime(timezone.now()).date()
     tag_custom = (ultimo_custom.strftime('%Y%m%d%H%M%S')
                   if ultimo_custom else 'none')
-    return (f'mkt_trend_segmenti:{oggi}:{n_punti}:{passo_giorni}:'
-            f'{cfg.aggiornato_il:%Y%m%d%H%M%S}:{tag_custom}')
+    pk_custom = '-'.join(str(seg.pk) for seg in custom) or 'none'
+    return f'{cfg.aggiornato_il:%Y%m%d%H%M%S}:{tag_custom}:{pk_custom}'
+
+
+def _chiave_cache(n_punti, passo_giorni, tag):
+    """La serie pronta vale un'ora e al massimo fino a fine giornata."""
+    oggi = timezone.localtime(timezone.now()).date()
+    return f'mkt_trend_segmenti:{oggi}:{n_punti}:{passo_giorni}:{tag}'
+
+
+def _inizio_giornata(giorno):
+    return timezone.make_aware(datetime.combine(giorno, time.min))
+
+
+def _punti_griglia(ora, n, passo_giorni) -> list:
+    """Le `n` date campione storiche, dalla piu' vecchia: fine dei
+    giorni con ordinale multiplo di passo_giorni, l'ultima prima di
+    oggi. Fisse da un giorno all'altro."""
+    giorno = ora.date() - timedelta(days=1)
+    giorno -= timedelta(days=giorno.toordinal() % passo_giorni)
+    return [_inizio_giornata(giorno - timedelta(days=passo_giorni * (i - 1)))
+            - timedelta(microseconds=1)
+            for i in range(n - 1, -1, -1)]
+
+
+class StatoTrend:
+    """Aggregati per cliente (n. lavaggi, primo, ultimo, speso) degli
+    ordini completati fino a `fino_a`, aggiornati scorrendo gli ordini
+    in ordine di data."""
+
+    def __init__(self, clienti=None, fino_a=None):
+        self.clienti = clienti if clienti is not None else {}
+        self.fino_a = fino_a
+
+    def copia(self):
+        return StatoTrend(dict(self.clienti), self.fino_a)
+
+    def _ordini(self, fino_a):
+        from apps.ordini.models import Ordine
+        qs = Ordine.objects.filter(stato='completato', cliente__isnull=False)
+        if self.fino_a is not None:
+            qs = qs.filter(data_ora__gt=self.fino_a)
+        if fino_a is not None:
+            qs = qs.filter(data_ora__lte=fino_a)
+        return (qs.order_by('data_ora', 'pk')
+                .values_list('cliente_id', 'data_ora', 'totale_finale')
+                .iterator(chunk_size=5000))
+
+    def scorri(self, punti, fino_a, fotografa) -> dict:
+        """Consuma gli ordini in (self.fino_a, fino_a] (fino_a None =
+        tutti) e ritorna {punto: fotografa(self, punto)} per i `punti`
+        (crescenti, tutti dentro l'intervallo)."""
+        punti = list(punti)
+        out = {}
+        i = 0
+        clienti = self.clienti
+        for cid, quando, totale in self._ordini(fino_a):
+            while i < len(punti) and quando > punti[i]:
+                out[punti[i]] = fotografa(self, punti[i])
+                i += 1
+            prec = clienti.get(cid)
+            if prec is None:
+                clienti[cid] = (1, quando, quando, totale)
+            else:
+                n, primo, _, speso = prec
+                clienti[cid] = (n + 1, primo, quando, speso + totale)
+        for punto in punti[i:]:
+            out[punto] = fotografa(self, punto)
+        self.fino_a = fino_a
+        return out
+
+    def statistiche(self, anagrafica, adesso) -> list:
+        """Come statistiche_clienti(alla_data=adesso) per lo stato corrente."""
+        return [cliente_segmentato(anagrafica[cid], n, primo, ultimo, speso, adesso)
+                for cid, (n, primo, ultimo, speso) in self.clienti.items()
+                if cid in anagrafica]
+
+
+def _conteggi(stats, punto, cfg, custom) -> dict:
+    ris = segmenta_clienti(cfg=cfg, stats=stats, adesso=punto)
+    valori = {c: len(ris.get(c)) for c in CHIAVI_AUTO}
+    for seg in custom:
+        valori[seg.chiave] = len(filtra_segmento_personalizzato(seg, stats))
+    return valori
+
+
+def conteggi_al_punto(punto, cfg, custom) -> dict:
+    """Conteggi segmento ricostruiti da zero con l'aggregato SQL (il
+    metodo di prima, un punto = una query): riferimento per test e
+    benchmark del passaggio incrementale."""
+    stats = statistiche_clienti(alla_data=punto)
+    return _conteggi(stats, punto, cfg, custom)
+
+
+def calcola_valori(punti_storici, passo_giorni, ora, cfg, custom, tag) -> list:
+    """Conteggi ({chiave: n}) per ogni punto storico e per `ora`.
+
+    Riprende dalla cache lo stato del passaggio e i punti assestati;
+    scorre solo gli ordini dopo l'ultimo assestamento.
+    """
+    assestato = _inizio_giornata(ora.date() - timedelta(days=ASSESTAMENTO_GIORNI))
+    chiave = f'mkt_trend_stato:{passo_giorni}:{tag}'
+
+    salvato = cache_condivisa.leggi(chiave)
+    valori = {}
+    stato = StatoTrend()
+    creato_il = ora
+    if salvato is not None and salvato['creato_il'] > ora - timedelta(
+            days=RICOSTRUZIONE_GIORNI):
+        fino_a = salvato['fino_a']
+        # Un punto assestato che manca e che lo stato ha gia' superato
+        # (periodo piu' lungo del solito) obbliga a ripartire da zero.
+        if all(p in salvato['valori'] or p > fino_a
+               for p in punti_storici if p <= assestato):
+            valori = salvato['valori']
+            stato = StatoTrend(salvato['clienti'], fino_a)
+            creato_il = salvato['creato_il']
+
+    anagrafica = Cliente.objects.filter(
+        ordine__stato='completato').distinct().in_bulk()
+
+    def fotografa(st, punto):
+        return _conteggi(st.statistiche(anagrafica, punto), punto, cfg, custom)
+
+    nuovi = [p for p in punti_storici if p <= assestato and p not in valori]
+    if stato.fino_a is None or stato.fino_a < assestato:
+        valori.update(stato.scorri(nuovi, assestato, fotografa))
+        limite = assestato - timedelta(days=passo_giorni * 120)
+        valori = {p: v for p, v in valori.items() if p >= limite}
+        cache_condivisa.scrivi(chiave, {
+            'creato_il': creato_il, 'fino_a': stato.fino_a,
+            'clienti': stato.clienti, 'valori': valori,
+        }, RICOSTRUZIONE_GIORNI * 24 * 60 * 60)
+
+    vivi = [p for p in punti_storici if p > assestato] + [ora]
+    valori_vivi = stato.copia().scorri(vivi, None, fotografa)
+    return ([valori[p] for p in punti_storici if p <= assestato]
+            + [valori_vivi[p] for p in vivi])
 
 
 def calcola_delta(trend: dict, giorni_confronto: int = 30) -> dict:
@@ -101,36 +252,24 @@ def serie_trend_segmenti(n_punti: int = 26, passo_giorni: int = 7,
     1h; il delta viene ricalcolato a ogni chiamata sulla finestra
     `giorni_confronto` richiesta (7/30/90...).
     """
-    chiave = _chiave_cache(n_punti, passo_giorni)
-    cached = cache.get(chiave)
+    cfg = ImpostazioniMarketing.get_solo()
+    custom = list(SegmentoPersonalizzato.objects.filter(attivo=True))
+    tag = _tag_configurazione(cfg, custom)
+    chiave = _chiave_cache(n_punti, passo_giorni, tag)
+    cached = cache_condivisa.leggi(chiave)
     if cached is not None:
         cached = dict(cached)
         cached['delta'] = calcola_delta(cached, giorni_confronto)
         return cached
 
-    cfg = ImpostazioniMarketing.get_solo()
-    custom = list(SegmentoPersonalizzato.objects.filter(attivo=True))
     ora = timezone.localtime(timezone.now())
-
     # Punti dal piu' vecchio a oggi (l'ultimo punto e' ADESSO)
-    punti = [ora - timedelta(days=passo_giorni * i)
-             for i in range(n_punti - 1, -1, -1)]
+    punti = _punti_griglia(ora, n_punti - 1, passo_giorni) + [ora]
+    per_punto = calcola_valori(punti[:-1], passo_giorni, ora, cfg, custom, tag)
 
-    valori = {c: [] for c in CHIAVI_AUTO}
+    valori = {c: [v[c] for v in per_punto] for c in CHIAVI_AUTO}
     for seg in custom:
-        valori[seg.chiave] = []
-
-    for punto in punti:
-        # Ultimo punto = presente: niente filtro alla_data (piu' veloce
-        # e identico ai numeri delle card).
-        alla_data = None if punto is punti[-1] else punto
-        stats = statistiche_clienti(alla_data=alla_data)
-        ris = segmenta_clienti(cfg=cfg, stats=stats, adesso=punto)
-        for c in CHIAVI_AUTO:
-            valori[c].append(len(ris.get(c)))
-        for seg in custom:
-            valori[seg.chiave].append(
-                len(filtra_segmento_personalizzato(seg, stats)))
+        valori[seg.chiave] = [v[seg.chiave] for v in per_punto]
 
     palette_custom = ['#0d6efd', '#6f42c1', '#20c997', '#e83e8c',
                       '#17a2b8', '#795548', '#ff7043', '#5c6bc0',
@@ -156,12 +295,12 @@ def serie_trend_segmenti(n_punti: int = 26, passo_giorni: int = 7,
     # Oltre l'anno di storia le date si ripetono: aggiungi l'anno
     fmt = '%d/%m/%y' if n_punti * passo_giorni > 360 else '%d/%m'
     out = {
-        'labels': [p.strftime(fmt) for p in punti],
+        'labels': [timezone.localtime(p).strftime(fmt) for p in punti],
         'serie': serie,
         'passo_giorni': passo_giorni,
         'generato_il': timezone.localtime(timezone.now()).strftime('%d/%m %H:%M'),
     }
-    cache.set(chiave, out, 60 * 60)
+    cache_condivisa.scrivi(chiave, out, 60 * 60)
     out = dict(out)
     out['delta'] = calcola_delta(out, giorni_confronto)
     return out
@@ -0,0 +1,137 @@
+"""Test della valutazione in blocco dell'eleggibilita' dei destinatari
+campagne e del trend segmenti incrementale.
+
+Esecuzione: python manage.py test apps.marketing
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from apps.clienti.models import Cliente
+from apps.ordini.models import Ordine
+
+from .models import (Campagna, ImpostazioniMarketing, InvioCampagna,
+                     SegmentoPersonalizzato)
+from .services.campagne import (crea_campagna, esiti_eleggibilita,
+                                prepara_destinatari, verifica_eleggibilita)
+from .services.trend import (_punti_griglia, calcola_valori,
+                             conteggi_al_punto, serie_trend_segmenti)
+
+
+class EleggibilitaTest(TestCase):
+    def setUp(self):
+        self.cfg = ImpostazioniMarketing.get_solo()
+        self.vecchia = Campagna.objects.create(
+            nome='Vecchia', template_meta='promo', stato='completata')
+        self.attiva = Campagna.objects.create(
+            nome='Attiva', template_meta='promo', stato='in_corso')
+
+        def cliente(telefono='3330000000', **kwargs):
+            return Cliente.objects.create(tipo='privato', telefono=telefono, **kwargs)
+
+        self.ok = cliente()
+        self.senza_telefono = cliente(telefono='')
+        self.opt_out = cliente(blocca_marketing=True)
+        self.contattato = cliente()
+        self.contattato_tempo_fa = cliente()
+        self.in_coda = cliente()
+
+        InvioCampagna.objects.create(
+            campagna=self.vecchia, cliente=self.contattato, stato='inviato',
+            inviato_il=timezone.now() - timedelta(days=1))
+        InvioCampagna.objects.create(
+            campagna=self.vecchia, cliente=self.contattato_tempo_fa, stato='inviato',
+            inviato_il=timezone.now() - timedelta(
+                days=self.cfg.finestra_no_ricontatto_giorni + 1))
+        InvioCampagna.objects.create(
+            campagna=self.attiva, cliente=self.in_coda, stato='in_coda')
+        self.clienti = [self.ok, self.senza_telefono, self.opt_out,
+                        self.contattato, self.contattato_tempo_fa, self.in_coda]
+
+    def test_stessi_motivi_della_verifica_singola(self):
+        esiti = esiti_eleggibilita(self.clienti, self.cfg)
+        for c in self.clienti:
+            self.assertEqual(esiti[c.pk], verifica_eleggibilita(c, self.cfg))
+
+        motivi = {c.pk: esiti[c.pk].motivo for c in self.clienti}
+        self.assertEqual(motivi[self.ok.pk], '')
+        self.assertEqual(motivi[self.contattato_tempo_fa.pk], '')
+        self.assertEqual(motivi[self.senza_telefono.pk], 'telefono mancante')
+        self.assertEqual(motivi[self.opt_out.pk], 'opt-out (non contattare)')
+        self.assertEqual(
+            motivi[self.contattato.pk],
+            f'contattato negli ultimi {self.cfg.finestra_no_ricontatto_giorni} giorni')
+        self.assertEqual(motivi[self.in_coda.pk], "gia' in un'altra campagna attiva")
+
+    def test_escludi_campagna(self):
+        esiti = esiti_eleggibilita([self.in_coda], self.cfg,
+                                   escludi_campagna=self.attiva)
+        self.assertTrue(esiti[self.in_coda.pk].eleggibile)
+
+    def test_query_costanti(self):
+        for i in range(50):
+            Cliente.objects.create(tipo='privato', telefono=f'33311{i:05d}')
+        ids = list(Cliente.objects.values_list('pk', flat=True))
+        # settings + clienti + contattati + in coda altrove
+        with self.assertNumQueries(4):
+            eleggibili, esclusi = prepara_destinatari(ids)
+        self.assertEqual(len(eleggibili), 52)
+        self.assertEqual(len(esclusi), 4)
+
+    def test_crea_campagna_salta_con_motivo(self):
+        campagna = crea_campagna(
+            'Nuova', 'promo', [], [c.pk for c in self.clienti], 'tutti', None)
+        stati = dict(campagna.invii.values_list('cliente_id', 'stato'))
+        self.assertEqual(stati[self.ok.pk], 'in_coda')
+        self.assertEqual(stati[self.in_coda.pk], 'saltato')
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'trend-segmenti'}})
+class TrendSegmentiTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cfg = ImpostazioniMarketing.get_solo()
+        self.custom = [SegmentoPersonalizzato.objects.create(
+            nome='Fedeli', lavaggi_min=3)]
+        self.ora = timezone.localtime(timezone.now())
+        # cadenze diverse: settimanale, mensile che si ferma, one-shot
+        for cadenza, n, fermo_da in ((7, 40, 0), (30, 10, 150), (1, 1, 200)):
+            cliente = Cliente.objects.create(tipo='privato', telefono='3330000000')
+            for i in range(n):
+                ordine = Ordine.objects.create(
+                    cliente=cliente, stato='completato',
+                    totale=Decimal('15.00'), totale_finale=Decimal('15.00'))
+                Ordine.objects.filter(pk=ordine.pk).update(
+                    data_ora=self.ora - timedelta(days=fermo_da + cadenza * i))
+
+    def _riferimento(self, punti, ora):
+        return [conteggi_al_punto(p, self.cfg, self.custom) for p in punti + [ora]]
+
+    def test_passaggio_unico_uguale_al_ricalcolo_per_punto(self):
+        punti = _punti_griglia(self.ora, 30, 14)
+        valori = calcola_valori(punti, 14, self.ora, self.cfg, self.custom, 't')
+        self.assertEqual(valori, self._riferimento(punti, self.ora))
+
+    def test_giorno_dopo_scorre_solo_gli_ordini_nuovi(self):
+        calcola_valori(_punti_griglia(self.ora, 25, 7), 7, self.ora,
+                       self.cfg, self.custom, 't')
+
+        domani = self.ora + timedelta(days=1)
+        punti = _punti_griglia(domani, 25, 7)
+        # clienti + ordini assestati + ordini recenti, niente aggregati per punto
+        with self.assertNumQueries(3):
+            valori = calcola_valori(punti, 7, domani, self.cfg, self.custom, 't')
+        self.assertEqual(valori, self._riferimento(punti, domani))
+
+    def test_serie(self):
+        trend = serie_trend_segmenti(n_punti=13, passo_giorni=7)
+        self.assertEqual(len(trend['labels']), 13)
+        attivi = next(s for s in trend['serie'] if s['chiave'] == 'attivi')
+        self.assertEqual(attivi['valori'][-1], 1)
+        fedeli = next(s for s in trend['serie'] if s['tipo'] == 'custom')
+        self.assertEqual(fedeli['valori'][-1], 2)
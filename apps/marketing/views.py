@@ -3,14 +3,14 @@
 F1: dashboard segmenti + dettaglio segmento + export CSV + impostazioni.
 Le fasi successive aggiungono composer campagne, dashboard conversioni.
 """
-import csv
-
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
 from django.shortcuts import redirect, render
 from django.utils import timezone
 
+from apps.core import esportazione
+
 from .models import ImpostazioniMarketing
 from .services.segmentazione import SEGMENTI_LABEL, segmenta_clienti
 
@@ -254,16 +254,12 @@ def trend_export_csv(request):
     trend = serie_trend_segmenti(
         n_punti=cfg_periodo['punti'], passo_giorni=cfg_periodo['passo'])
     oggi = timezone.localtime(timezone.now()).strftime('%Y%m%d')
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = (
-        f'attachment; filename="trend_segmenti_{oggi}.csv"'
-    )
-    response.write('﻿')
-    writer = csv.writer(response, delimiter=';')
-    writer.writerow(['Settimana'] + [s['nome'] for s in trend['serie']])
-    for i, label in enumerate(trend['labels']):
-        writer.writerow([label] + [s['valori'][i] for s in trend['serie']])
-    return response
+    return esportazione.esporta(
+        request, f'trend_segmenti_{oggi}',
+        ['Settimana'] + [s['nome'] for s in trend['serie']],
+        ([label] + [s['valori'][i] for s in trend['serie']]
+         for i, label in enumerate(trend['labels'])),
+        foglio='Trend segmenti')
 
 
 @_staff_required
@@ -288,28 +284,18 @@ def segmento_export_csv(request, chiave):
     ris = segmenta_clienti()
     oggi = timezone.localtime(timezone.now()).strftime('%Y%m%d')
 
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = (
-        f'attachment; filename="segmento_{chiave}_{oggi}.csv"'
-    )
-    # BOM per Excel che altrimenti sbaglia l'encoding degli accenti
-    response.write('﻿')
-    writer = csv.writer(response, delimiter=';')
-    writer.writerow([
+    return esportazione.esporta(request, f'segmento_{chiave}_{oggi}', [
         'Nome', 'Telefono', 'Email', 'Ultimo lavaggio',
         'Totale lavaggi', 'Frequenza media (gg)', 'Giorni da ultimo',
-    ])
-    for cs in ris.get(chiave):
-        writer.writerow([
-            cs.nome_completo,
-            cs.telefono,
-            cs.cliente.email or '',
-            timezone.localtime(cs.ultimo_lavaggio).strftime('%d/%m/%Y'),
-            cs.totale_lavaggi,
-            f'{cs.frequenza_media_giorni:.0f}' if cs.frequenza_media_giorni else '',
-            cs.giorni_da_ultimo,
-        ])
-    return response
+    ], ([
+        cs.nome_completo,
+        cs.telefono,
+        cs.cliente.email or '',
+        timezone.localtime(cs.ultimo_lavaggio).strftime('%d/%m/%Y'),
+        cs.totale_lavaggi,
+        f'{cs.frequenza_media_giorni:.0f}' if cs.frequenza_media_giorni else '',
+        cs.giorni_da_ultimo,
+    ] for cs in ris.get(chiave)), foglio='Segmento')
 
 
 @_staff_required
@@ -805,20 +791,11 @@ def campagna_export_csv(request, pk):
     )
 
     oggi = timezone.localtime(timezone.now()).strftime('%Y%m%d')
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = (
-        f'attachment; filename="campagna_{campagna.pk}_{oggi}.csv"'
-    )
-    response.write('﻿')
-    writer = csv.writer(response, delimiter=';')
-    writer.writerow([
-        'Cliente', 'Telefono', 'Stato', 'Inviato il', 'Consegna WA',
-        'Motivo salto', 'Convertito',
-    ])
     consegna_label = {'read': 'letto', 'delivered': 'recapitato',
                       'sent': 'inviato', 'failed': 'fallito'}
-    for i in campagna.invii.select_related('cliente', 'messaggio_wa'):
-        writer.writerow([
+
+    def _riga(i):
+        return [
             i.cliente.nome_completo,
             i.cliente.telefono,
             i.get_stato_display(),
@@ -828,8 +805,13 @@ def campagna_export_csv(request, pk):
             if i.messaggio_wa else '',
             i.motivo_salto,
             'SI' if i.cliente_id in convertiti else '',
-        ])
-    return response
+        ]
+
+    invii = campagna.invii.select_related('cliente', 'messaggio_wa').order_by('pk')
+    return esportazione.esporta(request, f'campagna_{campagna.pk}_{oggi}', [
+        'Cliente', 'Telefono', 'Stato', 'Inviato il', 'Consegna WA',
+        'Motivo salto', 'Convertito',
+    ], esportazione.righe_da_queryset(invii, _riga), foglio='Invii')
 
 
 @_staff_required
@@ -1190,27 +1172,18 @@ def segmento_custom_export(request, pk):
     seg = get_object_or_404(SegmentoPersonalizzato, pk=pk)
     oggi = timezone.localtime(timezone.now()).strftime('%Y%m%d')
 
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = (
-        f'attachment; filename="segmento_custom_{seg.pk}_{oggi}.csv"'
-    )
-    response.write('﻿')
-    writer = csv.writer(response, delimiter=';')
-    writer.writerow([
+    return esportazione.esporta(request, f'segmento_custom_{seg.pk}_{oggi}', [
         'Nome', 'Telefono', 'Email', 'Ultimo lavaggio', 'Totale lavaggi',
         'Frequenza media (gg)', 'Giorni da ultimo',
         'Spesa totale', 'Spesa media',
-    ])
-    for cs in filtra_segmento_personalizzato(seg):
-        writer.writerow([
-            cs.nome_completo,
-            cs.telefono,
-            cs.cliente.email or '',
-            timezone.localtime(cs.ultimo_lavaggio).strftime('%d/%m/%Y'),
-            cs.totale_lavaggi,
-            f'{cs.frequenza_media_giorni:.0f}' if cs.frequenza_media_giorni else '',
-            cs.giorni_da_ultimo,
-            f'{cs.totale_speso:.2f}',
-            f'{cs.spesa_media:.2f}',
-        ])
-    return response
+    ], ([
+        cs.nome_completo,
+        cs.telefono,
+        cs.cliente.email or '',
+        timezone.localtime(cs.ultimo_lavaggio).strftime('%d/%m/%Y'),
+        cs.totale_lavaggi,
+        f'{cs.frequenza_media_giorni:.0f}' if cs.frequenza_media_giorni else '',
+        cs.giorni_da_ultimo,
+        f'{cs.totale_speso:.2f}',
+        f'{cs.spesa_media:.2f}',
+    ] for cs in filtra_segmento_personalizzato(seg)), foglio='Segmento')
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import ConversazioneWhatsApp, MessaggioWhatsApp
+from .models import (ConversazioneWhatsApp, MessaggioInUscita, MessaggioWhatsApp,
+                     WebhookInArrivo)
 
 
 @admin.register(ConversazioneWhatsApp)
@@ -10,7 +11,9 @@ class ConversazioneWhatsAppAdmin(admin.ModelAdmin):
     list_filter = ('non_letti',)
     search_fields = ('numero_e164', 'cliente__nome', 'cliente__cognome',
                      'cliente__telefono')
-    readonly_fields = ('creata_il', 'ultimo_messaggio_il')
+    # proiezione dell'ultimo messaggio: la scrive MessaggioWhatsApp.save()
+    readonly_fields = ('creata_il', 'ultimo_messaggio', 'ultimo_messaggio_il',
+                       'ultimo_preview', 'ultimo_direzione', 'ultimo_stato')
     autocomplete_fields = ('cliente',)
 
 
@@ -26,3 +29,19 @@ class MessaggioWhatsAppAdmin(admin.ModelAdmin):
     def corpo_short(self, obj):
         return (obj.corpo or '')[:80]
     corpo_short.short_description = 'Corpo'
+
+
+@admin.register(MessaggioInUscita)
+class MessaggioInUscitaAdmin(admin.ModelAdmin):
+    list_display = ('id', 'numero_e164', 'tipo', 'template', 'priorita',
+                    'stato', 'tentativi', 'prossimo_tentativo_il', 'errore')
+    list_filter = ('stato', 'tipo', 'priorita', 'origine')
+    search_fields = ('numero_e164', 'template', 'wa_message_id')
+    readonly_fields = ('creato_il', 'inviato_il', 'preso_il', 'wa_message_id')
+
+
+@admin.register(WebhookInArrivo)
+class WebhookInArrivoAdmin(admin.ModelAdmin):
+    list_display = ('id', 'stato', 'tentativi', 'ricevuto_il', 'elaborato_il', 'errore')
+    list_filter = ('stato',)
+    readonly_fields = ('ricevuto_il', 'preso_il', 'elaborato_il')
@@ -5,3 +5,6 @@ class MessaggiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.messaggi'
     verbose_name = 'Messaggi WhatsApp'
+
+    def ready(self):
+        import apps.messaggi.signals  # noqa
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:50
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaggi', '0002_messaggiowhatsapp_media_id_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessaggioInUscita',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('numero_e164', models.CharField(max_length=32)),
+                ('tipo', models.CharField(choices=[('template', 'Template'), ('text', 'Testo')], default='template', max_length=10)),
+                ('template', models.CharField(blank=True, default='', max_length=120)),
+                ('parametri', models.JSONField(blank=True, default=list)),
+                ('testo', models.TextField(blank=True, default='')),
+                ('priorita', models.PositiveSmallIntegerField(default=0)),
+                ('stato', models.CharField(choices=[('in_coda', 'In coda'), ('in_invio', 'In invio'), ('inviato', 'Inviato'), ('fallito', 'Fallito')], default='in_coda', max_length=10)),
+                ('tentativi', models.PositiveSmallIntegerField(default=0)),
+                ('prossimo_tentativo_il', models.DateTimeField(default=django.utils.timezone.now)),
+                ('preso_il', models.DateTimeField(blank=True, null=True)),
+                ('origine', models.CharField(blank=True, default='', max_length=20)),
+                ('riferimento_id', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('wa_message_id', models.CharField(blank=True, default='', max_length=128)),
+                ('errore', models.CharField(blank=True, default='', max_length=255)),
+                ('creato_il', models.DateTimeField(auto_now_add=True)),
+                ('inviato_il', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Messaggio in uscita',
+                'verbose_name_plural': 'Messaggi in uscita',
+                'ordering': ['-creato_il'],
+                'indexes': [models.Index(fields=['stato', 'priorita', 'prossimo_tentativo_il'], name='outbox_prelievo_idx')],
+            },
+        ),
+    ]
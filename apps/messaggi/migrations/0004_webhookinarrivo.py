@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaggi', '0003_messaggioinuscita'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookInArrivo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.JSONField(default=dict)),
+                ('stato', models.CharField(choices=[('in_coda', 'In coda'), ('in_lavorazione', 'In lavorazione'), ('elaborato', 'Elaborato'), ('errore', 'Errore')], default='in_coda', max_length=15)),
+                ('tentativi', models.PositiveSmallIntegerField(default=0)),
+                ('ricevuto_il', models.DateTimeField(auto_now_add=True)),
+                ('preso_il', models.DateTimeField(blank=True, null=True)),
+                ('elaborato_il', models.DateTimeField(blank=True, null=True)),
+                ('errore', models.CharField(blank=True, default='', max_length=255)),
+            ],
+            options={
+                'verbose_name': 'Webhook WhatsApp in arrivo',
+                'verbose_name_plural': 'Webhook WhatsApp in arrivo',
+                'ordering': ['-ricevuto_il'],
+                'indexes': [models.Index(fields=['stato', 'id'], name='inbox_webhook_prelievo_idx')],
+            },
+        ),
+    ]
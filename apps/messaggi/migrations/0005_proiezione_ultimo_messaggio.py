@@ -0,0 +1,70 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def popola_ultimo_messaggio(apps, schema_editor):
+    """Ultimo messaggio di ogni conversazione, in un solo UPDATE."""
+    from django.db.models import Exists, F, OuterRef, Subquery
+    from django.db.models.functions import Coalesce, Substr
+
+    Conversazione = apps.get_model('messaggi', 'ConversazioneWhatsApp')
+    Messaggio = apps.get_model('messaggi', 'MessaggioWhatsApp')
+    ultimo = Messaggio.objects.filter(conversazione=OuterRef('pk')).order_by('-creato_il', '-pk')
+
+    def colonna(espressione):
+        return Subquery(ultimo.annotate(v=espressione).values('v')[:1])
+
+    Conversazione.objects.filter(Exists(ultimo)).update(
+        ultimo_messaggio=colonna(F('pk')),
+        ultimo_messaggio_il=Coalesce(colonna(F('creato_il')), F('ultimo_messaggio_il')),
+        ultimo_preview=colonna(Substr('corpo', 1, 80)),
+        ultimo_direzione=colonna(F('direzione')),
+        ultimo_stato=colonna(F('stato')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaggi', '0004_webhookinarrivo'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='conversazionewhatsapp',
+            options={'ordering': ['-ultimo_messaggio_il', '-id'], 'verbose_name': 'Conversazione WhatsApp', 'verbose_name_plural': 'Conversazioni WhatsApp'},
+        ),
+        migrations.AddField(
+            model_name='conversazionewhatsapp',
+            name='ultimo_direzione',
+            field=models.CharField(blank=True, default='', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='conversazionewhatsapp',
+            name='ultimo_messaggio',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='messaggi.messaggiowhatsapp'),
+        ),
+        migrations.AddField(
+            model_name='conversazionewhatsapp',
+            name='ultimo_preview',
+            field=models.CharField(blank=True, default='', max_length=80),
+        ),
+        migrations.AddField(
+            model_name='conversazionewhatsapp',
+            name='ultimo_stato',
+            field=models.CharField(blank=True, default='', max_length=12),
+        ),
+        migrations.AlterField(
+            model_name='conversazionewhatsapp',
+            name='ultimo_messaggio_il',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='conversazionewhatsapp',
+            index=models.Index(fields=['-ultimo_messaggio_il', '-id'], name='conv_wa_lista_idx'),
+        ),
+        migrations.RunPython(popola_ultimo_messaggio, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaggi', '0005_proiezione_ultimo_messaggio'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messaggioinuscita',
+            index=models.Index(fields=['preso_il'], name='outbox_preso_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messaggioinuscita',
+            index=models.Index(fields=['numero_e164', 'preso_il'], name='outbox_numero_preso_idx'),
+        ),
+    ]
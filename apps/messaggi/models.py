@@ -14,7 +14,8 @@ Ogni `MessaggioWhatsApp` ha:
   webhook di status update
 """
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 
 
 class ConversazioneWhatsApp(models.Model):
@@ -31,22 +32,51 @@ class ConversazioneWhatsApp(models.Model):
         related_name='conversazioni_wa',
         help_text="Cliente anagrafato associato. Null se numero sconosciuto."
     )
-    # Aggiornato ad ogni messaggio in o out (auto_now) -> per ordinare la lista
-    ultimo_messaggio_il = models.DateTimeField(auto_now=True, db_index=True)
+    # Proiezione dell'ultimo messaggio (in o out), per la lista della
+    # inbox senza una query per conversazione. La scrive
+    # MessaggioWhatsApp.save() nella stessa transazione del messaggio
+    # (e wa_inbox.applica_stati per gli status a lotti).
+    ultimo_messaggio = models.ForeignKey(
+        'MessaggioWhatsApp', null=True, blank=True,
+        on_delete=models.SET_NULL, related_name='+',
+    )
+    ultimo_messaggio_il = models.DateTimeField(default=timezone.now)
+    ultimo_preview = models.CharField(max_length=80, blank=True, default='')
+    ultimo_direzione = models.CharField(max_length=3, blank=True, default='')
+    ultimo_stato = models.CharField(max_length=12, blank=True, default='')
     # Solo quando arriva un messaggio incoming -> usato per finestra 24h
     ultimo_incoming_il = models.DateTimeField(null=True, blank=True)
     non_letti = models.PositiveIntegerField(default=0)
     creata_il = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        ordering = ['-ultimo_messaggio_il']
+        ordering = ['-ultimo_messaggio_il', '-id']
         verbose_name = 'Conversazione WhatsApp'
         verbose_name_plural = 'Conversazioni WhatsApp'
+        indexes = [
+            # lista inbox a chiave (ultimo_messaggio_il, id) decrescente
+            models.Index(fields=['-ultimo_messaggio_il', '-id'], name='conv_wa_lista_idx'),
+        ]
 
     def __str__(self):
         nome = self.cliente.nome if self.cliente else 'Sconosciuto'
         return f'{nome} ({self.numero_e164})'
 
+    def ricalcola_ultimo(self):
+        """Riallinea la proiezione sull'ultimo messaggio rimasto (dopo
+        una cancellazione)."""
+        ultimo = self.messaggi.order_by('-creato_il', '-pk').first()
+        self.ultimo_messaggio = ultimo
+        if ultimo is not None:
+            self.ultimo_messaggio_il = ultimo.creato_il
+        self.ultimo_preview = (ultimo.corpo or '')[:80] if ultimo else ''
+        self.ultimo_direzione = ultimo.direzione if ultimo else ''
+        self.ultimo_stato = ultimo.stato if ultimo else ''
+        ConversazioneWhatsApp.objects.filter(pk=self.pk).update(
+            ultimo_messaggio=ultimo, ultimo_messaggio_il=self.ultimo_messaggio_il,
+            ultimo_preview=self.ultimo_preview, ultimo_direzione=self.ultimo_direzione,
+            ultimo_stato=self.ultimo_stato)
+
     def finestra_24h_aperta(self) -> bool:
         """Vero se l'ultimo messaggio incoming e' < 24h fa.
 
@@ -139,3 +169,125 @@ class MessaggioWhatsApp(models.Model):
     def __str__(self):
         prefix = '>' if self.direzione == 'in' else '<'
         return f'{prefix} {self.corpo[:50]}'
+
+    def save(self, *args, **kwargs):
+        nuovo = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._proietta(nuovo)
+
+    def _proietta(self, nuovo: bool):
+        """Aggiorna l'ultimo messaggio della conversazione: un messaggio
+        nuovo diventa l'ultimo (salvo uno piu' recente gia' proiettato),
+        una modifica conta solo se e' gia' lui l'ultimo."""
+        campi = {'ultimo_preview': (self.corpo or '')[:80],
+                 'ultimo_direzione': self.direzione, 'ultimo_stato': self.stato}
+        convs = ConversazioneWhatsApp.objects.filter(pk=self.conversazione_id)
+        if nuovo:
+            campi.update(ultimo_messaggio=self, ultimo_messaggio_il=self.creato_il)
+            convs = convs.filter(models.Q(ultimo_messaggio__isnull=True)
+                                 | models.Q(ultimo_messaggio_il__lte=self.creato_il))
+        else:
+            convs = convs.filter(ultimo_messaggio=self)
+        if convs.update(**campi) and type(self).conversazione.is_cached(self):
+            # la conversazione in memoria (es. quella passata a create())
+            # resta allineata: un suo save() successivo non la riporta indietro
+            for campo, valore in campi.items():
+                setattr(self.conversazione, campo, valore)
+
+
+class MessaggioInUscita(models.Model):
+    """Outbox dei messaggi verso la Graph API Meta.
+
+    Ogni invio (notifica, campagna, risposta inbox) passa da qui: il
+    dispatcher (apps/clients/wa_dispatcher.py) preleva le righe in_coda
+    per priorita' e le manda. Una riga rimasta 'in_invio' da un
+    processo morto torna in coda dopo qualche minuto, quindi gli invii
+    accodati sopravvivono ai riavvii.
+    """
+    PRIORITA_NOTIFICA = 0
+    PRIORITA_CAMPAGNA = 10
+
+    TIPO = [
+        ('template', 'Template'),
+        ('text', 'Testo'),
+    ]
+    STATO = [
+        ('in_coda', 'In coda'),
+        ('in_invio', 'In invio'),
+        ('inviato', 'Inviato'),
+        ('fallito', 'Fallito'),
+    ]
+
+    numero_e164 = models.CharField(max_length=32)
+    tipo = models.CharField(max_length=10, choices=TIPO, default='template')
+    template = models.CharField(max_length=120, blank=True, default='')
+    parametri = models.JSONField(default=list, blank=True)
+    testo = models.TextField(blank=True, default='')
+    # 0 = notifiche transazionali (auto pronta, prenotazioni), 10 =
+    # campagne: a parita' di scadenza passano prima i numeri piu' bassi.
+    priorita = models.PositiveSmallIntegerField(default=PRIORITA_NOTIFICA)
+    stato = models.CharField(max_length=10, choices=STATO, default='in_coda')
+    tentativi = models.PositiveSmallIntegerField(default=0)
+    prossimo_tentativo_il = models.DateTimeField(default=timezone.now)
+    preso_il = models.DateTimeField(null=True, blank=True)
+    # Chi aspetta l'esito finale (es. 'campagna' -> InvioCampagna pk),
+    # vedi wa_dispatcher.GESTORI_ESITO.
+    origine = models.CharField(max_length=20, blank=True, default='')
+    riferimento_id = models.PositiveBigIntegerField(null=True, blank=True)
+    wa_message_id = models.CharField(max_length=128, blank=True, default='')
+    errore = models.CharField(max_length=255, blank=True, default='')
+    creato_il = models.DateTimeField(auto_now_add=True)
+    inviato_il = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-creato_il']
+        verbose_name = 'Messaggio in uscita'
+        verbose_name_plural = 'Messaggi in uscita'
+        indexes = [
+            models.Index(fields=['stato', 'priorita', 'prossimo_tentativo_il'],
+                         name='outbox_prelievo_idx'),
+            # rate limit del dispatcher (finestre su preso_il)
+            models.Index(fields=['preso_il'], name='outbox_preso_idx'),
+            models.Index(fields=['numero_e164', 'preso_il'], name='outbox_numero_preso_idx'),
+        ]
+
+    def __str__(self):
+        cosa = self.template if self.tipo == 'template' else self.testo[:30]
+        return f'{self.numero_e164} {cosa} ({self.stato})'
+
+
+class WebhookInArrivo(models.Model):
+    """Inbox dei webhook Meta: il body di ogni POST cosi' com'e' arrivato.
+
+    whatsapp_webhook salva la riga e risponde subito; l'elaboratore
+    (apps/api/wa_inbox.py) preleva le righe in_coda a lotti, crea i
+    messaggi in entrata e applica gli status. Una riga rimasta
+    'in_lavorazione' da un processo morto torna in coda dopo qualche
+    minuto, come per l'outbox.
+    """
+    STATO = [
+        ('in_coda', 'In coda'),
+        ('in_lavorazione', 'In lavorazione'),
+        ('elaborato', 'Elaborato'),
+        ('errore', 'Errore'),
+    ]
+
+    payload = models.JSONField(default=dict)
+    stato = models.CharField(max_length=15, choices=STATO, default='in_coda')
+    tentativi = models.PositiveSmallIntegerField(default=0)
+    ricevuto_il = models.DateTimeField(auto_now_add=True)
+    preso_il = models.DateTimeField(null=True, blank=True)
+    elaborato_il = models.DateTimeField(null=True, blank=True)
+    errore = models.CharField(max_length=255, blank=True, default='')
+
+    class Meta:
+        ordering = ['-ricevuto_il']
+        verbose_name = 'Webhook WhatsApp in arrivo'
+        verbose_name_plural = 'Webhook WhatsApp in arrivo'
+        indexes = [
+            models.Index(fields=['stato', 'id'], name='inbox_webhook_prelievo_idx'),
+        ]
+
+    def __str__(self):
+        return f'Webhook {self.pk} ({self.stato})'
@@ -0,0 +1,20 @@
+"""Proiezione dell'ultimo messaggio sulle conversazioni WhatsApp.
+
+Creazioni e modifiche le proietta MessaggioWhatsApp.save(); qui resta
+solo la cancellazione dell'ultimo messaggio (il SET_NULL su
+ultimo_messaggio e' gia' passato quando arriva il post_delete).
+"""
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import ConversazioneWhatsApp, MessaggioWhatsApp
+
+
+@receiver(post_delete, sender=MessaggioWhatsApp)
+def riproietta_ultimo(sender, instance, origin=None, **kwargs):
+    if getattr(origin, 'model', type(origin)) is ConversazioneWhatsApp:
+        return  # cascade dalla conversazione: se ne va anche lei
+    conv = ConversazioneWhatsApp.objects.filter(
+        pk=instance.conversazione_id, ultimo_messaggio__isnull=True).first()
+    if conv is not None:
+        conv.ricalcola_ultimo()
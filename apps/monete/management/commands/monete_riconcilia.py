@@ -1,4 +1,8 @@
-"""Riconciliazione acquisti PayPal rimasti a meta'.
+"""Riconciliazione acquisti PayPal rimasti a meta' (e lavaggi).
+
+Prima di PayPal chiude i lavaggi con l'invio impulsi interrotto
+(processo morto a meta' sequenza: storno degli impulsi non partiti) e
+marca le discrepanze col contatore.
 
 Caso coperto: il cliente approva il pagamento su paypal.com ma chiude
 il browser PRIMA di tornare sulla pagina di ritorno -> l'ordine e'
@@ -31,10 +35,17 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         dry = options['dry_run']
 
-        # 1. Verifica contatore <-> credito: lavaggi non confermati
-        #    entro la finestra -> discrepanza (log + visibile in admin)
+        # 1. Verifica contatore <-> credito: invii interrotti chiusi con
+        #    storno, lavaggi non confermati entro la finestra ->
+        #    discrepanza (log + visibile in admin)
         if not dry:
+            from apps.monete.services.lavaggio import recupera_invii_interrotti
             from apps.monete.services.verifica import scadenza_verifiche
+            interrotti = recupera_invii_interrotti()
+            if interrotti:
+                self.stdout.write(self.style.WARNING(
+                    f'{interrotti} lavaggi con invio interrotto chiusi '
+                    f'(impulsi non partiti stornati).'))
             discrepanze = scadenza_verifiche()
             if discrepanze:
                 self.stdout.write(self.style.WARNING(
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monete', '0007_alter_movimentomoneta_tipo'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='movimentomoneta',
+            index=models.Index(condition=models.Q(('verifica', 'in_attesa')), fields=['nodo', 'contatore_atteso'], name='idx_movimento_attesa_nodo'),
+        ),
+    ]
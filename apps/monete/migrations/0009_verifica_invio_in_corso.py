@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monete', '0008_movimentomoneta_idx_attesa_nodo'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='movimentomoneta',
+            name='verifica',
+            field=models.CharField(blank=True, choices=[('', '-'), ('invio_in_corso', 'Invio impulsi in corso'), ('in_attesa', 'In attesa conferma'), ('ok', 'Confermato dal contatore'), ('discrepanza', 'DISCREPANZA'), ('non_verificabile', 'Non verificabile')], default='', max_length=20),
+        ),
+    ]
@@ -235,8 +235,12 @@ class MovimentoMoneta(models.Model):
     # macchina: fotografiamo il totale prima dell'invio e verifichiamo
     # che salga di conseguenza. verifica='discrepanza' = credito scalato
     # ma impulsi non (tutti) contati -> da controllare/rimborsare.
+    # 'invio_in_corso' = addebitato, sequenza impulsi non ancora chiusa:
+    # se resta cosi' (worker riavviato a meta') la chiude il cron con
+    # lo storno (lavaggio.recupera_invii_interrotti).
     VERIFICA_CHOICES = [
         ('', '-'),
+        ('invio_in_corso', 'Invio impulsi in corso'),
         ('in_attesa', 'In attesa conferma'),
         ('ok', 'Confermato dal contatore'),
         ('discrepanza', 'DISCREPANZA'),
@@ -256,6 +260,11 @@ class MovimentoMoneta(models.Model):
         verbose_name_plural = 'Movimenti monete'
         indexes = [
             models.Index(fields=['cliente', '-creato_il']),
+            # Lavaggi in attesa di conferma per nodo, ordinati per totale
+            # atteso: aggiorna_verifiche conferma con un range scan
+            models.Index(fields=['nodo', 'contatore_atteso'],
+                         name='idx_movimento_attesa_nodo',
+                         condition=models.Q(verifica='in_attesa')),
         ]
         constraints = [
             models.UniqueConstraint(
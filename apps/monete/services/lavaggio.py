@@ -4,11 +4,22 @@ Sequenza (l'ordine e' deliberato):
 1. validazioni (nodo attivo, range impulsi, MQTT configurato);
 2. guard anti-raffica: cooldown per cliente+nodo (config singleton);
 3. ADDEBITO monete in transazione COMMITTATA prima del MQTT — mai
-   impulsi gratis, e mai chiamare MQTT dentro la transazione (dorme
-   ~1 s per impulso e terrebbe il lock sulla riga saldo);
-4. invio impulsi via apps.impianto.mqtt.moneta_virtuale;
-5. se sono partiti meno impulsi del previsto, STORNO automatico delle
-   monete corrispondenti agli impulsi non erogati.
+   impulsi gratis, e mai chiamare MQTT dentro la transazione (la
+   sequenza dura ~2 s per impulso e terrebbe il lock sulla riga saldo);
+4. invio impulsi come sequenza sul publisher persistente del processo
+   (apps.impianto.publisher): la view non aspetta i ~2 s tra un
+   impulso e l'altro, torna subito con l'esito "in corso" e la pagina
+   fa polling di stato_avvio() (avanzamento nella cache condivisa);
+5. a sequenza finita (osservatore del publisher, fuori dalla richiesta):
+   dati per la verifica col contatore e, se sono partiti meno impulsi
+   del previsto, STORNO automatico delle monete non erogate.
+
+L'addebito nasce gia' con verifica='invio_in_corso': se il processo
+muore a meta' sequenza (deploy, crash) il punto 5 non arriva mai, e il
+cron (monete_riconcilia -> recupera_invii_interrotti) chiude dopo
+INVIO_INTERROTTO_MIN i movimenti rimasti cosi', stornando gli impulsi
+che non risultano partiti. La chiusura e' un UPDATE condizionato
+(registra_esito_invio): fine sequenza e cron non stornano mai tutti e due.
 """
 import logging
 from dataclasses import dataclass
@@ -16,10 +27,18 @@ from datetime import timedelta
 
 from django.utils import timezone
 
-from apps.impianto.mqtt import moneta_virtuale, mqtt_configurato
+from apps.core import cache as cache_condivisa
+from apps.impianto.mqtt import mqtt_configurato
+from apps.impianto.publisher import SequenzaImpulsi, publisher
 from apps.monete.models import ImpostazioniMonete, MovimentoMoneta, NodoImpianto
 from . import wallet
 
+# Stato dell'avvio per il polling dalla pagina esito (qualunque worker)
+STATO_AVVIO_TTL_SEC = 60 * 60
+# Dopo quanto un 'invio_in_corso' e' da considerare interrotto (una
+# sequenza intera dura al massimo qualche decina di secondi)
+INVIO_INTERROTTO_MIN = 10
+
 logger = logging.getLogger('apps.monete.lavaggio')
 
 
@@ -30,16 +49,47 @@ class EsitoAvvio:
     inviati: int = 0
     movimento: MovimentoMoneta | None = None
     storno: MovimentoMoneta | None = None
+    in_corso: bool = False
+    sequenza: SequenzaImpulsi | None = None
+
+
+def _chiave_stato(movimento_pk) -> str:
+    return f'lavaggio_avvio:{movimento_pk}'
+
+
+def stato_avvio(movimento) -> dict:
+    """Avanzamento dell'invio impulsi di un movimento 'lavaggio'.
+
+    Dalla cache condivisa finche' c'e'; altrimenti (scaduta, cache giu')
+    lo si ricava dal movimento: invio chiuso = sequenza finita.
+    """
+    stato = cache_condivisa.leggi(_chiave_stato(movimento.pk))
+    if stato is not None:
+        return stato
+    return {'impulsi': movimento.impulsi, 'inviati': None,
+            'terminata': movimento.verifica not in ('', 'invio_in_corso'),
+            'ok': None, 'messaggio': ''}
+
+
+def _pubblica_stato(movimento, impulsi, inviati=0, terminata=False, ok=None,
+                    messaggio=''):
+    cache_condivisa.scrivi(_chiave_stato(movimento.pk), {
+        'impulsi': impulsi, 'inviati': inviati, 'terminata': terminata,
+        'ok': ok, 'messaggio': messaggio,
+    }, STATO_AVVIO_TTL_SEC)
 
 
 def avvia_lavaggio(*, cliente, nodo: NodoImpianto, impulsi: int,
                    operatore=None, chiave_idempotenza: str = '',
-                   forza: bool = False) -> EsitoAvvio:
-    """Scala il saldo del cliente e invia gli impulsi al nodo.
+                   forza: bool = False, attendi: bool = False) -> EsitoAvvio:
+    """Scala il saldo del cliente e fa partire gli impulsi verso il nodo.
 
     `chiave_idempotenza`: UUID generato dal form di conferma; un replay
     dello stesso form non produce un secondo addebito.
     `forza`: lo staff puo' scavalcare il cooldown anti-raffica.
+    `attendi`: False (default) ritorna appena la sequenza e' programmata,
+    con in_corso=True; True aspetta la fine (verifica e storno compresi)
+    e ritorna l'esito definitivo.
     """
     # 1. Validazioni
     if not nodo.attivo:
@@ -76,7 +126,7 @@ def avvia_lavaggio(*, cliente, nodo: NodoImpianto, impulsi: int,
 
     # Fotografa il contatore fisico PRIMA dell'invio: servira' alla
     # riconciliazione credito scalato <-> impulsi realmente contati.
-    from .verifica import baseline_contatore, registra_esito_invio
+    from .verifica import baseline_contatore
     baseline = baseline_contatore(nodo)
 
     # 3. Addebito PRIMA degli impulsi (transazione autonoma)
@@ -86,6 +136,7 @@ def avvia_lavaggio(*, cliente, nodo: NodoImpianto, impulsi: int,
             f'Avvio {nodo.nome}: {impulsi} gettone/i',
             nodo=nodo, impulsi=impulsi, operatore=operatore,
             chiave_idempotenza=chiave_idempotenza,
+            verifica='invio_in_corso', contatore_prima=baseline,
         )
     except wallet.SaldoInsufficienteError as exc:
         return EsitoAvvio(False, str(exc))
@@ -94,46 +145,129 @@ def avvia_lavaggio(*, cliente, nodo: NodoImpianto, impulsi: int,
             False, 'Operazione gia\' registrata: gli impulsi sono gia\' '
                    'stati inviati, non serve ripetere.')
 
-    # 4. Impulsi via MQTT (fuori da ogni transazione), con la pausa
-    # inter-impulso del nodo (> auto-off, altrimenti si fondono)
-    ok, msg, inviati = moneta_virtuale(
+    # 4. Impulsi sul publisher persistente (fuori da ogni transazione),
+    # con la pausa inter-impulso del nodo (> auto-off, altrimenti si
+    # fondono). Il resto lo fa _fine_invio a sequenza conclusa.
+    def osservatore(seq):
+        if not seq.terminata:
+            _pubblica_stato(movimento, impulsi, seq.inviati)
+            return None
+        return _fine_invio(seq, cliente=cliente, nodo=nodo, costo=costo,
+                           movimento=movimento, baseline=baseline,
+                           operatore=operatore)
+
+    _pubblica_stato(movimento, impulsi)
+    seq = publisher().avvia_sequenza(
         nodo.slug, impulsi, switch_id=nodo.switch_id,
-        pausa_s=nodo.pausa_impulsi_sec)
+        pausa_s=nodo.pausa_impulsi_sec, osservatore=osservatore)
+
+    if attendi:
+        ok, msg, inviati = seq.attendi()
+        return seq.risultato or EsitoAvvio(ok, msg, inviati, movimento)
+    return EsitoAvvio(True,
+                      f'Invio di {impulsi} gettone/i a {nodo.nome} in corso '
+                      f'({costo} monete).',
+                      0, movimento, in_corso=True, sequenza=seq)
+
+
+def _storna_non_erogati(movimento, cliente, nodo, non_erogati: int, motivo: str,
+                        operatore=None):
+    """Restituisce le monete degli impulsi non partiti. Chiave di
+    idempotenza legata al movimento: un solo storno per avvio."""
+    monete_storno = non_erogati * nodo.monete_per_impulso
+    chiave = (f'{movimento.chiave_idempotenza}:storno' if movimento.chiave_idempotenza
+              else f'lavaggio:{movimento.pk}:storno')
+    try:
+        return wallet.accredita(
+            cliente, monete_storno, 'storno',
+            f'Storno {non_erogati} gettone/i non erogati su {nodo.nome} ({motivo})',
+            operatore=operatore, chiave_idempotenza=chiave,
+        )
+    except Exception:
+        # Estremo: anche lo storno (solo DB) e' fallito. Logga tutto
+        # per la rettifica manuale dall'admin.
+        logger.exception(
+            'STORNO FALLITO: cliente=%s nodo=%s monete=%s chiave=%s',
+            cliente.pk, nodo.slug, monete_storno, chiave)
+        return None
+
+
+def _fine_invio(seq, *, cliente, nodo, costo, movimento, baseline,
+                operatore) -> EsitoAvvio:
+    """Sequenza conclusa: verifica, storno degli impulsi non erogati ed
+    esito definitivo (anche nella cache per il polling)."""
+    from .verifica import registra_esito_invio
+
+    ok, msg, inviati, impulsi = seq.ok, seq.messaggio, seq.inviati, seq.impulsi
 
     # Registra i dati per la verifica col contatore (in_attesa: sara'
     # il listener a confermare quando il totale raggiunge l'atteso)
-    registra_esito_invio(movimento, baseline, inviati)
+    if not registra_esito_invio(movimento, baseline, inviati):
+        # Sequenza piu' lenta della soglia: l'ha gia' chiusa (e stornata)
+        # recupera_invii_interrotti, lo stato per il polling e' il suo
+        logger.warning('Lavaggio %s: invio gia\' chiuso dal recupero, '
+                       'inviati %s/%s', movimento.pk, inviati, impulsi)
+        return EsitoAvvio(False, 'Invio gia\' chiuso dal controllo automatico.',
+                          inviati, movimento)
 
     # 5. Storno degli impulsi non erogati
     storno = None
     non_erogati = impulsi - inviati
     if non_erogati > 0:
-        monete_storno = non_erogati * nodo.monete_per_impulso
-        try:
-            storno = wallet.accredita(
-                cliente, monete_storno, 'storno',
-                f'Storno {non_erogati} gettone/i non erogati su {nodo.nome} ({msg})',
-                operatore=operatore,
-                chiave_idempotenza=(f'{chiave_idempotenza}:storno'
-                                    if chiave_idempotenza else ''),
-            )
-        except Exception:
-            # Estremo: anche lo storno (solo DB) e' fallito. Logga tutto
-            # per la rettifica manuale dall'admin.
-            logger.exception(
-                'STORNO FALLITO: cliente=%s nodo=%s monete=%s chiave=%s',
-                cliente.pk, nodo.slug, monete_storno, chiave_idempotenza)
+        storno = _storna_non_erogati(movimento, cliente, nodo, non_erogati, msg,
+                                     operatore=operatore)
 
     if ok:
-        return EsitoAvvio(True,
-                          f'{inviati} gettone/i inviati a {nodo.nome} '
-                          f'({costo} monete).',
-                          inviati, movimento, storno)
-    if inviati > 0:
-        return EsitoAvvio(False,
-                          f'Inviati solo {inviati}/{impulsi} gettoni: '
-                          f'stornate le monete rimanenti. ({msg})',
-                          inviati, movimento, storno)
-    return EsitoAvvio(False,
-                      f'Nessun gettone inviato: monete stornate. ({msg})',
-                      0, movimento, storno)
+        esito = EsitoAvvio(True,
+                           f'{inviati} gettone/i inviati a {nodo.nome} '
+                           f'({costo} monete).',
+                           inviati, movimento, storno)
+    elif inviati > 0:
+        esito = EsitoAvvio(False,
+                           f'Inviati solo {inviati}/{impulsi} gettoni: '
+                           f'stornate le monete rimanenti. ({msg})',
+                           inviati, movimento, storno)
+    else:
+        esito = EsitoAvvio(False,
+                           f'Nessun gettone inviato: monete stornate. ({msg})',
+                           0, movimento, storno)
+    _pubblica_stato(movimento, impulsi, inviati, True, esito.ok, esito.messaggio)
+    return esito
+
+
+def recupera_invii_interrotti(minuti: int = INVIO_INTERROTTO_MIN) -> int:
+    """Per il cron: chiude i lavaggi rimasti 'invio_in_corso' da piu' di
+    `minuti` (processo morto a meta' sequenza) e storna gli impulsi che
+    non risultano partiti. Ritorna i movimenti chiusi.
+
+    Partiti = il massimo tra l'ultimo avanzamento pubblicato nella cache
+    e l'avanzamento del contatore fisico (che puo' contare anche monete
+    vere: nel dubbio si storna di meno, il resto lo segnala la verifica).
+    """
+    from .verifica import baseline_contatore, registra_esito_invio
+
+    soglia = timezone.now() - timedelta(minutes=minuti)
+    chiusi = 0
+    for mv in MovimentoMoneta.objects.filter(
+            tipo='lavaggio', verifica='invio_in_corso', creato_il__lt=soglia,
+    ).select_related('cliente', 'nodo'):
+        impulsi = mv.impulsi or 0
+        progresso = cache_condivisa.leggi(_chiave_stato(mv.pk)) or {}
+        inviati = progresso.get('inviati') or 0
+        ultimo = baseline_contatore(mv.nodo) if mv.nodo else None
+        if ultimo is not None and mv.contatore_prima is not None:
+            inviati = max(inviati, ultimo - mv.contatore_prima)
+        inviati = max(0, min(impulsi, inviati))
+
+        if not registra_esito_invio(mv, mv.contatore_prima, inviati):
+            continue  # chiuso nel frattempo dalla fine della sequenza
+        chiusi += 1
+        if impulsi > inviati and mv.nodo:
+            _storna_non_erogati(mv, mv.cliente, mv.nodo, impulsi - inviati,
+                                'invio interrotto')
+        logger.warning('Lavaggio %s interrotto: inviati %s/%s, stornati %s',
+                       mv.pk, inviati, impulsi, impulsi - inviati)
+        _pubblica_stato(mv, impulsi, inviati, True, False,
+                        f'Invio interrotto: {inviati}/{impulsi} gettoni partiti, '
+                        f'monete rimanenti stornate.')
+    return chiusi
@@ -5,8 +5,9 @@ davvero ricevuto (fisici + virtuali) e arriva in EventoImpianto via
 listener MQTT. Flusso:
 
 1. avvia_lavaggio fotografa il totale del contatore PRIMA dell'invio
-   (contatore_prima) e, a invio concluso, calcola l'atteso
-   (contatore_atteso = prima + impulsi inviati) -> verifica='in_attesa';
+   (contatore_prima, con verifica='invio_in_corso' gia' nell'addebito)
+   e, a invio concluso, calcola l'atteso (contatore_atteso = prima +
+   impulsi inviati) -> verifica='in_attesa';
 2. il listener, a ogni nuovo totale del contatore, chiama
    aggiorna_verifiche(): se il totale ha raggiunto l'atteso ->
    verifica='ok' con l'avanzamento osservato;
@@ -18,10 +19,18 @@ Nota: se una moneta fisica entra nello stesso momento il contatore
 avanza di piu' dell'atteso -> resta 'ok' (mai falsi allarmi in
 eccesso); il caso patologico coperto e' il contatore che avanza MENO
 degli impulsi pagati.
+
+Accessi: l'ultimo totale di un nodo si legge da ContatoreNodo (una riga
+per nodo, tenuta dal listener) e non con un ORDER BY su EventoImpianto;
+i lavaggi in attesa stanno in un indice parziale (nodo,
+contatore_atteso) WHERE verifica='in_attesa', quindi un nuovo totale
+conferma tutti quelli soddisfatti con un range scan + un solo UPDATE.
 """
 import logging
 from datetime import timedelta
 
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 logger = logging.getLogger('apps.monete.verifica')
@@ -31,12 +40,16 @@ FINESTRA_CONFERMA_MIN = 5
 
 
 def _ultimo_totale(nodo_slug: str):
-    from apps.impianto.models import EventoImpianto
-    return (EventoImpianto.objects
-            .filter(nodo=nodo_slug, tipo_evento='contatore')
-            .order_by('-pk')
-            .values_list('valore', flat=True)
-            .first())
+    from apps.impianto.models import ContatoreNodo
+    return (ContatoreNodo.objects.filter(nodo=nodo_slug)
+            .values_list('valore', flat=True).first())
+
+
+def ultimi_totali(nodi_slug) -> dict:
+    """{slug: ultimo totale} per piu' nodi in una query."""
+    from apps.impianto.models import ContatoreNodo
+    return dict(ContatoreNodo.objects.filter(nodo__in=set(nodi_slug))
+                .values_list('nodo', 'valore'))
 
 
 def baseline_contatore(nodo) -> int | None:
@@ -44,62 +57,82 @@ def baseline_contatore(nodo) -> int | None:
     return _ultimo_totale(nodo.slug)
 
 
-def registra_esito_invio(movimento, baseline, inviati: int):
-    """Completa il movimento 'lavaggio' con i dati per la verifica."""
+def registra_esito_invio(movimento, baseline, inviati: int) -> bool:
+    """Chiude l'invio del movimento 'lavaggio' con i dati per la verifica.
+
+    Solo se e' ancora 'invio_in_corso': la chiusura la fa o la fine
+    della sequenza o il recupero degli invii interrotti, mai tutte e
+    due (False = l'ha gia' fatta l'altro, niente storno da qui)."""
     if baseline is None or inviati <= 0:
-        movimento.verifica = 'non_verificabile'
-        movimento.save(update_fields=['verifica'])
-        return
-    movimento.contatore_prima = baseline
-    movimento.contatore_atteso = baseline + inviati
-    movimento.verifica = 'in_attesa'
-    movimento.save(update_fields=['contatore_prima', 'contatore_atteso',
-                                  'verifica'])
+        campi = {'verifica': 'non_verificabile'}
+    else:
+        campi = {'contatore_prima': baseline, 'contatore_atteso': baseline + inviati,
+                 'verifica': 'in_attesa'}
+    from apps.monete.models import MovimentoMoneta
+    if not MovimentoMoneta.objects.filter(
+            pk=movimento.pk, verifica='invio_in_corso').update(**campi):
+        return False
+    for campo, valore in campi.items():
+        setattr(movimento, campo, valore)
+    return True
 
 
-def aggiorna_verifiche(nodo_slug: str, totale: int):
+def aggiorna_verifiche(nodo_slug: str, totale: int) -> int:
     """Chiamata dal listener MQTT a ogni nuovo totale del contatore:
-    conferma i lavaggi in attesa che l'hanno raggiunto."""
+    conferma in blocco i lavaggi in attesa che l'hanno raggiunto.
+    Ritorna quanti ne ha confermati."""
     from apps.monete.models import MovimentoMoneta
 
-    pendenti = MovimentoMoneta.objects.filter(
-        tipo='lavaggio', verifica='in_attesa', nodo__slug=nodo_slug)
-    for mv in pendenti:
-        if mv.contatore_atteso is not None and totale >= mv.contatore_atteso:
-            mv.impulsi_contati = totale - (mv.contatore_prima or 0)
-            mv.verifica = 'ok'
-            mv.save(update_fields=['impulsi_contati', 'verifica'])
-            logger.info('Lavaggio %s confermato dal contatore (%s >= %s).',
-                        mv.pk, totale, mv.contatore_atteso)
+    soddisfatti = MovimentoMoneta.objects.filter(
+        tipo='lavaggio', nodo__slug=nodo_slug, verifica='in_attesa',
+        contatore_atteso__lte=totale)
+    pks = list(soddisfatti.values_list('pk', flat=True))
+    if not pks:
+        return 0
+    # Filtro ripetuto: un cron concorrente puo' averli gia' chiusi
+    confermati = MovimentoMoneta.objects.filter(
+        pk__in=pks, verifica='in_attesa',
+    ).update(verifica='ok',
+             impulsi_contati=Value(totale) - Coalesce(F('contatore_prima'), 0))
+    logger.info('Lavaggi %s confermati dal contatore di %s (totale %s).',
+                pks, nodo_slug, totale)
+    return confermati
 
 
 def scadenza_verifiche(finestra_min: int = FINESTRA_CONFERMA_MIN) -> int:
     """Per il cron: marca 'discrepanza' i lavaggi non confermati entro
-    la finestra. Ritorna quante discrepanze trovate."""
+    la finestra. Ritorna quante discrepanze ha scritto (un lavaggio
+    confermato nel frattempo dal listener non conta e non si tocca)."""
     from apps.monete.models import MovimentoMoneta
 
     soglia = timezone.now() - timedelta(minutes=finestra_min)
-    discrepanze = 0
-    pendenti = MovimentoMoneta.objects.filter(
+    pendenti = list(MovimentoMoneta.objects.filter(
         tipo='lavaggio', verifica='in_attesa', creato_il__lt=soglia,
-    ).select_related('nodo', 'cliente')
+    ).select_related('nodo'))
+    if not pendenti:
+        return 0
 
+    # Un'unica query per l'ultimo totale di tutti i nodi coinvolti
+    totali = ultimi_totali(mv.nodo.slug for mv in pendenti if mv.nodo)
+    discrepanze = 0
     for mv in pendenti:
-        ultimo = _ultimo_totale(mv.nodo.slug) if mv.nodo else None
+        ultimo = totali.get(mv.nodo.slug) if mv.nodo else None
         contati = None
         if ultimo is not None and mv.contatore_prima is not None:
             contati = max(0, ultimo - mv.contatore_prima)
-        mv.impulsi_contati = contati
-        if (contati is not None and mv.contatore_atteso is not None
-                and ultimo >= mv.contatore_atteso):
-            mv.verifica = 'ok'
-        else:
-            mv.verifica = 'discrepanza'
+        confermato = (contati is not None and mv.contatore_atteso is not None
+                      and ultimo >= mv.contatore_atteso)
+        # Solo se ancora in_attesa: il listener (aggiorna_verifiche) puo'
+        # averlo confermato tra la lettura e qui, e vince lui
+        if not MovimentoMoneta.objects.filter(pk=mv.pk, verifica='in_attesa').update(
+                impulsi_contati=contati,
+                verifica='ok' if confermato else 'discrepanza'):
+            continue
+        if not confermato:
             discrepanze += 1
             logger.warning(
                 'DISCREPANZA lavaggio %s: cliente=%s nodo=%s impulsi_pagati=%s '
                 'contati=%s (atteso totale %s, ultimo %s)',
                 mv.pk, mv.cliente_id, mv.nodo.slug if mv.nodo else '?',
                 mv.impulsi, contati, mv.contatore_atteso, ultimo)
-        mv.save(update_fields=['impulsi_contati', 'verifica'])
     return discrepanze
@@ -77,9 +77,12 @@ def accredita(cliente, monete: int, tipo: str, descrizione: str, *,
 
 def addebita(cliente, monete: int, tipo: str, descrizione: str, *,
              nodo=None, impulsi=None, operatore=None,
-             chiave_idempotenza: str = '') -> MovimentoMoneta:
+             chiave_idempotenza: str = '', verifica: str = '',
+             contatore_prima=None) -> MovimentoMoneta:
     """Scala monete dal saldo del cliente e registra il movimento.
 
+    `verifica`/`contatore_prima`: stato iniziale della riconciliazione
+    per i lavaggi, scritto nella stessa transazione dell'addebito.
     Solleva SaldoInsufficienteError se il saldo non copre l'addebito.
     """
     if monete < 1:
@@ -96,4 +99,5 @@ def addebita(cliente, monete: int, tipo: str, descrizione: str, *,
             cliente, riga, -monete, tipo, descrizione,
             nodo=nodo, impulsi=impulsi, operatore=operatore,
             chiave_idempotenza=chiave_idempotenza,
+            verifica=verifica, contatore_prima=contatore_prima,
         )
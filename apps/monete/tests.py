@@ -0,0 +1,192 @@
+"""Test dell'avvio lavaggio con gli impulsi sul publisher persistente,
+del recupero degli invii interrotti e della riconciliazione col
+contatore (verifica.py).
+
+Gli impulsi vanno al broker finto in-process (apps.impianto.broker_finto).
+La fine della sequenza (verifica, storno) gira nel thread osservatori
+del publisher: TransactionTestCase perche' veda i dati del test.
+
+Esecuzione: python manage.py test apps.monete
+"""
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from apps.clienti.models import Cliente
+from apps.impianto import publisher as modulo_publisher
+from apps.impianto.broker_finto import BrokerFinto
+from apps.impianto.models import ContatoreNodo
+from apps.impianto.publisher import Publisher
+
+from .models import MovimentoMoneta, NodoImpianto
+from .services import wallet
+from .services.lavaggio import avvia_lavaggio, recupera_invii_interrotti, stato_avvio
+from .services.verifica import aggiorna_verifiche, registra_esito_invio, scadenza_verifiche
+
+
+@override_settings(MQTT_HOST='127.0.0.1', MQTT_USER='crm', CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'avvio-lavaggio'}})
+class AvvioLavaggioTest(TransactionTestCase):
+    def setUp(self):
+        self.broker = BrokerFinto().avvia()
+        self.addCleanup(self.broker.ferma)
+        self.pub = Publisher('127.0.0.1', self.broker.porta)
+        self.addCleanup(self.pub.ferma)
+        for patcher in (
+                mock.patch('apps.monete.services.lavaggio.publisher', return_value=self.pub),
+                mock.patch.object(modulo_publisher, 'PAUSA_MINIMA_SEC', 0.05),
+                mock.patch.object(modulo_publisher, 'TIMEOUT_ACK_SEC', 0.3)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.cliente = Cliente.objects.create(tipo='privato', telefono='3330000000')
+        wallet.accredita(self.cliente, 10, 'regalo', 'Benvenuto')
+        self.nodo = NodoImpianto.objects.create(
+            slug='pista2', nome='Pista 2', online=True, pausa_impulsi_sec=0.05)
+
+    def test_ritorna_subito_e_completa_in_background(self):
+        esito = avvia_lavaggio(cliente=self.cliente, nodo=self.nodo, impulsi=3)
+        self.assertTrue(esito.in_corso)
+        self.assertEqual(wallet.saldo_di(self.cliente), 7)
+
+        esito.sequenza.attendi(5)
+        stato = stato_avvio(esito.movimento)
+        self.assertEqual((stato['terminata'], stato['ok'], stato['inviati']), (True, True, 3))
+        esito.movimento.refresh_from_db()
+        self.assertEqual(esito.movimento.verifica, 'non_verificabile')  # contatore mai visto
+        self.assertEqual(len(self.broker.pubblicati), 3)
+
+    def test_impulsi_non_confermati_stornati(self):
+        self.broker.ack = False
+        esito = avvia_lavaggio(cliente=self.cliente, nodo=self.nodo, impulsi=2,
+                               attendi=True)
+        self.assertFalse(esito.ok)
+        self.assertIsNotNone(esito.storno)
+        self.assertEqual(wallet.saldo_di(self.cliente), 10)
+        self.assertIn('monete stornate', stato_avvio(esito.movimento)['messaggio'])
+
+
+class InvioInterrottoTest(TestCase):
+    """Processo morto a meta' sequenza: addebito fatto, fine invio mai
+    arrivata. Ci pensa il cron."""
+
+    def setUp(self):
+        cache.clear()  # avanzamenti di altri test con gli stessi pk
+        self.cliente = Cliente.objects.create(tipo='privato', telefono='3330000000')
+        wallet.accredita(self.cliente, 10, 'regalo', 'Benvenuto')
+        self.nodo = NodoImpianto.objects.create(
+            slug='pista2', nome='Pista 2', monete_per_impulso=2)
+        ContatoreNodo.objects.create(nodo='pista2', valore=101)
+
+    def _addebito(self, impulsi, minuti_fa):
+        mv = wallet.addebita(
+            self.cliente, self.nodo.costo_monete(impulsi), 'lavaggio', 'Avvio',
+            nodo=self.nodo, impulsi=impulsi, verifica='invio_in_corso',
+            contatore_prima=100)
+        MovimentoMoneta.objects.filter(pk=mv.pk).update(
+            creato_il=timezone.now() - timedelta(minutes=minuti_fa))
+        return mv
+
+    def test_storna_gli_impulsi_non_partiti(self):
+        interrotto = self._addebito(3, minuti_fa=30)
+        recente = self._addebito(1, minuti_fa=0)
+        self.assertEqual(wallet.saldo_di(self.cliente), 2)
+        self.assertFalse(stato_avvio(interrotto)['terminata'])
+
+        self.assertEqual(recupera_invii_interrotti(), 1)
+        # il contatore e' salito di 1: partito 1 impulso su 3
+        self.assertEqual(wallet.saldo_di(self.cliente), 6)
+        interrotto.refresh_from_db()
+        self.assertEqual((interrotto.verifica, interrotto.contatore_atteso),
+                         ('in_attesa', 101))
+        self.assertTrue(stato_avvio(interrotto)['terminata'])
+        recente.refresh_from_db()
+        self.assertEqual(recente.verifica, 'invio_in_corso')
+
+        # Ripetere il cron non storna due volte
+        self.assertEqual(recupera_invii_interrotti(), 0)
+        self.assertEqual(MovimentoMoneta.objects.filter(tipo='storno').count(), 1)
+
+    def test_fine_sequenza_in_ritardo_non_chiude_di_nuovo(self):
+        mv = self._addebito(3, minuti_fa=30)
+        recupera_invii_interrotti()
+        self.assertFalse(registra_esito_invio(mv, 100, 3))
+        mv.refresh_from_db()
+        self.assertEqual(mv.contatore_atteso, 101)
+
+    def test_senza_contatore_storna_tutto(self):
+        ContatoreNodo.objects.all().delete()
+        mv = self._addebito(2, minuti_fa=30)
+        self.assertEqual(recupera_invii_interrotti(), 1)
+        self.assertEqual(wallet.saldo_di(self.cliente), 10)
+        mv.refresh_from_db()
+        self.assertEqual(mv.verifica, 'non_verificabile')
+
+
+class VerificaContatoreTest(TestCase):
+    def setUp(self):
+        self.cliente = Cliente.objects.create(tipo='privato', telefono='3330000000')
+        self.pista = NodoImpianto.objects.create(slug='pista2', nome='Pista 2')
+        self.portale = NodoImpianto.objects.create(slug='portale1', nome='Portale')
+
+    def _in_attesa(self, nodo, prima, impulsi, minuti_fa=0):
+        mv = MovimentoMoneta.objects.create(
+            cliente=self.cliente, tipo='lavaggio', monete=-impulsi, saldo_dopo=0,
+            descrizione='Avvio', nodo=nodo, impulsi=impulsi, verifica='in_attesa',
+            contatore_prima=prima, contatore_atteso=prima + impulsi)
+        MovimentoMoneta.objects.filter(pk=mv.pk).update(
+            creato_il=timezone.now() - timedelta(minutes=minuti_fa))
+        return mv
+
+    def test_conferma_in_blocco_i_soddisfatti(self):
+        a = self._in_attesa(self.pista, 100, 2)
+        b = self._in_attesa(self.pista, 102, 3)
+        c = self._in_attesa(self.pista, 105, 4)
+        altro_nodo = self._in_attesa(self.portale, 0, 1)
+
+        self.assertEqual(aggiorna_verifiche('pista2', 106), 2)
+        stati = dict(MovimentoMoneta.objects.values_list('pk', 'verifica'))
+        self.assertEqual([stati[m.pk] for m in (a, b, c, altro_nodo)],
+                         ['ok', 'ok', 'in_attesa', 'in_attesa'])
+        b.refresh_from_db()
+        self.assertEqual(b.impulsi_contati, 4)  # 106 - 102
+
+    def test_scadenza_con_ultimo_totale_per_nodo(self):
+        ContatoreNodo.objects.create(nodo='pista2', valore=103)
+        ContatoreNodo.objects.create(nodo='portale1', valore=50)
+        ok = self._in_attesa(self.pista, 100, 3, minuti_fa=10)
+        mancano = self._in_attesa(self.portale, 49, 3, minuti_fa=10)
+        recente = self._in_attesa(self.pista, 103, 1)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(scadenza_verifiche(), 1)
+        self.assertFalse(any('impianto_eventoimpianto' in q['sql'] for q in ctx))
+
+        stati = dict(MovimentoMoneta.objects.values_list('pk', 'verifica'))
+        self.assertEqual([stati[m.pk] for m in (ok, mancano, recente)],
+                         ['ok', 'discrepanza', 'in_attesa'])
+        mancano.refresh_from_db()
+        self.assertEqual(mancano.impulsi_contati, 1)
+
+    def test_scadenza_non_sovrascrive_le_conferme_del_listener(self):
+        ContatoreNodo.objects.create(nodo='pista2', valore=100)
+        mv = self._in_attesa(self.pista, 100, 3, minuti_fa=10)
+        originale = MovimentoMoneta.objects.filter
+
+        def conferma_prima_della_scrittura(*args, **kwargs):
+            # Il listener conferma tra la lettura del cron e il suo UPDATE
+            if kwargs.get('verifica') == 'in_attesa' and 'pk' in kwargs:
+                aggiorna_verifiche('pista2', 103)
+            return originale(*args, **kwargs)
+
+        with mock.patch.object(MovimentoMoneta.objects, 'filter',
+                               side_effect=conferma_prima_della_scrittura):
+            self.assertEqual(scadenza_verifiche(), 0)
+        mv.refresh_from_db()
+        self.assertEqual((mv.verifica, mv.impulsi_contati), ('ok', 3))
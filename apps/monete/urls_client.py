@@ -15,4 +15,6 @@ urlpatterns = [
     path('paypal/ritorno/', views_client.paypal_ritorno, name='paypal-ritorno'),
     # sotto /api/ cosi' il CompletamentoProfiloMiddleware non lo redirige
     path('api/saldo/', views_client.api_saldo, name='api-saldo'),
+    path('api/lavaggio/<int:pk>/', views_client.api_lavaggio_stato,
+         name='api-lavaggio-stato'),
 ]
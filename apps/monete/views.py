@@ -157,7 +157,12 @@ def avvia_staff(request):
                 chiave_idempotenza=f'staff:{chiave}' if chiave else '',
                 forza=request.POST.get('forza') == 'on',
             )
-            if esito.ok:
+            if esito.in_corso:
+                # Gli impulsi partono in background: eventuali gettoni
+                # non erogati vengono stornati da soli (movimenti cliente)
+                messages.info(request, f'{esito.messaggio} Esito ed eventuali '
+                                       f'storni nei movimenti del cliente.')
+            elif esito.ok:
                 messages.success(request, esito.messaggio)
             else:
                 messages.error(request, esito.messaggio)
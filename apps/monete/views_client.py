@@ -99,6 +99,22 @@ def api_saldo(request, cliente):
     return JsonResponse({'saldo': wallet.saldo_di(cliente), 'nodi_online': nodi})
 
 
+@_cliente_required
+def api_lavaggio_stato(request, cliente, pk):
+    """Polling della pagina esito mentre gli impulsi partono: quanti ne
+    sono stati confermati, se la sequenza e' finita, esito e saldo."""
+    from django.http import JsonResponse
+    from .models import MovimentoMoneta
+    from .services.lavaggio import stato_avvio
+    movimento = MovimentoMoneta.objects.filter(
+        pk=pk, cliente=cliente, tipo='lavaggio').first()
+    if movimento is None:
+        return JsonResponse({'error': 'Avvio non trovato.'}, status=404)
+    stato = stato_avvio(movimento)
+    stato['saldo'] = wallet.saldo_di(cliente)
+    return JsonResponse(stato)
+
+
 def contesto_ricarica():
     """Contesto della sezione 'Ricarica il saldo': usato sia da
     'Le mie monete' sia dalla dashboard di ingresso area cliente."""
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Ordine, ItemOrdine, Pagamento
+from .models import ContatoreOrdini, Ordine, ItemOrdine, Pagamento
 
 
 @admin.register(Ordine)
@@ -31,4 +31,10 @@ class PagamentoAdmin(admin.ModelAdmin):
     readonly_fields = ['data_pagamento']
     
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('ordine')
\ No newline at end of file
+        return super().get_queryset(request).select_related('ordine')
+
+
+@admin.register(ContatoreOrdini)
+class ContatoreOrdiniAdmin(admin.ModelAdmin):
+    list_display = ['giorno', 'ultimo_numero']
+    readonly_fields = ['giorno', 'ultimo_numero']
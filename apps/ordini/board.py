@@ -0,0 +1,173 @@
+"""Board del giorno per la lista ordini (/ordini/).
+
+Prima OrdiniListView valutava lo stesso queryset del giorno circa otto
+volte (tre fette di attivi, da ritirare, completati, Sum totale, due
+aggregate Pagamento e un loop Python per il saldo), ognuna col suo
+prefetch pesante. Qui:
+
+- un solo fetch degli ordini del giorno con select/prefetch, poi
+  partizione in memoria nelle 3 sezioni (stesso ordinamento di prima);
+- le statistiche (totale, contanti, carte, non incassato) in UNA query
+  con aggregati condizionali;
+- il risultato e' in cache per (data, ultima modifica): ogni
+  salvataggio di Ordine/ItemOrdine/Pagamento aggiorna il marcatore
+  (segna_modifica), cosi' i reload dei tablet innescati dal WebSocket
+  riusano la stessa board finche' non cambia qualcosa.
+
+La cache si attiva solo se il backend e' condiviso tra i processi
+(con LocMemCache ogni worker avrebbe il suo marcatore e servirebbe
+board vecchie): override con settings.ORDINI_BOARD_CACHE. Accesso via
+apps.core.cache (contatori hit/miss sul prefisso 'ordini_board').
+"""
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (Case, DecimalField, F, OuterRef, Q, Subquery,
+                              Sum, Value, When)
+from django.db.models.functions import Coalesce
+
+from apps.core import cache as cache_condivisa
+
+from .models import Ordine, Pagamento
+
+STATI_ATTIVI = ('in_attesa', 'in_lavorazione')
+CHIAVE_MODIFICA = 'ordini_board:ultima_modifica'
+BOARD_TTL = 60 * 10
+
+METODI_CARTA = ('carta', 'bancomat')
+
+
+def cache_abilitata() -> bool:
+    forzata = getattr(settings, 'ORDINI_BOARD_CACHE', None)
+    if forzata is not None:
+        return bool(forzata)
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    return bool(backend) and not backend.endswith('LocMemCache')
+
+
+def _scrivi_marcatore():
+    cache_condivisa.scrivi(CHIAVE_MODIFICA, time.time_ns(), None)
+
+
+def segna_modifica():
+    """Marca la board come da ricalcolare (chiamata dai signal e dagli
+    update diretti su Ordine che bypassano i signal).
+
+    Al commit: marcando prima, un altro processo potrebbe ricalcolare
+    la board coi dati non ancora committati e metterla in cache sotto
+    il marcatore nuovo."""
+    transaction.on_commit(_scrivi_marcatore)
+
+
+def ultima_modifica():
+    token = cache_condivisa.leggi(CHIAVE_MODIFICA)
+    if token is None:
+        token = time.time_ns()
+        if not cache_condivisa.aggiungi(CHIAVE_MODIFICA, token, None):
+            token = cache_condivisa.leggi(CHIAVE_MODIFICA, token)
+    return token
+
+
+def ordini_del_giorno(data):
+    return Ordine.objects.select_related(
+        'cliente', 'operatore', 'prenotazione'
+    ).prefetch_related(
+        'items__servizio_prodotto', 'items__postazione_cq',
+        'items__aggiunto_da', 'pagamenti'
+    ).filter(data_ora__date=data)
+
+
+def _somma_pagamenti(filtro):
+    """Subquery: somma dei pagamenti dell'ordine che rispettano `filtro`."""
+    return Subquery(
+        Pagamento.objects.filter(filtro, ordine=OuterRef('pk'))
+        .values('ordine')
+        .annotate(s=Sum('importo'))
+        .values('s'),
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    )
+
+
+def statistiche_giorno(data) -> dict:
+    """Totali del giorno in una sola query."""
+    zero = Value(Decimal('0.00'))
+    decimale = DecimalField(max_digits=12, decimal_places=2)
+    righe = Ordine.objects.filter(data_ora__date=data).aggregate(
+        totale_ordini=Coalesce(Sum('totale_finale'), zero, output_field=decimale),
+        totale_contanti=Coalesce(
+            Sum(_somma_pagamenti(Q(metodo='contanti'))), zero,
+            output_field=decimale),
+        totale_carte=Coalesce(
+            Sum(_somma_pagamenti(Q(metodo__in=METODI_CARTA))), zero,
+            output_field=decimale),
+        totale_non_incassato=Coalesce(Sum(Case(
+            When(totale_finale__gt=F('importo_pagato'),
+                 then=F('totale_finale') - F('importo_pagato')),
+            default=zero, output_field=decimale,
+        )), zero, output_field=decimale),
+    )
+    statistiche = {k: Decimal(v) for k, v in righe.items()}
+    statistiche['totale_incassato'] = (statistiche['totale_contanti']
+                                       + statistiche['totale_carte'])
+    return statistiche
+
+
+def _ordina_attivi(ordini):
+    """Priorita' manuale prima, poi immediati per data_ora, poi
+    programmati per ora richiesta (senza ora in fondo, come Postgres)."""
+    con_priorita = sorted((o for o in ordini if o.priorita > 0),
+                          key=lambda o: o.priorita)
+    immediati = sorted((o for o in ordini if o.priorita == 0
+                        and o.tipo_consegna == 'immediata'),
+                       key=lambda o: o.data_ora)
+    programmati = sorted((o for o in ordini if o.priorita == 0
+                          and o.tipo_consegna == 'programmata'),
+                         key=lambda o: (o.ora_consegna_richiesta is None,
+                                        o.ora_consegna_richiesta))
+    return con_priorita + immediati + programmati
+
+
+def calcola_board(data) -> dict:
+    ordini = list(ordini_del_giorno(data).order_by('-data_ora'))
+    return {
+        'ordini_attivi': _ordina_attivi(
+            [o for o in ordini if o.stato in STATI_ATTIVI]),
+        'ordini_da_ritirare': [o for o in ordini if o.stato == 'completato'
+                               and not o.auto_ritirata],
+        'ordini_completati': [o for o in ordini if o.stato == 'completato'
+                              and o.auto_ritirata],
+        'statistiche': statistiche_giorno(data),
+    }
+
+
+def _precarica_stati_wa(board):
+    """Stato WhatsApp degli avvisi 'auto pronta' in una query (letto
+    fuori cache: cambia coi webhook Meta, non coi salvataggi ordine)."""
+    from apps.messaggi.models import MessaggioWhatsApp
+
+    ordini = [o for sezione in ('ordini_attivi', 'ordini_da_ritirare',
+                                'ordini_completati')
+              for o in board[sezione]]
+    ids = {o.cliente_avvisato_wa_message_id for o in ordini
+           if o.cliente_avvisato_wa_message_id}
+    stati = dict(MessaggioWhatsApp.objects.filter(
+        wa_message_id__in=ids).values_list('wa_message_id', 'stato')) if ids else {}
+    for o in ordini:
+        o._stato_wa_precaricato = stati.get(o.cliente_avvisato_wa_message_id, '')
+
+
+def board_giorno(data) -> dict:
+    """Board del giorno: sezioni ordini + statistiche, da cache se la
+    giornata non e' cambiata dall'ultimo calcolo."""
+    if cache_abilitata():
+        chiave = f'ordini_board:{data.isoformat()}:{ultima_modifica()}'
+        board = cache_condivisa.leggi(chiave)
+        if board is None:
+            board = calcola_board(data)
+            cache_condivisa.scrivi(chiave, board, BOARD_TTL)
+    else:
+        board = calcola_board(data)
+    _precarica_stati_wa(board)
+    return board
@@ -0,0 +1,217 @@
+"""Flusso versionato dello stato ordini per i client WebSocket.
+
+Prima OrdiniConsumer inoltrava solo "qualcosa e' cambiato"
+(ordine_modificato, pagamento_aggiunto, nuovo_ordine) e la lista
+ordini ricaricava tutta la pagina; a ogni caduta e riconnessione del
+layer pub/sub i messaggi persi nel frattempo non arrivavano mai, e al
+reconnect l'unica strada era ricaricare tutto.
+
+Qui ogni cambio di un ordine (signal su Ordine/ItemOrdine/Pagamento,
+al commit, una volta per transazione) diventa un delta:
+
+    {'seq': 1712345678123, 'ordine_id': 42, 'op': 'diff',
+     'campi': {'stato': 'in_lavorazione', 'stato_display': '...'},
+     'postazioni': [3]}
+
+- seq e' un contatore globale e crescente (INCR su Redis, senza Redis
+  una riga ContatoreCondiviso: vedi apps.core.cache.incrementa). Se la
+  chiave sparisce riparte dai millisecondi correnti, quindi resta sempre
+  piu' alto di quelli gia' visti;
+- campi e' la differenza dei campi board (stato_board) rispetto
+  all'ultimo stato pubblicato, tenuto in cache per ordine. 'op' e'
+  'completo' quando non c'era uno stato precedente (tutti i campi) e
+  'rimosso' per un ordine cancellato;
+- ogni delta resta in cache sotto la sua seq per DELTA_TTL: le ultime
+  ORDINI_FLUSSO_FINESTRA seq fanno da ring buffer.
+
+Il delta parte sul gruppo 'ordini_list' e sui gruppi delle postazioni
+coinvolte (prima e dopo il cambio). Al reconnect il client manda la
+sua ultima seq (riprendi()): riceve solo i delta persi o, se e' uscito
+dalla finestra o un delta intermedio non c'e' piu', uno snapshot
+completo. I delta riportano valori, non incrementi: riapplicare un
+delta gia' visto non fa danni.
+
+Due commit quasi simultanei sullo stesso ordine da processi diversi
+possono pubblicare nell'ordine inverso a quello del DB: il cambio
+successivo dell'ordine riallinea i client.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.core import cache as cache_condivisa
+from apps.core.al_commit import CodaAlCommit
+
+from .board import STATI_ATTIVI
+from .models import Ordine
+
+logger = logging.getLogger(__name__)
+
+CHIAVE_SEQ = 'ordini_flusso:seq'
+DELTA_TTL = 60 * 60 * 6
+STATO_TTL = 60 * 60 * 48
+
+
+def _chiave_delta(seq: int) -> str:
+    return f'ordini_flusso:delta:{seq}'
+
+
+def _chiave_stato(ordine_id: int) -> str:
+    return f'ordini_flusso:stato:{ordine_id}'
+
+
+def sezione(ordine) -> str:
+    """Sezione della board (/ordini/) in cui compare l'ordine."""
+    if ordine.stato in STATI_ATTIVI:
+        return 'attivi'
+    if ordine.stato == 'completato':
+        return 'completati' if ordine.auto_ritirata else 'da_ritirare'
+    return ordine.stato
+
+
+def stato_board(ordine) -> dict:
+    """I campi di un ordine che servono a board e postazioni.
+    Usa ordine.items.all(): prefetch consigliato."""
+    items = list(ordine.items.all())
+    prevista = ordine.ora_consegna_prevista
+    return {
+        'numero': ordine.numero_progressivo,
+        'giorno': timezone.localtime(ordine.data_ora).date().isoformat(),
+        'sezione': sezione(ordine),
+        'stato': ordine.stato,
+        'stato_display': ordine.get_stato_display(),
+        'stato_pagamento': ordine.stato_pagamento,
+        'totale_finale': str(ordine.totale_finale),
+        'importo_pagato': str(ordine.importo_pagato),
+        'cliente': str(ordine.cliente) if ordine.cliente_id else '',
+        'tipo_auto': ordine.tipo_auto,
+        'priorita': ordine.priorita,
+        'ora_consegna_prevista': prevista.isoformat() if prevista else None,
+        'postazioni': sorted({i.postazione_assegnata_id for i in items
+                              if i.postazione_assegnata_id}),
+        'items': {str(i.pk): i.stato for i in items},
+    }
+
+
+def differenza(prima: dict, dopo: dict) -> dict:
+    """Campi cambiati; per 'items' solo gli item cambiati (None = rimosso)."""
+    campi = {k: v for k, v in dopo.items() if k != 'items' and prima.get(k) != v}
+    items_prima = prima.get('items') or {}
+    items = {k: v for k, v in dopo['items'].items() if items_prima.get(k) != v}
+    items.update({k: None for k in items_prima if k not in dopo['items']})
+    if items:
+        campi['items'] = items
+    return campi
+
+
+def seq_corrente() -> int:
+    return cache_condivisa.valore_contatore(CHIAVE_SEQ) or 0
+
+
+def pubblica_ordine(ordine_id: int):
+    """Calcola e diffonde il delta di un ordine. Ritorna il delta, o
+    None se per la board non e' cambiato niente."""
+    ordine = (Ordine.objects.select_related('cliente').prefetch_related('items')
+              .filter(pk=ordine_id).first())
+    prima = cache_condivisa.leggi(_chiave_stato(ordine_id))
+    if ordine is None:
+        if prima is None:
+            return None
+        dopo, op, campi = None, 'rimosso', {}
+    else:
+        dopo = stato_board(ordine)
+        if prima is None:
+            op, campi = 'completo', dopo
+        else:
+            op, campi = 'diff', differenza(prima, dopo)
+            if not campi:
+                return None
+
+    seq = cache_condivisa.incrementa(CHIAVE_SEQ, iniziale=int(time.time() * 1000))
+    if seq is None:
+        logger.warning('Flusso ordini: seq non disponibile, delta ordine %s perso', ordine_id)
+        return None
+    postazioni = sorted(set((prima or {}).get('postazioni', ()))
+                        | set((dopo or {}).get('postazioni', ())))
+    delta = {'seq': seq, 'ordine_id': ordine_id, 'op': op, 'campi': campi,
+             'postazioni': postazioni}
+    cache_condivisa.scrivi(_chiave_delta(seq), delta, DELTA_TTL)
+    if dopo is None:
+        cache_condivisa.invalida(_chiave_stato(ordine_id))
+    else:
+        cache_condivisa.scrivi(_chiave_stato(ordine_id), dopo, STATO_TTL)
+
+    from apps.api.notify import notify_group
+    messaggio = {'type': 'ordine.delta', **delta}
+    notify_group('ordini_list', messaggio)
+    for postazione_id in postazioni:
+        notify_group(f'postazione_{postazione_id}', messaggio)
+    return delta
+
+
+def _pubblica_tutti(ordini_ids):
+    for ordine_id in ordini_ids:
+        _pubblica_sicuro(ordine_id)
+
+
+_coda_delta = CodaAlCommit(_pubblica_tutti, 'Flusso ordini')
+
+
+def pubblica_al_commit(*ordini_ids):
+    """Per i signal e per gli update diretti che li bypassano. Un delta
+    per ordine e transazione, anche se i save sono tanti (ordine, N
+    item, pagamento)."""
+    _coda_delta.aggiungi(*ordini_ids)
+
+
+def _pubblica_sicuro(ordine_id):
+    # Mai far fallire la view (il commit e' gia' avvenuto) per il flusso
+    try:
+        pubblica_ordine(ordine_id)
+    except Exception:
+        logger.exception('Flusso ordini: delta ordine %s fallito', ordine_id)
+
+
+def snapshot(postazione_id: int = None) -> dict:
+    """Stato completo: ordini di oggi e quelli ancora attivi (per una
+    postazione: solo gli attivi con item assegnati a lei)."""
+    # seq letta PRIMA dei dati: un delta arrivato nel mezzo viene
+    # riapplicato dal client, senza danni
+    seq = seq_corrente()
+    ordini = Ordine.objects.select_related('cliente').prefetch_related('items')
+    if postazione_id is None:
+        ordini = ordini.filter(Q(data_ora__date=timezone.localdate())
+                               | Q(stato__in=STATI_ATTIVI))
+    else:
+        ordini = ordini.filter(stato__in=STATI_ATTIVI,
+                               items__postazione_assegnata_id=postazione_id).distinct()
+    return {'type': 'snapshot', 'seq': seq,
+            'ordini': {str(o.pk): stato_board(o) for o in ordini}}
+
+
+def riprendi(dal_seq, postazione_id: int = None) -> dict:
+    """Delta persi dopo `dal_seq`, o uno snapshot se non bastano."""
+    corrente = seq_corrente()
+    if (not isinstance(dal_seq, int) or dal_seq > corrente
+            or corrente - dal_seq > settings.ORDINI_FLUSSO_FINESTRA):
+        return snapshot(postazione_id)
+
+    seqs = range(dal_seq + 1, corrente + 1)
+    trovati = cache_condivisa.leggi_molti(_chiave_delta(s) for s in seqs)
+    delta, ultimo, buco = [], dal_seq, False
+    for s in seqs:
+        d = trovati.get(_chiave_delta(s))
+        if d is None:
+            # In coda puo' mancare un delta appena allocato e non ancora
+            # scritto (arrivera' dal gruppo); in mezzo vuol dire perso
+            buco = True
+            continue
+        if buco:
+            return snapshot(postazione_id)
+        ultimo = s
+        if postazione_id is None or postazione_id in d['postazioni']:
+            delta.append(d)
+    return {'type': 'delta', 'seq': ultimo, 'delta': delta}
@@ -0,0 +1,111 @@
+"""Benchmark concorrenza della numerazione ordini.
+
+Simula N casse che chiudono ordini in parallelo: ogni "checkout" apre
+una transazione, alloca il numero dal contatore giornaliero e tiene la
+transazione aperta per --lavoro-ms (come completa_ordine mentre crea
+items e pagamenti). Alla fine verifica che non ci siano numeri
+duplicati e stampa la latenza per quartile del run: deve restare
+piatta al crescere degli ordini del giorno (nessuno scan).
+
+Usa un giorno fittizio (1999-01-01) e ne cancella il contatore alla
+fine: non tocca la numerazione reale.
+
+Uso:
+    python manage.py bench_numerazione
+    python manage.py bench_numerazione --casse 8 --checkout 200 --lavoro-ms 5
+"""
+import statistics
+import threading
+import time
+from collections import Counter
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from apps.ordini.models import ContatoreOrdini
+from apps.ordini.numerazione import prossimo_numero
+
+GIORNO_BENCH = date(1999, 1, 1)
+
+
+class Command(BaseCommand):
+    help = 'Checkout paralleli sul contatore ordini: collisioni e latenza.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--casse', type=int, default=4,
+                            help='Thread paralleli (default 4).')
+        parser.add_argument('--checkout', type=int, default=100,
+                            help='Checkout per cassa (default 100).')
+        parser.add_argument('--lavoro-ms', type=float, default=2.0,
+                            help='Tempo simulato dentro la transazione.')
+
+    def handle(self, *args, **options):
+        casse = options['casse']
+        per_cassa = options['checkout']
+        lavoro = options['lavoro_ms'] / 1000
+
+        ContatoreOrdini.objects.filter(giorno=GIORNO_BENCH).delete()
+        numeri, latenze, errori = [], [], []
+        lock = threading.Lock()
+        via = threading.Barrier(casse)
+
+        def cassa():
+            locali = []
+            try:
+                via.wait()
+                for _ in range(per_cassa):
+                    t0 = time.perf_counter()
+                    try:
+                        with transaction.atomic():
+                            numero = prossimo_numero(GIORNO_BENCH)
+                            time.sleep(lavoro)
+                    except Exception as e:
+                        with lock:
+                            errori.append(str(e))
+                        continue
+                    locali.append((t0, time.perf_counter() - t0, numero))
+            finally:
+                connection.close()
+            with lock:
+                for t0, durata, numero in locali:
+                    latenze.append((t0, durata))
+                    numeri.append(numero)
+
+        inizio = time.perf_counter()
+        threads = [threading.Thread(target=cassa) for _ in range(casse)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        totale = time.perf_counter() - inizio
+
+        ContatoreOrdini.objects.filter(giorno=GIORNO_BENCH).delete()
+
+        duplicati = [n for n, c in Counter(numeri).items() if c > 1]
+        self.stdout.write(
+            f'{len(numeri)} checkout in {totale:.2f}s '
+            f'({len(numeri) / totale:.0f}/s) con {casse} casse, '
+            f'backend {connection.vendor}.')
+
+        # Latenza per quartile temporale del run: se il costo crescesse
+        # con gli ordini del giorno, l'ultimo quartile sarebbe il peggiore.
+        latenze.sort()
+        quarto = max(1, len(latenze) // 4)
+        for i in range(4):
+            fetta = sorted(d * 1000 for _, d in latenze[i * quarto:(i + 1) * quarto])
+            if not fetta:
+                continue
+            p95 = fetta[min(len(fetta) - 1, int(len(fetta) * 0.95))]
+            self.stdout.write(
+                f'  Q{i + 1}: mediana {statistics.median(fetta):.2f} ms, '
+                f'p95 {p95:.2f} ms')
+
+        if errori:
+            self.stdout.write(self.style.WARNING(
+                f'{len(errori)} errori (es. {errori[0]})'))
+        if duplicati:
+            self.stdout.write(self.style.ERROR(
+                f'{len(duplicati)} numeri DUPLICATI: {duplicati[:5]}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Zero collisioni.'))
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ordini', '0012_avviso_wa_fallito'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContatoreOrdini',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('giorno', models.DateField(unique=True)),
+                ('ultimo_numero', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Contatore ordini',
+                'verbose_name_plural': 'Contatori ordini',
+                'ordering': ['-giorno'],
+            },
+        ),
+    ]
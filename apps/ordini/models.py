@@ -135,20 +135,14 @@ class Ordine(models.Model):
         super().save(*args, **kwargs)
     
     def genera_numero_progressivo(self):
-        oggi = timezone.now().date()
-        prefisso = oggi.strftime('%Y%m%d')
-        
-        ultimo_ordine = Ordine.objects.filter(
-            numero_progressivo__startswith=prefisso
-        ).order_by('-numero_progressivo').first()
-        
-        if ultimo_ordine:
-            ultimo_numero = int(ultimo_ordine.numero_progressivo[-4:])
-            nuovo_numero = ultimo_numero + 1
-        else:
-            nuovo_numero = 1
-        
-        return f"{prefisso}-{nuovo_numero:04d}"
+        """Prossimo numero del giorno (es. '20260307-0031').
+
+        Il numero arriva dal contatore giornaliero (ContatoreOrdini):
+        allocazione atomica, niente scan su numero_progressivo e niente
+        collisioni tra due casse che chiudono l'ordine insieme.
+        """
+        from .numerazione import prossimo_numero
+        return prossimo_numero()
     
     @property
     def numero_breve(self):
@@ -213,6 +207,9 @@ class Ordine(models.Model):
             return 'failed'
         if not self.cliente_avvisato_wa_message_id:
             return ''
+        # Precaricato in blocco dalla board del giorno (apps/ordini/board.py)
+        if hasattr(self, '_stato_wa_precaricato'):
+            return self._stato_wa_precaricato
         from apps.messaggi.models import MessaggioWhatsApp
         msg = MessaggioWhatsApp.objects.filter(
             wa_message_id=self.cliente_avvisato_wa_message_id,
@@ -431,6 +428,24 @@ class Pagamento(models.Model):
         # L'aggiornamento dello stato dell'ordine è gestito dal signal post_save
 
 
+class ContatoreOrdini(models.Model):
+    """Contatore giornaliero dei numeri progressivi ordine.
+
+    Una riga per giorno: ultimo_numero e' l'ultimo numero assegnato.
+    Aggiornato SOLO da apps.ordini.numerazione (UPDATE atomico).
+    """
+    giorno = models.DateField(unique=True)
+    ultimo_numero = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Contatore ordini'
+        verbose_name_plural = 'Contatori ordini'
+        ordering = ['-giorno']
+
+    def __str__(self):
+        return f"{self.giorno:%Y%m%d}: {self.ultimo_numero}"
+
+
 class ConfigurazionePianificazione(models.Model):
     """Configurazione orari di lavoro (singleton)"""
 
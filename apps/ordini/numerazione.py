@@ -0,0 +1,109 @@
+"""Numerazione progressiva giornaliera degli ordini ('YYYYMMDD-NNNN').
+
+Prima il numero nasceva da "ultimo numero del giorno + 1" letto con
+uno scan startswith + ORDER BY su Ordine: due casse che chiudono un
+ordine nello stesso istante (completa_ordine, converti_in_ordine)
+leggevano lo stesso massimo e la seconda esplodeva sul vincolo unique.
+
+Ora c'e' una riga ContatoreOrdini per giorno e ogni allocazione e' un
+singolo UPDATE atomico:
+
+- Postgres / SQLite >= 3.35: UPDATE ... RETURNING (un round trip);
+- altri backend: UPDATE + SELECT nella stessa transazione (il lock di
+  riga/database preso dall'UPDATE impedisce letture concorrenti).
+
+La riga del giorno viene creata al primo ordine, ripartendo dal
+massimo gia' usato (continuita' col vecchio schema nel giorno del
+deploy); e' l'unico scan, una volta al giorno.
+
+Se l'allocazione avviene dentro una transazione (es. completa_ordine)
+il lock di riga resta fino al commit: gli ordini concorrenti aspettano
+qualche ms invece di collidere. Un rollback restituisce i numeri.
+"""
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+
+def _prefisso(giorno) -> str:
+    return giorno.strftime('%Y%m%d')
+
+
+def formatta_numero(giorno, numero: int) -> str:
+    return f"{_prefisso(giorno)}-{numero:04d}"
+
+
+def _massimo_esistente(giorno) -> int:
+    """Ultimo numero gia' usato nel giorno da ordini esistenti."""
+    from .models import Ordine
+    numeri = Ordine.objects.filter(
+        numero_progressivo__startswith=f"{_prefisso(giorno)}-"
+    ).values_list('numero_progressivo', flat=True)
+    massimo = 0
+    for numero in numeri:
+        suffisso = numero.rsplit('-', 1)[-1]
+        if suffisso.isdigit():
+            massimo = max(massimo, int(suffisso))
+    return massimo
+
+
+def _crea_contatore(giorno):
+    from .models import ContatoreOrdini
+    # ignore_conflicts: se un'altra cassa l'ha appena creato va bene
+    # uguale, l'UPDATE successivo incrementa quello.
+    ContatoreOrdini.objects.bulk_create(
+        [ContatoreOrdini(giorno=giorno,
+                         ultimo_numero=_massimo_esistente(giorno))],
+        ignore_conflicts=True,
+    )
+
+
+def _supporta_returning() -> bool:
+    return (connection.vendor in ('postgresql', 'sqlite')
+            and connection.features.can_return_columns_from_insert)
+
+
+def _incrementa(giorno, quanti: int):
+    """Avanza il contatore di `quanti` e ritorna il nuovo ultimo numero.
+    None se la riga del giorno non esiste ancora."""
+    from .models import ContatoreOrdini
+
+    if _supporta_returning():
+        tabella = connection.ops.quote_name(ContatoreOrdini._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {tabella} SET ultimo_numero = ultimo_numero + %s '
+                f'WHERE giorno = %s RETURNING ultimo_numero',
+                [quanti, connection.ops.adapt_datefield_value(giorno)],
+            )
+            riga = cursor.fetchone()
+        return riga[0] if riga else None
+
+    with transaction.atomic():
+        contatore = ContatoreOrdini.objects.filter(giorno=giorno)
+        if not contatore.update(ultimo_numero=F('ultimo_numero') + quanti):
+            return None
+        return contatore.values_list('ultimo_numero', flat=True).get()
+
+
+def alloca_numeri(quanti: int = 1, giorno=None) -> list[str]:
+    """Riserva `quanti` numeri consecutivi del giorno (default oggi).
+
+    Per gli import massivi: un solo UPDATE per l'intero blocco.
+    """
+    if quanti < 1:
+        raise ValueError('quanti deve essere >= 1')
+    giorno = giorno or timezone.now().date()
+
+    ultimo = _incrementa(giorno, quanti)
+    if ultimo is None:
+        _crea_contatore(giorno)
+        ultimo = _incrementa(giorno, quanti)
+
+    primo = ultimo - quanti + 1
+    return [formatta_numero(giorno, n) for n in range(primo, ultimo + 1)]
+
+
+def prossimo_numero(giorno=None) -> str:
+    """Numero progressivo per un nuovo ordine."""
+    return alloca_numeri(1, giorno)[0]
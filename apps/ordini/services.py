@@ -1,83 +1,222 @@
+import threading
+import time
+from collections import defaultdict
+from django.db.models import F
 from django.utils import timezone
 from datetime import timedelta
-from apps.core.models import Postazione
 from .models import ItemOrdine, Ordine
 # Temporaneamente commentato - da riabilitare quando l'app prenotazioni sarà attiva
 # from apps.prenotazioni.models import Prenotazione
 from apps.core.models import StampanteRete
 
 
+STATI_APERTI = ('in_attesa', 'in_lavorazione')
+
+# Buffer di sicurezza applicato al tempo di ogni postazione (10%)
+FATTORE_CORREZIONE = 1.1
+
+# Oltre questa eta' lo snapshot di processo viene ricaricato dal DB:
+# copre le modifiche fatte da altri processi (altri worker, cron), che
+# i signal di questo processo non vedono.
+SNAPSHOT_TTL_SEC = 30
+
+
+class CodaPostazioni:
+    """Modello in memoria del carico di tutte le postazioni.
+
+    Caricato con una sola query sugli ItemOrdine aperti (item e ordine
+    in attesa/lavorazione, postazione assegnata): per ogni postazione
+    tiene i minuti in coda. Su questo snapshot si possono fare quante
+    simulazioni "se aggiungo questi servizi" si vuole; i dati mancanti
+    (postazioni abilitate e tempi medi storici dei servizi richiesti)
+    si caricano in blocco, una query ciascuno per tutto il carrello.
+
+    I signal di ItemOrdine/Ordine aggiornano lo snapshot di processo in
+    modo incrementale (aggiorna_item / aggiorna_ordine) al commit.
+    """
+
+    def __init__(self):
+        self.caricato_il = time.monotonic()
+        self._lock = threading.Lock()
+        # item_id -> (ordine_id, postazione_id, minuti)
+        self._items = {}
+        # postazione_id -> minuti in coda
+        self._carico = defaultdict(int)
+        self._ordini_chiusi = set()
+        # servizio_id -> [postazione_id attive]
+        self._postazioni_servizio = {}
+        # (postazione_id, servizio_id) -> minuti medi storici
+        self._medie = {}
+
+    @classmethod
+    def carica(cls):
+        coda = cls()
+        righe = ItemOrdine.objects.filter(
+            stato__in=STATI_APERTI,
+            ordine__stato__in=STATI_APERTI,
+            postazione_assegnata__isnull=False,
+        ).values_list('pk', 'ordine_id', 'postazione_assegnata_id',
+                      'servizio_prodotto__durata_minuti')
+        for pk, ordine_id, postazione_id, minuti in righe:
+            coda._aggiungi(pk, ordine_id, postazione_id, minuti)
+        return coda
+
+    @property
+    def scaduto(self):
+        return time.monotonic() - self.caricato_il > SNAPSHOT_TTL_SEC
+
+    def carico(self, postazione_id):
+        """Minuti di lavoro in coda sulla postazione."""
+        return self._carico.get(postazione_id, 0)
+
+    # --- aggiornamento incrementale ----------------------------------
+
+    def _aggiungi(self, pk, ordine_id, postazione_id, minuti):
+        self._items[pk] = (ordine_id, postazione_id, minuti or 0)
+        self._carico[postazione_id] += minuti or 0
+
+    def _togli(self, pk):
+        vecchio = self._items.pop(pk, None)
+        if vecchio:
+            _, postazione_id, minuti = vecchio
+            self._carico[postazione_id] -= minuti
+
+    def aggiorna_item(self, item, ordine_stato):
+        """Riallinea il contributo di un ItemOrdine dopo un salvataggio."""
+        with self._lock:
+            self._togli(item.pk)
+            if (item.stato in STATI_APERTI and ordine_stato in STATI_APERTI
+                    and item.postazione_assegnata_id):
+                self._aggiungi(item.pk, item.ordine_id,
+                               item.postazione_assegnata_id,
+                               item.servizio_prodotto.durata_minuti)
+
+    def rimuovi_item(self, item_id):
+        with self._lock:
+            self._togli(item_id)
+
+    def aggiorna_ordine(self, ordine_id, stato):
+        """Ordine chiuso/annullato: i suoi item escono dalla coda.
+        Ordine riaperto dopo essere uscito: lo snapshot va ricaricato
+        (i suoi item non sono piu' tracciati)."""
+        if stato in STATI_APERTI:
+            if ordine_id in self._ordini_chiusi:
+                invalida_coda_postazioni()
+            return
+        with self._lock:
+            self._ordini_chiusi.add(ordine_id)
+            for pk in [pk for pk, v in self._items.items() if v[0] == ordine_id]:
+                self._togli(pk)
+
+    # --- dati per servizio (caricati in blocco) ----------------------
+
+    def _carica_dati_servizi(self, servizi_ids):
+        from django.db.models import Avg, DurationField, ExpressionWrapper
+        from apps.core.models import ServizioProdotto
+
+        mancanti = [sid for sid in servizi_ids
+                    if sid not in self._postazioni_servizio]
+        if not mancanti:
+            return
+        postazioni = {sid: [] for sid in mancanti}
+        for sid, pid in ServizioProdotto.postazioni.through.objects.filter(
+            servizioprodotto_id__in=mancanti, postazione__attiva=True,
+        ).values_list('servizioprodotto_id', 'postazione_id'):
+            postazioni[sid].append(pid)
+
+        medie = ItemOrdine.objects.filter(
+            servizio_prodotto_id__in=mancanti,
+            postazione_assegnata__isnull=False,
+            stato='completato',
+            fine_lavorazione__isnull=False,
+            inizio_lavorazione__isnull=False,
+        ).values('postazione_assegnata_id', 'servizio_prodotto_id').annotate(
+            media=Avg(ExpressionWrapper(
+                F('fine_lavorazione') - F('inizio_lavorazione'),
+                output_field=DurationField(),
+            )),
+        )
+        with self._lock:
+            self._postazioni_servizio.update(postazioni)
+            for riga in medie:
+                if riga['media']:
+                    chiave = (riga['postazione_assegnata_id'],
+                              riga['servizio_prodotto_id'])
+                    self._medie[chiave] = riga['media'].total_seconds() / 60
+
+    def tempo_medio(self, postazione_id, servizio):
+        """Come Postazione.get_tempo_medio_servizio, senza query."""
+        return (self._medie.get((postazione_id, servizio.pk))
+                or servizio.durata_minuti)
+
+    # --- simulazione -------------------------------------------------
+
+    def tempo_attesa(self, servizi):
+        """Minuti di attesa se si aggiungono `servizi` alla coda attuale.
+
+        Per ogni servizio: la postazione piu' scarica tra quelle
+        abilitate (coda + tempo medio storico, +10%); i servizi sono in
+        parallelo -> conta il piu' lungo. Servizio senza postazioni:
+        vale la sua durata.
+        """
+        servizi = list(servizi)
+        self._carica_dati_servizi({s.pk for s in servizi})
+
+        tempo_attesa_totale = 0
+        for servizio in servizi:
+            postazioni = self._postazioni_servizio.get(servizio.pk)
+            if not postazioni:
+                tempo_attesa_totale = max(tempo_attesa_totale,
+                                          servizio.durata_minuti)
+                continue
+            tempo_servizio = min(
+                (self.carico(pid) + self.tempo_medio(pid, servizio))
+                * FATTORE_CORREZIONE
+                for pid in postazioni
+            )
+            tempo_attesa_totale = max(tempo_attesa_totale, tempo_servizio)
+        return int(tempo_attesa_totale)
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def coda_postazioni():
+    """Snapshot di processo della coda, ricaricato quando scade."""
+    global _snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.scaduto:
+            _snapshot = CodaPostazioni.carica()
+        return _snapshot
+
+
+def snapshot_attivo():
+    """Lo snapshot corrente se gia' caricato (per i signal), o None."""
+    return _snapshot
+
+
+def invalida_coda_postazioni():
+    global _snapshot
+    with _snapshot_lock:
+        _snapshot = None
+
+
 class CalcoloTempoAttesaService:
     """Servizio per il calcolo dei tempi di attesa"""
     
     @staticmethod
-    def calcola_tempo_attesa_nuovo_ordine(servizi_richiesti):
+    def calcola_tempo_attesa_nuovo_ordine(servizi_richiesti, coda=None):
         """
-        Calcola il tempo di attesa per un nuovo ordine
-        considerando tutti i fattori
+        Calcola il tempo di attesa per un nuovo ordine sullo snapshot
+        della coda (query costanti, indipendenti da servizi e postazioni)
         """
-        tempo_attesa_totale = 0
-        
-        for servizio in servizi_richiesti:
-            # 1. Trova postazioni disponibili per il servizio
-            postazioni = servizio.postazioni.filter(attiva=True)
-            
-            if not postazioni.exists():
-                # Se nessuna postazione specifica, usa tempo di default
-                tempo_attesa_totale = max(tempo_attesa_totale, servizio.durata_minuti)
-                continue
-            
-            tempi_attesa_postazioni = []
-            for postazione in postazioni:
-                # 2. Calcola carico attuale postazione
-                ordini_in_coda = ItemOrdine.objects.filter(
-                    postazione_assegnata=postazione,
-                    stato__in=['in_attesa', 'in_lavorazione'],
-                    ordine__stato__in=['in_attesa', 'in_lavorazione']
-                ).select_related('servizio_prodotto')
-                
-                # 3. Somma durate servizi in coda
-                tempo_coda = sum([
-                    item.servizio_prodotto.durata_minuti 
-                    for item in ordini_in_coda
-                ])
-                
-                # 4. Considera prenotazioni programmate
-                # Temporaneamente commentato - da riabilitare con l'app prenotazioni
-                # ora_attuale = timezone.now()
-                # prenotazioni_future = Prenotazione.objects.filter(
-                #     slot__data=ora_attuale.date(),
-                #     slot__ora_inizio__gte=ora_attuale.time(),
-                #     stato='confermata',
-                #     servizi=servizio
-                # ).count()
-                # tempo_prenotazioni = prenotazioni_future * servizio.durata_minuti
-                tempo_prenotazioni = 0  # Placeholder finché l'app prenotazioni non è attiva
-                
-                # 5. Aggiungi tempo medio storico e buffer sicurezza
-                tempo_medio_storico = postazione.get_tempo_medio_servizio(servizio)
-                fattore_correzione = 1.1  # 10% buffer sicurezza
-                
-                tempo_totale_postazione = (
-                    tempo_coda + tempo_prenotazioni + tempo_medio_storico
-                ) * fattore_correzione
-                
-                tempi_attesa_postazioni.append(tempo_totale_postazione)
-            
-            # 6. Prendi il tempo minimo tra le postazioni
-            if tempi_attesa_postazioni:
-                tempo_attesa_servizio = min(tempi_attesa_postazioni)
-            else:
-                tempo_attesa_servizio = servizio.durata_minuti
-            
-            # 7. Il tempo totale è il massimo tra i servizi (possono essere paralleli)
-            tempo_attesa_totale = max(tempo_attesa_totale, tempo_attesa_servizio)
-        
-        # 8. Calcola ora consegna prevista
-        ora_consegna_prevista = timezone.now() + timedelta(minutes=int(tempo_attesa_totale))
+        coda = coda or coda_postazioni()
+        tempo_attesa_totale = coda.tempo_attesa(servizi_richiesti)
+        ora_consegna_prevista = timezone.now() + timedelta(minutes=tempo_attesa_totale)
         
         return {
-            'tempo_attesa_minuti': int(tempo_attesa_totale),
+            'tempo_attesa_minuti': tempo_attesa_totale,
             'ora_consegna_prevista': ora_consegna_prevista,
             'consegna_suggerita': ora_consegna_prevista.strftime('%H:%M')
         }
@@ -85,21 +224,33 @@ class CalcoloTempoAttesaService:
     @staticmethod
     def aggiorna_tempi_attesa_real_time():
         """Task per aggiornare i tempi di attesa in tempo reale"""
-        # Ordini non completati
+        from django.db.models import Prefetch
+
+        coda = CodaPostazioni.carica()
         ordini_aperti = Ordine.objects.filter(
-            stato__in=['in_attesa', 'in_lavorazione']
-        )
+            stato__in=STATI_APERTI
+        ).prefetch_related(Prefetch(
+            'items',
+            queryset=ItemOrdine.objects.filter(
+                servizio_prodotto__tipo='servizio'
+            ).select_related('servizio_prodotto'),
+            to_attr='items_servizio',
+        ))
         
+        da_aggiornare = []
         for ordine in ordini_aperti:
-            servizi = [item.servizio_prodotto for item in ordine.items.filter(
-                servizio_prodotto__tipo='servizio'
-            )]
+            servizi = [item.servizio_prodotto for item in ordine.items_servizio]
             
             if servizi:
-                nuovo_tempo = CalcoloTempoAttesaService.calcola_tempo_attesa_nuovo_ordine(servizi)
+                nuovo_tempo = CalcoloTempoAttesaService.calcola_tempo_attesa_nuovo_ordine(
+                    servizi, coda=coda)
                 ordine.tempo_attesa_minuti = nuovo_tempo['tempo_attesa_minuti']
                 ordine.ora_consegna_prevista = nuovo_tempo['ora_consegna_prevista']
-                ordine.save(update_fields=['tempo_attesa_minuti', 'ora_consegna_prevista'])
+                da_aggiornare.append(ordine)
+        
+        Ordine.objects.bulk_update(
+            da_aggiornare, ['tempo_attesa_minuti', 'ora_consegna_prevista'],
+            batch_size=200)
 
 
 class StampaService:
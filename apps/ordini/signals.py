@@ -116,4 +116,81 @@ def aggiorna_ordine_dopo_cancellazione_pagamento(sender, instance, **kwargs):
         else:
             ordine.stato_pagamento = 'non_pagato'
         
-        ordine.save(update_fields=['importo_pagato', 'stato_pagamento'])
\ No newline at end of file
+        ordine.save(update_fields=['importo_pagato', 'stato_pagamento'])
+
+# --- Snapshot coda postazioni (tempi di attesa) ---------------------
+# Aggiornamento incrementale al commit: niente ricarica dell'intera
+# coda per ogni cambio di stato di un item. Se lo snapshot non e' mai
+# stato caricato in questo processo non c'e' nulla da fare.
+
+@receiver(post_save, sender=ItemOrdine)
+def aggiorna_coda_item(sender, instance, **kwargs):
+    from .services import snapshot_attivo
+    if snapshot_attivo() is None:
+        return
+    ordine_stato = instance.ordine.stato
+
+    def _applica():
+        coda = snapshot_attivo()
+        if coda is not None:
+            coda.aggiorna_item(instance, ordine_stato)
+    transaction.on_commit(_applica)
+
+
+@receiver(post_delete, sender=ItemOrdine)
+def rimuovi_coda_item(sender, instance, **kwargs):
+    from .services import snapshot_attivo
+    if snapshot_attivo() is None:
+        return
+    item_id = instance.pk
+
+    def _applica():
+        coda = snapshot_attivo()
+        if coda is not None:
+            coda.rimuovi_item(item_id)
+    transaction.on_commit(_applica)
+
+
+@receiver(post_save, sender=Ordine)
+def aggiorna_coda_ordine(sender, instance, created, **kwargs):
+    from .services import snapshot_attivo
+    if created or snapshot_attivo() is None:
+        return
+    ordine_id, stato = instance.pk, instance.stato
+
+    def _applica():
+        coda = snapshot_attivo()
+        if coda is not None:
+            coda.aggiorna_ordine(ordine_id, stato)
+    transaction.on_commit(_applica)
+
+
+# --- Board del giorno (/ordini/) ------------------------------------
+
+@receiver(post_save, sender=Ordine)
+@receiver(post_delete, sender=Ordine)
+@receiver(post_save, sender=ItemOrdine)
+@receiver(post_delete, sender=ItemOrdine)
+@receiver(post_save, sender=Pagamento)
+@receiver(post_delete, sender=Pagamento)
+def invalida_board_giorno(sender, **kwargs):
+    from .board import segna_modifica
+    segna_modifica()
+
+
+# --- Flusso versionato per i client WebSocket (apps/ordini/flusso.py) ---
+# Dopo invalida_board_giorno: al commit il marcatore della board cambia
+# prima che il delta parta, cosi' chi ricarica la pagina per quel delta
+# non trova la board vecchia in cache.
+
+@receiver(post_save, sender=Ordine)
+@receiver(post_delete, sender=Ordine)
+@receiver(post_save, sender=ItemOrdine)
+@receiver(post_delete, sender=ItemOrdine)
+@receiver(post_save, sender=Pagamento)
+@receiver(post_delete, sender=Pagamento)
+def pubblica_delta_ordine(sender, instance, **kwargs):
+    from .flusso import pubblica_al_commit
+    ordine_id = instance.pk if sender is Ordine else instance.ordine_id
+    if ordine_id:
+        pubblica_al_commit(ordine_id)
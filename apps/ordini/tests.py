@@ -0,0 +1,343 @@
+"""Test della numerazione progressiva giornaliera degli ordini, del
+motore dei tempi di attesa, della board del giorno e del flusso
+versionato per i client WebSocket.
+
+Esecuzione: python manage.py test apps.ordini
+"""
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from apps.core import cache as cache_condivisa
+from apps.core.models import Categoria, Postazione, ServizioProdotto
+
+from . import flusso
+from .board import board_giorno, calcola_board
+from .models import ContatoreOrdini, ItemOrdine, Ordine, Pagamento
+from .numerazione import alloca_numeri, prossimo_numero
+from .services import (CalcoloTempoAttesaService, CodaPostazioni,
+                       coda_postazioni, invalida_coda_postazioni)
+
+GIORNO = date(2026, 3, 7)
+
+
+def _ordine(**kwargs):
+    return Ordine.objects.create(
+        totale=Decimal('10.00'), totale_finale=Decimal('10.00'), **kwargs)
+
+
+class NumerazioneTest(TestCase):
+    def test_numeri_consecutivi(self):
+        self.assertEqual(prossimo_numero(GIORNO), '20260307-0001')
+        self.assertEqual(prossimo_numero(GIORNO), '20260307-0002')
+        self.assertEqual(
+            ContatoreOrdini.objects.get(giorno=GIORNO).ultimo_numero, 2)
+
+    def test_contatore_separato_per_giorno(self):
+        prossimo_numero(GIORNO)
+        self.assertEqual(prossimo_numero(date(2026, 3, 8)), '20260308-0001')
+
+    def test_blocco_per_import(self):
+        prossimo_numero(GIORNO)
+        blocco = alloca_numeri(3, GIORNO)
+        self.assertEqual(blocco, ['20260307-0002', '20260307-0003',
+                                  '20260307-0004'])
+        self.assertEqual(prossimo_numero(GIORNO), '20260307-0005')
+
+    def test_riparte_dal_massimo_esistente(self):
+        # ordini numerati prima dell'introduzione del contatore
+        _ordine(numero_progressivo='20260307-0041')
+        _ordine(numero_progressivo='20260307-0007')
+        self.assertEqual(prossimo_numero(GIORNO), '20260307-0042')
+
+    def test_quantita_non_valida(self):
+        with self.assertRaises(ValueError):
+            alloca_numeri(0, GIORNO)
+
+    def test_save_assegna_numero_senza_scan(self):
+        primo = _ordine()
+        secondo = _ordine()
+        self.assertEqual(secondo.numero_breve, primo.numero_breve + 1)
+        # a contatore creato l'allocazione e' un solo UPDATE ... RETURNING
+        with self.assertNumQueries(1):
+            prossimo_numero()
+
+
+class TempoAttesaTest(TestCase):
+    def setUp(self):
+        invalida_coda_postazioni()
+        self.addCleanup(invalida_coda_postazioni)
+        self.cat = Categoria.objects.create(nome='Lavaggi')
+        self.pa = Postazione.objects.create(nome='Tunnel A')
+        self.pb = Postazione.objects.create(nome='Tunnel B')
+        self.servizi = []
+        for i in range(5):
+            s = ServizioProdotto.objects.create(
+                titolo=f'Servizio {i}', prezzo=Decimal('10'),
+                categoria=self.cat, descrizione='-', durata_minuti=20)
+            s.postazioni.set([self.pa, self.pb])
+            self.servizi.append(s)
+        self.lungo = ServizioProdotto.objects.create(
+            titolo='Lungo', prezzo=Decimal('30'), categoria=self.cat,
+            descrizione='-', durata_minuti=30)
+
+    def _in_coda(self, postazione, servizio):
+        ordine = _ordine()
+        return ItemOrdine.objects.create(
+            ordine=ordine, servizio_prodotto=servizio,
+            prezzo_unitario=servizio.prezzo,
+            postazione_assegnata=postazione)
+
+    def test_sceglie_la_postazione_piu_scarica(self):
+        self._in_coda(self.pa, self.lungo)
+        coda = CodaPostazioni.carica()
+        self.assertEqual(coda.carico(self.pa.pk), 30)
+        # A: (30 + 20) * 1.1 = 55, B: 20 * 1.1 = 22
+        self.assertEqual(coda.tempo_attesa([self.servizi[0]]), 22)
+
+    def test_servizio_senza_postazioni_vale_la_durata(self):
+        coda = CodaPostazioni.carica()
+        self.assertEqual(coda.tempo_attesa([self.lungo]), 30)
+
+    def test_tempo_medio_storico(self):
+        item = self._in_coda(self.pb, self.servizi[0])
+        ora = timezone.now()
+        ItemOrdine.objects.filter(pk=item.pk).update(
+            stato='completato', inizio_lavorazione=ora - timedelta(minutes=40),
+            fine_lavorazione=ora)
+        coda = CodaPostazioni.carica()
+        self.assertEqual(coda.tempo_attesa([self.servizi[0]]), 22)
+        self.pa.attiva = False
+        self.pa.save()
+        coda = CodaPostazioni.carica()
+        self.assertEqual(coda.tempo_attesa([self.servizi[0]]), 44)
+
+    def test_query_costanti_rispetto_al_carrello(self):
+        for servizio in self.servizi:
+            self._in_coda(self.pa, servizio)
+        # carica coda + postazioni abilitate + medie storiche
+        with self.assertNumQueries(3):
+            CalcoloTempoAttesaService.calcola_tempo_attesa_nuovo_ordine(
+                self.servizi[:1], coda=CodaPostazioni.carica())
+        with self.assertNumQueries(3):
+            CalcoloTempoAttesaService.calcola_tempo_attesa_nuovo_ordine(
+                self.servizi, coda=CodaPostazioni.carica())
+        # simulazioni successive sullo stesso snapshot: zero query
+        coda = CodaPostazioni.carica()
+        coda.tempo_attesa(self.servizi)
+        with self.assertNumQueries(0):
+            coda.tempo_attesa(self.servizi[2:])
+
+    def test_aggiornamento_incrementale_al_commit(self):
+        item = self._in_coda(self.pa, self.lungo)
+        coda = coda_postazioni()
+        self.assertEqual(coda.carico(self.pa.pk), 30)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            nuovo = self._in_coda(self.pa, self.servizi[0])
+        self.assertEqual(coda.carico(self.pa.pk), 50)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            item.completa_lavorazione()
+        self.assertEqual(coda.carico(self.pa.pk), 20)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            nuovo.ordine.stato = 'annullato'
+            nuovo.ordine.save()
+        self.assertEqual(coda.carico(self.pa.pk), 0)
+        self.assertIs(coda_postazioni(), coda)
+
+
+class BoardGiornoTest(TestCase):
+    def setUp(self):
+        self.oggi = timezone.localdate()
+        cat = Categoria.objects.create(nome='Lavaggi')
+        self.servizio = ServizioProdotto.objects.create(
+            titolo='Esterno', prezzo=Decimal('10'), categoria=cat,
+            descrizione='-', durata_minuti=20)
+
+    def _ordine_con_item(self, **kwargs):
+        ordine = _ordine(**kwargs)
+        ItemOrdine.objects.create(ordine=ordine, servizio_prodotto=self.servizio,
+                                  prezzo_unitario=Decimal('10'))
+        return ordine
+
+    def _query_board(self):
+        with CaptureQueriesContext(connection) as ctx:
+            calcola_board(self.oggi)
+        return len(ctx)
+
+    def test_sezioni_e_ordinamento(self):
+        prog = self._ordine_con_item(tipo_consegna='programmata')
+        imm = self._ordine_con_item()
+        urgente = self._ordine_con_item(priorita=1)
+        da_ritirare = self._ordine_con_item(stato='completato')
+        ritirato = self._ordine_con_item(stato='completato', auto_ritirata=True)
+        _ordine(stato='annullato')
+
+        board = calcola_board(self.oggi)
+        self.assertEqual(board['ordini_attivi'], [urgente, imm, prog])
+        self.assertEqual(board['ordini_da_ritirare'], [da_ritirare])
+        self.assertEqual(board['ordini_completati'], [ritirato])
+
+    def test_statistiche_in_una_query(self):
+        pagato = _ordine()
+        Pagamento.objects.create(ordine=pagato, importo=Decimal('6'), metodo='contanti')
+        Pagamento.objects.create(ordine=pagato, importo=Decimal('4'), metodo='bancomat')
+        parziale = _ordine()
+        Pagamento.objects.create(ordine=parziale, importo=Decimal('3'), metodo='carta')
+        _ordine()
+
+        from .board import statistiche_giorno
+        with self.assertNumQueries(1):
+            stat = statistiche_giorno(self.oggi)
+        self.assertEqual(stat['totale_ordini'], Decimal('30.00'))
+        self.assertEqual(stat['totale_contanti'], Decimal('6.00'))
+        self.assertEqual(stat['totale_carte'], Decimal('7.00'))
+        self.assertEqual(stat['totale_incassato'], Decimal('13.00'))
+        self.assertEqual(stat['totale_non_incassato'], Decimal('17.00'))
+
+    def test_query_non_crescono_con_gli_ordini(self):
+        for _ in range(2):
+            self._ordine_con_item()
+        poche = self._query_board()
+        for _ in range(10):
+            ordine = self._ordine_con_item(stato='completato')
+            Pagamento.objects.create(ordine=ordine, importo=Decimal('10'),
+                                     metodo='carta')
+        self.assertEqual(self._query_board(), poche)
+
+    @override_settings(ORDINI_BOARD_CACHE=True)
+    def test_cache_per_ultima_modifica(self):
+        ordine = self._ordine_con_item()
+        with self.captureOnCommitCallbacks(execute=True):
+            board_giorno(self.oggi)
+        with self.assertNumQueries(0):
+            board = board_giorno(self.oggi)
+        self.assertEqual(board['ordini_attivi'], [ordine])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ordine.stato = 'completato'
+            ordine.save()
+        board = board_giorno(self.oggi)
+        self.assertEqual(board['ordini_attivi'], [])
+        self.assertEqual(board['ordini_da_ritirare'], [ordine])
+
+
+@override_settings(ORDINI_FLUSSO_FINESTRA=50, CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'flusso-ordini'}})
+class FlussoOrdiniTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        patcher = mock.patch('apps.api.notify.notify_group')
+        self.notify = patcher.start()
+        self.addCleanup(patcher.stop)
+        cat = Categoria.objects.create(nome='Lavaggi')
+        self.servizio = ServizioProdotto.objects.create(
+            titolo='Esterno', prezzo=Decimal('10'), categoria=cat,
+            descrizione='-', durata_minuti=20)
+        self.tunnel = Postazione.objects.create(nome='Tunnel')
+        self.box = Postazione.objects.create(nome='Box')
+
+    def _crea(self, postazione):
+        with self.captureOnCommitCallbacks(execute=True):
+            ordine = _ordine()
+            ItemOrdine.objects.create(ordine=ordine, servizio_prodotto=self.servizio,
+                                      prezzo_unitario=Decimal('10'),
+                                      postazione_assegnata=postazione)
+        return ordine
+
+    def _salva(self, ordine, **campi):
+        with self.captureOnCommitCallbacks(execute=True):
+            for campo, valore in campi.items():
+                setattr(ordine, campo, valore)
+            ordine.save()
+
+    def test_diff_solo_campi_cambiati(self):
+        ordine = self._crea(self.tunnel)
+        self._salva(ordine, stato='in_lavorazione')
+        self._salva(ordine, stato='in_lavorazione')  # nessun cambio, nessun delta
+
+        ultimo = flusso.riprendi(flusso.seq_corrente() - 1)
+        self.assertEqual(len(ultimo['delta']), 1)
+        delta = ultimo['delta'][0]
+        self.assertEqual(delta['op'], 'diff')
+        self.assertEqual(set(delta['campi']), {'stato', 'stato_display'})
+        self.notify.assert_any_call(f'postazione_{self.tunnel.pk}',
+                                    {'type': 'ordine.delta', **delta})
+
+    def test_riprendi_delta_persi(self):
+        ordine = self._crea(self.tunnel)
+        visto = flusso.seq_corrente()
+        self._salva(ordine, stato='in_lavorazione')
+        self._salva(ordine, priorita=1)
+
+        ripresa = flusso.riprendi(visto)
+        self.assertEqual(ripresa['type'], 'delta')
+        self.assertEqual([d['seq'] for d in ripresa['delta']], [visto + 1, visto + 2])
+        self.assertEqual(ripresa['seq'], flusso.seq_corrente())
+        self.assertEqual(flusso.riprendi(ripresa['seq'])['delta'], [])
+
+    def test_snapshot_fuori_finestra_o_con_buchi(self):
+        ordine = self._crea(self.tunnel)
+        visto = flusso.seq_corrente()
+        self._salva(ordine, stato='in_lavorazione')
+        self._salva(ordine, priorita=1)
+
+        self.assertEqual(flusso.riprendi(visto - 100)['type'], 'snapshot')
+        cache_condivisa.invalida(flusso._chiave_delta(visto + 1))
+        snap = flusso.riprendi(visto)
+        self.assertEqual(snap['type'], 'snapshot')
+        self.assertEqual(snap['ordini'][str(ordine.pk)]['priorita'], 1)
+
+    def test_filtro_per_postazione(self):
+        self._crea(self.tunnel)
+        visto = flusso.seq_corrente()
+        self._crea(self.tunnel)
+        nel_box = self._crea(self.box)
+
+        ripresa = flusso.riprendi(visto, postazione_id=self.box.pk)
+        self.assertEqual({d['ordine_id'] for d in ripresa['delta']}, {nel_box.pk})
+        snap = flusso.snapshot(postazione_id=self.box.pk)
+        self.assertEqual(set(snap['ordini']), {str(nel_box.pk)})
+
+    def test_un_delta_per_ordine_e_transazione(self):
+        with mock.patch.object(flusso, 'pubblica_ordine', wraps=flusso.pubblica_ordine) as pubblica, \
+                self.captureOnCommitCallbacks(execute=True):
+            ordine = _ordine()
+            for _ in range(3):
+                ItemOrdine.objects.create(ordine=ordine, servizio_prodotto=self.servizio,
+                                          prezzo_unitario=Decimal('10'),
+                                          postazione_assegnata=self.tunnel)
+            Pagamento.objects.create(ordine=ordine, importo=Decimal('10'), metodo='contanti')
+        pubblica.assert_called_once_with(ordine.pk)
+
+    def test_savepoint_annullato_non_perde_il_delta(self):
+        ordine = self._crea(self.tunnel)
+        visto = flusso.seq_corrente()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Ordine.objects.filter(pk=ordine.pk).update(priorita=2)
+                Pagamento.objects.create(ordine=ordine, importo=Decimal('1'),
+                                         metodo='contanti')
+                raise RuntimeError
+            # il callback del savepoint e' stato scartato con lui
+            ordine.stato = 'in_lavorazione'
+            ordine.save()
+        ripresa = flusso.riprendi(visto)
+        self.assertEqual(len(ripresa['delta']), 1)
+        self.assertEqual(ripresa['delta'][0]['campi']['stato'], 'in_lavorazione')
+        self.assertNotIn('priorita', ripresa['delta'][0]['campi'])
+
+    def test_seq_riparte_dai_millisecondi(self):
+        # Chiave sparita (restart di Redis): mai sotto le seq gia' viste
+        self.assertEqual(flusso.seq_corrente(), 0)
+        self._crea(self.tunnel)
+        self.assertGreater(flusso.seq_corrente(), 10 ** 12)
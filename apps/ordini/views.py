@@ -7,7 +7,7 @@ from django.views.generic import (
 from django.urls import reverse_lazy
 from django.http import JsonResponse, HttpResponse
 from django.contrib import messages
-from django.db.models import Q, Sum, Count, F, Case, When, Value, CharField
+from django.db.models import Q, Count, F, Case, When, Value, CharField
 from django.utils import timezone
 from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
@@ -447,11 +447,13 @@ def completa_ordine(request):
         )
         
         # Calcola tempo di attesa
-        servizi_nel_carrello = []
-        for item in carrello.values():
-            if item.get('tipo') == 'servizio':
-                servizio = ServizioProdotto.objects.get(id=item['id'])
-                servizi_nel_carrello.append(servizio)
+        servizi_carrello = ServizioProdotto.objects.in_bulk(
+            [int(item['id']) for item in carrello.values() if item.get('tipo') == 'servizio']
+        )
+        servizi_nel_carrello = [
+            servizi_carrello[int(item['id'])]
+            for item in carrello.values() if item.get('tipo') == 'servizio'
+        ]
         
         if servizi_nel_carrello:
             tempo_attesa = CalcoloTempoAttesaService.calcola_tempo_attesa_nuovo_ordine(servizi_nel_carrello)
@@ -734,7 +736,7 @@ def slot_giornata_api(request):
     a colpo d'occhio. Include anche gli slot passati/pieni con il
     rispettivo stato cosi l'UI puo colorarli.
     """
-    from apps.prenotazioni.models import SlotPrenotazione, ConfigurazioneSlot
+    from apps.prenotazioni.services import slot_periodo
     from datetime import datetime as _dt
 
     data_str = request.GET.get('data')
@@ -745,15 +747,11 @@ def slot_giornata_api(request):
     except ValueError:
         return JsonResponse({'error': 'Formato data non valido'}, status=400)
 
-    # Genera slot da configurazione se non esistono
-    giorno_settimana = data_richiesta.weekday()
-    for config in ConfigurazioneSlot.objects.filter(giorno_settimana=giorno_settimana, attivo=True):
-        config.genera_slot_per_data(data_richiesta)
-
     now_local = timezone.localtime(timezone.now())
     is_oggi = data_richiesta == now_local.date()
 
-    slot_qs = SlotPrenotazione.objects.filter(data=data_richiesta).order_by('ora_inizio')
+    # Genera gli slot mancanti e legge la giornata in blocco
+    slot_qs = slot_periodo(data_richiesta, data_richiesta)
     result = []
     for s in slot_qs:
         posti_liberi = max(0, s.max_prenotazioni - s.prenotazioni_attuali)
@@ -805,85 +803,14 @@ class OrdiniListView(LoginRequiredMixin, ListView):
         else:
             data = oggi
 
-        # Query base per tutti gli ordini del giorno selezionato
-        queryset = Ordine.objects.select_related(
-            'cliente', 'operatore', 'prenotazione'
-        ).prefetch_related(
-            'items__servizio_prodotto', 'items__postazione_cq', 'items__aggiunto_da', 'pagamenti'
-        ).filter(data_ora__date=data)
-
-        # Layout sempre in 3 sezioni (attivi / da ritirare / completati):
-        # ordini con priorita manuale vengono prima, poi immediati per
-        # data_ora, poi programmati per ora_consegna_richiesta.
-        ordini_con_priorita = queryset.filter(
-            stato__in=['in_attesa', 'in_lavorazione'],
-            priorita__gt=0,
-        ).order_by('priorita')
-
-        ordini_senza_priorita_imm = queryset.filter(
-            stato__in=['in_attesa', 'in_lavorazione'],
-            priorita=0,
-            tipo_consegna='immediata',
-        ).order_by('data_ora')
-
-        ordini_senza_priorita_prog = queryset.filter(
-            stato__in=['in_attesa', 'in_lavorazione'],
-            priorita=0,
-            tipo_consegna='programmata',
-        ).order_by('ora_consegna_richiesta')
-
-        from itertools import chain
-        context['ordini_attivi'] = list(chain(
-            ordini_con_priorita, ordini_senza_priorita_imm, ordini_senza_priorita_prog
-        ))
-
-        # Ordini da ritirare: completati ma NON ancora ritirati
-        context['ordini_da_ritirare'] = queryset.filter(
-            stato='completato',
-            auto_ritirata=False
-        ).order_by('-data_ora')
-
-        # Ordini completati: completati E gia' ritirati
-        context['ordini_completati'] = queryset.filter(
-            stato='completato',
-            auto_ritirata=True
-        ).order_by('-data_ora')
-
-        # Calcola statistiche finanziarie
-        # Usa lo stesso queryset filtrato per le statistiche
-        from decimal import Decimal
-
-        # Totale ordini (somma dei totale_finale)
-        totale_ordini = queryset.aggregate(
-            totale=Sum('totale_finale')
-        )['totale'] or Decimal('0.00')
-
-        # Totale incassato in contanti
-        totale_contanti = Pagamento.objects.filter(
-            ordine__in=queryset,
-            metodo='contanti'
-        ).aggregate(totale=Sum('importo'))['totale'] or Decimal('0.00')
-
-        # Totale incassato con carte (carta + bancomat)
-        totale_carte = Pagamento.objects.filter(
-            ordine__in=queryset,
-            metodo__in=['carta', 'bancomat']
-        ).aggregate(totale=Sum('importo'))['totale'] or Decimal('0.00')
-
-        # Totale non ancora incassato (saldo dovuto)
-        # Calcola manualmente perché saldo_dovuto è una property
-        totale_non_incassato = Decimal('0.00')
-        for ordine in queryset:
-            if ordine.saldo_dovuto > 0:
-                totale_non_incassato += ordine.saldo_dovuto
-
-        context['statistiche'] = {
-            'totale_ordini': totale_ordini,
-            'totale_contanti': totale_contanti,
-            'totale_carte': totale_carte,
-            'totale_non_incassato': totale_non_incassato,
-            'totale_incassato': totale_contanti + totale_carte,
-        }
+        # Sezioni (attivi / da ritirare / completati) e statistiche del
+        # giorno: un solo fetch + una query di aggregati, in cache finche'
+        # la giornata non cambia (vedi apps/ordini/board.py).
+        from .board import board_giorno
+        from .flusso import seq_corrente
+        # seq PRIMA della board: i delta nel mezzo si riapplicano senza danni
+        context['flusso_seq'] = seq_corrente()
+        context.update(board_giorno(data))
 
         # Prenotazioni del giorno selezionato ancora da fare checkin
         from apps.prenotazioni.models import Prenotazione
@@ -1980,6 +1907,10 @@ def segna_ritirata(request, pk):
                 auto_ritirata=ritirata,
                 data_ritiro=data_ritiro_val,
             )
+            from .board import segna_modifica
+            from .flusso import pubblica_al_commit
+            segna_modifica()
+            pubblica_al_commit(ordine.pk)
 
             # Notifica WebSocket (fire-and-forget)
             from apps.api.notify import notify_group
@@ -2055,7 +1986,7 @@ def avvisa_cliente_auto_pronta(request, pk):
     avvisato_local = timezone.localtime(ordine.cliente_avvisato_il)
     # Stato iniziale: 'sent' se invio riuscito, 'failed' se no. I
     # delivery report Meta aggiornano sent -> delivered -> read via
-    # webhook _handle_status; il polling JS riflette i cambi.
+    # webhook (apps/api/wa_inbox.applica_stati); il polling JS riflette i cambi.
     stato_wa = ordine.cliente_avvisato_stato_wa
     return JsonResponse({
         'ok': True,
@@ -2384,6 +2315,10 @@ def aggiorna_priorita_ordini(request):
             return JsonResponse({'success': False, 'error': 'Nessun ordine specificato'})
         for idx, ordine_id in enumerate(ordini_ids):
             Ordine.objects.filter(pk=ordine_id).update(priorita=idx + 1)
+        from .board import segna_modifica
+        from .flusso import pubblica_al_commit
+        segna_modifica()
+        pubblica_al_commit(*ordini_ids)
         return JsonResponse({'success': True, 'count': len(ordini_ids)})
     except (json.JSONDecodeError, ValueError) as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=400)
@@ -2407,8 +2342,6 @@ def prenotazione_accetta(request, pk):
 
     p.stato = 'confermata'
     p.save(update_fields=['stato'])
-    if hasattr(p.slot, 'aggiorna_contatori'):
-        p.slot.aggiorna_contatori()
 
     notifica_prenotazione_confermata(p)
     return JsonResponse({
@@ -2444,8 +2377,8 @@ def prenotazione_rifiuta(request, pk):
     # `can_be_cancelled` che richiede `is_future=True` (pensato per
     # richieste del cliente). L'operatore staff ha autorita' anche su
     # slot passati e prenotazioni "scadute": deve poterle sempre
-    # rifiutare. Andiamo a setting diretto + save() esplicito che fa
-    # ripartire anche aggiorna_contatori sullo slot.
+    # rifiutare. Andiamo a setting diretto + save() esplicito che
+    # libera anche il posto nello slot.
     p.stato = 'annullata'
     if motivo:
         p.nota_interna = f"Rifiutata dall'operatore: {motivo}"
@@ -2503,7 +2436,6 @@ def prenotazione_proponi_orario(request, pk):
         },
     )
 
-    vecchio_slot = p.slot
     p.slot = nuovo_slot
     # Lo stato RESTA 'in_attesa': la conferma definitiva arrivera' quando
     # il cliente rispondera' "Confermo" alla proposta WhatsApp e
@@ -2511,12 +2443,6 @@ def prenotazione_proponi_orario(request, pk):
     p.proposta_inviata_il = timezone.now()
     p.save(update_fields=['slot', 'proposta_inviata_il'])
 
-    # Aggiorna contatori vecchio + nuovo slot
-    if hasattr(vecchio_slot, 'aggiorna_contatori'):
-        vecchio_slot.aggiorna_contatori()
-    if hasattr(nuovo_slot, 'aggiorna_contatori'):
-        nuovo_slot.aggiorna_contatori()
-
     notifica_prenotazione_proposta_orario(p, vecchia_data, vecchia_ora)
     return JsonResponse({
         'ok': True,
@@ -4,4 +4,7 @@ from django.apps import AppConfig
 class PostazioniConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.postazioni'
-    verbose_name = 'Postazioni'
\ No newline at end of file
+    verbose_name = 'Postazioni'
+
+    def ready(self):
+        import apps.postazioni.signals
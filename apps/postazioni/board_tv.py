@@ -0,0 +1,221 @@
+"""Snapshot della dashboard TV (/postazioni/dashboard-tv/).
+
+Prima ogni TV chiamava dashboard_tv_data ogni 3 secondi e ogni chiamata
+rifaceva da capo la query degli ordini aperti (distinct + prefetch), le
+prenotazioni di oggi e, per ogni ordine, lookup della prenotazione,
+conversioni di fuso e formattazioni: N schermi = N calcoli identici.
+
+Qui la board serializzata (ordini aperti con item assegnati +
+prenotazioni confermate di oggi non ancora convertite) e' calcolata una
+volta per versione:
+
+- i signal su Ordine/ItemOrdine/Pagamento/Prenotazione cambiano la
+  versione al commit, una volta per transazione (segna_modifica); lo snapshot sta in cache sotto
+  (giorno, versione) con il suo ETag (hash del contenuto), cosi' il
+  polling di fallback risponde 304 finche' non cambia niente;
+- dopo un cambio parte sul gruppo 'dashboard_tv' solo la versione
+  nuova ('tv.versione', dal bus notifiche di apps/api/notify.py); lo
+  snapshot lo prepara il DashboardConsumer (ws/dashboard/tv/) quando la
+  riceve, nel thread pool di database_sync_to_async come per il primo
+  invio al connect, e lo manda alla TV se l'etag e' cambiato. Con la
+  cache condivisa N TV = un calcolo per versione.
+
+Prima il push partiva da un threading.Timer daemon per ogni raffica di
+salvataggi: calcola_board girava fuori da ogni richiesta, su una
+connessione DB mai chiusa (e nei test teneva bloccate le tabelle).
+
+L'ora del server non e' nello snapshot: la aggiunge la view a ogni
+risposta (e il client la tiene allineata con l'offset).
+
+Come per la board ordini, la cache si attiva solo se il backend e'
+condiviso tra i processi (apps.ordini.board.cache_abilitata).
+"""
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from apps.core import cache as cache_condivisa
+from apps.core.al_commit import CodaAlCommit
+from apps.ordini.board import STATI_ATTIVI, cache_abilitata
+from apps.ordini.models import ItemOrdine, Ordine
+
+GRUPPO = 'dashboard_tv'
+CHIAVE_VERSIONE = 'dashboard_tv:versione'
+SNAPSHOT_TTL = 60 * 10
+
+
+def versione():
+    token = cache_condivisa.leggi(CHIAVE_VERSIONE)
+    if token is None:
+        token = time.time_ns()
+        if not cache_condivisa.aggiungi(CHIAVE_VERSIONE, token, None):
+            token = cache_condivisa.leggi(CHIAVE_VERSIONE, token)
+    return token
+
+
+def _modificata(_chiavi):
+    from apps.api.notify import notify_group
+
+    token = time.time_ns()
+    cache_condivisa.scrivi(CHIAVE_VERSIONE, token, None)
+    notify_group(GRUPPO, {'type': 'tv.versione', 'versione': token})
+
+
+_coda_modifiche = CodaAlCommit(_modificata, 'Dashboard TV')
+
+
+def segna_modifica():
+    """Nuova versione + avviso alle TV al commit, una volta per transazione."""
+    _coda_modifiche.aggiungi(GRUPPO)
+
+
+# --- serializzazione ---------------------------------------------------
+
+def _ora(dt) -> str:
+    return timezone.localtime(dt).strftime('%H:%M')
+
+
+def _info_prenotazione(ordine):
+    """Dati della prenotazione da cui deriva l'ordine (o None)."""
+    prenotazione = getattr(ordine, 'prenotazione', None)
+    if prenotazione is None:
+        return None
+    cliente = prenotazione.cliente
+    nome = cliente.nome if cliente else ''
+    if cliente and cliente.cognome:
+        cognome = cliente.cognome
+    elif nome:
+        # Senza cognome si usa l'ultima parola del nome
+        cognome = nome.split()[-1]
+    else:
+        cognome = 'Cliente'
+    slot = prenotazione.slot
+    return {
+        'cliente_cognome': cognome,
+        'ora_prenotazione': slot.ora_inizio.strftime('%H:%M'),
+        'nota_cliente': prenotazione.nota_cliente or '',
+        'data_ora_prenotazione': datetime.combine(slot.data, slot.ora_inizio).isoformat(),
+        'ora_checkin': ordine.data_ora.isoformat(),
+    }
+
+
+def _ordine(ordine) -> dict:
+    data_ora_locale = timezone.localtime(ordine.data_ora)
+    prevista = ordine.ora_consegna_prevista or ordine.data_ora
+    booking_info = _info_prenotazione(ordine)
+    return {
+        'id': ordine.id,
+        'numero_progressivo': ordine.numero_progressivo,
+        'cliente': ordine.cliente.nome if ordine.cliente else 'Cliente Anonimo',
+        'tipo_auto': ordine.tipo_auto or '',
+        'stato': ordine.stato,
+        'stato_display': ordine.get_stato_display(),
+        'stato_pagamento': ordine.stato_pagamento,
+        'data_ora': data_ora_locale.strftime('%H:%M'),
+        'data_ora_completa': ordine.data_ora.isoformat(),
+        'data_ora_server_formatted': data_ora_locale.isoformat(),
+        'ora_consegna_prevista': _ora(prevista),
+        'ora_consegna_prevista_completa': prevista.isoformat(),
+        'ora_consegna_richiesta': (ordine.ora_consegna_richiesta.strftime('%H:%M')
+                                   if ordine.ora_consegna_richiesta else ''),
+        'tipo_consegna': ordine.tipo_consegna,
+        'totale_finale': str(ordine.totale_finale),
+        'nota': ordine.nota,
+        'is_from_booking': booking_info is not None,
+        'booking_info': booking_info,
+        'items': [{
+            'id': item.id,
+            'servizio': item.servizio_prodotto.titolo,
+            'quantita': item.quantita,
+            'stato': item.stato,
+            'stato_display': item.get_stato_display(),
+            'postazione': (item.postazione_assegnata.nome
+                           if item.postazione_assegnata else 'Non assegnata'),
+            'postazione_id': item.postazione_assegnata_id,
+        } for item in ordine.items.all()],
+    }
+
+
+def _prenotazione(prenotazione) -> dict:
+    slot = prenotazione.slot
+    ora = datetime.combine(slot.data, slot.ora_inizio)
+    consegna = ora + timedelta(minutes=prenotazione.durata_stimata_minuti)
+    return {
+        'id': f'prenotazione_{prenotazione.id}',
+        'numero_progressivo': 'prenotazione',
+        'cliente': prenotazione.cliente.nome,
+        'tipo_auto': prenotazione.tipo_auto or '',
+        'stato': 'da_confermare',
+        'stato_display': 'Da Confermare',
+        'stato_pagamento': 'non_pagato',
+        'data_ora': slot.ora_inizio.strftime('%H:%M'),
+        'data_ora_completa': ora.isoformat(),
+        'ora_consegna_prevista': consegna.strftime('%H:%M'),
+        'ora_consegna_prevista_completa': consegna.isoformat(),
+        'ora_consegna_richiesta': '',
+        'tipo_consegna': 'programmata',
+        'totale_finale': str(prenotazione.totale_stimato),
+        'nota': prenotazione.nota_cliente,
+        'codice_prenotazione': prenotazione.codice_prenotazione,
+        'durata_stimata': prenotazione.durata_stimata_minuti,
+        'is_prenotazione': True,
+        'servizi': [{'nome': s.titolo,
+                     'categoria': s.categoria.nome if s.categoria else ''}
+                    for s in prenotazione.servizi.all()],
+        'items': [],
+    }
+
+
+def calcola_board(giorno) -> dict:
+    from apps.prenotazioni.models import Prenotazione
+
+    assegnati = ItemOrdine.objects.filter(ordine=OuterRef('pk'),
+                                          postazione_assegnata__isnull=False)
+    ordini = Ordine.objects.select_related(
+        'cliente', 'prenotazione__cliente', 'prenotazione__slot'
+    ).prefetch_related(
+        'items__servizio_prodotto', 'items__postazione_assegnata'
+    ).filter(Exists(assegnati), stato__in=STATI_ATTIVI).order_by('numero_progressivo')
+
+    prenotazioni = Prenotazione.objects.select_related('cliente', 'slot').prefetch_related(
+        'servizi__categoria', 'prodotti_extra'
+    ).filter(
+        slot__data=giorno, stato='confermata',
+        ordine__isnull=True,  # solo quelle non ancora convertite in ordini
+    ).order_by('slot__ora_inizio')
+
+    return {'ordini': [_ordine(o) for o in ordini],
+            'prenotazioni': [_prenotazione(p) for p in prenotazioni]}
+
+
+def _con_etag(board) -> dict:
+    contenuto = json.dumps(board, sort_keys=True, default=str).encode()
+    return {'etag': hashlib.md5(contenuto).hexdigest(), 'board': board}
+
+
+def snapshot() -> dict:
+    """{'etag', 'board'} di oggi, da cache se la versione non e' cambiata."""
+    giorno = timezone.localdate()
+    if not cache_abilitata():
+        return _con_etag(calcola_board(giorno))
+    chiave = f'dashboard_tv:board:{giorno.isoformat()}:{versione()}'
+    snap = cache_condivisa.leggi(chiave)
+    if snap is None:
+        snap = _con_etag(calcola_board(giorno))
+        cache_condivisa.scrivi(chiave, snap, SNAPSHOT_TTL)
+    return snap
+
+
+def ora_server() -> dict:
+    """Campi dell'ora server aggiunti a ogni risposta (fuori snapshot)."""
+    adesso = timezone.now()
+    locale = timezone.localtime(adesso)
+    return {
+        'timestamp': adesso.isoformat(),
+        'server_time_local': locale.isoformat(),
+        'server_time_formatted': locale.strftime('%H:%M:%S'),
+    }
@@ -0,0 +1,16 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.ordini.models import ItemOrdine, Ordine, Pagamento
+from apps.prenotazioni.models import Prenotazione
+
+from .board_tv import segna_modifica
+
+
+@receiver([post_save, post_delete], sender=Ordine)
+@receiver([post_save, post_delete], sender=ItemOrdine)
+@receiver([post_save, post_delete], sender=Pagamento)
+@receiver([post_save, post_delete], sender=Prenotazione)
+def aggiorna_dashboard_tv(sender, instance, **kwargs):
+    """Nuova versione dello snapshot TV (e push alle TV) al commit."""
+    segna_modifica()
@@ -0,0 +1,91 @@
+"""Test dello snapshot condiviso della dashboard TV (board_tv.py) e
+dell'invio alle TV dal consumer.
+
+Esecuzione: python manage.py test apps.postazioni
+"""
+import json
+from decimal import Decimal
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from apps.api.consumers import DashboardConsumer
+from apps.core.models import Categoria, Postazione, ServizioProdotto
+from apps.ordini.models import ItemOrdine, Ordine
+
+from . import board_tv
+
+
+@override_settings(ORDINI_BOARD_CACHE=True, CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'dashboard-tv'}})
+class SnapshotTVTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        cat = Categoria.objects.create(nome='Lavaggi')
+        self.servizio = ServizioProdotto.objects.create(
+            titolo='Esterno', prezzo=Decimal('10'), categoria=cat,
+            descrizione='-', durata_minuti=20)
+        self.tunnel = Postazione.objects.create(nome='Tunnel')
+
+    def _ordine(self, postazione=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            ordine = Ordine.objects.create(totale=Decimal('10'), totale_finale=Decimal('10'))
+            ItemOrdine.objects.create(ordine=ordine, servizio_prodotto=self.servizio,
+                                      prezzo_unitario=Decimal('10'),
+                                      postazione_assegnata=postazione)
+        return ordine
+
+    def test_snapshot_in_cache_per_versione(self):
+        assegnato = self._ordine(self.tunnel)
+        self._ordine()  # senza postazione: non va in TV
+        primo = board_tv.snapshot()
+        self.assertEqual([o['id'] for o in primo['board']['ordini']], [assegnato.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(board_tv.snapshot(), primo)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            assegnato.stato = 'in_lavorazione'
+            assegnato.save()
+        dopo = board_tv.snapshot()
+        self.assertNotEqual(dopo['etag'], primo['etag'])
+        self.assertEqual(dopo['board']['ordini'][0]['stato'], 'in_lavorazione')
+
+    def test_un_avviso_per_transazione_senza_thread(self):
+        with mock.patch('apps.api.notify.notify_group') as notify, \
+                mock.patch('threading.Thread.start') as avvio:
+            for _ in range(3):
+                self._ordine(self.tunnel)
+        avvio.assert_not_called()
+        # un ordine + il suo item = una transazione = un avviso
+        avvisi = [c.args[1] for c in notify.call_args_list if c.args[0] == 'dashboard_tv']
+        self.assertEqual([m['type'] for m in avvisi], ['tv.versione'] * 3)
+        self.assertEqual(avvisi[-1]['versione'], board_tv.versione())
+
+    def test_consumer_manda_lo_snapshot_solo_se_cambiato(self):
+        self._ordine(self.tunnel)
+        consumer = DashboardConsumer()
+        with mock.patch.object(AsyncWebsocketConsumer, 'send') as send, \
+                mock.patch('channels.db.close_old_connections'):
+            async_to_sync(consumer.tv_versione)({'type': 'tv.versione', 'versione': 1})
+            async_to_sync(consumer.tv_versione)({'type': 'tv.versione', 'versione': 1})
+        send.assert_called_once()
+        frame = json.loads(send.call_args.kwargs['text_data'])
+        self.assertEqual(frame['type'], 'tv_board')
+        self.assertEqual(len(frame['board']['ordini']), 1)
+
+    def test_etag_e_304(self):
+        self._ordine(self.tunnel)
+        self.client.force_login(User.objects.create_user('tv', is_staff=True))
+        url = reverse('postazioni:dashboard-tv-data')
+        risposta = self.client.get(url)
+        self.assertEqual(len(risposta.json()['ordini']), 1)
+        self.assertIn('server_time_local', risposta.json())
+
+        risposta = self.client.get(url, HTTP_IF_NONE_MATCH=risposta['ETag'])
+        self.assertEqual(risposta.status_code, 304)
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from .models import (
     ConfigurazioneSlot, SlotPrenotazione, Prenotazione,
-    PrenotazioneProdotto, CalendarioPersonalizzato,
+    PrenotazioneProdotto, CalendarioPersonalizzato, DisponibilitaGiorno,
 )
 
 
@@ -52,4 +52,11 @@ class PrenotazioneAdmin(admin.ModelAdmin):
 class CalendarioPersonalizzatoAdmin(admin.ModelAdmin):
     list_display = ['data', 'chiuso', 'orario_speciale_inizio', 'orario_speciale_fine', 'note']
     list_filter = ['data', 'chiuso']
-    search_fields = ['note']
\ No newline at end of file
+    search_fields = ['note']
+
+
+@admin.register(DisponibilitaGiorno)
+class DisponibilitaGiornoAdmin(admin.ModelAdmin):
+    list_display = ['data', 'chiuso', 'aggiornato_il']
+    list_filter = ['chiuso']
+    readonly_fields = ['data', 'chiuso', 'slot_liberi', 'aggiornato_il']
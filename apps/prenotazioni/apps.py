@@ -4,4 +4,7 @@ from django.apps import AppConfig
 class PrenotazioniConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.prenotazioni'
-    verbose_name = 'Prenotazioni'
\ No newline at end of file
+    verbose_name = 'Prenotazioni'
+
+    def ready(self):
+        import apps.prenotazioni.signals
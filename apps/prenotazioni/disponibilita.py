@@ -0,0 +1,175 @@
+"""Indice della disponibilita' pubblica per il wizard di prenotazione.
+
+Il sito clienti (/app/servizi/) chiedeva gli slot giorno per giorno e
+ogni richiesta ricalcolava la disponibilita' da SlotPrenotazione; il
+contatore prenotazioni_attuali a sua volta veniva ricontato con una
+COUNT a ogni salvataggio (aggiorna_contatori) e di nuovo dalle view.
+
+Ora:
+- il contatore dello slot va a delta: Prenotazione.save()/delete()
+  chiamano sposta_occupazione() con lo slot occupato prima e dopo
+  (confermata -> annullata, cambio slot, conversione in ordine...);
+- per ogni giorno c'e' una riga DisponibilitaGiorno con l'elenco
+  compatto degli slot prenotabili dal sito (liberi, disponibili, con
+  zero prenotazioni: lato cliente ogni slot e' esclusivo). La riga dei
+  giorni toccati viene ricostruita nella stessa transazione, quindi
+  nessuno legge una disponibilita' che il rollback smentirebbe;
+- le righe mancanti (giorni mai letti, o invalidati da un cambio di
+  configurazione/calendario) si costruiscono alla prima lettura,
+  materializzando gli slot del periodo in blocco. Nello stesso giro i
+  contatori degli slot vengono ricontati (riallinea_contatori): un
+  contatore andato fuori strada (update() di massa, interventi a mano)
+  si corregge alla prima ricostruzione, oltre che con il comando
+  ricalcola_disponibilita.
+
+A regime i prossimi GIORNI_PUBBLICI giorni costano una query.
+"""
+from datetime import timedelta
+
+from django.db.models import Count, F, Q, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import DisponibilitaGiorno, Prenotazione, SlotPrenotazione
+from .services import chiusure_periodo, slot_per_giorno, slot_periodo
+
+GIORNI_PUBBLICI = 60
+
+
+def _libero_per_il_sito(slot) -> bool:
+    return (slot.disponibile and slot.prenotazioni_attuali == 0
+            and slot.max_prenotazioni > 0)
+
+
+def _riga(data, slot_del_giorno, giorno_speciale, adesso):
+    return DisponibilitaGiorno(
+        data=data,
+        chiuso=bool(giorno_speciale and giorno_speciale.chiuso),
+        slot_liberi=[
+            [s.id, s.ora_inizio.strftime('%H:%M'), s.ora_fine.strftime('%H:%M')]
+            for s in slot_del_giorno if _libero_per_il_sito(s)
+        ],
+        aggiornato_il=adesso,
+    )
+
+
+def _salva_righe(righe):
+    DisponibilitaGiorno.objects.bulk_create(
+        righe,
+        update_conflicts=True,
+        unique_fields=['data'],
+        update_fields=['chiuso', 'slot_liberi', 'aggiornato_il'],
+    )
+
+
+def aggiorna_giorni(giorni):
+    """Ricostruisce le righe indice dei giorni indicati (slot gia'
+    esistenti, nessuna materializzazione)."""
+    giorni = set(giorni)
+    if not giorni:
+        return
+    per_giorno = slot_per_giorno(
+        SlotPrenotazione.objects.filter(data__in=giorni).order_by('data', 'ora_inizio'))
+    chiusure = chiusure_periodo(min(giorni), max(giorni))
+    adesso = timezone.now()
+    _salva_righe([_riga(g, per_giorno.get(g, ()), chiusure.get(g), adesso)
+                  for g in sorted(giorni)])
+
+
+def sposta_occupazione(da_slot_id, a_slot_id) -> dict:
+    """Sposta un posto occupato da uno slot all'altro (None = nessuno)
+    e aggiorna l'indice dei giorni coinvolti. Ritorna {slot_id: delta}.
+
+    Va chiamata dentro la transazione del salvataggio della prenotazione.
+    """
+    if da_slot_id == a_slot_id:
+        return {}
+    delta = {}
+    if da_slot_id is not None:
+        delta[da_slot_id] = -1
+    if a_slot_id is not None:
+        delta[a_slot_id] = 1
+    for slot_id, d in delta.items():
+        SlotPrenotazione.objects.filter(pk=slot_id).update(
+            prenotazioni_attuali=Greatest(F('prenotazioni_attuali') + d, Value(0)))
+
+    # Giorni coinvolti e loro slot in un colpo solo
+    slot = list(SlotPrenotazione.objects.filter(
+        data__in=SlotPrenotazione.objects.filter(pk__in=delta).values('data'),
+    ).order_by('data', 'ora_inizio'))
+    per_giorno = slot_per_giorno(slot)
+    if per_giorno:
+        chiusure = chiusure_periodo(min(per_giorno), max(per_giorno))
+        adesso = timezone.now()
+        _salva_righe([_riga(g, lista, chiusure.get(g), adesso)
+                      for g, lista in per_giorno.items()])
+    return delta
+
+
+def invalida_indice(dal=None):
+    """Scarta le righe dal giorno indicato (default oggi) in poi: si
+    ricostruiscono alla prossima lettura. Per i cambi di
+    ConfigurazioneSlot e CalendarioPersonalizzato."""
+    dal = dal or timezone.localdate()
+    DisponibilitaGiorno.objects.filter(data__gte=dal).delete()
+
+
+def con_occupati(queryset=None):
+    """Slot annotati con `occupati`: le prenotazioni che li occupano
+    davvero, contate dal DB."""
+    if queryset is None:
+        queryset = SlotPrenotazione.objects.all()
+    return queryset.annotate(occupati=Count('prenotazioni', filter=Q(
+        prenotazioni__stato__in=Prenotazione.STATI_CHE_OCCUPANO)))
+
+
+def riallinea_contatori(slot) -> int:
+    """Corregge prenotazioni_attuali degli slot (annotati con
+    con_occupati) che non tornano col conteggio. Ritorna i corretti."""
+    sbagliati = []
+    for s in slot:
+        if s.prenotazioni_attuali != s.occupati:
+            s.prenotazioni_attuali = s.occupati
+            sbagliati.append(s)
+    SlotPrenotazione.objects.bulk_update(
+        sbagliati, ['prenotazioni_attuali'], batch_size=500)
+    return len(sbagliati)
+
+
+def _costruisci(mancanti):
+    dal, al = min(mancanti), max(mancanti)
+    slot = slot_periodo(dal, al, queryset=con_occupati())
+    riallinea_contatori(slot)
+    per_giorno = slot_per_giorno(slot)
+    chiusure = chiusure_periodo(dal, al)
+    adesso = timezone.now()
+    righe = [_riga(g, per_giorno.get(g, ()), chiusure.get(g), adesso)
+             for g in sorted(mancanti)]
+    _salva_righe(righe)
+    return righe
+
+
+def disponibilita_periodo(dal=None, giorni=GIORNI_PUBBLICI):
+    """Righe DisponibilitaGiorno da `dal` (default oggi) per `giorni`
+    giorni, in ordine di data."""
+    dal = dal or timezone.localdate()
+    al = dal + timedelta(days=giorni - 1)
+    righe = {r.data: r for r in DisponibilitaGiorno.objects.filter(
+        data__gte=dal, data__lte=al)}
+    mancanti = [dal + timedelta(days=i) for i in range(giorni)
+                if dal + timedelta(days=i) not in righe]
+    if mancanti:
+        righe.update((r.data, r) for r in _costruisci(mancanti))
+    return [righe[d] for d in sorted(righe)]
+
+
+def slot_prenotabili(riga, adesso=None):
+    """Slot liberi della riga come dict per il JSON, senza quelli gia'
+    iniziati se la riga e' di oggi."""
+    if riga.chiuso:
+        return []
+    adesso = adesso or timezone.localtime()
+    ora_limite = adesso.strftime('%H:%M:%S') if riga.data == adesso.date() else ''
+    return [{'id': sid, 'ora_inizio': inizio, 'ora_fine': fine}
+            for sid, inizio, fine in riga.slot_liberi
+            if not ora_limite or inizio >= ora_limite]
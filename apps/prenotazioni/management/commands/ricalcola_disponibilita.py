@@ -0,0 +1,50 @@
+"""Riallinea i contatori degli slot e l'indice della disponibilita'.
+
+Nel giro normale SlotPrenotazione.prenotazioni_attuali va a delta dai
+salvataggi delle prenotazioni e l'indice DisponibilitaGiorno si
+aggiorna nella stessa transazione (vedi disponibilita.py). Questo
+comando serve dopo interventi a mano sul DB o import massivi (che
+comunque si correggono alla prossima ricostruzione dell'indice): riconta
+le prenotazioni che occupano posti negli slot da --dal in poi, corregge
+solo i contatori sbagliati e scarta l'indice, che si ricostruisce alla
+prossima lettura.
+
+Uso:
+    python manage.py ricalcola_disponibilita
+    python manage.py ricalcola_disponibilita --dal 2026-01-01
+"""
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from apps.prenotazioni.disponibilita import (
+    con_occupati, invalida_indice, riallinea_contatori,
+)
+from apps.prenotazioni.models import SlotPrenotazione
+
+
+class Command(BaseCommand):
+    help = 'Riconta i posti occupati negli slot e ricostruisce l\'indice disponibilita.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dal', help='Primo giorno YYYY-MM-DD (default oggi).')
+
+    def handle(self, *args, **options):
+        if options['dal']:
+            try:
+                dal = datetime.strptime(options['dal'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Formato --dal non valido, usa YYYY-MM-DD')
+        else:
+            dal = timezone.localdate()
+
+        slot = list(con_occupati(SlotPrenotazione.objects.filter(data__gte=dal)))
+        with transaction.atomic():
+            corretti = riallinea_contatori(slot)
+            invalida_indice(dal)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{corretti} contatori corretti su {len(slot)} slot dal {dal}; '
+            f'indice disponibilita scartato.'))
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:46
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prenotazioni', '0008_prenotazione_origine'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DisponibilitaGiorno',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.DateField(unique=True)),
+                ('chiuso', models.BooleanField(default=False)),
+                ('slot_liberi', models.JSONField(blank=True, default=list)),
+                ('aggiornato_il', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Disponibilita giorno',
+                'verbose_name_plural': 'Disponibilita giorni',
+                'ordering': ['data'],
+            },
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import datetime, timedelta, time
@@ -82,8 +82,13 @@ class SlotPrenotazione(models.Model):
         )
     
     def aggiorna_contatori(self):
-        """Aggiorna il contatore delle prenotazioni attuali"""
-        count = self.prenotazioni.filter(stato='confermata').count()
+        """Ricalcola da zero il contatore delle prenotazioni attuali.
+
+        Solo per riparazioni (comando ricalcola_disponibilita): nel giro
+        normale il contatore e' tenuto a delta da Prenotazione.save()/
+        delete(), vedi disponibilita.sposta_occupazione."""
+        count = self.prenotazioni.filter(
+            stato__in=Prenotazione.STATI_CHE_OCCUPANO).count()
         if self.prenotazioni_attuali != count:
             self.prenotazioni_attuali = count
             self.save(update_fields=['prenotazioni_attuali'])
@@ -97,6 +102,9 @@ class Prenotazione(models.Model):
         ('annullata', 'Annullata'),
         ('no_show', 'No Show'),
     ]
+    # Stati che tengono occupato il posto nello slot
+    # (SlotPrenotazione.prenotazioni_attuali).
+    STATI_CHE_OCCUPANO = ('confermata',)
     TIPO_CONSEGNA_CHOICES = [
         ('immediata', 'Consegna immediata'),
         ('programmata', 'Ritiro programmato'),
@@ -181,29 +189,71 @@ class Prenotazione(models.Model):
     def __str__(self):
         return f"Prenotazione {self.codice_prenotazione} - {self.cliente}"
     
+    def _slot_che_occupa(self, stato, slot_id):
+        return slot_id if stato in self.STATI_CHE_OCCUPANO else None
+
+    def _slot_occupato_su_db(self, blocca=False):
+        """Slot occupato secondo la riga sul DB (None se non c'e' o se
+        la prenotazione non occupa posti). Con `blocca` la riga resta
+        bloccata fino al commit: due save concorrenti non applicano lo
+        stesso delta, il secondo aspetta e legge lo stato del primo."""
+        if self.pk is None:
+            return None
+        righe = Prenotazione.objects.filter(pk=self.pk)
+        if blocca:
+            righe = righe.select_for_update()
+        riga = righe.order_by().values_list('stato', 'slot_id').first()
+        return self._slot_che_occupa(*riga) if riga else None
+
+    def _slot_occupato_salvato(self, prima, update_fields):
+        """Slot occupato dopo il save appena fatto."""
+        if update_fields is None:
+            return self._slot_che_occupa(self.stato, self.slot_id)
+        campi = set(update_fields)
+        if not campi & {'stato', 'slot', 'slot_id'}:
+            return prima
+        if 'stato' in campi and campi & {'slot', 'slot_id'}:
+            return self._slot_che_occupa(self.stato, self.slot_id)
+        # Save parziale: il campo non salvato vale quello del DB
+        return self._slot_occupato_su_db()
+
+    def _allinea_slot_in_memoria(self, delta_per_slot):
+        # Lo slot gia' caricato sull'istanza vede subito il contatore
+        # nuovo (le view lo rileggono dopo il save).
+        if Prenotazione.slot.is_cached(self):
+            slot = self.slot
+            if slot is not None and slot.pk in delta_per_slot:
+                slot.prenotazioni_attuali = max(
+                    0, slot.prenotazioni_attuali + delta_per_slot[slot.pk])
+
     def save(self, *args, **kwargs):
+        from .disponibilita import sposta_occupazione
+
         if not self.codice_prenotazione:
             self.codice_prenotazione = self.genera_codice_prenotazione()
         if not self.durata_stimata_minuti:
             self.durata_stimata_minuti = self.calcola_durata_stimata()
         
-        # Salva prima l'oggetto
-        super().save(*args, **kwargs)
-        
-        # Aggiorna i contatori dello slot sempre dopo il salvataggio
-        if hasattr(self, 'slot') and self.slot:
-            self.slot.aggiorna_contatori()
+        # Contatore slot e indice disponibilita' nella stessa transazione
+        # del salvataggio: un delta per slot invece di un COUNT. Lo stato
+        # di partenza si rilegge (bloccato) dal DB, non dall'istanza:
+        # puo' essere vecchio (refresh, update() di massa, altri processi).
+        with transaction.atomic():
+            prima = self._slot_occupato_su_db(blocca=True)
+            super().save(*args, **kwargs)
+            nuovo = self._slot_occupato_salvato(prima, kwargs.get('update_fields'))
+            delta = sposta_occupazione(prima, nuovo)
+        self._allinea_slot_in_memoria(delta)
     
     def delete(self, *args, **kwargs):
-        # Memorizza lo slot prima di eliminare la prenotazione
-        slot = self.slot if hasattr(self, 'slot') else None
-        
-        # Elimina la prenotazione
-        super().delete(*args, **kwargs)
-        
-        # Aggiorna i contatori dello slot dopo l'eliminazione
-        if slot:
-            slot.aggiorna_contatori()
+        from .disponibilita import sposta_occupazione
+
+        with transaction.atomic():
+            prima = self._slot_occupato_su_db(blocca=True)
+            risultato = super().delete(*args, **kwargs)
+            delta = sposta_occupazione(prima, None)
+        self._allinea_slot_in_memoria(delta)
+        return risultato
     
     def genera_codice_prenotazione(self):
         """Genera un codice univoco di 8 caratteri"""
@@ -421,4 +471,28 @@ class CalendarioPersonalizzato(models.Model):
             return f"{self.data} - CHIUSO"
         elif self.orario_speciale_inizio:
             return f"{self.data} - Orario speciale {self.orario_speciale_inizio}-{self.orario_speciale_fine}"
-        return str(self.data)
\ No newline at end of file
+        return str(self.data)
+
+
+class DisponibilitaGiorno(models.Model):
+    """Indice della disponibilita' pubblica di un giorno: gli slot
+    ancora prenotabili dal sito, gia' pronti da servire al wizard.
+
+    Tenuto aggiornato da disponibilita.py nella stessa transazione delle
+    prenotazioni; le righe mancanti vengono costruite alla prima
+    lettura."""
+    data = models.DateField(unique=True)
+    chiuso = models.BooleanField(default=False)
+    # [[slot_id, 'HH:MM', 'HH:MM'], ...] in ordine di ora
+    slot_liberi = models.JSONField(default=list, blank=True)
+    aggiornato_il = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['data']
+        verbose_name = 'Disponibilita giorno'
+        verbose_name_plural = 'Disponibilita giorni'
+
+    def __str__(self):
+        if self.chiuso:
+            return f"{self.data} - CHIUSO"
+        return f"{self.data} - {len(self.slot_liberi)} slot liberi"
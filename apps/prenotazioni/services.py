@@ -0,0 +1,92 @@
+"""Materializzazione degli slot prenotazione su un intervallo di date.
+
+Gli slot (SlotPrenotazione) nascono dalle ConfigurazioneSlot del giorno
+della settimana. Prima ogni API chiamava genera_slot_per_data per ogni
+configurazione e per ogni giorno (un get_or_create a testa: fino a 42
+giorni x N configurazioni sulla vista mese) e poi rileggeva slot e
+chiusure giorno per giorno.
+
+Qui l'intervallo intero costa:
+- 1 query configurazioni attive;
+- 1 query slot esistenti nell'intervallo;
+- solo se manca qualcosa: 1 bulk_create(ignore_conflicts=True) + la
+  rilettura degli slot;
+- 1 query chiusure (CalendarioPersonalizzato) se serve.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from .models import CalendarioPersonalizzato, ConfigurazioneSlot, SlotPrenotazione
+
+
+def _giorni(data_inizio, data_fine):
+    giorno = data_inizio
+    while giorno <= data_fine:
+        yield giorno
+        giorno += timedelta(days=1)
+
+
+def _slot_mancanti(data_inizio, data_fine, configurazioni, esistenti):
+    per_giorno_settimana = defaultdict(list)
+    for config in configurazioni:
+        per_giorno_settimana[config.giorno_settimana].append(config)
+
+    nuovi = {}
+    for giorno in _giorni(data_inizio, data_fine):
+        for config in per_giorno_settimana.get(giorno.weekday(), ()):
+            chiave = (giorno, config.ora_inizio)
+            # Come get_or_create: a parita' di (data, ora_inizio) vince
+            # lo slot gia' esistente o la prima configurazione.
+            if chiave in esistenti or chiave in nuovi:
+                continue
+            nuovi[chiave] = SlotPrenotazione(
+                data=giorno,
+                ora_inizio=config.ora_inizio,
+                ora_fine=config.ora_fine,
+                max_prenotazioni=config.max_prenotazioni_per_slot,
+                prenotazioni_attuali=0,
+                disponibile=True,
+            )
+    return list(nuovi.values())
+
+
+def slot_periodo(data_inizio, data_fine, configurazioni=None, queryset=None):
+    """Slot dal data_inizio al data_fine compresi, ordinati per data e ora,
+    dopo aver creato in blocco quelli mancanti.
+
+    `configurazioni`: queryset/lista di ConfigurazioneSlot da
+    materializzare (default: tutte le attive). `queryset`: base per la
+    lettura degli slot (es. con prefetch delle prenotazioni).
+    """
+    if configurazioni is None:
+        configurazioni = ConfigurazioneSlot.objects.filter(attivo=True)
+    if queryset is None:
+        queryset = SlotPrenotazione.objects.all()
+    queryset = queryset.filter(
+        data__gte=data_inizio, data__lte=data_fine,
+    ).order_by('data', 'ora_inizio')
+
+    slot = list(queryset)
+    esistenti = {(s.data, s.ora_inizio) for s in slot}
+    nuovi = _slot_mancanti(data_inizio, data_fine, configurazioni, esistenti)
+    if nuovi:
+        # ignore_conflicts: un'altra request puo' averli appena creati
+        SlotPrenotazione.objects.bulk_create(nuovi, ignore_conflicts=True)
+        slot = list(queryset.all())
+    return slot
+
+
+def slot_per_giorno(slot):
+    """{data: [slot, ...]} mantenendo l'ordine per ora."""
+    out = defaultdict(list)
+    for s in slot:
+        out[s.data].append(s)
+    return out
+
+
+def chiusure_periodo(data_inizio, data_fine):
+    """{data: CalendarioPersonalizzato} dei giorni speciali nell'intervallo."""
+    return {
+        g.data: g for g in CalendarioPersonalizzato.objects.filter(
+            data__gte=data_inizio, data__lte=data_fine)
+    }
@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .disponibilita import aggiorna_giorni, invalida_indice
+from .models import CalendarioPersonalizzato, ConfigurazioneSlot, SlotPrenotazione
+
+
+@receiver([post_save, post_delete], sender=SlotPrenotazione)
+def aggiorna_disponibilita_slot(sender, instance, **kwargs):
+    """Slot creato a mano (cassa, proponi orario) o modificato da admin:
+    ricostruisce la riga indice del suo giorno."""
+    aggiorna_giorni({instance.data})
+
+
+@receiver([post_save, post_delete], sender=ConfigurazioneSlot)
+@receiver([post_save, post_delete], sender=CalendarioPersonalizzato)
+def invalida_disponibilita(sender, instance, **kwargs):
+    """Cambiano gli orari o i giorni di chiusura: l'indice dei giorni
+    futuri si ricostruisce alla prossima lettura."""
+    invalida_indice()
@@ -0,0 +1,222 @@
+"""Test della materializzazione degli slot, delle API calendario e
+dell'indice di disponibilita' pubblica.
+
+Esecuzione: python manage.py test apps.prenotazioni
+"""
+import json
+from datetime import date, time, timedelta
+
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from apps.clienti.models import Cliente
+from apps.clients.views import disponibilita_pub, slot_disponibili_pub
+
+from .disponibilita import disponibilita_periodo, invalida_indice
+from .models import (CalendarioPersonalizzato, ConfigurazioneSlot,
+                     DisponibilitaGiorno, Prenotazione, SlotPrenotazione)
+from .services import chiusure_periodo, slot_periodo
+from .views import calendario_mese_api, calendario_settimana_api
+
+LUNEDI = date(2030, 3, 4)
+
+
+class SlotPeriodoTest(TestCase):
+    def setUp(self):
+        for giorno in range(6):  # lun-sab
+            for ora in (9, 10, 11):
+                ConfigurazioneSlot.objects.create(
+                    giorno_settimana=giorno, ora_inizio=time(ora),
+                    ora_fine=time(ora, 30), max_prenotazioni_per_slot=2)
+
+    def test_crea_solo_i_mancanti(self):
+        SlotPrenotazione.objects.create(
+            data=LUNEDI, ora_inizio=time(9), ora_fine=time(9, 45),
+            max_prenotazioni=5)
+        slot = slot_periodo(LUNEDI, date(2030, 3, 10))
+
+        self.assertEqual(len(slot), 18)  # 6 giorni x 3, domenica chiusa
+        esistente = slot[0]
+        self.assertEqual((esistente.ora_fine, esistente.max_prenotazioni),
+                         (time(9, 45), 5))
+        self.assertEqual([(s.data, s.ora_inizio) for s in slot],
+                         sorted((s.data, s.ora_inizio) for s in slot))
+
+    def test_query_costanti_sul_periodo(self):
+        with CaptureQueriesContext(connection) as prima:
+            slot_periodo(LUNEDI, date(2030, 4, 14))
+        # configurazioni + lettura + bulk_create + rilettura
+        self.assertLessEqual(len(prima), 4)
+
+        with CaptureQueriesContext(connection) as dopo:
+            slot_periodo(LUNEDI, date(2030, 4, 14))
+        # a regime nessuna scrittura: configurazioni + lettura
+        self.assertEqual(len(dopo), 2)
+
+    def test_chiusure_periodo(self):
+        CalendarioPersonalizzato.objects.create(data=LUNEDI, chiuso=True)
+        self.assertEqual(list(chiusure_periodo(LUNEDI, date(2030, 3, 10))),
+                         [LUNEDI])
+
+
+class CalendarioApiTest(TestCase):
+    def setUp(self):
+        self.rf = RequestFactory()
+        for giorno in range(7):
+            for ora in (9, 10, 11, 12):
+                ConfigurazioneSlot.objects.create(
+                    giorno_settimana=giorno, ora_inizio=time(ora),
+                    ora_fine=time(ora, 30))
+        CalendarioPersonalizzato.objects.create(
+            data=date(2030, 3, 6), chiuso=True, note='Ferie')
+
+    def _json(self, view, **params):
+        response = view(self.rf.get('/', params))
+        return json.loads(response.content)
+
+    def test_mese_in_poche_query(self):
+        with CaptureQueriesContext(connection) as ctx:
+            dati = self._json(calendario_mese_api, year=2030, month=3)
+        self.assertLessEqual(len(ctx), 5)
+        self.assertEqual(dati['2030-03-04']['slot_disponibili'], 4)
+        self.assertTrue(dati['2030-03-06']['chiuso'])
+        self.assertEqual(dati['2030-03-06']['note'], 'Ferie')
+
+    def test_settimana_non_dipende_dagli_slot(self):
+        self._json(calendario_settimana_api, data='2030-03-04')
+        with CaptureQueriesContext(connection) as ctx:
+            dati = self._json(calendario_settimana_api, data='2030-03-04')
+        # configurazioni + slot + prenotazioni + servizi + chiusure
+        self.assertLessEqual(len(ctx), 5)
+        self.assertEqual(sum(g['totale_slot'] for g in dati['giorni']), 28)
+        self.assertTrue(dati['giorni'][2]['chiuso'])
+
+    def test_pubblico_giorno_chiuso(self):
+        dati = self._json(slot_disponibili_pub, data='2030-03-06')
+        self.assertEqual(dati['slot'], [])
+        self.assertTrue(dati['chiuso'])
+
+        dati = self._json(slot_disponibili_pub, data='2030-03-05')
+        self.assertEqual([s['ora_inizio'] for s in dati['slot']],
+                         ['09:00', '10:00', '11:00', '12:00'])
+
+
+class DisponibilitaTest(TestCase):
+    def setUp(self):
+        self.rf = RequestFactory()
+        self.cliente = Cliente.objects.create(tipo='privato', telefono='3330000000')
+        self.slot_9, self.slot_10 = [
+            SlotPrenotazione.objects.create(
+                data=LUNEDI, ora_inizio=time(ora), ora_fine=time(ora, 30),
+                max_prenotazioni=2)
+            for ora in (9, 10)
+        ]
+
+    def _prenota(self, slot, stato='confermata'):
+        return Prenotazione.objects.create(
+            cliente=self.cliente, slot=slot, stato=stato,
+            durata_stimata_minuti=30)
+
+    def _liberi(self):
+        riga = DisponibilitaGiorno.objects.get(data=LUNEDI)
+        return [ora for _, ora, _ in riga.slot_liberi]
+
+    def _contatori(self):
+        return list(SlotPrenotazione.objects.filter(data=LUNEDI)
+                    .values_list('prenotazioni_attuali', flat=True))
+
+    def test_contatore_a_delta_e_indice(self):
+        p = self._prenota(self.slot_9)
+        self.assertEqual(self._contatori(), [1, 0])
+        self.assertEqual(self._liberi(), ['10:00'])
+
+        # cambio slot con save parziale
+        p.slot = self.slot_10
+        p.save(update_fields=['slot'])
+        self.assertEqual(self._contatori(), [0, 1])
+        self.assertEqual(self._liberi(), ['09:00'])
+
+        p.stato = 'annullata'
+        p.save(update_fields=['stato'])
+        self.assertEqual(self._contatori(), [0, 0])
+        self.assertEqual(self._liberi(), ['09:00', '10:00'])
+
+    def test_in_attesa_non_occupa_poi_conferma_e_delete(self):
+        p = self._prenota(self.slot_9, stato='in_attesa')
+        self.assertEqual(self._contatori(), [0, 0])
+
+        p = Prenotazione.objects.get(pk=p.pk)
+        p.stato = 'confermata'
+        p.save()
+        self.assertEqual(p.slot.prenotazioni_attuali, 1)
+        self.assertEqual(self._contatori(), [1, 0])
+
+        Prenotazione.objects.get(pk=p.pk).delete()
+        self.assertEqual(self._contatori(), [0, 0])
+
+    def test_istanze_vecchie_non_ripetono_il_delta(self):
+        # Due operatori con la stessa prenotazione aperta annullano
+        # insieme: il posto si libera una volta sola
+        p = self._prenota(self.slot_9)
+        self._prenota(self.slot_9)
+        prima, seconda = (Prenotazione.objects.get(pk=p.pk) for _ in range(2))
+        prima.stato = seconda.stato = 'annullata'
+        prima.save()
+        seconda.save()
+        self.assertEqual(self._contatori(), [1, 0])
+
+    def test_update_di_massa_e_refresh(self):
+        p = self._prenota(self.slot_9, stato='in_attesa')
+        # update() salta save(): l'istanza resta con lo stato vecchio
+        Prenotazione.objects.filter(pk=p.pk).update(stato='confermata')
+        p.refresh_from_db()
+        p.stato = 'annullata'
+        p.save()
+        self.assertEqual(self._contatori(), [0, 0])
+
+        ridotta = Prenotazione.objects.only(
+            'codice_prenotazione', 'durata_stimata_minuti', 'nota_interna').get(pk=p.pk)
+        ridotta.nota_interna = 'x'
+        with self.assertNumQueries(4):  # savepoint, lettura bloccata, UPDATE, rilascio
+            ridotta.save(update_fields=['nota_interna'])
+
+    def test_contatore_sbagliato_corretto_alla_ricostruzione(self):
+        self._prenota(self.slot_9)
+        SlotPrenotazione.objects.filter(pk=self.slot_10.pk).update(prenotazioni_attuali=2)
+        invalida_indice(LUNEDI)
+        disponibilita_periodo(LUNEDI, giorni=1)
+        self.assertEqual(self._contatori(), [1, 0])
+        self.assertEqual(self._liberi(), ['10:00'])
+
+    def test_rollback_non_tocca_contatori(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self._prenota(self.slot_9)
+                raise RuntimeError
+        self.assertEqual(self._contatori(), [0, 0])
+
+    def test_periodo_una_query_a_regime(self):
+        dal = timezone.localdate()
+        self.assertEqual(len(disponibilita_periodo(dal)), 60)
+        with self.assertNumQueries(1):
+            disponibilita_periodo(dal)
+
+    def test_etag_e_304(self):
+        risposta = disponibilita_pub(self.rf.get('/'))
+        self.assertEqual(risposta.status_code, 200)
+        etag = risposta.headers['ETag']
+        self.assertIn('Last-Modified', risposta.headers)
+
+        risposta = disponibilita_pub(self.rf.get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(risposta.status_code, 304)
+
+        domani = timezone.localdate() + timedelta(days=1)
+        SlotPrenotazione.objects.create(
+            data=domani, ora_inizio=time(9), ora_fine=time(9, 30),
+            max_prenotazioni=1)
+        risposta = disponibilita_pub(self.rf.get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(risposta.status_code, 200)
+        giorni = json.loads(risposta.content)['giorni']
+        self.assertEqual(giorni[domani.isoformat()]['slot'][0]['ora_inizio'], '09:00')
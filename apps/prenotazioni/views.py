@@ -8,7 +8,7 @@ from django.views.generic import (
 from django.urls import reverse_lazy, reverse
 from django.http import JsonResponse
 from django.contrib import messages
-from django.db.models import Q, Count, F
+from django.db.models import Q, Count, F, Prefetch
 from django.utils import timezone
 from django.db import transaction
 import json
@@ -17,6 +17,7 @@ from .models import (
     ConfigurazioneSlot, SlotPrenotazione, Prenotazione, CalendarioPersonalizzato
 )
 from .forms import ConfigurazioneSlotForm, PrenotazioneForm
+from .services import chiusure_periodo, slot_per_giorno, slot_periodo
 from apps.clienti.models import Cliente
 from apps.core.models import ServizioProdotto
 from apps.abbonamenti.models import Abbonamento
@@ -299,11 +300,6 @@ class NuovaPrenotazioneView(TemplateView):
                 prenotazione.servizi.set(servizi)
                 print(f"Servizi assegnati: {[s.titolo for s in servizi]}")
                 
-                # 7. Forza aggiornamento contatori dopo assegnazione servizi
-                if hasattr(prenotazione, 'slot') and prenotazione.slot:
-                    prenotazione.slot.aggiorna_contatori()
-                    print(f"Contatori slot aggiornati: {prenotazione.slot.prenotazioni_attuali}/{prenotazione.slot.max_prenotazioni}")
-                
                 messages.success(
                     self.request, 
                     f'Prenotazione creata con successo! Codice: {prenotazione.codice_prenotazione}'
@@ -465,10 +461,6 @@ class NuovaPrenotazioneClassicaView(CreateView):
         # Assegna i servizi
         prenotazione.servizi.set(servizi)
         
-        # Forza aggiornamento contatori dopo assegnazione servizi
-        if hasattr(prenotazione, 'slot') and prenotazione.slot:
-            prenotazione.slot.aggiorna_contatori()
-        
         self.object = prenotazione
         
         # Invia email di conferma (da implementare)
@@ -631,10 +623,6 @@ def prenotazione_rapida_api(request):
         # Assegna i servizi
         prenotazione.servizi.add(servizio)
         
-        # Forza aggiornamento contatori dopo assegnazione servizi
-        if hasattr(prenotazione, 'slot') and prenotazione.slot:
-            prenotazione.slot.aggiorna_contatori()
-        
         return JsonResponse({
             'success': True,
             'prenotazione_id': prenotazione.id,
@@ -701,29 +689,17 @@ def slot_disponibili_api(request):
     except ValueError:
         return JsonResponse({'error': 'Formato data non valido'}, status=400)
     
-    # Genera slot per la data se non esistono
-    giorno_settimana = data_richiesta.weekday()
-    configurazioni = ConfigurazioneSlot.objects.filter(
-        giorno_settimana=giorno_settimana,
-        attivo=True
-    )
-    
+    configurazioni = ConfigurazioneSlot.objects.filter(attivo=True)
     if servizio_id:
         configurazioni = configurazioni.filter(
             servizi_ammessi__id=servizio_id
         )
     
-    # Crea slot se non esistono
-    for config in configurazioni:
-        config.genera_slot_per_data(data_richiesta)
-    
-    # Ottieni slot disponibili
-    slot = SlotPrenotazione.objects.filter(
-        data=data_richiesta,
-        disponibile=True
-    ).annotate(
-        posti_liberi=F('max_prenotazioni') - F('prenotazioni_attuali')
-    ).filter(posti_liberi__gt=0).order_by('ora_inizio')
+    # Crea gli slot mancanti e legge quelli della data in blocco
+    slot = [
+        s for s in slot_periodo(data_richiesta, data_richiesta, configurazioni)
+        if s.disponibile and s.posti_disponibili > 0
+    ]
     
     slot_data = []
     for s in slot:
@@ -757,13 +733,16 @@ def calendario_mese_api(request):
     giorni_da_includere = primo_giorno - timedelta(days=primo_giorno.weekday())
     fine_periodo = ultimo_giorno + timedelta(days=6-ultimo_giorno.weekday())
     
+    # Slot e giorni speciali del periodo: una lettura ciascuno
+    slot_per_data = slot_per_giorno(slot_periodo(giorni_da_includere, fine_periodo))
+    chiusure = chiusure_periodo(giorni_da_includere, fine_periodo)
+    
     calendario_data = {}
     
     # Itera su tutti i giorni del periodo
     giorno_corrente = giorni_da_includere
     while giorno_corrente <= fine_periodo:
-        # Verifica giorni speciali
-        giorno_speciale = CalendarioPersonalizzato.objects.filter(data=giorno_corrente).first()
+        giorno_speciale = chiusure.get(giorno_corrente)
         
         if giorno_speciale and giorno_speciale.chiuso:
             calendario_data[giorno_corrente.isoformat()] = {
@@ -774,12 +753,10 @@ def calendario_mese_api(request):
             }
         else:
             # Conta slot disponibili per questo giorno
-            slot_count = SlotPrenotazione.objects.filter(
-                data=giorno_corrente,
-                disponibile=True
-            ).annotate(
-                posti_liberi=F('max_prenotazioni') - F('prenotazioni_attuali')
-            ).filter(posti_liberi__gt=0).count()
+            slot_count = sum(
+                1 for s in slot_per_data.get(giorno_corrente, ())
+                if s.disponibile and s.posti_disponibili > 0
+            )
             
             calendario_data[giorno_corrente.isoformat()] = {
                 'data': giorno_corrente.isoformat(),
@@ -805,20 +782,21 @@ def calendario_settimana_api(request):
     # Calcola l'inizio della settimana (lunedì)
     inizio_settimana = data_riferimento - timedelta(days=data_riferimento.weekday())
     
-    # Genera slot per tutta la settimana se non esistono
-    for i in range(7):
-        giorno = inizio_settimana + timedelta(days=i)
-        giorno_settimana = giorno.weekday()
-        
-        # Trova le configurazioni per questo giorno
-        configurazioni = ConfigurazioneSlot.objects.filter(
-            giorno_settimana=giorno_settimana,
-            attivo=True
-        )
-        
-        # Crea slot se non esistono
-        for config in configurazioni:
-            config.genera_slot_per_data(giorno)
+    fine_settimana = inizio_settimana + timedelta(days=6)
+    
+    # Genera gli slot mancanti e legge la settimana in blocco, con le
+    # prenotazioni confermate (cliente e servizi) gia' precaricate
+    slot_settimana = slot_per_giorno(slot_periodo(
+        inizio_settimana, fine_settimana,
+        queryset=SlotPrenotazione.objects.prefetch_related(Prefetch(
+            'prenotazioni',
+            queryset=Prenotazione.objects.filter(
+                stato='confermata'
+            ).select_related('cliente').prefetch_related('servizi'),
+            to_attr='prenotazioni_confermate',
+        )),
+    ))
+    chiusure = chiusure_periodo(inizio_settimana, fine_settimana)
     
     # Costruisce la struttura dati per la settimana
     settimana_data = {
@@ -831,19 +809,13 @@ def calendario_settimana_api(request):
     for i in range(7):
         giorno = inizio_settimana + timedelta(days=i)
         
-        # Verifica giorni speciali
-        giorno_speciale = CalendarioPersonalizzato.objects.filter(data=giorno).first()
-        
-        # Ottieni tutti gli slot per questo giorno
-        slot_giorno = SlotPrenotazione.objects.filter(
-            data=giorno,
-            disponibile=True
-        ).order_by('ora_inizio')
+        giorno_speciale = chiusure.get(giorno)
         
         slot_data = []
-        for slot in slot_giorno:
-            # Ottieni prenotazioni per questo slot
-            prenotazioni = slot.prenotazioni.filter(stato='confermata').select_related('cliente')
+        for slot in slot_settimana.get(giorno, ()):
+            if not slot.disponibile:
+                continue
+            prenotazioni = slot.prenotazioni_confermate
             
             slot_info = {
                 'id': slot.id,
@@ -1271,7 +1243,6 @@ def checkin_prenotazione(request, pk):
                             nuova_ora != prenotazione.slot.ora_inizio):
                         durata = prenotazione.durata_stimata_minuti or 30
                         ora_fine_dt = _dt.combine(nuova_data, nuova_ora) + _td(minutes=durata)
-                        vecchio_slot = prenotazione.slot
                         nuovo_slot, _ = SlotPrenotazione.objects.get_or_create(
                             data=nuova_data, ora_inizio=nuova_ora,
                             defaults={
@@ -1282,11 +1253,7 @@ def checkin_prenotazione(request, pk):
                             },
                         )
                         prenotazione.slot = nuovo_slot
-                        prenotazione.save()
-                        if hasattr(vecchio_slot, 'aggiorna_contatori'):
-                            vecchio_slot.aggiorna_contatori()
-                        if hasattr(nuovo_slot, 'aggiorna_contatori'):
-                            nuovo_slot.aggiorna_contatori()
+                        prenotazione.save()  # sposta il posto occupato
                 except (ValueError, TypeError):
                     pass
 
@@ -1557,12 +1524,9 @@ class ModificaPrenotazioneView(LoginRequiredMixin, UpdateView):
                             }
                         )
                         
-                        # Aggiorna la prenotazione con il nuovo slot
+                        # Aggiorna la prenotazione con il nuovo slot (i
+                        # contatori dei due slot si aggiornano al save)
                         prenotazione.slot = nuovo_slot
-                        
-                        # Aggiorna i contatori di entrambi gli slot
-                        slot_corrente.aggiorna_contatori()
-                        nuovo_slot.aggiorna_contatori()
                 
                 # 3. Aggiorna gli altri campi
                 if tipo_auto is not None:
@@ -1752,7 +1716,6 @@ def aggiorna_prenotazione_inline(request, pk):
                         nuova_ora != prenotazione.slot.ora_inizio):
                     durata = prenotazione.durata_stimata_minuti or 30
                     ora_fine_dt = _dt.combine(nuova_data, nuova_ora) + _td(minutes=durata)
-                    vecchio_slot = prenotazione.slot
                     nuovo_slot, _ = SlotPrenotazione.objects.get_or_create(
                         data=nuova_data, ora_inizio=nuova_ora,
                         defaults={
@@ -1763,11 +1726,7 @@ def aggiorna_prenotazione_inline(request, pk):
                         },
                     )
                     prenotazione.slot = nuovo_slot
-                    prenotazione.save()
-                    if hasattr(vecchio_slot, 'aggiorna_contatori'):
-                        vecchio_slot.aggiorna_contatori()
-                    if hasattr(nuovo_slot, 'aggiorna_contatori'):
-                        nuovo_slot.aggiorna_contatori()
+                    prenotazione.save()  # sposta il posto occupato
             except (ValueError, TypeError):
                 pass
 
@@ -272,6 +272,54 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Bus notifiche WebSocket (apps/api/notify.py): finestra in cui gli
+# eventi di una raffica vengono fusi e spediti in un unico messaggio per
+# gruppo, e messaggi massimi in coda prima di scartare.
+NOTIFY_FINESTRA_MS = int(os.environ.get('NOTIFY_FINESTRA_MS', '50'))
+NOTIFY_CODA_MAX = int(os.environ.get('NOTIFY_CODA_MAX', '5000'))
+# Flusso versionato degli ordini (apps/ordini/flusso.py): quanti delta
+# restano recuperabili al reconnect prima di passare allo snapshot.
+ORDINI_FLUSSO_FINESTRA = int(os.environ.get('ORDINI_FLUSSO_FINESTRA', '500'))
+
+# Cache condivisa tra i processi (worker Daphne, cron, mqtt_listener).
+# Con REDIS_URL (o CACHE_REDIS_URL per un'istanza dedicata) usa Redis,
+# altrimenti una cache su file: mai la LocMemCache di default, che
+# duplicava cache e invalidazioni per ogni processo. Timeout socket
+# bassi: se Redis non risponde apps.core.cache degrada a miss invece di
+# bloccare la request. Accesso via apps.core.cache (contatori hit/miss).
+_CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL') or os.environ.get('REDIS_URL', '')
+if _CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': _CACHE_REDIS_URL,
+            'KEY_PREFIX': 'mwc',
+            'OPTIONS': {
+                'socket_connect_timeout': 1,
+                'socket_timeout': 1,
+            },
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_DIR', str(BASE_DIR / '.cache')),
+            'OPTIONS': {'MAX_ENTRIES': 5000},
+        },
+    }
+
+# I test usano sempre CACHES_TEST (LocMemCache): niente file nel repo e
+# niente stato tra un'esecuzione e l'altra. `manage.py test` la mette su
+# col runner config.test_runner; per altri runner (pytest-django)
+# DJANGO_SETTINGS_MODULE=config.settings_test.
+CACHES_TEST = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+TEST_RUNNER = 'config.test_runner.TestRunner'
+
 # Email (notifiche cliente prenotazioni)
 # In dev usa console (le email appaiono in stdout del runserver).
 # In produzione configura SMTP via env vars.
@@ -295,6 +343,19 @@ MQTT_HOST = os.environ.get('MQTT_HOST', '')
 MQTT_PORT = int(os.environ.get('MQTT_PORT', '1883'))
 MQTT_USER = os.environ.get('MQTT_USER', '')
 MQTT_PASSWORD = os.environ.get('MQTT_PASSWORD', '')
+# Ingestione del listener (apps/impianto/ingestione.py): messaggi
+# massimi in coda tra il thread paho e lo scrittore, finestra e
+# dimensione massima dei lotti scritti con bulk_create.
+MQTT_CODA_MAX = int(os.environ.get('MQTT_CODA_MAX', '10000'))
+MQTT_LOTTO_MS = int(os.environ.get('MQTT_LOTTO_MS', '200'))
+MQTT_LOTTO_MAX = int(os.environ.get('MQTT_LOTTO_MAX', '500'))
+# Serie storica eventi impianto (apps/impianto/serie.py, comando
+# impianto_serie): giorni di eventi grezzi e di aggregati orari tenuti
+# (i giornalieri restano sempre), mesi di partizioni create in anticipo
+# su Postgres.
+IMPIANTO_EVENTI_GIORNI = int(os.environ.get('IMPIANTO_EVENTI_GIORNI', '30'))
+IMPIANTO_AGGREGATI_ORARI_GIORNI = int(os.environ.get('IMPIANTO_AGGREGATI_ORARI_GIORNI', '400'))
+IMPIANTO_PARTIZIONI_AVANTI = int(os.environ.get('IMPIANTO_PARTIZIONI_AVANTI', '3'))
 
 # === Pagamenti online (monete virtuali) ===
 # Vuoti = provider spento (il bottone non compare nell'area cliente).
@@ -345,5 +406,18 @@ META_WA_OMIT_BODY_PARAMS = os.environ.get(
 META_WHATSAPP_VERIFY_TOKEN = os.environ.get('META_WHATSAPP_VERIFY_TOKEN', '')
 META_WHATSAPP_APP_SECRET = os.environ.get('META_WHATSAPP_APP_SECRET', '')
 WHATSAPP_ENABLED = bool(META_WHATSAPP_PHONE_ID and META_WHATSAPP_ACCESS_TOKEN)
+# Dispatcher invii (apps/clients/wa_dispatcher.py): base URL Graph API
+# (override per puntare a un server finto nei test), worker paralleli,
+# tetto globale messaggi/secondo e intervallo minimo verso lo stesso
+# numero (Meta limita le raffiche verso un singolo utente, errore 131056).
+# I worker girano nel processo `manage.py dispatcher_whatsapp`;
+# WA_DISPATCHER_NEL_WEB=True li avvia anche nel web (solo in locale,
+# per non dover lanciare il comando a parte).
+META_GRAPH_URL = os.environ.get('META_GRAPH_URL', 'https://graph.facebook.com')
+WA_DISPATCHER_WORKERS = int(os.environ.get('WA_DISPATCHER_WORKERS', '4'))
+WA_DISPATCHER_NEL_WEB = os.environ.get('WA_DISPATCHER_NEL_WEB', 'False').lower() in ('true', '1', 'yes')
+WA_INVII_AL_SECONDO = float(os.environ.get('WA_INVII_AL_SECONDO', '20'))
+WA_INTERVALLO_STESSO_NUMERO_SEC = float(os.environ.get('WA_INTERVALLO_STESSO_NUMERO_SEC', '6'))
+WA_MAX_TENTATIVI = int(os.environ.get('WA_MAX_TENTATIVI', '6'))
 
 # --- FINE CONFIGURAZIONE ---
\ No newline at end of file
@@ -0,0 +1,7 @@
+"""Settings per i test lanciati senza `manage.py test` (es. pytest-django
+con DJANGO_SETTINGS_MODULE=config.settings_test): come settings, con la
+cache dei test gia' al posto di quella condivisa."""
+from .settings import *  # noqa: F401,F403
+from .settings import CACHES_TEST
+
+CACHES = CACHES_TEST
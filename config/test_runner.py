@@ -0,0 +1,20 @@
+"""Runner di `manage.py test`: DiscoverRunner con la cache dei test.
+
+La cache di default e' condivisa (Redis o file, vedi CACHES in
+settings): i test la sostituiscono con CACHES_TEST per tutta la durata
+della suite, invece di capirlo da sys.argv dentro settings.
+"""
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._cache_test = override_settings(CACHES=settings.CACHES_TEST)
+        self._cache_test.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._cache_test.disable()
+        super().teardown_test_environment(**kwargs)
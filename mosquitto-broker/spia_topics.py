@@ -2,7 +2,7 @@
 
 Sostituto minimale di MQTT Explorer per il collaudo. Uso:
 
-    python mosquitto-broker/spia_topics.py HOST PORTA UTENTE PASSWORD
+    python mosquitto-broker/spia_topics.py HOST PORTA UTENTE PASSWORD [FILE]
 
 Esempio (endpoint TCP Proxy di Railway, utente debug):
 
@@ -10,17 +10,24 @@ Esempio (endpoint TCP Proxy di Railway, utente debug):
 
 Poi genera un impulso sullo Shelly e guarda cosa compare (topic e
 payload). Ctrl+C per uscire.
+
+Con FILE la spia registra anche ogni messaggio come riga JSON
+({"t": secondi, "topic": ..., "payload": ...}): la cattura si rigioca
+con `python manage.py mqtt_replay FILE` per misurare il listener.
 """
+import json
 import sys
+import time
 
 import paho.mqtt.client as mqtt
 
 
 def main():
-    if len(sys.argv) != 5:
+    if len(sys.argv) not in (5, 6):
         print(__doc__)
         raise SystemExit(1)
     host, porta, utente, password = sys.argv[1:5]
+    cattura = open(sys.argv[5], 'a', encoding='utf-8') if len(sys.argv) == 6 else None
 
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
                          client_id='debug-spia')
@@ -39,6 +46,10 @@ def main():
         except UnicodeDecodeError:
             corpo = repr(msg.payload)
         print(f'\n>>> {msg.topic}\n    {corpo}')
+        if cattura:
+            cattura.write(json.dumps({'t': round(time.time(), 3), 'topic': msg.topic,
+                                      'payload': corpo}) + '\n')
+            cattura.flush()
 
     client.on_connect = on_connect
     client.on_message = on_message
@@ -47,6 +58,9 @@ def main():
         client.loop_forever()
     except KeyboardInterrupt:
         print('\nciao!')
+    finally:
+        if cattura:
+            cattura.close()
 
 
 if __name__ == '__main__':
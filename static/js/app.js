@@ -188,7 +188,12 @@ class AutolavaggioWebSocket {
             
             this.socket.onmessage = (event) => {
                 const data = JSON.parse(event.data);
-                this.handleMessage(data);
+                // Le raffiche del bus notifiche arrivano come 'batch'
+                if (data.type === 'batch') {
+                    data.eventi.forEach(ev => this.handleMessage(ev));
+                } else {
+                    this.handleMessage(data);
+                }
             };
             
             this.socket.onclose = () => {